@@ -0,0 +1,212 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+""" Coarse-to-fine alignment of EMC reconstructions and streaming statistics over the aligned volumes. """
+
+import multiprocessing
+import numpy
+from supp_py_modules import rotateIntens
+from SimEx.Utilities import QuaternionGrid
+from SimEx.Utilities.StreamingStatistics import StreamingStatistics
+
+# Angle between neighbouring vertices of the 600-cell, the spacing of the level 1 quaternion grid.
+GRID_SPACING_LEVEL_1 = numpy.pi/5.
+
+# Memory for reading the stack of volumes when computing the median.
+MEDIAN_BUFFER_BYTES = 1<<28
+
+# Data shared with the worker processes, set once per process by _init_worker.
+_WORKER_DATA = {}
+
+def log_scaled_intensities(intens, i_off=1.E-7):
+    """ Intensities as used for scoring orientations: abs(log(I/Imax + i_off)), negative values set to 0. """
+    scaled  = (intens>0.)*intens
+    scaled  /= scaled.max()
+    return numpy.abs(numpy.log(scaled+i_off))
+
+def coarse_quaternions(level):
+    """ Quaternions and weights (one row of 5 per rotation) of the given refinement level. """
+    (quats, weights) = QuaternionGrid.generateQuaternions(level)
+    return numpy.column_stack((quats, weights))
+
+def neighbouring_quaternions(quats, candidates, angle):
+    """ Select all quaternions within angle (of the quaternion sphere) of any of the candidates. """
+    cos_angle   = numpy.cos(angle)
+    keep        = numpy.zeros(len(quats), dtype=bool)
+    for c in candidates:
+        keep |= numpy.abs(quats[:,:4].dot(c[:4])) >= cos_angle
+    return quats[keep]
+
+class OrientationAligner(object):
+    """
+    Find the rotation that best maps a reconstruction onto a reference reconstruction.
+
+    All orientations of a coarse quaternion grid are scored first, then the fine quaternions
+    around the best coarse candidates. Scoring is distributed over a pool of processes which
+    read the reference and the reconstruction to align from shared memory.
+    """
+
+    def __init__(self, reference, qPos, quats, coarse_level=4, number_of_candidates=4, number_of_processes=1):
+        """
+        :param reference: The (log scaled) reference intensities.
+        :type reference: numpy.array (3D)
+
+        :param qPos: Voxel coordinates compared when scoring an orientation.
+        :type qPos: numpy.array, shape (n,3)
+
+        :param quats: The fine quaternions and weights.
+        :type quats: numpy.array, shape (m,5)
+
+        :param coarse_level: Refinement level of the coarse quaternion grid (default 4).
+        :type coarse_level: int
+
+        :param number_of_candidates: Number of best coarse orientations to refine (default 4).
+        :type number_of_candidates: int
+
+        :param number_of_processes: Number of processes to score orientations on (default 1).
+        :type number_of_processes: int
+        """
+        self.intens_len     = reference.shape[0]
+        self.quats          = quats
+        self.coarse_quats   = coarse_quaternions(coarse_level)
+        self.angle          = GRID_SPACING_LEVEL_1/coarse_level
+        self.number_of_candidates = number_of_candidates
+
+        # Buffers for the reference and the reconstruction to align, shared with the workers.
+        self.__reference    = multiprocessing.RawArray('d', reference.size)
+        self.__current      = multiprocessing.RawArray('d', reference.size)
+        numpy.frombuffer(self.__reference)[:] = reference.ravel()
+        initargs = (self.__reference, self.__current, numpy.ascontiguousarray(qPos, dtype=float).ravel(), self.intens_len)
+
+        self.number_of_chunks = 4*number_of_processes
+        if number_of_processes > 1:
+            self.__pool = multiprocessing.Pool(number_of_processes, initializer=_init_worker, initargs=initargs)
+        else:
+            self.__pool = None
+            _init_worker(*initargs)
+
+    def align(self, current):
+        """
+        Find the best orientation of a reconstruction.
+
+        :param current: The (log scaled) intensities to align.
+        :type current: numpy.array (3D)
+
+        :return: The best quaternion (with weight) and its score.
+        :rtype: tuple (numpy.array, float)
+        """
+        numpy.frombuffer(self.__current)[:] = current.ravel()
+
+        # Exhaustive search if the coarse grid is not coarser than the fine one.
+        if len(self.coarse_quats) >= len(self.quats):
+            candidates = self.quats
+        else:
+            scores      = self.score(self.coarse_quats)
+            best        = self.coarse_quats[scores.argsort()[:self.number_of_candidates]]
+            candidates  = neighbouring_quaternions(self.quats, best, self.angle)
+            # Keep the coarse winners in case the fine grid has no quaternion close enough.
+            candidates  = numpy.concatenate((best, candidates))
+
+        scores  = self.score(candidates)
+        ml      = scores.argmin()
+        return (candidates[ml], scores[ml])
+
+    def score(self, quats):
+        """ Score the given quaternions for the current reconstruction (lower is better). """
+        chunks = [c for c in numpy.array_split(quats, self.number_of_chunks) if len(c)]
+        if self.__pool is None:
+            return numpy.concatenate([_score_chunk(c) for c in chunks])
+        return numpy.concatenate(self.__pool.map(_score_chunk, chunks))
+
+    def close(self):
+        """ Stop the worker processes. """
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+        _WORKER_DATA.clear()
+
+def rotate_intensities(intens, quat, qPos_full):
+    """ Rotate an intensity volume by the given quaternion. """
+    out_intens = numpy.zeros_like(intens)
+    rotateIntens.interp_intensities(intens.ravel(), out_intens.ravel(), qPos_full.ravel(), quat, len(intens))
+    return out_intens
+
+class RunningStatistics(object):
+    """
+    Mean and median of a stack of volumes written one at a time to a HDF5 dataset.
+
+    Only the streaming statistics and the central slices are held in memory; the median is computed
+    from slabs of the dataset once all volumes are written, reading at most max_bytes at a time.
+    """
+
+    def __init__(self, dataset, max_bytes=MEDIAN_BUFFER_BYTES):
+        """
+        :param dataset: Dataset to hold the stack, shape (number of volumes, L, L, L).
+        :type dataset: h5py.Dataset
+
+        :param max_bytes: Memory for reading slabs of the stack in median() (default MEDIAN_BUFFER_BYTES).
+        :type max_bytes: int
+        """
+        self.dataset        = dataset
+        self.max_bytes      = max_bytes
+        self.statistics     = StreamingStatistics()
+        self.central_slices = numpy.zeros((dataset.shape[0],) + dataset.shape[2:])
+
+    @property
+    def count(self):
+        """ Number of volumes added so far. """
+        return self.statistics.count
+
+    @property
+    def mean(self):
+        """ Mean over the volumes added so far. """
+        return self.statistics.mean
+
+    def add(self, index, volume):
+        """ Write the volume to the stack at the given index and update the statistics. """
+        self.dataset[index]         = volume
+        self.central_slices[index]  = volume[volume.shape[0]//2]
+        self.statistics.update(volume)
+
+    def median(self):
+        """ Median over the stack, computed from slabs of the dataset. """
+        (num_volumes, length)   = self.dataset.shape[:2]
+        slab_bytes  = num_volumes * numpy.prod(self.dataset.shape[2:]) * self.dataset.dtype.itemsize
+        slab_size   = max(1, int(self.max_bytes // slab_bytes))
+        median      = numpy.zeros(self.dataset.shape[1:])
+        for start in range(0, length, slab_size):
+            stop = min(start+slab_size, length)
+            median[start:stop] = numpy.median(self.dataset[:, start:stop], axis=0)
+        return median
+
+def _init_worker(reference, current, qPos, intens_len):
+    """ Make the shared data available to scoring in this process. """
+    _WORKER_DATA['reference']   = numpy.frombuffer(reference)
+    _WORKER_DATA['current']     = numpy.frombuffer(current)
+    _WORKER_DATA['qPos']        = qPos
+    _WORKER_DATA['intens_len']  = intens_len
+
+def _score_chunk(quats):
+    """ Score a chunk of quaternions against the shared volumes. """
+    return rotateIntens.orient_two_intensities(_WORKER_DATA['reference'], _WORKER_DATA['current'],
+                                               _WORKER_DATA['qPos'], numpy.ascontiguousarray(quats).ravel(),
+                                               _WORKER_DATA['intens_len'])
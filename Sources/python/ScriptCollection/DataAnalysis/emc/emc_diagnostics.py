@@ -27,14 +27,19 @@ import matplotlib
 matplotlib.use('pdf')
 
 from argparse import ArgumentParser
+from emc_alignment import OrientationAligner
+from emc_alignment import RunningStatistics
+from emc_alignment import log_scaled_intensities
+from emc_alignment import rotate_intensities
 from matplotlib import pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from mpl_toolkits.mplot3d import Axes3D
+from SimEx.Utilities import ReciprocalGrid
 from supp_py_modules import read_results
-from supp_py_modules import rotateIntens
 from supp_py_modules import viewRecon
 import glob
 import h5py
+import multiprocessing
 import numpy
 import os
 import time
@@ -45,13 +50,8 @@ def load_reference_intensites(ref_file):
     intens_len = len(t_intens)
     qmax    = intens_len/2
     (q_low, q_high) = (15, int(0.9*qmax))
-    qRange1 = numpy.arange(-q_high, q_high + 1)
-    qRange2 = numpy.arange(-qmax, qmax + 1)
-    qPos0   = numpy.array([[i,j,0] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-    qPos1   = numpy.array([[i,0,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-    qPos2   = numpy.array([[0,i,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-    qPos    = numpy.concatenate((qPos0, qPos1, qPos2))
-    qPos_full = numpy.array([[i,j,k] for i in qRange2 for j in qRange2 for k in qRange2]).astype("float")
+    qPos    = ReciprocalGrid.planarSlicePositions(q_high, q_low)
+    qPos_full = ReciprocalGrid.coordinateGrid(qmax)
     return (qmax, t_intens, intens_len, qPos, qPos_full)
 
 def load_quaternions(quat_fn):
@@ -139,35 +139,39 @@ def do_analysis(args):
     quats       = load_quaternions(os.path.join(curr_dir, "quaternion.dat"))
 
     num_dirs        = len(dirs)
-    intens_stack    = numpy.zeros((num_dirs, intens_len, intens_len, intens_len))
-    intens_stack[0] = t_intens.copy()
-    dir_ct          = 1
     i_off           = 1.E-7
-    tt_intens       = (t_intens>0.)*t_intens
-    tt_intens       /= tt_intens.max()
-    tt_intens       = numpy.abs(numpy.log(tt_intens+i_off))
+    tt_intens       = log_scaled_intensities(t_intens, i_off)
 
-    if num_dirs > 1:
-        for dir_ct in range(num_dirs):
-            dir         = dirs[dir_ct]
-            t0          = time.time()
-            curr_file   = glob.glob(os.path.join(dir, args.tmp_fn))[0]
-            c_intens    = (read_results.extract_value_from_h5(curr_file, "/data/data")).astype("float")
-            cc_intens   = (c_intens>0.)*c_intens
-            cc_intens   /= cc_intens.max()
-            cc_intens   = numpy.abs(numpy.log(cc_intens+i_off))
-            scores      = rotateIntens.orient_two_intensities(tt_intens.ravel(), cc_intens.ravel(), qPos.ravel(), quats.ravel(), intens_len)
-            ml_quat     = quats[(scores.argsort())[0]]
-            out_intens  = numpy.zeros_like(cc_intens)
-            rotateIntens.interp_intensities(c_intens.ravel(), out_intens.ravel(), qPos_full.ravel(), ml_quat, intens_len)
-            t1          = time.time()
-            intens_stack[dir_ct] = out_intens.copy()
-            print "Done orienting intensity %d of %d. Took %lf s."%(dir_ct, num_dirs, t1-t0)
-
-    # Save stack.
+    # Aligned volumes go straight to the file, only the running statistics are kept in memory.
     h5 = h5py.File("3d_stack.h5", "w")
     h5.create_group("data")
-    h5.create_dataset("data/oriented_diffraction_volumes", data=intens_stack )
+    stack           = h5.create_dataset("data/oriented_diffraction_volumes", shape=(num_dirs,)+t_intens.shape, dtype=t_intens.dtype)
+    stats           = RunningStatistics(stack, max_bytes=args.median_buffer*(1<<20))
+
+    if num_dirs > 1:
+        aligner = OrientationAligner(tt_intens, qPos, quats,
+                                     coarse_level=args.coarse_level,
+                                     number_of_candidates=args.number_of_candidates,
+                                     number_of_processes=args.number_of_processes)
+        try:
+            for dir_ct in range(num_dirs):
+                dir         = dirs[dir_ct]
+                t0          = time.time()
+                curr_file   = glob.glob(os.path.join(dir, args.tmp_fn))[0]
+                c_intens    = (read_results.extract_value_from_h5(curr_file, "/data/data")).astype("float")
+                (ml_quat, score) = aligner.align(log_scaled_intensities(c_intens, i_off))
+                stats.add(dir_ct, rotate_intensities(c_intens, ml_quat, qPos_full))
+                t1          = time.time()
+                print "Done orienting intensity %d of %d. Took %lf s."%(dir_ct, num_dirs, t1-t0)
+        finally:
+            aligner.close()
+    else:
+        stats.add(0, t_intens)
+
+    # Save mean and median.
+    median = stats.median()
+    h5.create_dataset("data/mean", data=stats.mean)
+    h5.create_dataset("data/median", data=median)
     h5.close()
     # Make diagnostic images from individual reconstructions
     # only if make_diag_imgs option is true
@@ -206,8 +210,7 @@ def do_analysis(args):
             for c in range(cols):
                 if stack_ct >= num_dirs:
                     break
-                out_intens  = intens_stack[stack_ct]
-                im          = ax[r, c].imshow(numpy.log(numpy.abs(out_intens[qmax])+1.E-7), cmap=plt.cm.coolwarm, aspect='auto')
+                im          = ax[r, c].imshow(numpy.log(numpy.abs(stats.central_slices[stack_ct])+1.E-7), cmap=plt.cm.coolwarm, aspect='auto')
                 plt.draw()
                 stack_ct    += 1
 
@@ -225,7 +228,7 @@ def do_analysis(args):
         plt.close(fig)
 
         fig2, ax2       = plt.subplots(1, 1)
-        im              = ax2.imshow(numpy.log(numpy.abs((numpy.median(intens_stack, axis=0))[qmax])+1.E-7))
+        im              = ax2.imshow(numpy.log(numpy.abs(median[qmax])+1.E-7))
         fig2.subplots_adjust(wspace=0.01)
         cbar_ax2        = fig2.add_axes([0.9, 0.1, 0.025, 0.8])
         fig2.colorbar(im, cax=cbar_ax2, label="log10(intensities)")
@@ -257,6 +260,30 @@ if __name__ == "__main__":
                         dest="tmp_fn",
                         default="orient*.h5",
                         help="name of temporary file from EMC recon")
+    parser.add_argument("-p",
+                        "--processes",
+                        type=int,
+                        dest="number_of_processes",
+                        default=multiprocessing.cpu_count(),
+                        help="number of processes to score orientations on")
+    parser.add_argument("-c",
+                        "--coarse_level",
+                        type=int,
+                        dest="coarse_level",
+                        default=4,
+                        help="refinement level of the coarse orientation search")
+    parser.add_argument("-n",
+                        "--number_of_candidates",
+                        type=int,
+                        dest="number_of_candidates",
+                        default=4,
+                        help="number of coarse orientations refined with the quaternions of the reconstruction")
+    parser.add_argument("-b",
+                        "--median_buffer",
+                        type=int,
+                        dest="median_buffer",
+                        default=256,
+                        help="memory (MB) for reading the stack of aligned volumes when computing the median")
 
     args = parser.parse_args()
 
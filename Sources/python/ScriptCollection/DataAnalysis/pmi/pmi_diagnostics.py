@@ -7,6 +7,7 @@ import copy
 import datetime
 import h5py
 import matplotlib
+import multiprocessing
 import numpy
 import os
 import pylab
@@ -18,6 +19,7 @@ import string
 import sys
 import time
 
+from SimEx.Utilities import ElementLayout
 from SimEx.Utilities.IOUtilities import loadPDB
 
 global g_s2e_setup
@@ -45,6 +47,11 @@ def f_load_snp_content( a_fp , a_snp ) :
     xsnp['xyz'] = a_fp.get( dbase_root + 'xyz' ) .value
     xsnp['r']   = a_fp.get( dbase_root + 'r' )   .value
     xsnp['Nph']   = a_fp.get( dbase_root + 'Nph' )   .value
+    # Restore the sample's atom order of files in element sorted layout.
+    if a_fp.get( '/data/permutation' ) is not None :
+        permutation = a_fp.get( '/data/permutation' ) .value
+        for key in [ 'Z' , 'xyz' , 'r' ] :
+            xsnp[key] = ElementLayout.restoreOrder( xsnp[key] , permutation )
     N = xsnp['Z'].size
     xsnp['q'] = numpy.array( [ xsnp['ff'][ pylab.find( xsnp['T'] == x ) , 0 ]  for x in xsnp['xyz'] ] ) .reshape(N,)
     xsnp['snp'] = a_snp ;
@@ -84,15 +91,46 @@ def f_load_sample( ) :
 ##############################################################################
 
 
+def f_saved_snp( a_fp , a_num_digits ) :
+    """ Indices of the snapshots saved in an open pmi file.
+
+    Files listing their snapshots in /data/snapshots may have gaps (snapshot stride, time window),
+    older files hold the contiguous sequence snp_0000001, snp_0000002, ...
+    """
+    if '/data/snapshots' in a_fp :
+        return a_fp[ '/data/snapshots' ][...].astype(int)
+
+    cc = 1
+    while a_fp.get( "/data/snp_" + str( cc ).zfill( a_num_digits ) ) :
+        cc = cc + 1
+    return numpy.arange( 1 , cc )
+
+
+##############################################################################
+
+
+def f_snp_list( all_real ) :
+    """ Indices of the snapshots saved for the first of the given realizations. """
+    global g_s2e_setup
+    xfp  = h5py.File( g_s2e_setup['prj'] + '/pmi/pmi_out_' + str( all_real[0] ).zfill(g_s2e_setup['num_digits'])  + '.h5' , "r" )
+    all_snp = f_saved_snp( xfp , g_s2e_setup['num_digits'] )
+    xfp.close()
+    return all_snp
+
+
+##############################################################################
+
+
 def f_num_snp( all_real ) :
+    """ Number of time steps of the given realizations, i.e. the index of the last step. """
     global g_s2e_setup
     xfp  = h5py.File( g_s2e_setup['prj'] + '/pmi/pmi_out_' + str( all_real[0] ).zfill(g_s2e_setup['num_digits'])  + '.h5' , "r" )
-    cc = 1
-    while 1 :
-        if not  xfp.get( "/data/snp_" + str( cc ).zfill(g_s2e_setup['num_digits']) )  :
-            xfp.close()
-            return cc - 1
-        cc = cc + 1
+    if '/data/snapshots' in xfp :
+        num_snp = int( xfp[ '/data/snapshots' ].attrs['number_of_steps'] )
+    else :
+        num_snp = len( f_saved_snp( xfp , g_s2e_setup['num_digits'] ) )
+    xfp.close()
+    return num_snp
 
 
 ##############################################################################
@@ -127,6 +165,122 @@ def f_eval_numE( a_snp , a_sample ) :
 ##############################################################################
 
 
+def f_element_columns( a_sample ) :
+    """ Map each atom to its column in the per element result arrays (ordered as a_sample['selZ'].keys()). """
+    col = numpy.zeros( ( len( a_sample['Z'] ) , ) , dtype=int )
+    cc = 0
+    for sel_Z in a_sample['selZ'].keys() :
+        col[a_sample['selZ'][sel_Z]] = cc
+        cc = cc + 1
+    return col
+
+
+##############################################################################
+
+
+def f_reduce_real( a_args ) :
+    """ Accumulate displacement, charge and Nph statistics of one realization in a single pass over its file.
+
+    Returns per element sums (not means) such that partial results of several realizations can be merged by
+    f_merge_partials.
+    """
+    prj , num_digits , x_real , all_snp , col , all_Z = a_args
+    num_Z = col.max() + 1
+    count = numpy.bincount( col , minlength=num_Z ).astype(float)
+
+    partial = dict()
+    partial['disp'] = numpy.zeros( ( len( all_snp ) , num_Z ) )
+    partial['numE'] = numpy.zeros( ( len( all_snp ) , num_Z ) )
+    partial['Nph']  = numpy.zeros( ( len( all_snp ) , ) )
+    partial['num_real'] = 1
+
+    xfp  = h5py.File( prj + '/pmi/pmi_out_' + str( x_real ).zfill(num_digits)  + '.h5' , "r" )
+
+    # Displacements are measured from the first saved snapshot.
+    saved = f_saved_snp( xfp , num_digits )
+    missing = numpy.setdiff1d( all_snp , saved )
+    if len( missing ) > 0 :
+        xfp.close()
+        raise KeyError( "Snapshots %s are not saved in realization %d." % ( str( missing ) , x_real ) )
+    r0 = xfp[ "/data/snp_" + str( saved[0] ).zfill(num_digits) + "/r" ][...]
+
+    # Files in element sorted layout are reduced by slicing, per element statistics do not depend on the atom order.
+    offsets = None
+    if '/data/element_offsets' in xfp :
+        offsets = xfp[ '/data/element_offsets' ][...]
+        layout_col = [ all_Z.index( sel_Z ) for sel_Z in xfp[ '/data/elements' ][...] ]
+        layout_count = numpy.diff( offsets ).astype(float)
+
+    for cc , xsnp in enumerate( all_snp ) :
+        dbase_root = "/data/snp_" + str( xsnp ).zfill(num_digits) + "/"
+        r   = xfp[ dbase_root + 'r' ][...]
+        T   = xfp[ dbase_root + 'T' ][...]
+        ff  = xfp[ dbase_root + 'ff' ][...]
+        xyz = xfp[ dbase_root + 'xyz' ][...]
+
+        # Number of bound electrons per atom: T is sorted, so look up each atom's (Z,q) id at once.
+        q = ff[ numpy.searchsorted( T , xyz ) , 0 ]
+
+        dr = r - r0
+        disp = numpy.sqrt( numpy.sum( dr * dr , axis = 1 ) )
+        if offsets is None :
+            partial['disp'][cc,:] = numpy.bincount( col , weights=disp , minlength=num_Z ) / count / 1e-10
+            partial['numE'][cc,:] = numpy.bincount( col , weights=q , minlength=num_Z ) / count
+        else :
+            partial['disp'][cc,layout_col] = ElementLayout.reduceByElement( disp , offsets ) / layout_count / 1e-10
+            partial['numE'][cc,layout_col] = ElementLayout.reduceByElement( q , offsets ) / layout_count
+        partial['Nph'][cc]    = xfp[ dbase_root + 'Nph' ][...].sum()
+
+    xfp.close()
+
+    sys.stdout.write('%07d  ' % ( x_real ) )
+    sys.stdout.flush()
+
+    return partial
+
+
+##############################################################################
+
+
+def f_merge_partials( a_partials ) :
+    """ Merge partial results from f_reduce_real into realization averages. """
+    merged = dict()
+    num_real = sum( [ p['num_real'] for p in a_partials ] )
+    for key in [ 'disp' , 'numE' , 'Nph' ] :
+        merged[key] = sum( [ p[key] for p in a_partials ] ) / num_real
+    return merged
+
+
+##############################################################################
+
+
+def f_streaming_diagnostics( a_prj , a_real , a_snp , a_sample , a_num_digits=7 , a_num_workers=None ) :
+    """ Reduce all realizations, each file is read once, realizations are distributed over worker processes. """
+    col = f_element_columns( a_sample )
+    all_Z = list( a_sample['selZ'].keys() )
+    tasks = [ ( a_prj , a_num_digits , x_real , a_snp , col , all_Z ) for x_real in a_real ]
+
+    if a_num_workers is None :
+        a_num_workers = multiprocessing.cpu_count()
+    a_num_workers = max( 1 , min( a_num_workers , len( tasks ) ) )
+
+    if a_num_workers == 1 :
+        partials = [ f_reduce_real( task ) for task in tasks ]
+    else :
+        pool = multiprocessing.Pool( a_num_workers )
+        try :
+            partials = pool.map( f_reduce_real , tasks )
+        finally :
+            pool.close()
+            pool.join()
+    print
+
+    return f_merge_partials( partials )
+
+
+##############################################################################
+
+
 def   f_pmi_diagnostics_help() :
     print """
 - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -139,9 +293,10 @@ Usage - Detailed:
       or
         >> data = pmi_diagnostics( <PROJ_FOLDER> , 'default' )
       or
-        >> data = pmi_diagnostics( <PROJ_FOLDER> , 'load' , <pmi_out_instances> [ , <snapshots> ] )
+        >> data = pmi_diagnostics( <PROJ_FOLDER> , 'load' , <pmi_out_instances> [ , <snapshots> [ , <num_workers> ] ] )
       or if current folder is the project folder:
-        >> data = pmi_diagnostics( 'load' , <pmi_out_instances> [ , <snapshots> ] )
+        >> data = pmi_diagnostics( 'load' , <pmi_out_instances> [ , <snapshots> [ , <num_workers> ] ] )
+      Realizations are processed in parallel on <num_workers> processes (default: all cores).
     * III.  plot displacements and number of electrons
         >> figure()
         >> pmi_diagnostics( 'plot-disp' , data , <Z> ,  <color> ) ;
@@ -247,13 +402,15 @@ def pmi_diagnostics( *args ) :
         if  len(args) > 0 :
             data['real'] = numpy.array( args[0] )
 
+        # Select from the saved snapshots, which need not be contiguous.
+        all_snp = f_snp_list( data['real'] )
         if  len(args) > 1 :
             data['snp'] = args[1]
         else :
-            data['snp'] = numpy.arange( 1 ,  f_num_snp( data['real'] ) + 1 )
+            data['snp'] = all_snp
 
         if len( data['snp'] ) == 1 :
-            data['snp'] = numpy.around( numpy.linspace( 1 ,  f_num_snp( data['real'] ) ,  data['snp'] ) ) .astype(int)
+            data['snp'] = all_snp[ numpy.around( numpy.linspace( 0 , len( all_snp ) - 1 , data['snp'][0] ) ) .astype(int) ]
 
         # Read sample data.
         try:
@@ -274,29 +431,16 @@ def pmi_diagnostics( *args ) :
         print "Num. snp:   " , data['num_snp']
 
 
-        data['disp'] = numpy.zeros( ( data['num_snp'] , len( data['sample']['selZ'].keys() ) ) )
-        data['numE'] = numpy.zeros( ( data['num_snp'] , len( data['sample']['selZ'].keys() ) ) )
-        data['Nph']  = numpy.zeros( ( data['num_snp'] ,  ) )
+        num_workers = None
+        if  len(args) > 2 :
+            num_workers = args[2]
 
-        for x_real in data['real'] :
-            #print 'Real: %0' + str(NUM_DIGITS) + 'd' % ( x_real ) ,
-            print '%07d  ' % ( x_real ) ,
-            sys.stdout.flush()
-
-
-            data_snp0 = f_load_snp( x_real , 1 )
-            cc = 0
-            for xsnp in data['snp'] :
-                #print '.',
-                sys.stdout.write('.')
-                sys.stdout.flush()
-                data_snp = f_load_snp( x_real , xsnp )
-                data['disp'][cc,:] += f_eval_disp( data_snp , data_snp0['r'] , data['sample'] ) / data['num_real']
-                data['numE'][cc,:] += f_eval_numE( data_snp , data['sample'] ) / data['num_real']
-                data['Nph'][cc]    += data_snp['Nph'] / data['num_real']
-                cc = cc + 1
-
-            print
+        data.update( f_streaming_diagnostics( g_s2e_setup['prj'] ,
+                                              data['real'] ,
+                                              data['snp'] ,
+                                              data['sample'] ,
+                                              g_s2e_setup['num_digits'] ,
+                                              num_workers ) )
 
         return data
         #return data_snp
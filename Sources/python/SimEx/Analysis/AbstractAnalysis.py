@@ -23,16 +23,46 @@
 from abc import ABCMeta, abstractmethod
 import exceptions
 import os
+import sys
+
+# Environment variables set by batch schedulers inside a job.
+_BATCH_JOB_VARIABLES = ['SLURM_JOB_ID', 'PBS_JOBID', 'LSB_JOBID', 'JOB_ID']
+
+def _selectBackend():
+    """ """
+    """ Choose the matplotlib backend.
+
+    An explicit choice (MPLBACKEND or pyplot imported before) is kept. Without a display or inside a
+    batch job, figures are rendered with the non-interactive Agg backend, which needs no GUI stack.
+    Interactive sessions use Qt4Agg if PyQt4 is installed and the matplotlib default otherwise.
+
+    :return: Name of the backend to use, None to leave the choice to matplotlib.
+    :rtype: str
+    """
+    if 'MPLBACKEND' in os.environ or 'matplotlib.pyplot' in sys.modules:
+        return None
+
+    headless = sys.platform.startswith('linux') and not os.environ.get('DISPLAY')
+    batch = any(variable in os.environ for variable in _BATCH_JOB_VARIABLES)
+    if headless or batch:
+        return 'Agg'
+
+    try:
+        import PyQt4
+    except ImportError:
+        return None
+    return 'Qt4Agg'
 
 # The one and only pyplot import.
 import matplotlib as mpl
-mpl.use("Qt4Agg")
+_backend = _selectBackend()
+if _backend is not None:
+    mpl.use(_backend)
 from matplotlib import pyplot as plt
 
 from SimEx.Utilities.EntityChecks import checkAndSetInstance
 
 import dill
-import sys
 
 class AbstractAnalysis(object):
     """
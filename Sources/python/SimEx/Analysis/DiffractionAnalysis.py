@@ -23,13 +23,18 @@
 from SimEx.Analysis.AbstractAnalysis import AbstractAnalysis, plt, mpl
 from matplotlib.colors import Normalize, LogNorm
 
+from SimEx.Utilities.FrameRenderer import FrameRenderer, colorLimits
+from SimEx.Utilities.PatternBatchReader import PatternBatchReader
+from SimEx.Utilities.PatternIndex import PatternIndex
+from SimEx.Utilities.PatternSummary import PatternSummary
+from SimEx.Utilities.RadialIntegration import radialIntegrator
+from SimEx.Utilities.StreamingStatistics import StreamingStatistics, isStreamable
+
 import h5py
 import math
+import multiprocessing
 import numpy
 import os
-import tempfile
-
-import pyFAI
 
 class DiffractionAnalysis(AbstractAnalysis):
     """
@@ -74,6 +79,8 @@ class DiffractionAnalysis(AbstractAnalysis):
         self.parameters = diffractionParameters(self.input_path)
 
         self.mask = mask
+        self.__pattern_index = None
+        self.__summary = None
 
     @property
     def parameters(self):
@@ -108,6 +115,44 @@ class DiffractionAnalysis(AbstractAnalysis):
     def patterns_iterator(self):
         return self.patternGenerator()
 
+    @property
+    def pattern_index(self):
+        """ Query the persistent index of the patterns in the input (built or updated on first access). """
+        if self.__pattern_index is None:
+            self.__pattern_index = PatternIndex(self.input_path)
+        return self.__pattern_index
+
+    @property
+    def summary(self):
+        """ Query the per pattern summary table of the input patterns, masked as in patternGenerator() (built or updated on first access).
+
+        :example: Restrict the analysis to patterns with more than 1000 photons:\n
+                  analyzer.pattern_indices = analyzer.summary.select(analyzer.summary['total_photons'] > 1000)
+
+        """
+        mask = self.mask if isinstance(self.mask, numpy.ndarray) else None
+        if os.path.isdir(self.input_path): # legacy format, patterns are read without mask.
+            mask = None
+        summary = self.__summary
+        if summary is None or summary.poissonize != self.poissonize or (summary.mask is None) != (mask is None) or (mask is not None and not numpy.array_equal(summary.mask, mask)):
+            self.__summary = PatternSummary(self.input_path, poissonize=self.poissonize, mask=mask)
+        return self.__summary
+
+    def readPattern(self, number):
+        """ Read a single pattern by its number, without scanning the patterns before it.
+
+        :param number: The pattern number (group number for v0.2 files, position in the sorted directory listing for the legacy format).
+        :type number: int
+
+        :return: The pattern (multiplied by the mask for v0.2 files).
+        :rtype: numpy.array
+
+        """
+        pattern = self.pattern_index.read(number, self.poissonize)
+        if os.path.isdir(self.input_path):
+            return pattern
+        return pattern*self.mask
+
     @property
     def poissonize(self):
         """ Query whether to read data with (True) or without (False) Poisson noise. """
@@ -146,11 +191,21 @@ class DiffractionAnalysis(AbstractAnalysis):
 
         indices = self.pattern_indices
         path = self.input_path
+
+        # Subsets are read through the pattern index.
+        if indices != 'all':
+            if os.path.isdir(path): # legacy format, skip missing and unreadable files.
+                index = self.pattern_index
+                for pattern in index.readMany([ix for ix in indices if ix in index], self.poissonize):
+                    yield pattern
+            else:
+                for pattern in self.pattern_index.readMany(indices, self.poissonize):
+                    yield pattern*self.mask
+            return
+
         if os.path.isdir(path): # legacy format.
             dir_listing = os.listdir(path)
             dir_listing.sort()
-            if indices != 'all':
-                dir_listing = [d for (i,d) in enumerate(dir_listing) if i in indices]
             h5_files = [os.path.join(path, f) for f in dir_listing if f.split('.')[-1] == "h5"]
             for h5_file in h5_files:
                 try:
@@ -170,10 +225,7 @@ class DiffractionAnalysis(AbstractAnalysis):
         else: # v0.2
             # Open file for reading
             with h5py.File(path, 'r') as h5:
-                if indices is None or indices == 'all':
-                    indices = [key for key in h5['data'].iterkeys()]
-                else:
-                    indices = ["%0.7d" % ix for ix in indices]
+                indices = [key for key in h5['data'].iterkeys()]
                 for ix in indices:
                     root_path = '/data/%s/'% (ix)
                     if self.poissonize:
@@ -181,39 +233,176 @@ class DiffractionAnalysis(AbstractAnalysis):
                     else:
                         path_to_data = root_path + 'diffr'
 
-                    diffr = h5[path_to_data].value
+                    # Read into a single new array and apply the mask in place.
+                    data = h5[path_to_data]
+                    diffr = numpy.empty(data.shape, dtype=numpy.result_type(data.dtype, self.mask))
+                    data.read_direct(diffr)
+                    diffr *= self.mask
 
-                    yield diffr*self.mask
+                    yield diffr
 
 
+    def patternBatches(self, batch_size=100, buffers=None, prefetch=True):
+        """ Yield the selected patterns in batches, read directly into reusable buffers.
 
-    def plotRadialProjection(self, operation=None, logscale=False):
-        """ Plot the radial projection of a pattern.
+        :param batch_size: Number of patterns per batch (default 100). Ignored if buffers are given.
+        :type batch_size: int
 
-        :param operation: Operation to apply to selected patterns (default numpy.sum).
+        :param buffers: Buffers to fill, each of shape (batch_size, ny, nx) and C-contiguous (default: a pool of two allocated buffers).
+        :type buffers: numpy.array || list of numpy.array
+
+        :param prefetch: Whether to read the next batch in a background thread while the current one is processed (default True).
+        :type prefetch: bool
+
+        :return: Batches of shape (n, ny, nx), multiplied by the mask for v0.2 files. Each batch is a view into a buffer which is refilled once the next batch is requested.
+        :rtype: PatternBatchReader
+
+        """
+        index = self.pattern_index
+        numbers = self.__allPatternIndices()
+        mask = self.mask if isinstance(self.mask, numpy.ndarray) else None
+        if os.path.isdir(self.input_path): # legacy format, skip missing and unreadable files.
+            numbers = [ix for ix in numbers if ix in index]
+            mask = None
+
+        return PatternBatchReader(index, numbers, batch_size=batch_size, poissonize=self.poissonize, mask=mask, buffers=buffers, prefetch=prefetch)
+
+    def streamingStatistics(self, number_of_processes=1):
+        """ Accumulate per pixel statistics and photon numbers of the selected patterns in a single pass.
+
+        :param number_of_processes: Number of processes to read and reduce disjoint subsets of the patterns (default 1).
+        :type number_of_processes: int
+
+        :return: The statistics over all selected patterns.
+        :rtype: StreamingStatistics
+
+        """
+        if number_of_processes <= 1:
+            return StreamingStatistics(pattern for batch in self.patternBatches() for pattern in batch)
+
+        # Split the patterns into contiguous subsets and merge the partial statistics in order.
+        # Workers read their subsets through the pattern index, which is brought up to date here.
+        indices = self.__allPatternIndices()
+        subsets = [s.tolist() for s in numpy.array_split(indices, number_of_processes) if len(s)]
+        mask = self.mask if isinstance(self.mask, numpy.ndarray) else None
+        tasks = [(self.input_path, subset, self.poissonize, mask) for subset in subsets]
+
+        pool = multiprocessing.Pool(min(number_of_processes, len(tasks)))
+        try:
+            partials = pool.map(_streamingStatisticsWorker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        statistics = StreamingStatistics()
+        for partial in partials:
+            statistics.merge(partial)
+
+        return statistics
+
+    def __allPatternIndices(self):
+        """ """
+        """ Get the selected pattern indices as a list, resolving "all". """
+        index = self.pattern_index
+        if self.pattern_indices != 'all':
+            return list(self.pattern_indices)
+
+        return index.numbers.tolist()
+
+    def __reducePatterns(self, operation, number_of_processes):
+        """ """
+        """ Apply operation over the selected patterns, streaming if possible. """
+        if isStreamable(operation):
+            return self.streamingStatistics(number_of_processes).reduce(operation)
+
+        return operation(numpy.array([p for p in self.patterns_iterator]), axis=0)
+
+    def radialProfiles(self, batch_size=100, polarization_factor=None):
+        """ Integrate all selected patterns over the azimuthal angle.
+
+        :param batch_size: Number of patterns to read and integrate at once (default 100).
+        :type batch_size: int
+
+        :param polarization_factor: Degree of horizontal polarization for polarization correction (default None: no correction).
+        :type polarization_factor: float
+
+        :return: Bin centers (1/nm) and the radial profile of each pattern.
+        :rtype: tuple (numpy.array, numpy.array, shape (number of patterns, number of bins))
+
+        """
+        mask = self.mask if isinstance(self.mask, numpy.ndarray) else None
+
+        qs, profiles = None, []
+        for batch in self.patternBatches(batch_size):
+            qs, batch_profiles = azimuthalIntegration(batch, self.__parameters, mask=mask, polarization_factor=polarization_factor)
+            profiles.append(batch_profiles)
+
+        if qs is None:
+            return None, numpy.zeros((0,0))
+
+        return qs, numpy.concatenate(profiles)
+
+    def reducedPattern(self, operation=None, number_of_processes=1):
+        """ Get the selected pattern, or the reduction over all selected patterns, without plotting.
+
+        :param operation: Operation to apply to selected patterns (default numpy.sum). Ignored if a single pattern is selected.
         :type operation: python function
         :note operation: Operation must accept a 3D numpy.array as first input argument and the "axis" keyword-argument. Operation must return a 2D numpy.array. Axis will always be chosen as axis=0.
         :example operation: numpy.mean, numpy.std, numpy.sum
 
-        :param logscale: Whether to plot the intensity on a logarithmic scale (z-axis) (default False).
-        :type logscale: bool
+        :param number_of_processes: Number of processes to reduce the patterns with (default 1).
+        :type number_of_processes: int
+        :note number_of_processes: numpy.sum, numpy.mean, numpy.std, numpy.var, numpy.min and numpy.max are evaluated in a single pass with constant memory, other operations need all patterns in memory.
+
+        :return: The pattern.
+        :rtype: numpy.array
 
         """
+        if len(self.pattern_indices) == 1:
+            return next(self.patterns_iterator)
+
         # Handle default operation
         if operation is None:
             operation = numpy.sum
 
-        # Get pattern to plot.
-        pi = self.patterns_iterator
-        if len(self.pattern_indices) == 1:
-            pattern_to_plot = pi.next()
-        else:
-            pattern_to_plot = operation(numpy.array([p for p in pi]), axis=0)
+        return self.__reducePatterns(operation, number_of_processes)
+
+    def radialProjection(self, operation=None, number_of_processes=1):
+        """ Get the radial projection of the selected pattern (or of the reduction over all selected patterns) without plotting.
+
+        :param operation: Operation to apply to selected patterns (default numpy.sum), see reducedPattern().
+        :type operation: python function
+
+        :param number_of_processes: Number of processes to reduce the patterns with (default 1).
+        :type number_of_processes: int
+
+        :return: Bin centers (1/nm) and mean intensity per bin.
+        :rtype: tuple (numpy.array, numpy.array)
+
+        """
+        return azimuthalIntegration(self.reducedPattern(operation, number_of_processes), self.__parameters)
+
+    def plotRadialProjection(self, operation=None, logscale=False, number_of_processes=1):
+        """ Plot the radial projection of a pattern.
+
+        :param operation: Operation to apply to selected patterns (default numpy.sum).
+        :type operation: python function
+        :note operation: Operation must accept a 3D numpy.array as first input argument and the "axis" keyword-argument. Operation must return a 2D numpy.array. Axis will always be chosen as axis=0.
+        :example operation: numpy.mean, numpy.std, numpy.sum
+
+        :param logscale: Whether to plot the intensity on a logarithmic scale (z-axis) (default False).
+        :type logscale: bool
+
+        :param number_of_processes: Number of processes to reduce the patterns with (default 1).
+        :type number_of_processes: int
+        :note number_of_processes: numpy.sum, numpy.mean, numpy.std, numpy.var, numpy.min and numpy.max are evaluated in a single pass with constant memory, other operations need all patterns in memory.
 
+        """
         # Plot radial projection.
-        plotRadialProjection(pattern_to_plot, self.__parameters, logscale)
+        qs, intensities = self.radialProjection(operation, number_of_processes)
+        plotRadialProfile(qs, intensities, logscale)
 
-    def plotPattern(self, operation=None, logscale=False, offset=1e-1):
+    def plotPattern(self, operation=None, logscale=False, offset=1e-1, number_of_processes=1):
         """ Plot a pattern.
 
         :param operation: Operation to apply to selected patterns (default numpy.sum).
@@ -227,38 +416,36 @@ class DiffractionAnalysis(AbstractAnalysis):
         :param offset: Offset to apply if logarithmic scaling is on.
         :type offset: float
 
+        :param number_of_processes: Number of processes to reduce the patterns with (default 1).
+        :type number_of_processes: int
+        :note number_of_processes: numpy.sum, numpy.mean, numpy.std, numpy.var, numpy.min and numpy.max are evaluated in a single pass with constant memory, other operations need all patterns in memory.
+
         """
 
-        # Handle default operation
         if operation is not None and len(self.pattern_indices) == 1:
             print "WARNING: Giving an operation with a single pattern has no effect."
-            operation = None
-        if operation is None and len(self.pattern_indices) > 1:
-            operation = numpy.sum
 
         # Get pattern to plot.
-        pi = self.patterns_iterator
-        if len(self.pattern_indices) == 1:
-            pattern_to_plot = pi.next()
-        else:
-            pattern_to_plot = operation(numpy.array([p for p in pi]), axis=0)
+        pattern_to_plot = self.reducedPattern(operation, number_of_processes)
 
         # Plot image and colorbar.
         plotImage(pattern_to_plot, logscale, offset)
 
-    def statistics(self):
-        """ Get statistics of photon numbers per pattern (mean and rms) over selected patterns and plot a historgram. """
+    def statistics(self, number_of_processes=1):
+        """ Get statistics of photon numbers per pattern (mean and rms) over selected patterns and plot a historgram.
+
+        :param number_of_processes: Number of processes to read the patterns with (default 1).
+        :type number_of_processes: int
 
-        pi = self.patterns_iterator
-        stack = numpy.array([p for p in pi])
+        """
 
-        photonStatistics(stack)
+        photonNumberStatistics(self.streamingStatistics(number_of_processes).totals)
 
-    def animatePatterns(self, output_path=None, logscale=False, offset=1e-1):
+    def animatePatterns(self, output_path=None, logscale=False, offset=1e-1, fps=1, number_of_processes=None):
         """
-        Make an animated gif out of the given patterns.
+        Make an animated gif (or video) out of the given patterns.
 
-        :param output_path: Where to save the animated git.
+        :param output_path: Where to save the animated gif. Extensions other than .gif produce a video (needs ffmpeg).
         :type output_path: str
         :raises IOError: File exists or parent directory not found.
 
@@ -267,6 +454,12 @@ class DiffractionAnalysis(AbstractAnalysis):
 
         :param offset: Offset to apply if logarithmic scaling is on.
         :type offset: float
+
+        :param fps: Frames per second (default 1).
+        :type fps: float
+
+        :param number_of_processes: Number of processes rendering the frames (default None: one per cpu).
+        :type number_of_processes: int
         """
 
         # Handle default path for saving the animated gif.
@@ -284,33 +477,61 @@ class DiffractionAnalysis(AbstractAnalysis):
 
         self.__animation_output_path=os.path.abspath(output_path)
 
-        # Make tempdir.
-        tmp_out_dir = tempfile.mkdtemp()
-        stack = numpy.array([p for p in self.patternGenerator()])
-
-        mn, mx = stack.min(), stack.max()
-        x_range, y_range = stack.shape[1:]
-        for i,img in enumerate(stack):
-            plotImage(img, logscale=logscale, offset=offset)
-
-            # Save image.
-            if self.pattern_indices != "all":
-                png_filename = "%07d.png" % (self.pattern_indices[i])
-            else:
-                png_filename = "%07d.png" % (i)
+        # Common color scale of all frames.
+        mn, mx = colorLimits(self.patternBatches())
+        if mn is None:
+            raise ValueError("No patterns to animate.")
+        shift = 0.0
+        if logscale and mn <= 0.0:
+            shift = offset - mn
+            mn, mx = mn + shift, mx + shift
+        if mx <= mn:
+            mx = mn + 1.0
+
+        renderer = FrameRenderer(mn, mx,
+                                 logscale=logscale,
+                                 offset=shift,
+                                 origin='lower',
+                                 xlabel=r'$x$ (pixel)',
+                                 ylabel=r'$y$ (pixel)',
+                                 )
+
+        renderer.animate(self.patternGenerator(), output_path, fps=fps, number_of_processes=number_of_processes)
+
+def _streamingStatisticsWorker(args):
+    """ """
+    """ Reduce a subset of patterns in a worker process.
 
-            plt.savefig(os.path.join(tmp_out_dir, png_filename) )
+    :param args: Input path, pattern indices, poissonize flag and mask of the analysis.
+    :type args: tuple
 
-            # Clear figure.
-            plt.clf()
+    :return: The statistics over the subset.
+    :rtype: StreamingStatistics
+    """
+    input_path, indices, poissonize, mask = args
+    analyzer = DiffractionAnalysis(input_path=input_path, pattern_indices=indices, poissonize=poissonize, mask=mask)
 
-        # Render the animated gif.
-        os.system("convert -delay 100 %s %s" %(os.path.join(tmp_out_dir, "*.png"), output_path) )
+    return analyzer.streamingStatistics()
 
 def plotRadialProjection(pattern, parameters, logscale=True):
     """ Perform integration over azimuthal angle and plot as function of radius. """
 
     qs, intensities = azimuthalIntegration(pattern, parameters)
+    plotRadialProfile(qs, intensities, logscale)
+
+def plotRadialProfile(qs, intensities, logscale=True):
+    """ Plot a radial profile (as returned by azimuthalIntegration).
+
+    :param qs: Bin centers (1/nm).
+    :type qs: numpy.array
+
+    :param intensities: Intensity per bin.
+    :type intensities: numpy.array
+
+    :param logscale: Whether to plot the intensity on a logarithmic scale (default True).
+    :type logscale: bool
+
+    """
 
     if logscale:
         plt.semilogy(qs, intensities)
@@ -321,7 +542,25 @@ def plotRadialProjection(pattern, parameters, logscale=True):
     plt.ylabel("Intensity (arb. units)")
     plt.tight_layout()
 
-def azimuthalIntegration(pattern, parameters):
+def azimuthalIntegration(pattern, parameters, mask=None, polarization_factor=None):
+    """ Integrate one pattern or a batch of patterns over the azimuthal angle.
+
+    :param pattern: The pattern(s) to integrate.
+    :type pattern: numpy.array, shape (rows, columns) or (number of patterns, rows, columns)
+
+    :param parameters: Beam and geometry parameters (as returned by diffractionParameters).
+    :type parameters: dict
+
+    :param mask: Pixels to include (nonzero) or exclude (zero) (default: all pixels).
+    :type mask: numpy.array
+
+    :param polarization_factor: Degree of horizontal polarization for polarization correction (default None: no correction).
+    :type polarization_factor: float
+
+    :return: Bin centers (1/nm) and solid angle corrected mean intensities per bin.
+    :rtype: tuple (numpy.array, numpy.array)
+
+    """
 
     # Extract parameters.
     beam = parameters['beam']
@@ -338,33 +577,18 @@ def azimuthalIntegration(pattern, parameters):
     # Number of pixels in each dimension
     Npix = geom['mask'].shape[0]
 
-    # Find center.
-    center = 0.5*(Npix-1)
-
-    azimuthal_integrator = pyFAI.AzimuthalIntegrator(
-            dist=Ddet,
-            pixel1=apix,
-            pixel2=apix,
-            wavelength=lmd*1e-9)
-
-
-    azimuthal_integrator.setFit2D(
-            directDist=Ddet*1e3,
-            centerX=center,
-            centerY=center,
-            tilt=0.0,
-            tiltPlanRotation=0.0,
-            pixelX=apix*1e6,
-            pixelY=apix*1e6,
-            )
-    qs, intensities = azimuthal_integrator.integrate1d(
-            pattern,
-            min(Npix,1024),
-            unit="q_nm^-1",
-            #unit="2th_deg",
+    # The pixel-to-bin map is computed once per geometry and cached.
+    integrator = radialIntegrator(
+            shape=(Npix, Npix),
+            pixel_size=apix,
+            distance=Ddet,
+            wavelength=lmd,
+            number_of_bins=min(Npix,1024),
+            mask=mask,
+            polarization_factor=polarization_factor,
             )
 
-    return qs, intensities
+    return integrator.q, integrator.integrate(pattern)
 
 def diffractionParameters(path):
     """ Extract beam parameters and geometry from given file or directory.
@@ -487,19 +711,23 @@ def plotResolutionRings(parameters):
 def photonStatistics(stack):
     """ """
 
-    number_of_images = stack.shape[0]
-    photons = numpy.sum(stack, axis=(1,2))
-    avg_photons = numpy.mean(photons)
-    rms_photons =  numpy.std(photons)
+    photonNumberStatistics(numpy.sum(stack, axis=(1,2)))
 
-    print "*************************"
-    print "avg = %6.5e" % (avg_photons)
-    print "std = %6.5e" % (rms_photons)
-    print "*************************"
+def photonNumberHistogram(photons):
+    """ Get mean and rms of the photon numbers per pattern and their histogram, without plotting.
 
+    :param photons: Photon number of each pattern.
+    :type photons: numpy.array
+
+    :return: Mean, rms, counts per bin and bin edges.
+    :rtype: tuple (float, float, numpy.array, numpy.array)
+
+    """
+
+    number_of_images = len(photons)
+    avg_photons = numpy.mean(photons)
+    rms_photons =  numpy.std(photons)
 
-    # Plot histogram.
-    plt.figure()
     max_photon_number = int(numpy.max( photons ))
     min_photon_number = int(numpy.min( photons ))
     if max_photon_number == min_photon_number:
@@ -507,12 +735,33 @@ def photonStatistics(stack):
 
     binwidth = max_photon_number - min_photon_number
     number_of_bins = min(20, number_of_images)
-    binwidth = int( binwidth / number_of_bins )
+    binwidth = max(1, int( binwidth / number_of_bins ))
 
-    plt.hist(photons, bins=xrange(min_photon_number, max_photon_number, binwidth), facecolor='red', alpha=0.75)
-    plt.xlim([min_photon_number, max_photon_number])
+    # The last bin includes the largest photon number.
+    counts, edges = numpy.histogram(photons, bins=numpy.arange(min_photon_number, max_photon_number + binwidth, binwidth))
+
+    return avg_photons, rms_photons, counts, edges
+
+def photonNumberStatistics(photons):
+    """ Print mean and rms of the photon numbers per pattern and plot their histogram.
+
+    :param photons: Photon number of each pattern.
+    :type photons: numpy.array
+
+    """
+
+    avg_photons, rms_photons, counts, edges = photonNumberHistogram(photons)
+
+    print "*************************"
+    print "avg = %6.5e" % (avg_photons)
+    print "std = %6.5e" % (rms_photons)
+    print "*************************"
+
+
+    # Plot histogram.
+    plt.figure()
+    plt.hist(photons, bins=edges, facecolor='red', alpha=0.75)
+    plt.xlim([edges[0], edges[-1]])
     plt.xlabel("Photons")
     plt.ylabel("Histogram")
     plt.title("Photon number histogram")
-
-
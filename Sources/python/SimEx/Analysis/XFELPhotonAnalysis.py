@@ -21,9 +21,10 @@
 ##########################################################################
 
 from SimEx.Analysis.AbstractAnalysis import AbstractAnalysis, plt, mpl
+from SimEx.Utilities.FrameRenderer import FrameRenderer, colorLimits
+from SimEx.Utilities.WavefrontStream import WavefrontStream
 
-import os,shutil
-import copy
+import os
 import numpy
 import wpg
 
@@ -43,23 +44,23 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         # Initialize base class. This takes care of parameter checking.
         super(XFELPhotonAnalysis, self).__init__(input_path)
 
-        # Get wavefront file name.
-        wavefront = wpg.Wavefront()
+        # Reductions read the file in chunks of slices, the full wavefront is only loaded when needed.
+        self.__stream = WavefrontStream(self.input_path)
 
-        print "\n Loading wavefront from %s." % (self.input_path)
-        wavefront.load_hdf5(self.input_path)
-        print " ... done."
-
-        # Init intensity.
+        # Init intensity and wavefront.
         self.__intensity = None
+        self.__wavefront = None
 
-        # Init wavefront, triggers assignment of intensity.
-        self.wavefront = wavefront
-
+    @property
+    def stream(self):
+        """ Query the chunked reader of the wavefront file. """
+        return self.__stream
 
     @property
     def intensity(self):
-        """ Query for the intensity. """
+        """ Query for the intensity (loads the wavefront on first access). """
+        if self.__intensity is None and self.__wavefront is None:
+            self.wavefront
         return self.__intensity
     @intensity.setter
     def intensity(self, val):
@@ -69,7 +70,17 @@ class XFELPhotonAnalysis(AbstractAnalysis):
 
     @property
     def wavefront(self):
-        """ Query for the wavefront. """
+        """ Query for the wavefront (loaded on first access). """
+        if self.__wavefront is None:
+            wavefront = wpg.Wavefront()
+
+            print "\n Loading wavefront from %s." % (self.input_path)
+            wavefront.load_hdf5(self.input_path)
+            print " ... done."
+
+            # Triggers assignment of intensity.
+            self.wavefront = wavefront
+
         return self.__wavefront
     @wavefront.setter
     def wavefront(self, val):
@@ -85,40 +96,93 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         self.__nans = mask_nans(self.intensity)
         print " ... done."
 
-    def animate(self, qspace=False, logscale=False):
-        """ Generate an animated gif from the wavefront data. """
-        intensity = self.intensity
+    def animate(self, qspace=False, logscale=False, output_path=None, fps=10, number_of_processes=None):
+        """ Generate an animated gif from the wavefront data.
 
-        # Get limits.
-        xmin, xmax, ymax, ymin = self.wavefront.get_limits()
-        mx = intensity.max()
-        mn = intensity.min()
-        if logscale and mn <= 0.0:
-            mn = intensity[numpy.where(intensity > 0.0)].min(),
-
-        inp_filename = os.path.split(self.input_path)[-1]
-        os.mkdir("tmp")
-        number_of_slices = intensity.shape[-1]
-        # Setup a figure.
+        :param qspace: Not supported yet, the animation shows the real space intensity.
+        :type qspace: bool
+
+        :param logscale: Whether to show the intensity on a logarithmic scale (default False).
+        :type logscale: bool
+
+        :param output_path: Where to save the animation (default: <input file name>.gif in the current directory). Extensions other than .gif produce a video (needs ffmpeg).
+        :type output_path: str
+
+        :param fps: Frames per second (default 10).
+        :type fps: float
+
+        :param number_of_processes: Number of processes rendering the slices (default None: one per cpu).
+        :type number_of_processes: int
 
-        for i in xrange(0,number_of_slices):
+        """
+        if output_path is None:
+            output_path = "%s.gif" % (os.path.split(self.input_path)[-1])
+
+        # Get limits, common to all slices, in a first pass over the file.
+        xmin, xmax, ymin, ymax = self.__stream.limits
+        mn, mx = colorLimits((chunk for first, chunk in self.__stream.intensityChunks()), logscale=logscale)
+
+        renderer = FrameRenderer(mn, mx,
+                                 logscale=logscale,
+                                 extent=[xmin*1.e6, xmax*1.e6, ymax*1.e6, ymin*1.e6],
+                                 )
 
-            print "Processing slice #%d." % (i)
+        slices = (chunk[:,:,i] for first, chunk in self.__stream.intensityChunks() for i in range(chunk.shape[-1]))
+        renderer.animate(slices, output_path, fps=fps, number_of_processes=number_of_processes)
 
-            # Plot profile as 2D colorcoded map.
-            if logscale:
-                plt.imshow(intensity[:,:,i], norm=mpl.colors.LogNorm(vmin=mn, vmax=mx), extent=[xmin*1.e6, xmax*1.e6, ymax*1.e6, ymin*1.e6], cmap="viridis")
-            else:
-                plt.imshow(intensity[:,:,i], norm=mpl.colors.Normalize(vmin=mn, vmax=mx), extent=[xmin*1.e6, xmax*1.e6, ymax*1.e6, ymin*1.e6], cmap="viridis")
+    def intensityMap(self, qspace=False, number_of_processes=1):
+        """ Get the intensity integrated over time (or frequency) as function of x,y or qx, qy, without plotting.
+
+        :param qspace: Whether to return the reciprocal space intensity map (default False).
+        :type qspace: bool
+
+        :param number_of_processes: Number of processes reducing the time slices (default 1).
+        :type number_of_processes: int
+
+        :return: The intensity map, shape (ny, nx), and its limits (xmin, xmax, ymin, ymax) in m (rad for qspace).
+        :rtype: tuple (numpy.array, tuple)
+
+        """
+        if not qspace:
+            return self.__stream.intensityMap(number_of_processes)
 
-            plt.gca().set_aspect('equal', 'datalim')
-            plt.savefig("tmp/%s_%07d.png" % (inp_filename, i) )
-            plt.clf()
+        # Far field intensity from transforms of chunks of slices, without copying the wavefront.
+        intensity_map, angles_x, angles_y = self.__stream.angularIntensityMap(number_of_processes)
 
-        os.system("convert -delay 10 tmp/*.png %s.gif" % (inp_filename) )
-        shutil.rmtree("tmp")
+        return intensity_map, (angles_x[0], angles_x[-1], angles_y[0], angles_y[-1])
+
+    def totalPower(self, spectrum=False, number_of_processes=1):
+        """ Get the power integrated over the transverse dimensions, without plotting.
+
+        :param spectrum: Whether to return the spectral energy (True) or the power as function of time (False, default).
+        :type spectrum: bool
+
+        :param number_of_processes: Number of processes reducing disjoint parts of the wavefront (default 1).
+        :type number_of_processes: int
+
+        :return: Time (s) or photon energy (eV) of each slice and the power (W) or spectral energy (J/eV).
+        :rtype: tuple (numpy.array, numpy.array)
+
+        """
+        if spectrum:
+            return self.__stream.spectrum(number_of_processes)
+        return self.__stream.totalPower(number_of_processes)
 
-    def plotIntensityMap(self, qspace=False, logscale=False):
+    def onAxisPowerDensity(self, spectrum=False):
+        """ Get the power density on the beam axis, without plotting.
+
+        :param spectrum: Whether to return the spectral fluence (True) or the power density as function of time (False, default).
+        :type spectrum: bool
+
+        :return: Time (s) or photon energy (eV) of each slice and the power density (W/mm^2) or spectral fluence (J/eV/mm^2).
+        :rtype: tuple (numpy.array, numpy.array)
+
+        """
+        if spectrum:
+            return self.__stream.onAxisSpectrum()
+        return self.__stream.onAxisPowerDensity()
+
+    def plotIntensityMap(self, qspace=False, logscale=False, number_of_processes=1):
         """ Plot the integrated intensity as function of x,y or qx, qy on a colormap.
 
         :param qspace: Whether to plot the reciprocal space intensity map (default False).
@@ -127,35 +191,16 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         :param logscale: Whether to plot the intensity on a logarithmic scale (z-axis) (default False).
         :type logscale: bool
 
+        :param number_of_processes: Number of processes reducing the time slices (default 1).
+        :type number_of_processes: int
+
         """
 
         print "\n Plotting intensity map."
         # Setup new figure.
         plt.figure()
 
-        wf = self.wavefront
-        wf_intensity = self.intensity
-
-
-        # Switch to q-space if requested.
-        if qspace:
-            print "\n Switching to reciprocal space."
-            srwl_wf_a = copy.deepcopy(self.wavefront._srwl_wf)
-            wpg.srwlib.srwl.SetRepresElecField(srwl_wf_a, 'a')
-            wf = wpg.Wavefront(srwl_wf_a)
-            print " ... done."
-            wf_intensity = wf.get_intensity()
-            nans = mask_nans(wf_intensity)
-
-        # Get average and time slicing.
-        wf_intensity = wf_intensity.sum(axis=-1)
-
-        nslices = wf.params.Mesh.nSlices
-        if (nslices>1):
-            dt = (wf.params.Mesh.sliceMax-wf.params.Mesh.sliceMin)/(nslices-1)
-            t0 = dt*nslices/2 + wf.params.Mesh.sliceMin
-        else:
-            t0 = (wf.params.Mesh.sliceMax+wf.params.Mesh.sliceMin)/2
+        wf_intensity, (xmin, xmax, ymin, ymax) = self.intensityMap(qspace, number_of_processes)
 
         # Setup a figure.
         figure = plt.figure(figsize=(10, 10), dpi=100)
@@ -164,7 +209,6 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         profile = plt.subplot2grid((3, 3), (1, 0), colspan=2, rowspan=2)
 
         # Get limits.
-        xmin, xmax, ymax, ymin = wf.get_limits()
         mn, mx = wf_intensity.min(), wf_intensity.max()
 
         # Plot profile as 2D colorcoded map.
@@ -205,17 +249,15 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         # Set range according to input.
         profile.set_ylim([ymin*1.e6, ymax*1.e6])
 
-        # Cleanup.
-        if qspace:
-            del wf
-
-
-    def plotTotalPower(self, spectrum=False):
+    def plotTotalPower(self, spectrum=False, number_of_processes=1):
         """ Method to plot the total power.
 
         :param spectrum: Whether to plot the power density in energy domain (True) or time domain (False, default).
         :type spectrum: bool
 
+        :param number_of_processes: Number of processes reducing disjoint parts of the wavefront (default 1).
+        :type number_of_processes: int
+
         """
 
         """ Adapted from github:Samoylv/WPG/wpg/wpg_uti_wf.integral_intensity() """
@@ -223,41 +265,19 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         # Setup new figure.
         plt.figure()
 
-        # Switch to frequency (energy) domain if requested.
-        if spectrum:
-            print "\n Switching to frequency domain."
-            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 'f')
-            self.intensity = self.wavefront.get_intensity()
-
-        # Get dimensions.
-        mesh = self.wavefront.params.Mesh
-        dx = (mesh.xMax - mesh.xMin)/(mesh.nx - 1)
-        dy = (mesh.yMax - mesh.yMin)/(mesh.ny - 1)
-
-        # Get intensity by integrating over transverse dimensions.
-        int0 = self.intensity.sum(axis=(0,1))
-
-        # Scale to get unit W/mm^2
-        int0 = int0*(dx*dy*1.e6) #  amplitude units sqrt(W/mm^2)
-        int0max = int0.max()
-
-        # Get center pixel numbers.
-        center_nx = int(mesh.nx/2)
-        center_ny = int(mesh.ny/2)
+        xs, int0 = self.totalPower(spectrum, number_of_processes)
 
         # Get meaningful slices.
-        aw = [a[0] for a in numpy.argwhere(int0 > int0max*0.01)]
+        aw = _significantSlices(int0)
         int0_mean = int0[min(aw):max(aw)]  # meaningful range of pulse
-        dSlice = (mesh.sliceMax - mesh.sliceMin)/(mesh.nSlices - 1)
-        xs = numpy.arange(mesh.nSlices)*dSlice+ mesh.sliceMin
-        xs_mf = numpy.arange(min(aw), max(aw))*dSlice + mesh.sliceMin
-        if(self.wavefront.params.wDomain=='time'):
+        xs_mf = xs[min(aw):max(aw)]
+        if not spectrum:
             plt.plot(xs*1e15, int0) # time axis converted to fs.
             plt.plot(xs_mf*1e15, int0_mean, 'ro')
             plt.title('Power')
             plt.xlabel('time (fs)')
             plt.ylabel('Power (W)')
-            dt = (mesh.sliceMax - mesh.sliceMin)/(mesh.nSlices - 1)
+            dt = xs[1] - xs[0]
             print('Pulse energy {:1.2g} J'.format(int0_mean.sum()*dt))
 
         else: #frequency domain
@@ -267,10 +287,6 @@ class XFELPhotonAnalysis(AbstractAnalysis):
             plt.xlabel('eV')
             plt.ylabel('J/eV')
 
-            # Switch back to time domain.
-            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 't')
-            self.intensity = self.wavefront.get_intensity()
-
     def plotOnAxisPowerDensity(self, spectrum=False):
         """ Method to plot the on-axis power density.
 
@@ -284,40 +300,16 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         # Setup new figure.
         plt.figure()
 
-        # Switch to frequency (energy) domain if requested.
-        if spectrum:
-            wpg.srwlib.srwl.SetRepresElecField(wf._srwl_wf, 'f')
-            self.intensity = self.wavefront.get_intensity()
-
-        # Get dimensions.
-        mesh = self.wavefront.params.Mesh
-        dx = (mesh.xMax - mesh.xMin)/(mesh.nx - 1)
-        dy = (mesh.yMax - mesh.yMin)/(mesh.ny - 1)
-
-        # Get center pixel numbers.
-        center_nx = int(mesh.nx/2)
-        center_ny = int(mesh.ny/2)
-
-        # Get time slices of intensity.
-        intensity = self.intensity
-
-        # Get on-axis intensity.
-        int0_00 = intensity[center_ny, center_nx, :]
-        int0 = intensity.sum(axis=(0,1))*(dx*dy*1.e6) #  amplitude units sqrt(W/mm^2)
-        int0max = int0.max()
+        # On-axis power density, and total power for the meaningful slices.
+        xs, int0_00 = self.onAxisPowerDensity(spectrum)
+        int0 = self.totalPower(spectrum)[1]
 
         # Get meaningful slices.
-        aw = [a[0] for a in numpy.argwhere(int0 > int0max*0.01)]
-        if aw == []:
-            raise RuntimeError("No significant intensities found.")
-
-        dSlice = (mesh.sliceMax - mesh.sliceMin)/(mesh.nSlices - 1)
-
-        xs = numpy.arange(mesh.nSlices)*dSlice+ mesh.sliceMin
-        xs_mf = numpy.arange(min(aw), max(aw))*dSlice + mesh.sliceMin
+        aw = _significantSlices(int0)
+        xs_mf = xs[min(aw):max(aw)]
 
         # Plot.
-        if(self.wavefront.params.wDomain=='time'):
+        if not spectrum:
             plt.plot(xs*1e15,int0_00)
             plt.plot(xs_mf*1e15, int0_00[min(aw):max(aw)], 'ro')
             plt.title('On-Axis Power Density')
@@ -330,9 +322,14 @@ class XFELPhotonAnalysis(AbstractAnalysis):
             plt.xlabel('photon energy (eV)')
             plt.ylabel(r'fluence (J/eV/mm${}^{2}$)')
 
-            # Switch back to time domain.
-            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 't')
-            self.intensity = self.wavefront.get_intensity()
+def _significantSlices(power):
+    """ """
+    """ Indices of the slices holding more than 1% of the peak power. """
+    aw = [a[0] for a in numpy.argwhere(power > power.max()*0.01)]
+    if aw == []:
+        raise RuntimeError("No significant intensities found.")
+
+    return aw
 
 def mask_nans(a, replacement=0.0):
     """ Find nans in an array and replace.
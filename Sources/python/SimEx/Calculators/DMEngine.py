@@ -0,0 +1,398 @@
+""" Module that holds the in-process Difference Map (DM) phasing engine.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+import multiprocessing
+import numpy
+import scipy.ndimage
+
+# Shrinkwrap: Gaussian blur (in voxels) and threshold (relative to the maximum) of the averaged density.
+SHRINKWRAP_SIGMA = 1.0
+SHRINKWRAP_THRESHOLD = 0.1
+
+# Read-only data of the worker processes, set once per process by _initWorker.
+_WORKER_DATA = {}
+
+def modulusFromIntensities(intensities):
+    """
+    Fourier modulus constraint from a centered 3D intensity volume.
+
+    :param intensities: Intensities with q=0 at the center. Negative values mark unmeasured voxels.
+    :type intensities: numpy.array (3D)
+
+    :return: Moduli and mask of measured voxels in the layout of numpy.fft.rfftn.
+    :rtype: tuple (numpy.array, numpy.array (bool))
+    """
+    intensities = numpy.fft.ifftshift(numpy.asarray(intensities, dtype=float))
+    intensities = intensities[..., :intensities.shape[-1]//2+1]
+
+    known = intensities >= 0.
+    modulus = numpy.sqrt(numpy.where(known, intensities, 0.))
+
+    return modulus, known
+
+def supportFromPositions(positions, shape):
+    """
+    Convert a list of support voxels into a boolean volume.
+
+    :param positions: Voxel indices, one (i,j,k) per row.
+    :type positions: numpy.array, shape (n,3)
+
+    :param shape: Shape of the real space volume.
+    :type shape: tuple
+
+    :return: The support.
+    :rtype: numpy.array (bool)
+    """
+    support = numpy.zeros(shape, dtype=bool)
+    support[tuple(numpy.asarray(positions, dtype=int).T)] = True
+
+    return support
+
+def differenceMap(modulus, known, support, number_of_iterations, averaging_start, leash, seed=None):
+    """
+    Run one Difference Map trial from a random start.
+
+    The iterate x is updated as x + P_S(2 P_M(x) - x) - P_M(x) with the Fourier modulus projection P_M and the
+    projection P_S onto real, positive densities inside the support. After averaging_start iterations the
+    solution estimates P_S(...) are averaged and the iterate is pulled towards the running average by the
+    fraction 'leash' of their difference.
+
+    :param modulus: Fourier moduli (see modulusFromIntensities).
+    :type modulus: numpy.array
+
+    :param known: Mask of measured moduli.
+    :type known: numpy.array (bool)
+
+    :param support: The support.
+    :type support: numpy.array (bool, 3D)
+
+    :param number_of_iterations: Number of DM iterations.
+    :type number_of_iterations: int
+
+    :param averaging_start: Number of iterations before averaging starts.
+    :type averaging_start: int
+
+    :param leash: Strength of the pull towards the running average.
+    :type leash: float
+
+    :param seed: Seed of the random start.
+    :type seed: int
+
+    :return: The reconstruction (averaged estimate, or estimate of minimal error if averaging never started) and the error per iteration.
+    :rtype: tuple (numpy.array, numpy.array)
+    """
+    shape = support.shape
+    prng = numpy.random.RandomState(seed)
+    x = prng.rand(*shape) * support
+
+    errors = numpy.zeros(number_of_iterations)
+    min_error = numpy.inf
+    min_object = numpy.zeros(shape)
+    average = numpy.zeros(shape)
+    number_averaged = 0
+    ratio = numpy.ones(modulus.shape)
+
+    for iteration in range(number_of_iterations):
+        # Fourier modulus projection.
+        transform = numpy.fft.rfftn(x)
+        amplitude = numpy.abs(transform)
+        ratio.fill(1.)
+        numpy.divide(modulus, amplitude, out=ratio, where=known & (amplitude > 0.))
+        transform *= ratio
+        p_m = numpy.fft.irfftn(transform, s=shape)
+
+        # Support and positivity projection of the reflected iterate.
+        p_s = 2.*p_m - x
+        p_s[~support | (p_s < 0.)] = 0.
+
+        difference = p_s - p_m
+        x += difference
+
+        errors[iteration] = numpy.sqrt(numpy.sum(difference**2) / max(numpy.sum(p_s**2), numpy.finfo(float).tiny))
+        if errors[iteration] < min_error:
+            min_error = errors[iteration]
+            min_object[...] = p_s
+
+        if iteration >= averaging_start:
+            average += p_s
+            number_averaged += 1
+            if leash > 0.:
+                x += leash * (average/number_averaged - p_s)
+
+    if number_averaged > 0:
+        return average / number_averaged, errors
+
+    return min_object, errors
+
+def alignReconstruction(reference, reconstruction):
+    """
+    Align a reconstruction to a reference by translation and, if it fits better, inversion (twin image).
+
+    :param reference: The reference density.
+    :type reference: numpy.array (3D)
+
+    :param reconstruction: The density to align.
+    :type reconstruction: numpy.array (3D, same shape as reference)
+
+    :return: The aligned density.
+    :rtype: numpy.array
+    """
+    # Zero padding avoids wrap around of the cross correlation.
+    shape = tuple(2*s for s in reference.shape)
+    reference_transform = numpy.conj(numpy.fft.rfftn(reference, s=shape))
+
+    best = (-numpy.inf, None, None)
+    for candidate in [reconstruction, reconstruction[::-1,::-1,::-1]]:
+        correlation = numpy.fft.irfftn(numpy.fft.rfftn(candidate, s=shape) * reference_transform, s=shape)
+        peak = numpy.argmax(correlation)
+        if correlation.flat[peak] > best[0]:
+            best = (correlation.flat[peak], candidate, numpy.unravel_index(peak, shape))
+
+    (_, candidate, shift) = best
+
+    # Shift that maps the candidate onto the reference, cut back to the original box.
+    aligned = numpy.zeros(shape)
+    aligned[tuple(slice(0, s) for s in candidate.shape)] = candidate
+    # One axis at a time, rolling over several axes at once needs numpy >= 1.12.
+    for axis, s in enumerate(shift):
+        aligned = numpy.roll(aligned, -s, axis=axis)
+
+    return aligned[tuple(slice(0, s) for s in candidate.shape)]
+
+def shrinkwrapSupport(density, support, sigma=SHRINKWRAP_SIGMA, threshold=SHRINKWRAP_THRESHOLD):
+    """
+    Shrink the support to the voxels where the blurred density exceeds a fraction of its maximum.
+
+    :param density: The density.
+    :type density: numpy.array (3D)
+
+    :param support: The current support (same shape as density).
+    :type support: numpy.array (bool)
+
+    :param sigma: Width of the Gaussian blur in voxels.
+    :type sigma: float
+
+    :param threshold: Fraction of the maximum of the blurred density.
+    :type threshold: float
+
+    :return: The new support, a subset of the current one.
+    :rtype: numpy.array (bool)
+    """
+    blurred = scipy.ndimage.gaussian_filter(density, sigma)
+
+    return support & (blurred > threshold * blurred.max())
+
+def runTrials(intensities, support, number_of_trials, number_of_iterations, averaging_start, leash, number_of_processes=None, seed=None, box=None, pool=None):
+    """
+    Run independent Difference Map trials and rank them by their final error.
+
+    :param intensities: Intensities with q=0 at the center, negative values mark unmeasured voxels.
+    :type intensities: numpy.array (3D)
+
+    :param support: The support.
+    :type support: numpy.array (bool, same shape as intensities)
+
+    :param number_of_trials: Number of random starts.
+    :type number_of_trials: int
+
+    :param number_of_iterations: Number of DM iterations per trial.
+    :type number_of_iterations: int
+
+    :param averaging_start: Number of iterations before averaging starts.
+    :type averaging_start: int
+
+    :param leash: Strength of the pull towards the running average.
+    :type leash: float
+
+    :param number_of_processes: Number of worker processes.
+    :type number_of_processes: int, default None (number of cpus)
+
+    :param seed: Seed of the first trial, trial i uses seed+i.
+    :type seed: int, default None (random)
+
+    :param box: Region of the reconstructions to return.
+    :type box: tuple of slices, default None (bounding box of the support)
+
+    :param pool: Pool to run the trials on (created by phase). If given, intensities are taken from the pool's workers.
+    :type pool: multiprocessing.Pool
+
+    :return: Reconstructions cropped to the box (trials x box), error per trial and iteration, best trial first.
+    :rtype: dict
+    """
+    support = numpy.asarray(support, dtype=bool)
+    if box is None:
+        box = _boundingBox(support)
+
+    if seed is None:
+        seed = numpy.random.randint(0, 2**31 - number_of_trials)
+    tasks = [(support, number_of_iterations, averaging_start, leash, seed + trial, box) for trial in range(number_of_trials)]
+
+    if pool is not None:
+        results = pool.map(_runTrial, tasks)
+    else:
+        modulus, known = modulusFromIntensities(intensities)
+        results = _mapTrials(modulus, known, tasks, number_of_processes)
+
+    reconstructions = numpy.array([r[0] for r in results])
+    errors = numpy.array([r[1] for r in results])
+
+    order = numpy.argsort(errors[:,-1], kind='mergesort')
+
+    return {'reconstructions' : reconstructions[order],
+            'errors'          : errors[order],
+            'box'             : box,
+            }
+
+def phase(intensities, support, number_of_trials, number_of_iterations, averaging_start, leash, number_of_shrink_cycles, number_of_processes=None, seed=None):
+    """
+    Phase a 3D intensity volume with Difference Map trials and shrinkwrap cycles.
+
+    Each cycle runs all trials with the current support, aligns the reconstructions to the best one and averages
+    them. The averaged density determines the support of the next cycle (see shrinkwrapSupport).
+
+    :param intensities: Intensities with q=0 at the center, negative values mark unmeasured voxels.
+    :type intensities: numpy.array (3D)
+
+    :param support: The initial support.
+    :type support: numpy.array (bool, same shape as intensities)
+
+    :param number_of_trials: Number of random starts per cycle.
+    :type number_of_trials: int
+
+    :param number_of_iterations: Number of DM iterations per trial.
+    :type number_of_iterations: int
+
+    :param averaging_start: Number of iterations before averaging starts.
+    :type averaging_start: int
+
+    :param leash: Strength of the pull towards the running average.
+    :type leash: float
+
+    :param number_of_shrink_cycles: Number of cycles.
+    :type number_of_shrink_cycles: int
+
+    :param number_of_processes: Number of worker processes.
+    :type number_of_processes: int, default None (number of cpus)
+
+    :param seed: Seed of the random starts.
+    :type seed: int, default None (random)
+
+    :return: The averaged density of the last cycle ('electron_density'), the aligned reconstructions and errors of its trials
+             (best first), the final support and the support size of each cycle ('support_sizes'). Densities are cropped
+             to the bounding box of the initial support ('box').
+    :rtype: dict
+    """
+    support = numpy.asarray(support, dtype=bool)
+    modulus, known = modulusFromIntensities(intensities)
+
+    pool = None
+    if _numberOfProcesses(number_of_processes) > 1:
+        pool = multiprocessing.Pool(_numberOfProcesses(number_of_processes), initializer=_initWorker, initargs=(modulus, known))
+    else:
+        _initWorker(modulus, known)
+
+    try:
+        box = _boundingBox(support)
+        support_sizes = []
+        for cycle in range(number_of_shrink_cycles):
+            support_sizes.append(int(support.sum()))
+            cycle_seed = None if seed is None else seed + cycle*number_of_trials
+            results = runTrials(None, support, number_of_trials, number_of_iterations, averaging_start, leash,
+                                seed=cycle_seed, box=box, pool=pool if pool is not None else _SerialPool())
+
+            reconstructions = results['reconstructions']
+            for trial in range(1, len(reconstructions)):
+                reconstructions[trial] = alignReconstruction(reconstructions[0], reconstructions[trial])
+            density = numpy.mean(reconstructions, axis=0)
+
+            if cycle < number_of_shrink_cycles - 1:
+                cropped = shrinkwrapSupport(density, support[box])
+                support = numpy.zeros_like(support)
+                support[box] = cropped
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _WORKER_DATA.clear()
+
+    return {'electron_density' : density,
+            'reconstructions'  : reconstructions,
+            'errors'           : results['errors'],
+            'support'          : support,
+            'support_sizes'    : numpy.array(support_sizes),
+            'box'              : box,
+            }
+
+class _SerialPool(object):
+    """ """
+    """ Stand-in for multiprocessing.Pool running tasks in the calling process. """
+    def map(self, function, tasks):
+        return [function(task) for task in tasks]
+
+def _numberOfProcesses(number_of_processes):
+    """ """
+    """ Number of worker processes, default: number of cpus. """
+    if number_of_processes is None:
+        return multiprocessing.cpu_count()
+    return max(int(number_of_processes), 1)
+
+def _mapTrials(modulus, known, tasks, number_of_processes):
+    """ """
+    """ Run trial tasks on a temporary pool (or in process for a single process). """
+    number_of_processes = min(_numberOfProcesses(number_of_processes), len(tasks))
+    if number_of_processes <= 1:
+        _initWorker(modulus, known)
+        try:
+            return [_runTrial(task) for task in tasks]
+        finally:
+            _WORKER_DATA.clear()
+
+    pool = multiprocessing.Pool(number_of_processes, initializer=_initWorker, initargs=(modulus, known))
+    try:
+        return pool.map(_runTrial, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def _initWorker(modulus, known):
+    """ """
+    """ Store the read-only Fourier constraint in the worker process (inherited without copy on fork). """
+    _WORKER_DATA['modulus'] = modulus
+    _WORKER_DATA['known'] = known
+
+def _runTrial(task):
+    """ """
+    """ Run one trial in a worker process and crop the reconstruction. """
+    (support, number_of_iterations, averaging_start, leash, seed, box) = task
+    reconstruction, errors = differenceMap(_WORKER_DATA['modulus'], _WORKER_DATA['known'], support, number_of_iterations, averaging_start, leash, seed)
+
+    return reconstruction[box], errors
+
+def _boundingBox(support):
+    """ """
+    """ Slices of the bounding box of the support. """
+    positions = numpy.argwhere(support)
+    if len(positions) == 0:
+        raise ValueError("The support is empty.")
+    (low, high) = (positions.min(axis=0), positions.max(axis=0) + 1)
+
+    return tuple(slice(l, h) for l, h in zip(low, high))
@@ -20,17 +20,21 @@
 #                                                                        #
 ##########################################################################
 
+from distutils.spawn import find_executable
 import glob
 import h5py
 import numpy
 import os
 import re
+import scipy.ndimage
 import shutil
 import subprocess
 import tempfile
 
 from AbstractPhotonAnalyzer import AbstractPhotonAnalyzer
+from SimEx.Calculators import DMEngine
 from SimEx.Parameters.DMPhasingParameters import DMPhasingParameters
+from SimEx.Utilities import ReciprocalGrid
 from SimEx.Utilities.EntityChecks import checkAndSetInstance
 
 class DMPhasing(AbstractPhotonAnalyzer):
@@ -144,10 +148,13 @@ class DMPhasing(AbstractPhotonAnalyzer):
             intensity_tmp = os.path.join(run_instance_dir, "object_intensity.dat")
             output_file          = os.path.join(out_dir, "phase_out.h5")
 
-            #Read intensity and translate into ASCII *.dat format
+            use_binary = (self._engine() == "binary")
+
+            #Read intensity and translate into ASCII *.dat format (for the object_recon executable)
             (qmax, t_intens, intens_len, qPos, qPos_full) = _load_intensities(input_intensity_file)
             input_intens = t_intens
-            input_intens.tofile(intensity_tmp, sep=" ")
+            if use_binary:
+                input_intens.tofile(intensity_tmp, sep=" ")
 
             # Compute autocorrelation and support
             #print_to_log("Computing autocorrelation...")
@@ -157,7 +164,32 @@ class DMPhasing(AbstractPhotonAnalyzer):
             (a_0, a_1)  = _cluster_two_means(auto.ravel())
             #print_to_log("cluster averages: %lf %lf"%(a_0, a_1))
             #print_to_log("Determining support from autocorrelation (will write to support.dat by default)...")
-            support     = _support_from_autocorr(auto, qmax, a_0, a_1, support_file)
+            support     = _support_from_autocorr(auto, qmax, a_0, a_1, support_file, write=use_binary)
+
+            if not use_binary:
+                # In-process phasing, trials run concurrently on a process pool.
+                result = DMEngine.phase(t_intens, DMEngine.supportFromPositions(support, t_intens.shape),
+                                        number_of_trials, number_of_iterations, averaging_start, leash, number_of_shrink_cycles,
+                                        number_of_processes=self.parameters.number_of_processes)
+
+                fp          = h5py.File(output_file, "w")
+                g_data      = fp.create_group("data")
+                g_params    = fp.create_group("params")
+                g_err       = fp.create_group("/history/error")
+                g_hist_obj  = fp.create_group("/history/object")
+                # Trials are ranked, 0001 has the smallest final error.
+                for n, (err, obj) in enumerate(zip(result['errors'], result['reconstructions'])):
+                    g_err.create_dataset("%0.4d"%(n+1), data=err, compression="gzip")
+                    g_hist_obj.create_dataset("%0.4d"%(n+1), data=obj, compression="gzip")
+
+                g_data.create_dataset("electronDensity", data=result['electron_density'], compression="gzip")
+                self._write_parameters(g_params, support)
+                fp.create_dataset("/history/shrinkwrap", data=result['support_sizes'], compression="gzip")
+                fp.create_dataset("version", data=h5py.version.hdf5_version)
+                fp.close()
+
+                shutil.copy( output_file, os.path.join( cwd, self.output_path ) )
+                return 0
 
             #Start phasing
             #Store parameters into phase_out.h5.
@@ -202,12 +234,7 @@ class DMPhasing(AbstractPhotonAnalyzer):
             g_data.create_dataset("electronDensity", data=finish_object, compression="gzip")
             os.system("cp finish_object.dat start_object.dat")
 
-            g_params.create_dataset("DM_support",           data=support, compression="gzip")
-            g_params.create_dataset("DM_numTrials",         data=number_of_trials)
-            g_params.create_dataset("DM_numIterPerTrial",   data=number_of_iterations)
-            g_params.create_dataset("DM_startAvePerIter",   data=averaging_start)
-            g_params.create_dataset("DM_leashParameter",    data=leash)
-            g_params.create_dataset("DM_shrinkwrapCycles",  data=number_of_shrink_cycles)
+            self._write_parameters(g_params, support)
 
             shrinkWrap = _parse_shrinkwrap_log(shrinkWrapFile)
             fp.create_dataset("/history/shrinkwrap", data=shrinkWrap, compression="gzip")
@@ -223,6 +250,36 @@ class DMPhasing(AbstractPhotonAnalyzer):
             os.chdir(cwd)
             return 1
 
+    def _write_parameters(self, g_params, support):
+        """ """
+        """ Private method to store the support and the DM parameters in the output file.
+
+        :param g_params: The params group of the output file.
+        :type g_params: h5py.Group
+
+        :param support: The support voxels.
+        :type support: numpy.array
+        """
+        g_params.create_dataset("DM_support",           data=support, compression="gzip")
+        g_params.create_dataset("DM_numTrials",         data=self.parameters.number_of_trials)
+        g_params.create_dataset("DM_numIterPerTrial",   data=self.parameters.number_of_iterations)
+        g_params.create_dataset("DM_startAvePerIter",   data=self.parameters.averaging_start)
+        g_params.create_dataset("DM_leashParameter",    data=self.parameters.leash)
+        g_params.create_dataset("DM_shrinkwrapCycles",  data=self.parameters.number_of_shrink_cycles)
+
+    def _engine(self):
+        """ """
+        """ Private method to select the DM engine: the object_recon executable or the in-process numpy engine.
+
+        :return: "binary" or "numpy"
+        :rtype: str
+        """
+        engine = self.parameters.engine
+        if engine == "auto":
+            engine = "binary" if find_executable("object_recon") is not None else "numpy"
+
+        return engine
+
 def _load_intensities(ref_file):
     """ """
     """ Private function for loading 3D intensity maps from a file.
@@ -237,75 +294,134 @@ def _load_intensities(ref_file):
     intens_len = len(t_intens)
     qmax    = intens_len/2
     (q_low, q_high) = (15, int(0.9*qmax))
-    qRange1 = numpy.arange(-q_high, q_high + 1)
-    qRange2 = numpy.arange(-qmax, qmax + 1)
-    qPos0   = numpy.array([[i,j,0] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-    qPos1   = numpy.array([[i,0,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-    qPos2   = numpy.array([[0,i,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-    qPos    = numpy.concatenate((qPos0, qPos1, qPos2))
-    qPos_full = numpy.array([[i,j,k] for i in qRange2 for j in qRange2 for k in qRange2]).astype("float")
+    qPos    = ReciprocalGrid.planarSlicePositions(q_high, q_low)
+    qPos_full = ReciprocalGrid.coordinateGrid(qmax)
     return (qmax, t_intens, intens_len, qPos, qPos_full)
 
-def _zero_neg(x):
-    return 0. if x<=0. else x
+def _v_zero_neg(x):
+    """ """
+    """ Private function to clip negative values to zero.
 
-_v_zero_neg  = numpy.vectorize(_zero_neg)
+    :param x: The values.
+    :type x: numpy.array
+
+    :return: Copy of x with all non-positive values set to zero.
+    :rtype: numpy.array
+    """
+    return numpy.where(x <= 0., 0., x)
+
+def _find_two_means(sorted_vals, cumulative, v0, v1):
+    """ """
+    """ Private function for one assignment step of the two means clustering.
+
+    A value belongs to the cluster of v1 if it is closer to v1 than to v0, i.e. if it lies on v1's side of the
+    midpoint. On sorted values both clusters are contiguous, their sums follow from the cumulative sum.
+
+    :param sorted_vals: The values, sorted ascendingly.
+    :type sorted_vals: numpy.array
+
+    :param cumulative: Cumulative sum of sorted_vals.
+    :type cumulative: numpy.array
+
+    :param v0: Current mean of cluster 0.
+    :type v0: float
+
+    :param v1: Current mean of cluster 1.
+    :type v1: float
+
+    :return: The new cluster means.
+    :rtype: tuple
+    """
+    n = len(sorted_vals)
+    midpoint = 0.5*(v0 + v1)
+    if v0 < v1:
+        # Cluster 1: values above the midpoint.
+        split = numpy.searchsorted(sorted_vals, midpoint, side='right')
+        (n0, n1) = (split, n - split)
+        s0 = cumulative[split-1] if split > 0 else 0.
+        s1 = cumulative[-1] - s0
+    elif v0 > v1:
+        # Cluster 1: values below the midpoint.
+        split = numpy.searchsorted(sorted_vals, midpoint, side='left')
+        (n0, n1) = (n - split, split)
+        s1 = cumulative[split-1] if split > 0 else 0.
+        s0 = cumulative[-1] - s1
+    else:
+        (n0, n1) = (n, 0)
+        (s0, s1) = (cumulative[-1], 0.)
+
+    v0_t = s0 / n0 if n0 > 0 else 0.
+    v1_t = s1 / n1 if n1 > 0 else 0.
 
-def _find_two_means(vals, v0, v1):
-    v0_t    = 0.
-    v0_t_n  = 0.
-    v1_t    = 0.
-    v1_t_n  = 0.
-    for vv in vals:
-        if (numpy.abs(vv-v0) > abs(vv-v1)):
-            v1_t    += vv
-            v1_t_n  += 1.
-        else:
-            v0_t    += vv
-            v0_t_n  += 1.
-    if v0_t_n > 0.:
-        v0_t /= v0_t_n
-    if v1_t_n > 0.:
-        v1_t /= v1_t_n
     return (v0_t, v1_t)
 
 def _cluster_two_means(vals):
+    """ """
+    """ Private function to separate values into two clusters (background and signal) by 2-means clustering.
+
+    :param vals: The values to cluster.
+    :type vals: numpy.array
+
+    :return: The means of the two clusters.
+    :rtype: tuple
+    """
+    sorted_vals = numpy.sort(numpy.asarray(vals, dtype=float).ravel())
+    cumulative  = numpy.cumsum(sorted_vals)
+
     (v0,v1)     = (0.,0.1)
-    (v00, v11)  = _find_two_means(vals, v0, v1)
+    (v00, v11)  = _find_two_means(sorted_vals, cumulative, v0, v1)
     err = 0.5*(numpy.abs(v00-v0)+numpy.abs(v11-v1))
     while(err > 1.E-5):
-        (v00, v11)  = _find_two_means(vals, v0, v1)
+        (v00, v11)  = _find_two_means(sorted_vals, cumulative, v0, v1)
         err         = 0.5*(numpy.abs(v00-v0)+numpy.abs(v11-v1))
         (v0, v1)    = (v00, v11)
     return (v0, v1)
 
 def _support_from_autocorr(auto, qmax, thr_0, thr_1, supp_file, kl=1, write=True):
-    pos     = numpy.argwhere(numpy.abs(auto-thr_0) > numpy.abs(auto-thr_1))
-    pos_set = set()
-    pos_list= []
-    kerl    = range(-kl,kl+1)
-    ker     = [[i,j,k] for i in kerl for j in kerl for k in kerl]
+    """ """
+    """ Private function to determine the support of the object from its autocorrelation.
+
+    Voxels of the autocorrelation closer to the signal mean thr_1 than to the background mean thr_0 are dilated
+    by a cube of half width kl. The support is the dilated voxel set at half the resolution (one row per dilated voxel).
+
+    :param auto: The autocorrelation.
+    :type auto: numpy.array (3D)
+
+    :param qmax: Half length of the intensity volume.
+    :type qmax: int
+
+    :param thr_0: Background mean.
+    :type thr_0: float
 
-    def trun(v):
-        return int(numpy.ceil(0.5*v))
+    :param thr_1: Signal mean.
+    :type thr_1: float
 
-    v_trun = numpy.vectorize(trun)
+    :param supp_file: Path of the support file.
+    :type supp_file: str
+
+    :param kl: Half width of the dilation kernel.
+    :type kl: int, default 1
+
+    :param write: Whether to write the support file.
+    :type write: bool, default True
+
+    :return: The support voxels.
+    :rtype: numpy.array, shape (n,3)
+    """
+    significant = numpy.abs(auto-thr_0) > numpy.abs(auto-thr_1)
 
-    for (pi, pj, pk) in pos:
-        for (ci, cj, ck) in ker:
-            pos_set.add((pi+ci, pj+cj, pk+ck))
-    for s in pos_set:
-        pos_list.append([s[0], s[1], s[2]])
+    # Pad so that the dilation may extend beyond the volume.
+    significant = numpy.pad(significant, kl, mode='constant', constant_values=False)
+    dilated     = scipy.ndimage.binary_dilation(significant, structure=numpy.ones((2*kl+1,)*3, dtype=bool))
 
-    pos_array = numpy.array(pos_list)
-    pos_array -= [a.min() for a in pos_array.transpose()]
-    pos_array = numpy.array([v_trun(a) for a in pos_array])
+    pos_array = numpy.argwhere(dilated)
+    pos_array -= pos_array.min(axis=0)
+    pos_array = (pos_array + 1) // 2
 
     if write:
         fp  = open(supp_file, "w")
         fp.write("%d %d\n"%(qmax, len(pos_array)))
-        for p in pos_array:
-            fp.write("%d %d %d\n" % (p[0], p[1], p[2]))
+        numpy.savetxt(fp, pos_array, fmt="%d")
         fp.close()
 
     return pos_array
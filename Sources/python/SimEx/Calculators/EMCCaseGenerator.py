@@ -26,6 +26,9 @@ import os
 import sys
 import time
 
+from SimEx.Utilities import ReciprocalGrid
+from SimEx.Utilities import SparsePhotons
+
 def _print_to_log(msg, log_file=None):
     if not os.path.exists(log_file):
         fp = open(log_file, "w")
@@ -62,13 +65,8 @@ def load_intensities(ref_file):
             intens_len = len(t_intens)
             qmax    = intens_len/2
             (q_low, q_high) = (15, int(0.9*qmax))
-            qRange1 = numpy.arange(-q_high, q_high + 1)
-            qRange2 = numpy.arange(-qmax, qmax + 1)
-            qPos0   = numpy.array([[i,j,0] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-            qPos1   = numpy.array([[i,0,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-            qPos2   = numpy.array([[0,i,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-            qPos    = numpy.concatenate((qPos0, qPos1, qPos2))
-            qPos_full = numpy.array([[i,j,k] for i in qRange2 for j in qRange2 for k in qRange2]).astype("float")
+            qPos    = ReciprocalGrid.planarSlicePositions(q_high, q_low)
+            qPos_full = ReciprocalGrid.coordinateGrid(qmax)
 
             fp.close()
             return (qmax, t_intens, intens_len, qPos, qPos_full)
@@ -83,13 +81,8 @@ def load_intensities(ref_file):
             intens_len = t_intens.shape[1]
             qmax    = intens_len/2
             (q_low, q_high) = (15, int(0.9*qmax))
-            qRange1 = numpy.arange(-q_high, q_high + 1)
-            qRange2 = numpy.arange(-qmax, qmax + 1)
-            qPos0   = numpy.array([[i,j,0] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-            qPos1   = numpy.array([[i,0,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-            qPos2   = numpy.array([[0,i,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-            qPos    = numpy.concatenate((qPos0, qPos1, qPos2))
-            qPos_full = numpy.array([[i,j,k] for i in qRange2 for j in qRange2 for k in qRange2]).astype("float")
+            qPos    = ReciprocalGrid.planarSlicePositions(q_high, q_low)
+            qPos_full = ReciprocalGrid.coordinateGrid(qmax)
 
             fp.close()
             return (qmax, t_intens, intens_len, qPos, qPos_full)
@@ -152,6 +145,43 @@ def support_from_autocorr(auto, qmax, thr_0, thr_1, kl=1, write=True):
 
     return pos_array
 
+# Number of dense patterns converted to sparse format in one batch.
+SPARSE_CHUNK_SIZE = 256
+
+def sparse_photon_arrays(frames, pos):
+    """
+    Convert a stack of dense photon patterns to sparse patterns.
+
+    :param frames: Dense photon counts, one pattern per leading index.
+    :type frames: numpy.array, shape (n_patterns, ...)
+
+    :param pos: Running index of each detector pixel, -1 for disqualified pixels.
+    :type pos: numpy.array, shape (n_pixels,)
+
+    :return: The sparse patterns in the layout of SimEx.Utilities.SparsePhotons.
+    :rtype: dict
+    """
+    frames = numpy.asarray(frames)
+    number_of_frames = frames.shape[0]
+    qualified = pos >= 0
+    # Truncate to integer counts as int() would do on each pixel.
+    counts = frames.reshape(number_of_frames, -1)[:, qualified].astype(numpy.int64)
+    qualified_pos = pos[qualified]
+
+    frame_index, pixel_index = numpy.nonzero(counts > 0)
+    hits = counts[frame_index, pixel_index]
+    hit_pos = qualified_pos[pixel_index]
+    is_one = (hits == 1)
+
+    # Hits are ordered by pattern, so the per pattern offsets follow from a search.
+    patterns = numpy.arange(number_of_frames+1)
+    return {'ones_offsets' : numpy.searchsorted(frame_index[is_one], patterns),
+            'multi_offsets' : numpy.searchsorted(frame_index[~is_one], patterns),
+            'place_ones' : hit_pos[is_one],
+            'place_multi' : hit_pos[~is_one],
+            'count_multi' : hits[~is_one],
+            }
+
 
 ###############################################################
 # Convert photons into sparse format, split into multiple files
@@ -228,6 +258,56 @@ class EMCCaseGenerator(object):
 
         return v/vDenom - numpy.array([0,0,zL])
 
+    def placePixels(self, ii, jj, zL):
+        """
+        Vectorized version of placePixel for arrays of pixel indices.
+
+        :param ii: Pixel indices in x direction
+        :type ii: numpy.array
+
+        :param jj: Pixel indices in y direction
+        :type jj: numpy.array
+
+        :param zL: Distance of pixel from detector in units of detector size.
+        :type zL: float
+
+        :return: (qx,qy,qz) positions, one row per pixel.
+        :rtype: numpy.array, shape (n_pixels, 3)
+        """
+        ii = numpy.asarray(ii).ravel()
+        jj = numpy.asarray(jj).ravel()
+        v = numpy.empty((len(ii), 3), dtype=numpy.result_type(ii, jj, zL, float))
+        v[:,0] = ii
+        v[:,1] = jj
+        v[:,2] = zL
+        vDenom = numpy.sqrt(1 + (ii*ii + jj*jj)/(zL*zL))
+
+        v /= vDenom[:,numpy.newaxis]
+        v[:,2] -= zL
+
+        return v
+
+    def _enumerateDetectorPixels(self, zL):
+        """ """
+        """ Compute detector pixel positions and enumerate the qualified pixels.
+
+        :param zL: Distance of pixel from detector in units of detector size.
+        :type zL: float
+
+        :return: Pixel positions, running index of qualified pixels (-1 for disqualified ones) and the flat mask.
+        :rtype: tuple (numpy.array, numpy.array, numpy.array)
+        """
+        [x,y] = numpy.mgrid[-self.numPixToEdge:self.numPixToEdge+1, -self.numPixToEdge:self.numPixToEdge+1]
+        tmpQ = self.placePixels(x, y, zL)
+
+        qNorm = numpy.sqrt(numpy.sum(tmpQ*tmpQ, axis=1))
+        qualified = (qNorm < self.qmax) & (qNorm > self.qmin) & (numpy.abs(tmpQ[:,0]) > 3)
+
+        pos = numpy.where(qualified, numpy.cumsum(qualified) - 1, -1)
+        flatMask = qualified.astype(float)
+
+        return tmpQ, pos, flatMask
+
     def readGeomFromPhotonData(self, fn,thisProcess):
         """
         Extract detector geometry from S2E photon files.
@@ -258,16 +338,13 @@ class EMCCaseGenerator(object):
         self.qmax = int(2 * self.numPixToEdge * numpy.sin(0.5*maxScattAng) / numpy.tan(maxScattAng))
 
         #Write detector to file
-        [x,y] = numpy.mgrid[-self.numPixToEdge:self.numPixToEdge+1, -self.numPixToEdge:self.numPixToEdge+1]
-        tempDetectorPix = [self.placePixel(i,j,zL) for i,j in zip(x.flat, y.flat)]
-        qualifiedDetectorPix = [i for i in tempDetectorPix if (numpy.sqrt(i[0]*i[0] +i[1]*i[1] + i[2]*i[2])>self.qmin and numpy.sqrt(i[0]*i[0] +i[1]*i[1] + i[2]*i[2])<self.qmax and numpy.abs(i[0])>3)]
-        self.detector = numpy.array(qualifiedDetectorPix)
+        tempDetectorPix, pos, flatMask = self._enumerateDetectorPixels(zL)
+        self.detector = tempDetectorPix[pos >= 0]
 
         # qmin defaults to 2 pixel beamstop
         self.qmin = 2
         fQmin = numpy.floor(self.qmin)
-        [x,y,z] = numpy.mgrid[-fQmin:fQmin+1, -fQmin:fQmin+1, -fQmin:fQmin+1]
-        self.beamstop = numpy.array([[xx,yy,zz] for xx,yy,zz in zip(x.flat, y.flat, z.flat) if numpy.sqrt(xx*xx + yy*yy + zz*zz)<=self.qmin])
+        self.beamstop = ReciprocalGrid.spherePositions(fQmin, self.qmin, inclusive=True).astype(float)
 
     def readGeomFromDetectorFile(self, fn="detector.dat"):
         """
@@ -287,7 +364,7 @@ class EMCCaseGenerator(object):
 
         return
 
-    def writeSparsePhotonFile(self, fileList, outFN, outFNH5Avg,thisProcess,numProcesses):
+    def writeSparsePhotonFile(self, fileList, outFN, outFNH5Avg,thisProcess,numProcesses, chunk_size=SPARSE_CHUNK_SIZE, binary=False):
         """
         Convert dense S2E file format to sparse EMC photons.dat format.
 
@@ -299,12 +376,18 @@ class EMCCaseGenerator(object):
 
         :param outFNH5Avg: Filename for averaged photon file.
         :type outFNH5Avg: str
+
+        :param chunk_size: Number of patterns to convert in one batch.
+        :type chunk_size: int, default SPARSE_CHUNK_SIZE
+
+        :param binary: Write a binary sparse photon file (see SimEx.Utilities.SparsePhotons) instead of ASCII.
+        :type binary: bool, default False
         """
 
         # Check if we deal with v0.2 file.
         if len(fileList) == 1 and h5py.File(fileList[0], 'r')['version'].value == 0.2:
             if thisProcess==0:
-                self._writeSparsePhotonFileFromSingleH5(fileList[0], outFN, outFNH5Avg)
+                self._writeSparsePhotonFileFromSingleH5(fileList[0], outFN, outFNH5Avg, chunk_size, binary)
             return
 
         # Log: destination output to file
@@ -312,27 +395,14 @@ class EMCCaseGenerator(object):
             msg = "Writing diffr output to %s"%os.path.dirname(outFN)
             _print_to_log(msg, log_file=self.runLog)
 
-        # Define in-plane detector x,y coordinates
-        [x,y] = numpy.mgrid[-self.numPixToEdge:self.numPixToEdge+1, -self.numPixToEdge:self.numPixToEdge+1]
-
-        # Compute qx,qy,qz positions of detector
+        # Compute qx,qy,qz positions of detector and enumerate qualified
+        # detector pixels with a running index.
         zL = self.detectorDist / self.pixSize
-        tmpQ = numpy.array([self.placePixel(i,j,zL) for i,j in zip(x.flat, y.flat)])
-
-        # Enumerate qualified detector pixels with a running index, currPos
-        pos = -1 + 0*x.flatten()
-        currPos = 0
-        flatMask = 0.*pos
-        for p,v in enumerate(tmpQ):
-            if numpy.sqrt(v[0]*v[0] +v[1]*v[1] + v[2]*v[2])<self.qmax and numpy.sqrt(v[0]*v[0] +v[1]*v[1] + v[2]*v[2])>self.qmin and numpy.abs(v[0])>3:
-                    pos[p] = currPos
-                    flatMask[p] = 1.
-                    currPos += 1
-
-        outf = open(outFN, "w")
+        tmpQ, pos, flatMask = self._enumerateDetectorPixels(zL)
+
+        meanPhoton = 0.
         if thisProcess==0:
             # Compute mean photon count.
-            meanPhoton = 0.
             totPhoton = 0.
             count=0 # counts the processed images. Loop breaks if count goes above 200.
             for fn in fileList:
@@ -360,8 +430,13 @@ class EMCCaseGenerator(object):
             # Start stepping through diffraction images and writing them to sparse format
             msg = "Average intensities: %lf"%(totPhoton)
             _print_to_log(msg, log_file=self.runLog)
-            outf.write("%d %lf \n"%(len(fileList), meanPhoton))
 
+        if binary:
+            outf = SparsePhotons.SparsePhotonWriter(outFN, num_pix=numpy.count_nonzero(pos >= 0), mean_photon=meanPhoton)
+        else:
+            outf = open(outFN, "w")
+            if thisProcess==0:
+                outf.write(SparsePhotons.asciiHeader(len(fileList), meanPhoton))
 
         mask = flatMask.reshape(2*self.numPixToEdge+1, -1)
         avg = 0.*mask
@@ -370,73 +445,32 @@ class EMCCaseGenerator(object):
             msg = "Converting individual data frames to sparse format %s"%("."*20)
             _print_to_log(msg, log_file=self.runLog)
 
+        translated = 0
+        frames = []
         for n,fn in enumerate(fileList):
             if n % numProcesses != thisProcess:
                 continue
-            #try:
-            if True:
-                f = h5py.File(fn, 'r')
-                data_format_version = (f["version"].value).astype("float")
-                if data_format_version < 0.2:
-                    v = f["data/data"].value
-                    avg += v
-                    temp = {"o":[], "m":[]}
-
-                    for p,vv in zip(pos, v.flat):
-                        # Todo: remove this
-                        vv = int(vv)
-                        if (p < 0) or (vv==0):
-                            pass
-                        else:
-                            if vv == 1:
-                                temp["o"].append(p)
-                            if vv > 1:
-                                temp["m"].append([p,vv])
-
-                    [num_o, num_m] = [len(temp["o"]), len(temp["m"])]
-                    strNumO = str(num_o)
-                    ssO = ' '.join([str(i) for i in temp["o"]])
-                    strNumM = str(num_m)
-                    ssM = ' '.join(["%d %d "%(i[0], i[1]) for i in temp["m"]])
-                    outf.write(' '.join([strNumO, ssO, strNumM, ssM]) + "\n")
-                    f.close()
-
-                else:
-                    tasks = f["data"].keys()
-                    for task in tasks:
-                        v = f["data"][task]["data"].value
-#                        print "In %s/%s/data, found max. %f and avg %f photons." % (fn, task, v.max(), v.mean())
-                        avg += v
-                        temp = {"o":[], "m":[]}
-
-                        for p,vv in zip(pos, v.flat):
-                            # Todo: remove this
-                            vv = int(vv)
-                            if (p < 0) or (vv==0):
-                                pass
-                            else:
-                                if vv == 1:
-                                    temp["o"].append(p)
-                                if vv > 1:
-                                    temp["m"].append([p,vv])
-
-                        [num_o, num_m] = [len(temp["o"]), len(temp["m"])]
-                        strNumO = str(num_o)
-                        ssO = ' '.join([str(i) for i in temp["o"]])
-                        strNumM = str(num_m)
-                        ssM = ' '.join(["%d %d "%(i[0], i[1]) for i in temp["m"]])
-                        outf.write(' '.join([strNumO, ssO, strNumM, ssM]) + "\n")
-                    f.close()
-
-            #except:
+            f = h5py.File(fn, 'r')
+            data_format_version = (f["version"].value).astype("float")
+            if data_format_version < 0.2:
+                frames.append(f["data/data"].value)
             else:
-                msg = "Failed to read file #%d %s." % (n, fn)
-                _print_to_log(msg, log_file=self.runLog)
+                for task in f["data"].keys():
+                    frames.append(f["data"][task]["data"].value)
+            f.close()
 
-            if n%10 == 0:
-                msg = "Translated %d patterns"%n
+            # Convert in chunks to keep the memory footprint bounded.
+            if len(frames) >= chunk_size:
+                translated += self._writeSparseChunk(outf, frames, pos, avg)
+                frames = []
+                msg = "Translated %d patterns"%translated
                 _print_to_log(msg, log_file=self.runLog)
 
+        if len(frames) > 0:
+            translated += self._writeSparseChunk(outf, frames, pos, avg)
+            msg = "Translated %d patterns"%translated
+            _print_to_log(msg, log_file=self.runLog)
+
         outf.close()
 
         # Write average photon and mask patterns to file
@@ -446,7 +480,7 @@ class EMCCaseGenerator(object):
             outh5.create_dataset("mask", data=mask, compression="gzip", compression_opts=9)
         outh5.close()
 
-    def _writeSparsePhotonFileFromSingleH5(self, dense_file, outFN, outFNH5Avg):
+    def _writeSparsePhotonFileFromSingleH5(self, dense_file, outFN, outFNH5Avg, chunk_size=SPARSE_CHUNK_SIZE, binary=False):
         """
         Convert dense S2E file format to sparse EMC photons.dat format.
 
@@ -458,28 +492,22 @@ class EMCCaseGenerator(object):
 
         :param outFNH5Avg: Filename for averaged photon file.
         :type outFNH5Avg: str
+
+        :param chunk_size: Number of patterns to convert in one batch.
+        :type chunk_size: int, default SPARSE_CHUNK_SIZE
+
+        :param binary: Write a binary sparse photon file (see SimEx.Utilities.SparsePhotons) instead of ASCII.
+        :type binary: bool, default False
         """
 
         # Log: destination output to file
         msg = "Writing diffr output to %s"%outFN
         _print_to_log(msg, log_file=self.runLog)
 
-        # Define in-plane detector x,y coordinates
-        [x,y] = numpy.mgrid[-self.numPixToEdge:self.numPixToEdge+1, -self.numPixToEdge:self.numPixToEdge+1]
-
-        # Compute qx,qy,qz positions of detector
+        # Compute qx,qy,qz positions of detector and enumerate qualified
+        # detector pixels with a running index.
         zL = self.detectorDist / self.pixSize
-        tmpQ = numpy.array([self.placePixel(i,j,zL) for i,j in zip(x.flat, y.flat)])
-
-        # Enumerate qualified detector pixels with a running index, currPos
-        pos = -1 + 0*x.flatten()
-        currPos = 0
-        flatMask = 0.*pos
-        for p,v in enumerate(tmpQ):
-            if numpy.sqrt(v[0]*v[0] +v[1]*v[1] + v[2]*v[2])<self.qmax and numpy.sqrt(v[0]*v[0] +v[1]*v[1] + v[2]*v[2])>self.qmin and numpy.abs(v[0])>3:
-                    pos[p] = currPos
-                    flatMask[p] = 1.
-                    currPos += 1
+        tmpQ, pos, flatMask = self._enumerateDetectorPixels(zL)
 
         # Compute mean photon count from the first 200 diffraction images
         # (or total number of images, whichever is smaller)
@@ -490,8 +518,6 @@ class EMCCaseGenerator(object):
         meanPhoton = 0.
         totPhoton = 0.
 
-        # Open dense file.
-        h5_dense = h5py.File( dense_file, 'r')
         excluded_keys = ["version", "params", "info"]
         all_keys = h5_dense.keys()
         relevant_keys = [k for k in all_keys if not k in excluded_keys]
@@ -507,45 +533,32 @@ class EMCCaseGenerator(object):
         # Start stepping through diffraction images and writing them to sparse format
         msg = "Average intensities: %lf"%(totPhoton)
         _print_to_log(msg, log_file=self.runLog)
-        outf = open(outFN, "w")
-        outf.write("%d %lf \n"%(number_of_patterns, meanPhoton))
+        if binary:
+            outf = SparsePhotons.SparsePhotonWriter(outFN, num_pix=numpy.count_nonzero(pos >= 0), mean_photon=meanPhoton)
+        else:
+            outf = open(outFN, "w")
+            outf.write(SparsePhotons.asciiHeader(number_of_patterns, meanPhoton))
         mask = flatMask.reshape(2*self.numPixToEdge+1, -1)
         avg = 0.*mask
 
         msg = "Converting individual data frames to sparse format %s"%("."*20)
         _print_to_log(msg, log_file=self.runLog)
 
-        for n,fn in enumerate(h5_dense.keys()):
-            try:
-                f = h5_dense[fn]
-                v = f["data/data"].value
-                avg += v
-                temp = {"o":[], "m":[]}
-
-                for p,vv in zip(pos, v.flat):
-                    # Todo: remove this
-                    vv = int(vv)
-                    if (p < 0) or (vv==0):
-                        pass
-                    else:
-                        if vv == 1:
-                            temp["o"].append(p)
-                        if vv > 1:
-                            temp["m"].append([p,vv])
-
-                [num_o, num_m] = [len(temp["o"]), len(temp["m"])]
-                strNumO = str(num_o)
-                ssO = ' '.join([str(i) for i in temp["o"]])
-                strNumM = str(num_m)
-                ssM = ' '.join(["%d %d "%(i[0], i[1]) for i in temp["m"]])
-                outf.write(' '.join([strNumO, ssO, strNumM, ssM]) + "\n")
-            except:
-                msg = "Failed to read pattern #%d %s." % (n, fn)
-                _print_to_log(msg, log_file=self.runLog)
-
-            if n%10 == 0:
-                msg = "Translated %d patterns"%n
-                _print_to_log(msg, log_file=self.runLog)
+        translated = 0
+        for start in range(0, len(relevant_keys), chunk_size):
+            frames = []
+            for n,fn in enumerate(relevant_keys[start:start+chunk_size]):
+                try:
+                    frames.append(h5_dense[fn]["data/data"].value)
+                except:
+                    msg = "Failed to read pattern #%d %s." % (start+n, fn)
+                    _print_to_log(msg, log_file=self.runLog)
+
+            # Convert in chunks to keep the memory footprint bounded.
+            if len(frames) > 0:
+                translated += self._writeSparseChunk(outf, frames, pos, avg)
+            msg = "Translated %d patterns"%translated
+            _print_to_log(msg, log_file=self.runLog)
 
         h5_dense.close()
         outf.close()
@@ -557,6 +570,106 @@ class EMCCaseGenerator(object):
         outh5.close()
 
 
+    def listPatterns(self, fileList):
+        """
+        List all diffraction patterns in S2E photon files.
+
+        :param fileList: List of files holding the patterns.
+        :type fileList: List of str.
+
+        :return: (file, dataset) pairs, one per pattern, in the order in which they are converted.
+        :rtype: list of tuple
+        """
+
+        # Single v0.2 file: one group per pattern.
+        if len(fileList) == 1:
+            with h5py.File(fileList[0], 'r') as f:
+                if f['version'].value == 0.2:
+                    keys = [k for k in f.keys() if not k in ["version", "params", "info"]]
+                    keys.sort()
+                    return [(fileList[0], "%s/data/data" % k) for k in keys]
+
+        patterns = []
+        for fn in fileList:
+            with h5py.File(fn, 'r') as f:
+                data_format_version = (f["version"].value).astype("float")
+                if data_format_version < 0.2:
+                    patterns.append((fn, "data/data"))
+                else:
+                    patterns += [(fn, "data/%s/data" % task) for task in f["data"].keys()]
+
+        return patterns
+
+    def convertPatterns(self, patterns, writer, chunk_size=SPARSE_CHUNK_SIZE):
+        """
+        Convert dense patterns to sparse format.
+
+        :param patterns: (file, dataset) pairs of the patterns to convert (see listPatterns).
+        :type patterns: list of tuple
+
+        :param writer: Destination of the sparse patterns.
+        :type writer: SparsePhotons.SparsePhotonWriter or SparsePhotons.SparsePhotonBuffer
+
+        :param chunk_size: Number of patterns to convert in one batch.
+        :type chunk_size: int, default SPARSE_CHUNK_SIZE
+
+        :return: Sum of all converted patterns and detector mask.
+        :rtype: tuple (numpy.array, numpy.array)
+        """
+
+        zL = self.detectorDist / self.pixSize
+        tmpQ, pos, flatMask = self._enumerateDetectorPixels(zL)
+        mask = flatMask.reshape(2*self.numPixToEdge+1, -1)
+        avg = 0.*mask
+
+        f = None
+        open_file = None
+        for start in range(0, len(patterns), chunk_size):
+            frames = []
+            for fn, dataset in patterns[start:start+chunk_size]:
+                # Consecutive patterns mostly share a file, open it only once.
+                if fn != open_file:
+                    if f is not None:
+                        f.close()
+                    f = h5py.File(fn, 'r')
+                    open_file = fn
+                frames.append(f[dataset].value)
+
+            self._writeSparseChunk(writer, frames, pos, avg)
+
+        if f is not None:
+            f.close()
+
+        return avg, mask
+
+    def _writeSparseChunk(self, outf, frames, pos, avg):
+        """ """
+        """ Write a chunk of dense patterns to the sparse photon file and accumulate their sum.
+
+        :param outf: Open sparse photon file.
+        :type outf: file, SparsePhotons.SparsePhotonWriter or SparsePhotons.SparsePhotonBuffer
+
+        :param frames: Dense photon patterns.
+        :type frames: list of numpy.array
+
+        :param pos: Running index of each detector pixel, -1 for disqualified pixels.
+        :type pos: numpy.array
+
+        :param avg: Accumulated photon pattern, updated in place.
+        :type avg: numpy.array
+
+        :return: Number of patterns written.
+        :rtype: int
+        """
+        frames = numpy.asarray(frames)
+        avg += frames.sum(axis=0)
+        if isinstance(outf, (SparsePhotons.SparsePhotonWriter, SparsePhotons.SparsePhotonBuffer)):
+            outf.append(sparse_photon_arrays(frames, pos))
+        else:
+            outf.writelines(SparsePhotons.toASCIILines(sparse_photon_arrays(frames, pos)))
+
+        return len(frames)
+
     def showDetector(self):
         """
         Shows detector pixels as points on scatter plot; could be slow for large detectors.
@@ -593,9 +706,8 @@ class EMCCaseGenerator(object):
 
         self.radius = int(numpy.floor(self.particleRadius) + numpy.floor(self.pad))
         self.size = 2*self.radius + 1
-        [x,y,z] = numpy.mgrid[-self.radius:self.radius+1, -self.radius:self.radius+1, -self.radius:self.radius+1]
-        self.support = numpy.sqrt(x*x + y*y + z*z) < self.particleRadius
-        filter = numpy.fft.ifftshift(numpy.exp(-self.damping * (x*x + y*y + z*z) / (self.radius*self.radius)))
+        self.support = ReciprocalGrid.sphericalMask(self.radius, self.particleRadius)
+        filter = numpy.fft.ifftshift(numpy.exp(-self.damping * ReciprocalGrid.radiusGrid(self.radius)**2 / (self.radius*self.radius)))
         suppRad = numpy.floor(self.radius)
         flatSupport = self.support.flatten()
 
@@ -619,8 +731,7 @@ class EMCCaseGenerator(object):
         self.density = iter.reshape(self.size, self.size, self.size)
 
         #Create padded support
-        paddedSupport = numpy.sqrt(x*x + y*y + z*z) < (self.particleRadius + self.pad)
-        self.supportPositions = numpy.array([[self.radius+i,self.radius+j,self.radius+k] for i,j,k,l in zip(x.flat, y.flat, z.flat, paddedSupport.flat) if l >0]).astype(int)
+        self.supportPositions = ReciprocalGrid.spherePositions(self.radius, self.particleRadius + self.pad, centered=False)
 
     def createTestScatteringGeometry(self):
         """
@@ -654,12 +765,10 @@ class EMCCaseGenerator(object):
 
         #make beamstop
         fQmin = numpy.floor(self.qmin)
-        [x,y,z] = numpy.mgrid[-fQmin:fQmin+1, -fQmin:fQmin+1, -fQmin:fQmin+1]
         if op.beamstop:
-            tempBeamstop = [[i,j,k] for i,j,k in zip(x.flat, y.flat, z.flat) if (numpy.sqrt(i*i + j*j + k*k) < (self.qmin - numpy.sqrt(3.)))]
+            self.beamstop = ReciprocalGrid.spherePositions(fQmin, self.qmin - numpy.sqrt(3.))
         else:
-            tempBeamstop = [[0,0,0]]
-        self.beamstop = numpy.array(tempBeamstop).astype(int)
+            self.beamstop = numpy.array([[0,0,0]])
 
     def diffractTestCase(self, inMaxScattAngDeg=45., inSigma=6.0, inQminNumShannonPix=1.4302966531242025):
         """
@@ -0,0 +1,325 @@
+""" Module that holds the EMCEngine class, an in-process implementation of the Expand-Maximize-Compress (EMC) algorithm.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+import numpy
+import scipy.sparse
+
+def quaternionsToRotations(quaternions):
+    """
+    Compute rotation matrices from unit quaternions (convention of the EMC code).
+
+    :param quaternions: Quaternions (q0, q1, q2, q3), one per row. Further columns are ignored.
+    :type quaternions: numpy.array, shape (n, >=4)
+
+    :return: The rotation matrices.
+    :rtype: numpy.array, shape (n, 3, 3)
+    """
+
+    q0, q1, q2, q3 = numpy.asarray(quaternions, dtype=float)[:,:4].T
+
+    rot = numpy.empty((len(q0), 3, 3))
+    rot[:,0,0] = 1. - 2.*(q2*q2 + q3*q3)
+    rot[:,0,1] = 2.*(q1*q2 + q0*q3)
+    rot[:,0,2] = 2.*(q1*q3 - q0*q2)
+    rot[:,1,0] = 2.*(q1*q2 - q0*q3)
+    rot[:,1,1] = 1. - 2.*(q1*q1 + q3*q3)
+    rot[:,1,2] = 2.*(q0*q1 + q2*q3)
+    rot[:,2,0] = 2.*(q0*q2 + q1*q3)
+    rot[:,2,1] = 2.*(q2*q3 - q0*q1)
+    rot[:,2,2] = 1. - 2.*(q1*q1 + q2*q2)
+
+    return rot
+
+def readQuaternionFile(path):
+    """
+    Read an EMC quaternion file (number of quaternions, then one "q0 q1 q2 q3 weight" line per quaternion).
+
+    :param path: Path to the quaternion file.
+    :type path: str
+
+    :return: Quaternions and weights.
+    :rtype: tuple (numpy.array, shape (n,4), numpy.array, shape (n,))
+    """
+
+    data = numpy.loadtxt(path, skiprows=1, ndmin=2)
+
+    return data[:,:4], data[:,4]
+
+def sparsePhotonMatrix(sparse, start, stop, num_pix):
+    """
+    Assemble patterns of a sparse photon container into a sparse (patterns x pixels) count matrix.
+
+    :param sparse: The sparse patterns (see SimEx.Utilities.SparsePhotons).
+    :type sparse: dict
+
+    :param start: Index of the first pattern.
+    :type start: int
+
+    :param stop: Index after the last pattern.
+    :type stop: int
+
+    :param num_pix: Number of detector pixels.
+    :type num_pix: int
+
+    :return: The photon counts.
+    :rtype: scipy.sparse.csr_matrix
+    """
+
+    ones_offsets = numpy.asarray(sparse['ones_offsets'][start:stop+1])
+    multi_offsets = numpy.asarray(sparse['multi_offsets'][start:stop+1])
+    patterns = numpy.arange(stop-start)
+
+    rows = numpy.concatenate((numpy.repeat(patterns, numpy.diff(ones_offsets)),
+                              numpy.repeat(patterns, numpy.diff(multi_offsets))))
+    cols = numpy.concatenate((sparse['place_ones'][ones_offsets[0]:ones_offsets[-1]],
+                              sparse['place_multi'][multi_offsets[0]:multi_offsets[-1]]))
+    counts = numpy.concatenate((numpy.ones(ones_offsets[-1]-ones_offsets[0]),
+                                sparse['count_multi'][multi_offsets[0]:multi_offsets[-1]]))
+
+    return scipy.sparse.csr_matrix((counts.astype(float), (rows, cols)), shape=(stop-start, num_pix))
+
+class EMCEngine(object):
+    """
+    Class representing an in-process EMC reconstruction. The model, the photon data and the rotations stay in memory
+    across iterations. If an MPI communicator is given, each process handles a contiguous chunk of patterns and
+    the compressed model is summed over all processes.
+    """
+
+    def __init__(self, detector, qmax, photons, quaternions, weights=None, comm=None, rotation_block=64, seed=None):
+        """
+        :param detector: (qx, qy, qz) positions of the detector pixels in voxel units (as in detector.dat).
+        :type detector: numpy.array, shape (num_pix, 3)
+
+        :param qmax: Half length of the cubic intensity model.
+        :type qmax: int
+
+        :param photons: The sparse patterns (as returned by SimEx.Utilities.SparsePhotons.readSparsePhotons).
+        :type photons: dict
+
+        :param quaternions: The rotation set.
+        :type quaternions: numpy.array, shape (num_rot, 4)
+
+        :param weights: Weights of the rotations.
+        :type weights: numpy.array, default None (uniform)
+
+        :param comm: Communicator to distribute the patterns over.
+        :type comm: mpi4py.MPI.Comm, default None (single process)
+
+        :param rotation_block: Number of rotations expanded at once (limits the memory footprint).
+        :type rotation_block: int, default 64
+
+        :param seed: Seed for the random initial model.
+        :type seed: int, default None
+        """
+
+        self.__detector = numpy.asarray(detector, dtype=float)
+        self.__qmax = int(qmax)
+        self.__size = 2*self.__qmax + 1
+        self.__comm = comm
+        self.__rotation_block = int(rotation_block)
+
+        # Contiguous chunk of patterns handled by this process.
+        rank, size = (0, 1) if comm is None else (comm.rank, comm.size)
+        self.__num_data = int(photons['num_data'])
+        first = rank * self.__num_data // size
+        last = (rank+1) * self.__num_data // size
+        self.__photons = sparsePhotonMatrix(photons, first, last, len(self.__detector))
+
+        self.setQuaternions(quaternions, weights)
+
+        # Random initial model around the mean photon count per pixel.
+        mean_count = numpy.array([self.__photons.sum(), self.__photons.shape[0]], dtype=float)
+        self.__allreduce(mean_count)
+        mean_count = mean_count[0] / max(mean_count[1] * len(self.__detector), 1.)
+        intensities = None
+        if rank == 0:
+            prng = numpy.random.RandomState(seed)
+            intensities = mean_count * (1. + prng.rand(self.__size, self.__size, self.__size))
+        self.intensities = self.__bcast(intensities)
+
+        self.__mutual_info = None
+        self.__most_likely_orientations = None
+
+    def __allreduce(self, buf):
+        """ """
+        """ Sum a float array over all processes in place (buffer based, no pickling). """
+        if self.__comm is None:
+            return
+        from mpi4py import MPI
+        self.__comm.Allreduce(MPI.IN_PLACE, buf, op=MPI.SUM)
+
+    def __bcast(self, value):
+        if self.__comm is None:
+            return value
+        return self.__comm.bcast(value, root=0)
+
+    def __allgather(self, value):
+        if self.__comm is None:
+            return value
+        return numpy.concatenate(self.__comm.allgather(value))
+
+    @property
+    def intensities(self):
+        """ Query for the intensity model. """
+        return self.__intensities
+    @intensities.setter
+    def intensities(self, value):
+        """ Set the intensity model, e.g. to continue a previous reconstruction. """
+        value = numpy.asarray(value, dtype=float)
+        if value.shape != (self.__size,)*3:
+            raise ValueError( "Intensities must have shape (%d, %d, %d)." % ((self.__size,)*3) )
+        self.__intensities = value.copy()
+
+    @property
+    def mutual_info(self):
+        """ Query for the mutual information between each pattern and the rotations in the last iteration. """
+        return self.__mutual_info
+
+    @property
+    def most_likely_orientations(self):
+        """ Query for the most likely quaternion of each pattern in the last iteration. """
+        return self.__most_likely_orientations
+
+    def setQuaternions(self, quaternions, weights=None):
+        """
+        Set the rotation set, e.g. for the next refinement level.
+
+        :param quaternions: The rotation set.
+        :type quaternions: numpy.array, shape (num_rot, 4)
+
+        :param weights: Weights of the rotations.
+        :type weights: numpy.array, default None (uniform)
+        """
+
+        self.__quaternions = numpy.asarray(quaternions, dtype=float)[:,:4]
+        self.__rotations = quaternionsToRotations(self.__quaternions)
+        if weights is None:
+            weights = numpy.ones(len(self.__quaternions))
+        weights = numpy.asarray(weights, dtype=float)
+        self.__weights = weights / weights.sum()
+
+    def _interpolation(self, rotations):
+        """ """
+        """ Voxel indices and weights of the trilinear interpolation at the rotated detector pixels.
+
+        :return: Voxel indices and weights (rotations x pixels x 8).
+        """
+
+        size = self.__size
+        positions = numpy.einsum('rij,tj->rti', rotations, self.__detector) + self.__qmax
+        positions = numpy.clip(positions, 0., size - 1. - 1.e-9)
+        lower = numpy.floor(positions).astype(numpy.int64)
+        fraction = positions - lower
+
+        indices = numpy.empty(lower.shape[:2] + (8,), dtype=numpy.int64)
+        weights = numpy.empty(lower.shape[:2] + (8,))
+        for c, (dx, dy, dz) in enumerate([(dx,dy,dz) for dx in (0,1) for dy in (0,1) for dz in (0,1)]):
+            indices[...,c] = ((lower[...,0]+dx)*size + lower[...,1]+dy)*size + lower[...,2]+dz
+            weights[...,c] = (numpy.abs(1-dx-fraction[...,0]) *
+                              numpy.abs(1-dy-fraction[...,1]) *
+                              numpy.abs(1-dz-fraction[...,2]))
+
+        return indices, weights
+
+    def _expand(self, rotations):
+        """ """
+        """ Interpolate the model at the rotated detector pixels (trilinear).
+
+        :return: Expanded model (rotations x pixels), and voxel indices and weights of the interpolation (rotations x pixels x 8).
+        """
+
+        indices, weights = self._interpolation(rotations)
+        expanded = numpy.sum(self.__intensities.ravel()[indices] * weights, axis=2)
+
+        return expanded, indices, weights
+
+    def _logLikelihood(self, expanded):
+        """ """
+        """ Poisson log-likelihood of the local patterns for each expanded rotation (patterns x rotations). """
+        log_expanded = numpy.log(numpy.maximum(expanded, 1.e-30))
+        return numpy.asarray(self.__photons.dot(log_expanded.T)) - expanded.sum(axis=1)
+
+    def iterate(self):
+        """
+        Perform one EMC iteration.
+
+        :return: The rms change of the intensity model.
+        :rtype: float
+        """
+
+        num_local = self.__photons.shape[0]
+        blocks = [slice(b, b+self.__rotation_block) for b in range(0, len(self.__rotations), self.__rotation_block)]
+        log_weights = numpy.log(self.__weights)
+
+        # Maximize, first pass: normalization of the rotation probabilities (streamed log-sum-exp) and most likely rotation.
+        # The log-likelihoods of the local patterns (patterns x rotations) are kept for the second pass.
+        log_max = numpy.full(num_local, -numpy.inf)
+        sum_exp = numpy.zeros(num_local)
+        best = numpy.zeros(num_local, dtype=numpy.int64)
+        log_likelihoods = []
+        for block in blocks:
+            log_likelihoods.append(self._logLikelihood(self._expand(self.__rotations[block])[0]))
+            log_p = log_likelihoods[-1] + log_weights[block]
+            block_max = log_p.max(axis=1)
+            new_max = numpy.maximum(log_max, block_max)
+            sum_exp = sum_exp*numpy.exp(log_max - new_max) + numpy.exp(log_p - new_max[:,numpy.newaxis]).sum(axis=1)
+            best = numpy.where(block_max > log_max, block.start + log_p.argmax(axis=1), best)
+            log_max = new_max
+        log_norm = log_max + numpy.log(sum_exp)
+
+        # Second pass: rotation probabilities, compress and merge into the 3D model.
+        # Photon counts and normalization of a block are summed over the processes in one preallocated buffer.
+        num_pix = len(self.__detector)
+        reduce_buffer = numpy.empty((self.__rotation_block, num_pix+1))
+        tomogram = numpy.zeros(self.__size**3)
+        tomogram_weights = numpy.zeros(self.__size**3)
+        mutual_info = -log_norm
+        for block, log_likelihood in zip(blocks, log_likelihoods):
+            indices, weights = self._interpolation(self.__rotations[block])
+            probabilities = numpy.exp(log_likelihood + log_weights[block] - log_norm[:,numpy.newaxis])
+            mutual_info += numpy.sum(probabilities * log_likelihood, axis=1)
+
+            # Probability weighted mean photon counts for each rotation.
+            summed = reduce_buffer[:probabilities.shape[1]]
+            summed[:,:num_pix] = numpy.asarray(self.__photons.T.dot(probabilities)).T
+            summed[:,num_pix] = probabilities.sum(axis=0)
+            self.__allreduce(summed)
+            counts, norm = summed[:,:num_pix], summed[:,num_pix]
+            has_data = norm > 0.
+            compressed = counts / numpy.where(has_data, norm, 1.)[:,numpy.newaxis]
+
+            merge_weights = weights * (self.__weights[block] * has_data)[:,numpy.newaxis,numpy.newaxis]
+            tomogram += numpy.bincount(indices.ravel(), weights=(merge_weights * compressed[:,:,numpy.newaxis]).ravel(), minlength=self.__size**3)
+            tomogram_weights += numpy.bincount(indices.ravel(), weights=merge_weights.ravel(), minlength=self.__size**3)
+
+        # Voxels not covered by any rotated pixel keep their value.
+        old_intensities = self.__intensities
+        intensities = numpy.where(tomogram_weights > 0., tomogram / numpy.where(tomogram_weights > 0., tomogram_weights, 1.), old_intensities.ravel())
+        intensities = intensities.reshape(old_intensities.shape)
+
+        # Friedel symmetry.
+        self.__intensities = 0.5*(intensities + intensities[::-1,::-1,::-1])
+
+        self.__mutual_info = self.__allgather(mutual_info)
+        self.__most_likely_orientations = self.__allgather(self.__quaternions[best])
+
+        return numpy.sqrt(numpy.mean((self.__intensities - old_intensities)**2))
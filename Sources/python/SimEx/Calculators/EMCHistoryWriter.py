@@ -0,0 +1,228 @@
+""" Module that holds the EMCHistoryWriter class, a background writer for the iteration history of EMCOrientation.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+import h5py
+import numpy
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class EMCHistoryWriter(object):
+    """
+    Class representing a background writer for the EMC iteration history. Each iteration's state is copied
+    and queued, the compression and the write to the hdf5 file happen in a separate thread while the next iteration runs.
+
+    :note: h5py 2.x holds the global interpreter lock while writing and compressing. The write overlaps with
+        iterations of the EMC executable (the main thread waits for the subprocess), but hardly with iterations of
+        the in-process numpy engine. Use compression "lzf" or "none" there if writing the history is slow.
+    """
+
+    def __init__(self, path, compression="gzip", compression_level=4, history_depth=None, max_pending=2):
+        """
+        :param path: Path of the output file. It must contain the groups 'data' and 'history/*'.
+        :type path: str
+
+        :param compression: Compression filter for the intensities and orientations ("gzip", "lzf" or "none").
+        :type compression: str, default "gzip"
+
+        :param compression_level: Compression level for gzip.
+        :type compression_level: int, default 4
+
+        :param history_depth: Number of most recent snapshots of intensities, orientations and mutual information to keep.
+        :type history_depth: int, default None (keep all)
+
+        :param max_pending: Maximum number of queued iterations, writing blocks if the writer falls behind further.
+        :type max_pending: int, default 2
+        """
+
+        self.__path = path
+        self.__compression = None if compression == "none" else compression
+        self.__compression_opts = compression_level if compression == "gzip" else None
+        self.__history_depth = history_depth
+
+        self.__error = None
+        self.__queue = queue.Queue(maxsize=max_pending)
+        # A thread, not a process: the snapshots are handed over without copying through a pipe (see note above).
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, iteration, intensities, error, angle, mutual_info, quaternion, time_taken, detailed_output=True):
+        """
+        Queue the state of one iteration for writing.
+
+        :param iteration: The iteration number (used as dataset name).
+        :type iteration: int
+
+        :param intensities: The intensity model after this iteration.
+        :type intensities: numpy.array
+
+        :param error: The rms change of the intensities.
+        :type error: float
+
+        :param angle: The most likely orientations.
+        :type angle: numpy.array
+
+        :param mutual_info: The mutual information.
+        :type mutual_info: numpy.array
+
+        :param quaternion: The quaternion refinement level.
+        :type quaternion: int
+
+        :param time_taken: Duration of the iteration.
+        :type time_taken: float
+
+        :param detailed_output: Whether to store the intensities in the history.
+        :type detailed_output: bool, default True
+
+        :raises IOError: If writing a previous iteration failed.
+        """
+        self.__raiseOnError()
+
+        # Snapshot: the caller may modify its arrays in the next iteration.
+        snapshot = {'iteration'       : int(iteration),
+                    'intensities'     : numpy.array(intensities, copy=True),
+                    'error'           : error,
+                    'angle'           : numpy.array(angle, copy=True),
+                    'mutual_info'     : numpy.array(mutual_info, copy=True),
+                    'quaternion'      : quaternion,
+                    'time'            : time_taken,
+                    'detailed_output' : detailed_output,
+                    }
+        self.__queue.put(snapshot)
+
+    def flush(self):
+        """
+        Wait until all queued iterations are written.
+
+        :raises IOError: If writing failed.
+        """
+        self.__queue.join()
+        self.__raiseOnError()
+
+    def close(self):
+        """
+        Write all queued iterations, close the output file and stop the writer thread.
+
+        :raises IOError: If writing failed.
+        """
+        if self.__thread.is_alive():
+            self.__queue.put(None)
+            self.__thread.join()
+        self.__raiseOnError()
+
+    def __raiseOnError(self):
+        """ """
+        """ Private method to forward an error of the writer thread. """
+        if self.__error is not None:
+            raise IOError("Writing the EMC history to %s failed: %s" % (self.__path, self.__error))
+
+    def __run(self):
+        """ """
+        """ Private method running in the writer thread. """
+        h5 = None
+        while True:
+            snapshot = self.__queue.get()
+            try:
+                if snapshot is None:
+                    if h5 is not None:
+                        h5.close()
+                    return
+
+                # After an error, only drain the queue.
+                if self.__error is None:
+                    if h5 is None:
+                        h5 = h5py.File(self.__path, "a")
+                    self.__write(h5, snapshot)
+                    h5.flush()
+            except Exception as e:
+                self.__error = e
+            finally:
+                self.__queue.task_done()
+
+    def __write(self, h5, snapshot):
+        """ """
+        """ Private method to write one snapshot to the open output file. """
+        name = "%04d" % (snapshot['iteration'])
+
+        if snapshot['detailed_output']:
+            self.__createSnapshot(h5["history/intensities"], name, snapshot['intensities'])
+        self.__replaceDataset(h5, "data/data", snapshot['intensities'])
+
+        h5["history/error"].create_dataset(name, data=snapshot['error'])
+
+        self.__createSnapshot(h5["history/angle"], name, snapshot['angle'])
+        self.__replaceDataset(h5, "data/angle", snapshot['angle'])
+
+        self.__createSnapshot(h5["history/mutual_info"], name, snapshot['mutual_info'], compress=False)
+        h5["history/quaternion"].create_dataset(name, data=snapshot['quaternion'])
+        h5["history/time"].create_dataset(name, data=snapshot['time'])
+
+    def __createSnapshot(self, group, name, data, compress=True):
+        """ """
+        """ Private method to create a snapshot dataset (intensities, angle, mutual_info), subject to the history depth. Once the depth is reached,
+        the dataset of the oldest snapshot is renamed and overwritten, deleted datasets would not free space in the file. """
+        if self.__history_depth is not None:
+            keys = sorted(group.keys(), key=int)
+            while len(keys) > self.__history_depth:
+                del group[keys.pop(0)]
+            if len(keys) == self.__history_depth:
+                oldest = group[keys[0]]
+                data = numpy.asarray(data)
+                if oldest.shape == data.shape and oldest.dtype == data.dtype:
+                    group.move(keys[0], name)
+                    group[name][...] = data
+                    return
+                del group[keys[0]]
+
+        if compress:
+            self.__createDataset(group, name, data)
+        else:
+            group.create_dataset(name, data=data)
+
+    def __createDataset(self, group, name, data):
+        """ """
+        """ Private method to create a (compressed if applicable) dataset. """
+        data = numpy.asarray(data)
+        if data.ndim == 0 or data.size == 0:
+            return group.create_dataset(name, data=data)
+        return group.create_dataset(name, data=data, compression=self.__compression, compression_opts=self.__compression_opts)
+
+    def __replaceDataset(self, h5, name, data):
+        """ """
+        """ Private method to overwrite a dataset, or create it if it does not exist yet or changed shape. """
+        if name in h5:
+            dataset = h5[name]
+            if dataset.shape == numpy.shape(data):
+                dataset[...] = data
+                return
+            del h5[name]
+        self.__createDataset(h5, name, data)
@@ -20,18 +20,25 @@
 #                                                                        #
 ##########################################################################
 
+from distutils.spawn import find_executable
 import h5py
+import hashlib
 import numpy
 import os
+import shutil
 import subprocess,shlex
 import tempfile
 import time
 
 from EMCCaseGenerator import  EMCCaseGenerator, _print_to_log
+from EMCEngine import EMCEngine
+from EMCHistoryWriter import EMCHistoryWriter
 from SimEx.Calculators.AbstractPhotonAnalyzer import AbstractPhotonAnalyzer
 from SimEx.Parameters.EMCOrientationParameters import EMCOrientationParameters
 from SimEx.Utilities import IOUtilities
 from SimEx.Utilities import ParallelUtilities
+from SimEx.Utilities import QuaternionGrid
+from SimEx.Utilities import SparsePhotons
 from SimEx.Utilities.EntityChecks import checkAndSetInstance
 
 class EMCOrientation(AbstractPhotonAnalyzer):
@@ -182,10 +189,11 @@ class EMCOrientation(AbstractPhotonAnalyzer):
             run_instance_dir = self.run_files_path
 
         self._sparsePhotonFile    = os.path.join(tmp_out_dir, "photons.dat")
+        self._sparsePhotonBinaryFile = os.path.join(tmp_out_dir, "photons.bin")
         self._detectorFile        = os.path.join(tmp_out_dir, "detector.dat")
         self._outputLog           = os.path.join(run_instance_dir, "EMC_extended.log")
         self._avgPatternFile      = os.path.join(tmp_out_dir, "avg_photon.h5")
-        self._lockFile            = os.path.join(tmp_out_dir, "write.lock")
+        self._photonKeyFile       = os.path.join(tmp_out_dir, "photons.key")
 
         self._run_instance_dir = run_instance_dir
         self._tmp_out_dir = tmp_out_dir
@@ -242,88 +250,125 @@ class EMCOrientation(AbstractPhotonAnalyzer):
         # Return the return code from the backengine.
         return proc.returncode
 
-    def _need_prepare_photon_files(self,thisProcess):
-        ###############################################################
-        # A lock file is created if subprocess is converting sparse photons
-        #   so that another subprocess does not clobber an ongoing conversion.
-        # Make photons.dat and detector.dat if they don't exist.
-        # Create time-tagged output subdirectory for intermediate states.
-        ###############################################################
+    def _photon_files(self):
+        """ """
+        """ Private method to list the input photon files. """
+        if os.path.isdir(self.input_path):
+            photonFiles         = [ os.path.join(self.input_path, pf) for pf in os.listdir( self.input_path ) ]
+            photonFiles.sort()
+        elif os.path.isfile(self.input_path):
+            photonFiles = [self.input_path]
+        else:
+            raise IOError( " Input file %s not found." % self.input_path )
 
-        while (os.path.isfile(self._lockFile)):
-            # Sleep in 30 s intervals, then check if sparse photon lock has been released.
-            sleep_duration = 30
-            msg = "Lock file in " + self._tmp_out_dir + ". "
-            msg += "Photons.dat likely being written to tmpDir by another programm. "
-            msg += "Sleeping this programm for %d s." % sleep_duration
-            if thisProcess == 0:
-                _print_to_log(msg, log_file=self._outputLog)
-            time.sleep(sleep_duration)
+        return photonFiles
 
-        return not (os.path.isfile(self._sparsePhotonFile) and os.path.isfile(self._detectorFile))
+    def _photon_files_key(self, comm, photonFiles):
+        """ """
+        """ Private method to compute the key of the input photon files from their names, sizes and modification times.
 
-    def _join_photon_files(self,numProcesses):
+        :return: Hex digest identifying the sparse photon files prepared from the input (on all processes).
+        :rtype: str
+        """
+        key = None
+        if comm.rank == 0:
+            key = hashlib.sha1(("sparse photons v%d\n" % SparsePhotons.SPARSE_PHOTON_VERSION).encode())
+            for fname in photonFiles:
+                stat = os.stat(fname)
+                key.update(("%s %d %r\n" % (os.path.basename(fname), stat.st_size, stat.st_mtime)).encode())
+            key = key.hexdigest()
 
-        outf = open(self._sparsePhotonFile, "w")
+        return comm.bcast(key, root=0)
 
-        for n in range(0,numProcesses):
-            fname=self._sparsePhotonFile + "_"+str(n)
-            with open(fname) as infile:
-                    for line in infile:
-                        outf.write(line)
-            os.system("rm %s " % fname)
-        outf.close()
+    def _need_prepare_photon_files(self, comm, photonFiles):
+        ###############################################################
+        # Make photons.bin and detector.dat unless they exist and were
+        # prepared from the same input (same file stamps).
+        # All outputs are written under temporary names and renamed,
+        # a concurrent run on the same tmp dir never sees partial files.
+        ###############################################################
 
-        outh5 = h5py.File(self._avgPatternFile, 'w')
-        for n in range(0,numProcesses):
-            fname=self._avgPatternFile + "_"+str(n)
-            f = h5py.File(fname, 'r')
-            if n == 0:
-                mask = f["mask"].value
-                avg = f["average"].value
-            else:
-                avg += f["average"].value
-            os.system("rm %s " % fname)
+        self._photonKey = self._photon_files_key(comm, photonFiles)
 
-        outh5.create_dataset("average", data=avg, compression="gzip", compression_opts=9)
-        outh5.create_dataset("mask", data=mask, compression="gzip", compression_opts=9)
-        outh5.close()
+        need_prepare = None
+        if comm.rank == 0:
+            prepared_files = [self._sparsePhotonBinaryFile, self._detectorFile, self._photonKeyFile]
+            need_prepare = not all([os.path.isfile(fname) for fname in prepared_files])
+            if not need_prepare:
+                with open(self._photonKeyFile, 'r') as fp:
+                    need_prepare = (fp.read().strip() != self._photonKey)
 
+        return comm.bcast(need_prepare, root=0)
 
-    def _prepare_photon_files(self,comm):
+    def _prepare_photon_files(self, comm, photonFiles):
         thisProcess = comm.rank
         numProcesses = comm.size
 
-        # Prepare for reading input.
-        if os.path.isdir(self.input_path):
-            photonFiles         = [ os.path.join(self.input_path, pf) for pf in os.listdir( self.input_path ) ]
-            photonFiles.sort()
-        elif os.path.isfile(self.input_path):
-            photonFiles = [self.input_path]
-        else:
-            raise IOError( " Input file %s not found." % self.input_path )
-
         gen = EMCCaseGenerator(self._outputLog)
         gen.readGeomFromPhotonData(photonFiles[0],thisProcess)
 
         if thisProcess == 0:
-            os.system("touch %s" % self._lockFile)
-            gen.writeDetectorToFile(filename=self._detectorFile)
+            gen.writeDetectorToFile(filename=self._detectorFile + ".tmp")
+            patterns = gen.listPatterns(photonFiles)
+            # Remove the key first, a stale photons.dat is never mistaken for the new input.
+            for fname in [self._photonKeyFile, self._sparsePhotonFile]:
+                if os.path.isfile(fname):
+                    os.remove(fname)
+        else:
+            patterns = None
+        patterns = comm.bcast(patterns, root=0)
+
+        # Each process converts a contiguous range of patterns, the sparse patterns are much smaller than the dense input.
+        first = thisProcess * len(patterns) // numProcesses
+        last = (thisProcess+1) * len(patterns) // numProcesses
+        buf = SparsePhotons.SparsePhotonBuffer()
+        avg, mask = gen.convertPatterns(patterns[first:last], buf)
+
+        # Offsets of every process' region in the joined file.
+        sizes = numpy.array(comm.allgather((buf.num_data, buf.num_ones, buf.num_multi)))
+        starts = numpy.cumsum(sizes, axis=0) - sizes
+        totals = sizes.sum(axis=0)
+        avg = comm.reduce(avg, root=0)
+
+        tmp_file = self._sparsePhotonBinaryFile + ".tmp"
+        if thisProcess == 0:
+            meanPhoton = avg.sum() / (1.*max(totals[0], 1)*avg.size)
+            _print_to_log("Found %f mean photons per pixel in %d patterns." % (meanPhoton, totals[0]), log_file=self._outputLog)
+            SparsePhotons.allocateSparsePhotonFile(tmp_file, totals[0], len(gen.detector), totals[1], totals[2], mean_photon=meanPhoton)
+        comm.Barrier()
 
-        gen.writeSparsePhotonFile(photonFiles, self._sparsePhotonFile+ "_"+str(thisProcess),
-                                               self._avgPatternFile + "_"+str(thisProcess),
-                                               thisProcess,numProcesses)
+        # Each process writes its range straight into the shared file.
+        SparsePhotons.writeSparsePhotonRegion(tmp_file, buf.sparse(), *starts[thisProcess])
+        del buf
         comm.Barrier()
 
         if thisProcess == 0:
-            self._join_photon_files(numProcesses)
+            os.rename(tmp_file, self._sparsePhotonBinaryFile)
+            os.rename(self._detectorFile + ".tmp", self._detectorFile)
+
+            outh5 = h5py.File(self._avgPatternFile + ".tmp", 'w')
+            outh5.create_dataset("average", data=avg, compression="gzip", compression_opts=9)
+            outh5.create_dataset("mask", data=mask, compression="gzip", compression_opts=9)
+            outh5.close()
+            os.rename(self._avgPatternFile + ".tmp", self._avgPatternFile)
+
+            # Written last, marks the prepared files as complete.
+            with open(self._photonKeyFile, 'w') as fp:
+                fp.write(self._photonKey)
+
+            _print_to_log(msg="Sparse photons file created.", log_file=self._outputLog)
 
         comm.Barrier()
 
-        if thisProcess == 0:
-            _print_to_log(msg="Sparse photons file created. Deleting lock file now", log_file=self._outputLog)
-            #        _print_to_log(msg="Detector parameters: %d %d %d"%(gen.qmax, len(gen.detector), len(gen.beamstop)), log_file=self._outputLog)
-            os.system("rm %s " % self._lockFile)
+    def _prepare_ascii_photon_file(self):
+        """ """
+        """ Private method to write photons.dat for the EMC executable, which reads the ASCII format, unless it exists. """
+
+        if os.path.isfile(self._sparsePhotonFile):
+            return
+
+        SparsePhotons.writeASCII(SparsePhotons.readSparsePhotons(self._sparsePhotonBinaryFile), self._sparsePhotonFile + ".tmp")
+        os.rename(self._sparsePhotonFile + ".tmp", self._sparsePhotonFile)
 
     def _run(self):
 
@@ -342,20 +387,24 @@ class EMCOrientation(AbstractPhotonAnalyzer):
         comm = MPI.COMM_WORLD
         thisProcess = comm.rank
 
-        if self._need_prepare_photon_files(thisProcess):
+        photonFiles = self._photon_files()
+        if self._need_prepare_photon_files(comm, photonFiles):
             if thisProcess == 0:
-                msg = "Photons.dat and detector.dat not found in " + self._tmp_out_dir + ". Will create them now..."
+                msg = "Photons.dat and detector.dat for this input not found in " + self._tmp_out_dir + ". Will create them now..."
                 _print_to_log(msg=msg, log_file=self._outputLog)
-            self._prepare_photon_files(comm)
+            self._prepare_photon_files(comm, photonFiles)
         else:
             if thisProcess == 0:
-                msg = "Photons.dat and detector.dat already exists in " + self._tmp_out_dir + "."
+                msg = "Photons.dat and detector.dat for this input already exist in " + self._tmp_out_dir + "."
                 _print_to_log(msg=msg, log_file=self._outputLog)
 
-# the rest is non-parallel (yet)
-        if thisProcess != 0:
+# the rest is non-parallel (yet) for the EMC executable, the numpy engine runs on all processes.
+        use_binary = (self._engine() == "binary")
+        if use_binary and thisProcess != 0:
             MPI.Finalize()
             return 0
+        if use_binary:
+            self._prepare_ascii_photon_file()
 
         ###############################################################
         # Instantiate a reconstruction object
@@ -368,17 +417,19 @@ class EMCOrientation(AbstractPhotonAnalyzer):
         beamstop = self.parameters.beamstop
         detailed_output = self.parameters.detailed_output
 
-        quaternion_dir      = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'CalculatorUtilities', 'quaternions')
+        # Rotation samplings are generated per refinement level and cached next to the photon files.
+        quaternion_cache    = os.path.join(self._tmp_out_dir, 'quaternions')
 
         gen = EMCCaseGenerator(self._outputLog)
         gen.readGeomFromDetectorFile(self._detectorFile)
-        _print_to_log(msg="Detector parameters: %d %d %d"%(gen.qmax, len(gen.detector),len(gen.beamstop)), log_file=self._outputLog)
 
+        if thisProcess == 0:
+            _print_to_log(msg="Detector parameters: %d %d %d"%(gen.qmax, len(gen.detector),len(gen.beamstop)), log_file=self._outputLog)
 
-        if not (os.path.isfile(os.path.join(self._run_instance_dir,"detector.dat"))):
-            os.symlink(os.path.join(self._tmp_out_dir,"detector.dat"), os.path.join(self._run_instance_dir,"detector.dat"))
-        if not (os.path.isfile(os.path.join(self._run_instance_dir,"photons.dat"))):
-            os.symlink(os.path.join(self._tmp_out_dir,"photons.dat"), os.path.join(self._run_instance_dir,"photons.dat"))
+            if not (os.path.isfile(os.path.join(self._run_instance_dir,"detector.dat"))):
+                os.symlink(os.path.join(self._tmp_out_dir,"detector.dat"), os.path.join(self._run_instance_dir,"detector.dat"))
+            if use_binary and not (os.path.isfile(os.path.join(self._run_instance_dir,"photons.dat"))):
+                os.symlink(os.path.join(self._tmp_out_dir,"photons.dat"), os.path.join(self._run_instance_dir,"photons.dat"))
 
         ###############################################################
         # Create dummy destination h5 for intermediate output from EMC
@@ -388,7 +439,8 @@ class EMCOrientation(AbstractPhotonAnalyzer):
         #Output file is kept in tmpOutDir.
         outFile = self.output_path
         offset_iter = 0
-        if not (os.path.isfile(outFile)):
+        start_intensities = None
+        if thisProcess == 0 and not (os.path.isfile(outFile)):
             f = h5py.File(outFile, "w")
             f.create_group("data")
             f.create_group("misc")
@@ -411,9 +463,12 @@ class EMCOrientation(AbstractPhotonAnalyzer):
 
             f.create_dataset("version", data=h5py.version.hdf5_version)
             f.close()
-        else:
+        elif thisProcess == 0:
             f = h5py.File(outFile, 'r')
-            offset_iter = len(f["/history/intensities"].keys())
+            offset_iter = len(f["/history/error"].keys())
+            # Continue from the last model.
+            if "data/data" in f:
+                start_intensities = f["data/data"].value
             f.close()
             msg = "Output will be appended to the results of %d iterations before this."%offset_iter
             _print_to_log(msg=msg, log_file=self._outputLog)
@@ -425,103 +480,140 @@ class EMCOrientation(AbstractPhotonAnalyzer):
         iter_num = 1
         currQuat = initial_number_of_quaternions
 
+        history_writer = None
         try:
+            if thisProcess == 0:
+                history_writer = EMCHistoryWriter(outFile,
+                                                  compression=self.parameters.history_compression,
+                                                  compression_level=self.parameters.history_compression_level,
+                                                  history_depth=self.parameters.history_depth)
+
+            emc_engine = None
+            if not use_binary:
+                quaternions, weights = QuaternionGrid.generateQuaternions(currQuat, cache_dir=quaternion_cache)
+                emc_engine = EMCEngine(gen.detector, gen.qmax,
+                                       SparsePhotons.readSparsePhotons(self._sparsePhotonBinaryFile),
+                                       quaternions, weights, comm=comm)
+                start_intensities = comm.bcast(start_intensities, root=0)
+                if start_intensities is not None:
+                    emc_engine.intensities = start_intensities
+
             while(currQuat <= max_number_of_quaternions):
-                if os.path.isfile(os.path.join(self._run_instance_dir,"quaternion.dat")):
-                    os.remove(os.path.join(self._run_instance_dir,"quaternion.dat"))
-                os.symlink(os.path.join(quaternion_dir ,"quaternion"+str(currQuat)+".dat"), os.path.join(self._run_instance_dir,"quaternion.dat"))
+                quaternions, weights = QuaternionGrid.generateQuaternions(currQuat, cache_dir=quaternion_cache)
+                if thisProcess == 0:
+                    if os.path.lexists(os.path.join(self._run_instance_dir,"quaternion.dat")):
+                        os.remove(os.path.join(self._run_instance_dir,"quaternion.dat"))
+                    QuaternionGrid.writeQuaternionFile(os.path.join(self._run_instance_dir,"quaternion.dat"), quaternions, weights)
+                if emc_engine is not None:
+                    emc_engine.setQuaternions(quaternions, weights)
 
                 diff = 1.
                 while (iter_num <= max_number_of_iterations):
                     if (iter_num > 1 and diff < min_error):
-                        _print_to_log(msg="Error %0.3e is smaller than threshold %0.3e. Going to next quaternion."%(diff, min_error),
-                                log_file=self._outputLog)
+                        if thisProcess == 0:
+                            _print_to_log(msg="Error %0.3e is smaller than threshold %0.3e. Going to next quaternion."%(diff, min_error),
+                                    log_file=self._outputLog)
                         break
-                    _print_to_log("Beginning iteration %d, with quaternion %d %s"%(iter_num+offset_iter, currQuat, "."*20),
-                                log_file=self._outputLog)
+                    if thisProcess == 0:
+                        _print_to_log("Beginning iteration %d, with quaternion %d %s"%(iter_num+offset_iter, currQuat, "."*20),
+                                    log_file=self._outputLog)
 
-                    # Here is the actual timed EMC iteration, which calls the EMC.c code.
+                    # Here is the actual timed EMC iteration, which calls the EMC.c code or the numpy engine.
                     start_time = time.clock()
 
-                    #command_sequence = ['EMC.x', '1']
-                    command_sequence = ['EMC', '1']
-                    process_handle = subprocess.Popen(command_sequence)
-                    process_handle.wait()
-                    time_taken = time.clock() - start_time
-                    _print_to_log("Took %lf s"%(time_taken),
-                                log_file=self._outputLog)
-
-                    # Read intermediate output of EMC.c and stuff them into a h5 file
-                    # Delete these EMC.c-generated intermediate files afterwards,
-                    # except finish_intensity.dat --> start_intensity.dat for next iteration.
-                    gen.intensities = (numpy.fromfile("finish_intensity.dat", sep=" ")).reshape(intensL, intensL, intensL)
-
-                    data_info = numpy.fromfile("mutual_info.dat", sep=" ")
-                    most_likely_orientations = numpy.fromfile("most_likely_orientations.dat", sep=" ")
-
-                    if(os.path.isfile("start_intensity.dat")):
-                        intens1 = numpy.fromfile("start_intensity.dat", sep=" ")
-                        diff = numpy.sqrt(numpy.mean(numpy.abs(gen.intensities.flatten()-intens1)**2))
+                    if use_binary:
+                        #command_sequence = ['EMC.x', '1']
+                        command_sequence = ['EMC', '1']
+                        process_handle = subprocess.Popen(command_sequence)
+                        process_handle.wait()
+                        time_taken = time.clock() - start_time
+
+                        # Read intermediate output of EMC.c and stuff them into a h5 file
+                        # Delete these EMC.c-generated intermediate files afterwards,
+                        # except finish_intensity.dat --> start_intensity.dat for next iteration.
+                        gen.intensities = (numpy.fromfile("finish_intensity.dat", sep=" ")).reshape(intensL, intensL, intensL)
+
+                        data_info = numpy.fromfile("mutual_info.dat", sep=" ")
+                        most_likely_orientations = numpy.fromfile("most_likely_orientations.dat", sep=" ")
+
+                        if(os.path.isfile("start_intensity.dat")):
+                            intens1 = numpy.fromfile("start_intensity.dat", sep=" ")
+                            diff = numpy.sqrt(numpy.mean(numpy.abs(gen.intensities.flatten()-intens1)**2))
+                        else:
+                            diff = 2.*min_error
                     else:
-                        diff = 2.*min_error
-
-                    f = h5py.File(outFile, "a")
-                    gg = f["history/intensities"]
-                    if detailed_output:
-                        gg.create_dataset("%04d"%(iter_num + offset_iter), data=gen.intensities, compression="gzip", compression_opts=9)
-                    try:
-                        f.create_dataset("data/data", data=gen.intensities, compression="gzip", compression_opts=9)
-                    except:
-                        temp = f["data/data"]
-                        temp[...] = gen.intensities
-
-                    gg = f["history/error"]
-                    gg.create_dataset("%04d"%(iter_num + offset_iter), data=diff)
-                    _print_to_log("rms change in intensities %e"%(diff),
-                                log_file=self._outputLog)
-
-                    gg = f["history/angle"]
-                    gg.create_dataset("%04d"%(iter_num + offset_iter), data=most_likely_orientations, compression="gzip", compression_opts=9)
-                    try:
-                        f.create_dataset("data/angle", data=most_likely_orientations, compression="gzip", compression_opts=9)
-                    except:
-                        temp = f["data/angle"]
-                        temp[...] = most_likely_orientations
-
-                    gg = f["history/mutual_info"]
-                    gg.create_dataset("%04d"%(iter_num + offset_iter), data=data_info)
-
-                    gg = f["history/quaternion"]
-                    gg.create_dataset("%04d"%(iter_num + offset_iter), data=currQuat)
-
-                    gg = f["history/time"]
-                    gg.create_dataset("%04d"%(iter_num + offset_iter), data=time_taken)
-
-                    f.close()
-
-                    f = open(self._outputLog, "a")
-                    f.write("%e\t %lf\n"%(diff, time_taken))
-                    f.close()
-
-                    os.system("cp finish_intensity.dat start_intensity.dat")
-
-                    _print_to_log("Iteration number %d completed"%(iter_num),
-                                log_file=self._outputLog)
+                        diff = emc_engine.iterate()
+                        time_taken = time.clock() - start_time
+
+                        gen.intensities = emc_engine.intensities
+                        data_info = emc_engine.mutual_info
+                        most_likely_orientations = emc_engine.most_likely_orientations
+
+                    if thisProcess == 0:
+                        _print_to_log("Took %lf s"%(time_taken),
+                                    log_file=self._outputLog)
+                        self._write_iteration(history_writer, iter_num + offset_iter, gen.intensities, diff, most_likely_orientations, data_info, currQuat, time_taken, detailed_output)
+
+                    if use_binary:
+                        shutil.copyfile("finish_intensity.dat", "start_intensity.dat")
+
+                    if thisProcess == 0:
+                        _print_to_log("Iteration number %d completed"%(iter_num),
+                                    log_file=self._outputLog)
                     iter_num += 1
 
                 currQuat += 1
 
-            _print_to_log("All EMC iterations completed", log_file=self._outputLog)
+            # Final model and orientations in the format of the EMC executable.
+            if emc_engine is not None and thisProcess == 0:
+                numpy.savetxt("finish_intensity.dat", emc_engine.intensities.reshape(1,-1))
+                numpy.savetxt("mutual_info.dat", emc_engine.mutual_info.reshape(1,-1))
+                numpy.savetxt("most_likely_orientations.dat", emc_engine.most_likely_orientations)
+
+            if thisProcess == 0:
+                history_writer.close()
+                _print_to_log("All EMC iterations completed", log_file=self._outputLog)
 
             os.chdir(cwd)
             MPI.Finalize()
             return 0
 
         except:
+            if history_writer is not None:
+                try:
+                    history_writer.close()
+                except IOError:
+                    pass
             os.chdir(cwd)
             MPI.Finalize()
             return 1
 
+    def _write_iteration(self, history_writer, iteration, intensities, diff, most_likely_orientations, data_info, currQuat, time_taken, detailed_output):
+        """ """
+        """ Private method to hand the results of one EMC iteration to the history writer and append them to the log. """
+
+        history_writer.write(iteration, intensities, diff, most_likely_orientations, data_info, currQuat, time_taken, detailed_output)
+
+        _print_to_log("rms change in intensities %e"%(diff),
+                    log_file=self._outputLog)
+
+        f = open(self._outputLog, "a")
+        f.write("%e\t %lf\n"%(diff, time_taken))
+        f.close()
+
+    def _engine(self):
+        """ """
+        """ Private method to select the EMC engine: the EMC executable or the in-process numpy engine.
+
+        :return: "binary" or "numpy"
+        :rtype: str
+        """
+        engine = self.parameters.engine
+        if engine == "auto":
+            engine = "binary" if find_executable("EMC") is not None else "numpy"
+
+        return engine
+
 def _checkPaths(run_files_path, tmp_files_path):
     """ """
     """ Private (hidden) utility to check validity of paths given to constructor. """
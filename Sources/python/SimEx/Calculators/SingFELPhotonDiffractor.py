@@ -29,6 +29,7 @@ from pysingfel.radiationDamage import generateRotations, rotateParticle
 from pysingfel.toolbox import convert_to_poisson
 import copy
 import h5py
+import numpy
 import os
 import subprocess
 import shlex
@@ -122,6 +123,41 @@ class SingFELPhotonDiffractor(AbstractPhotonDiffractor):
         """ Query for the data provided by the Diffractor. """
         return self.__provided_data
 
+    def _checkSnapshots(self, input_dir):
+        """
+        Check that the pmi files hold all snapshots read by the backengine.
+
+        The backengine reads the snapshots slice_interval, 2*slice_interval, ..., number_of_slices*slice_interval.
+        Files listing their saved snapshots in /data/snapshots (written with a snapshot stride or time window)
+        are checked against that list, older files hold all time steps.
+
+        :param input_dir: Directory holding the pmi files.
+        :type input_dir: str
+
+        :raises ValueError: If slice_interval is not a multiple of the snapshot stride or snapshots are missing.
+        """
+        slice_interval = self.parameters.slice_interval
+        required = slice_interval*numpy.arange(1, self.parameters.number_of_slices+1)
+
+        for pmi_id in range(self.parameters.pmi_start_ID, self.parameters.pmi_stop_ID+1):
+            pmi_file = os.path.join(input_dir, 'pmi_out_%07d.h5' % (pmi_id))
+            if not os.path.isfile(pmi_file):
+                continue
+
+            with h5py.File(pmi_file, 'r') as h5:
+                if '/data/snapshots' not in h5:
+                    continue
+                snapshots = h5['/data/snapshots']
+                stride = int(snapshots.attrs.get('snapshot_stride', 1))
+                saved = snapshots[...]
+
+            if slice_interval % stride != 0:
+                raise ValueError("The parameter 'slice_interval' (%d) must be a multiple of the snapshot stride (%d) of %s." % (slice_interval, stride, pmi_file))
+
+            missing = numpy.setdiff1d(required, saved)
+            if len(missing) > 0:
+                raise ValueError("Snapshots %s are not saved in %s, check 'slice_interval' and 'number_of_slices' against the pmi time window." % (str(missing), pmi_file))
+
     def computeNTasks(self):
         resources = ParallelUtilities.getParallelResourceInfo()
         ncores = resources['NCores']
@@ -171,6 +207,9 @@ class SingFELPhotonDiffractor(AbstractPhotonDiffractor):
         elif os.path.isfile(self.input_path):
             input_dir = os.path.dirname(self.input_path)
 
+        # Check that all snapshots read by the backengine were saved.
+        self._checkSnapshots(input_dir)
+
         config_file = '/dev/null'
 
         # collect MPI arguments
@@ -259,9 +298,12 @@ class SingFELPhotonDiffractor(AbstractPhotonDiffractor):
         mpi_rank = mpi_comm.Get_rank()
         mpi_size = mpi_comm.Get_size()
 
-        # Perform common work on all cores.
-        initial_particle = Particle()
-        initial_particle.readPDB(self.input_path, ff='WK')
+        # Parse the sample once and share it with all cores.
+        initial_particle = None
+        if mpi_rank == 0:
+            initial_particle = Particle()
+            initial_particle.readPDB(self.input_path, ff='WK')
+        initial_particle = mpi_comm.bcast(initial_particle, root=0)
 
         # Generate rotations.
         quaternions = generateRotations(
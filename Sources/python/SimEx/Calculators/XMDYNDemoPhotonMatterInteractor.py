@@ -26,8 +26,10 @@ import os
 import random
 import subprocess
 import sys
+import zlib
 
 from SimEx.Calculators.AbstractPhotonInteractor import AbstractPhotonInteractor
+from SimEx.Utilities import ElementLayout
 from SimEx.Utilities import IOUtilities
 
 class XMDYNDemoPhotonMatterInteractor(AbstractPhotonInteractor):
@@ -42,6 +44,29 @@ class XMDYNDemoPhotonMatterInteractor(AbstractPhotonInteractor):
         :param parameters: Parameters that govern the PMI calculation.
         :type parameters: dict
 
+        Output volume is controlled by the following optional parameters:
+
+        * 'snapshot_stride' (int, default 1): Save every n-th time step only. Snapshots keep the
+          index of their time step (snp_<n>, snp_<2n>, ...) and 'Nph' holds all photons
+          of the skipped steps, so the integrated fluence is unchanged. The SingFELPhotonDiffractor
+          checks that its 'slice_interval' is a multiple of the stride. The
+          diffraction error is bounded by the structural change within n time steps.
+        * 'time_window' (tuple (t_min, t_max) in s, default None): Save only snapshots whose time
+          (measured on the pulse time mesh) lies in the window.
+        * 'output_dtypes' (dict, default float64 for 'r', 'ff', 'halfQ', 'Sq_halfQ', 'Sq_bound', 'Sq_free'):
+          Storage precision per quantity, one of float64, float32 or float16. Lower precision is opt-in,
+          e.g. {'r' : numpy.float32, 'ff' : numpy.float16}. float32 positions have a
+          relative rounding error of 6e-8, i.e. a phase error below 4e-5 rad at q = 1/Angstrom for a
+          100 Angstrom sample. float16 form factors have a relative error below 4.9e-4, giving a relative
+          error of at most 1e-3 in the diffracted intensity. float16 is not allowed for positions
+          since positions in m are below the float16 resolution.
+        * 'compression' ('gzip' or 'lzf', default None) and 'compression_opts' (gzip level, default 4):
+          Lossless hdf5 compression filter (with byte shuffling) applied to all snapshot arrays.
+
+        The indices of the saved snapshots are written to /data/snapshots (with the stride and the
+        number of time steps as attributes), readers should iterate over them instead of assuming
+        a contiguous sequence starting at snp_0000001.
+
         :param input_path: Location of data needed by the PMI calculation (Laser source wavefront data).
         :type input_path: str
 
@@ -73,6 +98,10 @@ class XMDYNDemoPhotonMatterInteractor(AbstractPhotonInteractor):
                                 '/data/snp_<7 digit index>/Sq_halfQ',
                                 '/data/snp_<7 digit index>/Sq_bound',
                                 '/data/snp_<7 digit index>/Sq_free',
+                                '/data/snapshots',
+                                '/data/elements',
+                                '/data/element_offsets',
+                                '/data/permutation',
                                 '/history/parent/detail',
                                 '/history/parent/parent',
                                 '/info/package_version',
@@ -129,6 +158,41 @@ class XMDYNDemoPhotonMatterInteractor(AbstractPhotonInteractor):
         if "random_rotation" not in self.parameters.keys():
             self.parameters["random_rotation"] = False
 
+        if "ionization" not in self.parameters.keys():
+            self.parameters["ionization"] = False
+
+        if "random_seed" not in self.parameters.keys():
+            self.parameters["random_seed"] = None
+
+        if "snapshot_stride" not in self.parameters.keys():
+            self.parameters["snapshot_stride"] = 1
+        if int(self.parameters["snapshot_stride"]) < 1:
+            raise ValueError( "The parameter 'snapshot_stride' must be a positive integer." )
+
+        if "time_window" not in self.parameters.keys():
+            self.parameters["time_window"] = None
+        if self.parameters["time_window"] is not None and len(self.parameters["time_window"]) != 2:
+            raise ValueError( "The parameter 'time_window' must be a tuple (t_min, t_max)." )
+
+        output_dtypes = dict(PMI_OUTPUT_DTYPES)
+        if "output_dtypes" in self.parameters.keys():
+            output_dtypes.update(self.parameters["output_dtypes"])
+        for quantity, dtype in output_dtypes.items():
+            if quantity not in PMI_OUTPUT_DTYPES.keys():
+                raise ValueError( "Precision of %s cannot be set, must be one of %s." % (quantity, str(PMI_OUTPUT_DTYPES.keys())) )
+            if numpy.dtype(dtype) not in [numpy.dtype(numpy.float64), numpy.dtype(numpy.float32), numpy.dtype(numpy.float16)]:
+                raise ValueError( "Unsupported output dtype %s for %s." % (str(dtype), quantity) )
+        if numpy.dtype(output_dtypes['r']) == numpy.dtype(numpy.float16):
+            raise ValueError( "Atom positions cannot be stored at half precision." )
+        self.parameters["output_dtypes"] = output_dtypes
+
+        if "compression" not in self.parameters.keys():
+            self.parameters["compression"] = None
+        if self.parameters["compression"] not in [None, 'gzip', 'lzf']:
+            raise ValueError( "The parameter 'compression' must be one of None, 'gzip', 'lzf'." )
+        if "compression_opts" not in self.parameters.keys():
+            self.parameters["compression_opts"] = 4 if self.parameters["compression"] == 'gzip' else None
+
     def expectedData(self):
         """ Query for the data expected by the Interactor. """
         return self.__expected_data
@@ -181,6 +245,13 @@ class XMDYNDemoPhotonMatterInteractor(AbstractPhotonInteractor):
 
             pmi_demo.g_s2e['maxZ'] = 100
             pmi_demo.g_s2e['random_rotation'] = self.parameters['random_rotation']
+            pmi_demo.g_s2e['ionization'] = self.parameters['ionization']
+            pmi_demo.g_s2e['random_seed'] = self.parameters['random_seed']
+            pmi_demo.g_s2e['snapshot_stride'] = self.parameters['snapshot_stride']
+            pmi_demo.g_s2e['time_window'] = self.parameters['time_window']
+            pmi_demo.g_s2e['setup']['output_dtypes'] = self.parameters['output_dtypes']
+            pmi_demo.g_s2e['setup']['compression'] = self.parameters['compression']
+            pmi_demo.g_s2e['setup']['compression_opts'] = self.parameters['compression_opts']
             pmi_demo.g_s2e['setup']['pmi_out'] = output_file
             # Setup the database.
             pmi_demo.f_dbase_setup()
@@ -207,12 +278,16 @@ class XMDYNDemoPhotonMatterInteractor(AbstractPhotonInteractor):
             else:
                 raise IOError("Sample file is in an unsupported format (supported are h5, pdb, xyz).")
 
+            # Store atoms contiguously per element.
+            pmi_demo.g_s2e['sample'] = ElementLayout.sortByElement( pmi_demo.g_s2e['sample'] )
+            pmi_demo.f_save_layout()
+
             pmi_demo.f_rotate_sample()
             pmi_demo.f_system_setup()
 
             # Perform the trajectories for this pulse and orientation.
             for traj in range( self.parameters['number_of_trajectories'] ):
-                pmi_demo.f_time_evolution()
+                pmi_demo.f_time_evolution( traj )
 
         return status
 
@@ -236,6 +311,15 @@ class XMDYNDemoPhotonMatterInteractor(AbstractPhotonInteractor):
         """
         pass # No action required since output is written in backengine.
 
+# Default storage precision of the floating point snapshot quantities.
+PMI_OUTPUT_DTYPES = {'r'        : numpy.float64,
+                     'ff'       : numpy.float64,
+                     'halfQ'    : numpy.float64,
+                     'Sq_halfQ' : numpy.float64,
+                     'Sq_bound' : numpy.float64,
+                     'Sq_free'  : numpy.float64,
+                    }
+
 class PMIDemo(object):
 
     def __init__(self):
@@ -272,6 +356,12 @@ class PMIDemo(object):
     def f_init_random(self) :
         random.seed( self.g_s2e['id'] )
 
+        # Base seed for the per-trajectory ionization random streams.
+        if self.g_s2e.get( 'random_seed' , None ) is None :
+            self.g_s2e['seed'] = zlib.crc32( str( self.g_s2e['id'] ) ) & 0xffffffff
+        else :
+            self.g_s2e['seed'] = int( self.g_s2e['random_seed'] )
+
 
     ##############################################################################
 
@@ -334,6 +424,11 @@ class PMIDemo(object):
         xsnp['ff']  = a_fp.get( dbase_root + 'ff' )  .value
         xsnp['xyz'] = a_fp.get( dbase_root + 'xyz' ) .value
         xsnp['r']   = a_fp.get( dbase_root + 'r' )   .value
+        # Restore the sample's atom order of files in element sorted layout.
+        if a_fp.get( '/data/permutation' ) is not None :
+            permutation = a_fp.get( '/data/permutation' ) .value
+            for key in [ 'Z' , 'xyz' , 'r' ] :
+                xsnp[key] = ElementLayout.restoreOrder( xsnp[key] , permutation )
         N = xsnp['Z'].size
         xsnp['q'] = numpy.array( [ xsnp['ff'][ numpy.nonzero( xsnp['T'] == x )[0] , 0 ]  for x in xsnp['xyz'] ] ) .reshape(N,)
         xsnp['snp'] = a_snp ;
@@ -406,6 +501,18 @@ class PMIDemo(object):
 
 
 
+    ##############################################################################
+
+    def f_save_layout( self ) :
+        """ Save the element layout of the (element sorted) atom arrays, valid for all snapshots.
+
+        /data/permutation holds the index of each stored atom in the sample, readers restore the
+        sample order with ElementLayout.restoreOrder.
+        """
+        self.f_save_data( '/data/elements' , self.g_s2e['sample']['elements'] )
+        self.f_save_data( '/data/element_offsets' , self.g_s2e['sample']['element_offsets'] )
+        self.f_save_data( '/data/permutation' , self.g_s2e['sample']['permutation'] )
+
     ##############################################################################
 
     def f_system_setup( self ) :
@@ -417,10 +524,66 @@ class PMIDemo(object):
         self.g_s2e['sys']['Nph'] = 1e99
         #print '   NOTE: Nph is uniform.'
 
+        if self.g_s2e.get( 'ionization' , False ) :
+            self.f_ionization_setup()
+
+
+    ##############################################################################
+
+    def f_ionization_setup( self ) :
+        """ Setup the rate tables and per atom state needed by the stochastic ionization engine. """
+
+        Eph = float( self.g_s2e['pulse']['photonEnergy'] )
+        self.g_dbase['ph_sigma'] = f_dbase_ph_sigma( self.g_s2e['maxZ'] , Eph )
+        self.g_dbase['auger_yield'] = f_dbase_auger_yield( self.g_s2e['maxZ'] )
+
+        # Photon fluence per time step (photons / m^2) and time step length (s).
+        area = self.g_s2e['pulse']['xFWHM'] * self.g_s2e['pulse']['yFWHM']
+        self.g_s2e['sys']['fluence'] = self.g_s2e['pulse']['sel_int'] / area
+        self.g_s2e['sys']['dt'] = ( self.g_s2e['pulse']['sliceMax'] - self.g_s2e['pulse']['sliceMin'] ) / ( self.g_s2e['steps'] * 1.0 )
+
+        # Core hole flags, one per atom.
+        self.g_s2e['sys']['hole'] = numpy.zeros( self.g_s2e['sys']['Z'].shape , dtype=bool )
+
+    ##############################################################################
+
+    def f_ionize( self , a_snp , a_rng ) :
+        """ Advance the ionization state of all atoms by one time step. """
+
+        fluence = self.g_s2e['sys']['fluence'][a_snp-1]
+        f_sample_ionization( self.g_s2e['sys']['Z'],
+                             self.g_s2e['sys']['q'],
+                             self.g_s2e['sys']['hole'],
+                             self.g_dbase['ph_sigma'],
+                             self.g_dbase['auger_yield'],
+                             fluence,
+                             self.g_s2e['sys']['dt'],
+                             a_rng,
+                           )
+
+
+    ##############################################################################
+
+    def f_write_dataset( self , a_fp , a_dset , a_data ) :
+        """ Write a snapshot array, applying the lossless compression filter if requested. """
+        compression = self.g_s2e['setup'].get( 'compression' , None )
+        if compression is None or numpy.size( a_data ) < 2 :
+            a_fp[ a_dset ] = a_data
+        else :
+            a_fp.create_dataset( a_dset ,
+                                 data=a_data ,
+                                 compression=compression ,
+                                 compression_opts=self.g_s2e['setup'].get( 'compression_opts' , None ) ,
+                                 shuffle=True ,
+                               )
 
     ##############################################################################
 
-    def f_save_snp( self,  a_snp ) :
+    def f_save_snp( self,  a_snp , a_first_step=None ) :
+
+        # Photons of all steps since the last saved snapshot are attributed to this one.
+        if a_first_step is None :
+            a_first_step = a_snp
 
         self.g_s2e['sys']['xyz'] = self.f_dbase_Zq2id( self.g_s2e['sys']['Z'] , self.g_s2e['sys']['q'] )
         self.g_s2e['sys']['T'] = numpy.sort( numpy.unique( self.g_s2e['sys']['xyz'] ) )
@@ -438,16 +601,17 @@ class PMIDemo(object):
         except:
             1
         grp_hist_parent = xfp.create_group( grp )
-        xfp[ grp + '/Z' ]   = self.g_s2e['sys']['Z']
-        xfp[ grp + '/T' ]   = self.g_s2e['sys']['T'] .astype(numpy.int32)
-        xfp[ grp + '/xyz' ] = self.g_s2e['sys']['xyz'] .astype(numpy.int32)
-        xfp[ grp + '/r' ] = self.g_s2e['sys']['r'] .astype(numpy.float32)
-        xfp[ grp + '/Nph' ] = numpy.array( [self.g_s2e['pulse']['sel_int'][a_snp-1]] )
-        xfp[ grp + '/halfQ' ] = self.g_dbase['halfQ'] .astype(numpy.float32)
-        xfp[ grp + '/ff' ] = ff .astype(numpy.float32)
-        xfp[ grp + '/Sq_halfQ' ] = self.g_dbase['Sq_halfQ'] .astype(numpy.float32)
-        xfp[ grp + '/Sq_bound' ] = self.g_dbase['Sq_bound'] .astype(numpy.float32)
-        xfp[ grp + '/Sq_free' ] = self.g_dbase['Sq_free'] .astype(numpy.float32)
+        dtypes = self.g_s2e['setup'].get( 'output_dtypes' , PMI_OUTPUT_DTYPES )
+        self.f_write_dataset( xfp , grp + '/Z' , self.g_s2e['sys']['Z'] )
+        self.f_write_dataset( xfp , grp + '/T' , self.g_s2e['sys']['T'] .astype(numpy.int32) )
+        self.f_write_dataset( xfp , grp + '/xyz' , self.g_s2e['sys']['xyz'] .astype(numpy.int32) )
+        self.f_write_dataset( xfp , grp + '/r' , self.g_s2e['sys']['r'] .astype(dtypes['r']) )
+        xfp[ grp + '/Nph' ] = numpy.array( [ numpy.sum( self.g_s2e['pulse']['sel_int'][a_first_step-1:a_snp] ) ] )
+        self.f_write_dataset( xfp , grp + '/halfQ' , self.g_dbase['halfQ'] .astype(dtypes['halfQ']) )
+        self.f_write_dataset( xfp , grp + '/ff' , ff .astype(dtypes['ff']) )
+        self.f_write_dataset( xfp , grp + '/Sq_halfQ' , self.g_dbase['Sq_halfQ'] .astype(dtypes['Sq_halfQ']) )
+        self.f_write_dataset( xfp , grp + '/Sq_bound' , self.g_dbase['Sq_bound'] .astype(dtypes['Sq_bound']) )
+        self.f_write_dataset( xfp , grp + '/Sq_free' , self.g_dbase['Sq_free'] .astype(dtypes['Sq_free']) )
 
         xfp.close()
 
@@ -568,10 +732,53 @@ class PMIDemo(object):
 
     ##############################################################################
 
-    def f_time_evolution(self) :
+    def f_time_evolution(self, a_traj=0) :
+
+        ionization = self.g_s2e.get( 'ionization' , False )
+        if ionization :
+            rng = numpy.random.RandomState( f_trajectory_seed( self.g_s2e['seed'] , a_traj ) )
 
+        stride = self.g_s2e.get( 'snapshot_stride' , 1 )
+        first_step = 1
+        saved = []
         for step in range( 1 , self.g_s2e['steps'] + 1 ) :
-            self.f_save_snp( step )
+            if ionization :
+                self.f_ionize( step , rng )
+
+            # Photons outside the time window are not attributed to any snapshot.
+            if not self.f_in_time_window( step ) :
+                first_step = step + 1
+                continue
+
+            if step % stride == 0 :
+                self.f_save_snp( step , first_step )
+                saved.append( step )
+                first_step = step + 1
+
+        self.f_save_snapshots( saved )
+
+    ##############################################################################
+
+    def f_save_snapshots( self , a_saved ) :
+        """ Save the indices of the saved snapshots, with the stride and number of time steps as attributes. """
+        xfp  = h5py.File( self.g_s2e['setup']['pmi_out'] , "a" )
+        dset = xfp.create_dataset( '/data/snapshots' , data=numpy.array( a_saved , dtype=numpy.int32 ) )
+        dset.attrs['snapshot_stride'] = self.g_s2e.get( 'snapshot_stride' , 1 )
+        dset.attrs['number_of_steps'] = self.g_s2e['steps']
+        xfp.close()
+
+    ##############################################################################
+
+    def f_in_time_window( self , a_snp ) :
+        """ Check if the time of the given time step lies in the selected time window. """
+        time_window = self.g_s2e.get( 'time_window' , None )
+        if time_window is None :
+            return True
+
+        dt = ( self.g_s2e['pulse']['sliceMax'] - self.g_s2e['pulse']['sliceMin'] ) / ( self.g_s2e['steps'] * 1.0 )
+        t = self.g_s2e['pulse']['sliceMin'] + a_snp * dt
+
+        return time_window[0] <= t <= time_window[1]
 
 
 
@@ -660,6 +867,115 @@ def s2e_rand_orient( r ,mat ) :
         r[ii,2] = mat[6] * vv[0] + mat[7] * vv[1] + mat[8] * vv[2]
 
 
+##############################################################################
+
+# Auger (K-shell) lifetime used for the decay of core holes.
+AUGER_LIFETIME = 1.0e-14 # s
+
+# Cache for the photoionization cross section tables, keyed by (maxZ, photon energy).
+_PH_SIGMA_CACHE = dict()
+
+def f_dbase_ph_sigma( a_maxZ , a_Eph ) :
+    """ Tabulate photoionization cross sections for all (Z,q) states.
+
+    Uses a Kramers type scaling sigma ~ Z^4 / E^3 normalized to the carbon cross
+    section at 8 keV, reduced by the K-edge jump ratio below the (hydrogenic) K-edge and
+    scaled with the fraction of remaining bound electrons, i.e. the same scaling as the
+    form factor database. Tables are cached per (maxZ, photon energy).
+
+    :param a_maxZ: Largest atomic number in the table.
+    :type a_maxZ: int
+
+    :param a_Eph: Photon energy (eV).
+    :type a_Eph: float
+
+    :return: Cross sections (m^2) indexed by f_dbase_Zq2id(Z, q).
+    :rtype: numpy.array
+    """
+    key = ( int( a_maxZ ) , float( a_Eph ) )
+    if key in _PH_SIGMA_CACHE :
+        return _PH_SIGMA_CACHE[key]
+
+    Z = numpy.concatenate( [ numpy.ones( ZZ+1 ) * ZZ for ZZ in range( 1 , a_maxZ+1 ) ] )
+    q = numpy.concatenate( [ numpy.arange( ZZ+1 ) for ZZ in range( 1 , a_maxZ+1 ) ] )
+
+    # Carbon at 8 keV: ~92 barn.
+    sigma = 92.0e-28 * ( Z / 6.0 )**4 * ( 8000.0 / a_Eph )**3
+    below_K_edge = a_Eph < 13.6 * Z**2
+    sigma[below_K_edge] /= 8.0
+    sigma *= ( Z - q ) / Z
+
+    sigma.setflags( write=False )
+    _PH_SIGMA_CACHE[key] = sigma
+
+    return sigma
+
+def f_dbase_auger_yield( a_maxZ ) :
+    """ Auger yield ( 1 - K-shell fluorescence yield ) for Z = 0 ... maxZ. """
+    Z = numpy.arange( a_maxZ+1 ) * 1.0
+    auger_yield = 1.0 - Z**4 / ( 1.12e6 + Z**4 )
+    # H and He have no Auger channel.
+    auger_yield[:3] = 0.0
+    return auger_yield
+
+def f_trajectory_seed( a_seed , a_traj ) :
+    """ Derive a reproducible seed for trajectory a_traj from the base seed. """
+    return ( int( a_seed ) * 1000003 + int( a_traj ) ) % 2**32
+
+def f_sample_ionization( Z , q , hole , sigma , auger_yield , fluence , dt , rng ) :
+    """ Sample photoabsorption and Auger decay events for all atoms in one time step.
+
+    Events are drawn for all atoms at once, the rates are looked up in the cross section
+    and Auger yield tables. The charge and core hole arrays are updated in place.
+
+    :param Z: Atomic numbers.
+    :type Z: numpy.array (int)
+
+    :param q: Charge states, updated in place.
+    :type q: numpy.array
+
+    :param hole: Core hole flags, updated in place.
+    :type hole: numpy.array (bool)
+
+    :param sigma: Cross section table as returned by f_dbase_ph_sigma.
+    :type sigma: numpy.array
+
+    :param auger_yield: Auger yield table as returned by f_dbase_auger_yield.
+    :type auger_yield: numpy.array
+
+    :param fluence: Photon fluence in this time step (1/m^2).
+    :type fluence: float
+
+    :param dt: Time step (s).
+    :type dt: float
+
+    :param rng: The random number generator.
+    :type rng: numpy.random.RandomState
+
+    :return: Number of photoabsorption and Auger events.
+    :rtype: tuple
+    """
+    Z = numpy.asarray( Z , dtype=int )
+    iq = q.astype( int )
+    N = Z.size
+
+    # Photoabsorption.
+    ids = ( Z * ( Z + 1 ) ) // 2 - 1 + iq
+    p_abs = -numpy.expm1( -sigma[ids] * fluence )
+    absorbed = ( rng.random_sample( N ) < p_abs ) & ( iq < Z )
+    q[absorbed] += 1
+
+    # Only a photoabsorption leaving at least two bound electrons can be followed by Auger decay.
+    hole |= absorbed & ( Z - iq >= 3 )
+
+    # Decay of core holes.
+    decayed = hole & ( rng.random_sample( N ) < -numpy.expm1( -dt / AUGER_LIFETIME ) )
+    auger = decayed & ( rng.random_sample( N ) < auger_yield[Z] ) & ( Z - q >= 2 )
+    q[auger] += 1
+    hole[decayed] = False
+
+    return numpy.count_nonzero( absorbed ) , numpy.count_nonzero( auger )
+
 ##############################################################################
 def f_eval_numE( a_snp , a_sample ) :
 
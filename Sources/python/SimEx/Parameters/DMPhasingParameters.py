@@ -42,6 +42,8 @@ class DMPhasingParameters(AbstractCalculatorParameters):
                  averaging_start         = None,
                  leash                   = None,
                  number_of_shrink_cycles = None,
+                 engine                  = None,
+                 number_of_processes     = None,
                  parameters_dictionary = None,
                  **kwargs
                 ):
@@ -61,6 +63,12 @@ class DMPhasingParameters(AbstractCalculatorParameters):
 
         :param number_of_shrink_cycles: DM shrink cycles.
         :type number_of_shrink_cycles: int>0, default 10
+
+        :param engine: Which DM implementation to run: The object_recon executable ("binary"), the in-process numpy engine ("numpy") or the executable if found in PATH, else numpy ("auto").
+        :type engine: str, default "auto"
+
+        :param number_of_processes: Number of processes running trials concurrently (numpy engine only).
+        :type number_of_processes: int>0, default None (number of cpus)
         """
 
         # Legacy support for dictionaries.
@@ -70,6 +78,8 @@ class DMPhasingParameters(AbstractCalculatorParameters):
             self.averaging_start = parameters_dictionary['averaging_start']
             self.leash = parameters_dictionary['leash']
             self.number_of_shrink_cycles = parameters_dictionary['number_of_shrink_cycles']
+            self.engine = parameters_dictionary.get('engine', None)
+            self.number_of_processes = parameters_dictionary.get('number_of_processes', None)
 
         else:
             # Check all parameters.
@@ -78,6 +88,8 @@ class DMPhasingParameters(AbstractCalculatorParameters):
             self.averaging_start = averaging_start
             self.leash = leash
             self.number_of_shrink_cycles = number_of_shrink_cycles
+            self.engine = engine
+            self.number_of_processes = number_of_processes
 
     def _setDefaults(self):
         """ """
@@ -168,3 +180,37 @@ class DMPhasingParameters(AbstractCalculatorParameters):
             self.__number_of_shrink_cycles = number_of_shrink_cycles
         else:
             raise ValueError( "The parameter 'number_of_shrink_cycles' must be a positive integer.")
+
+    @property
+    def engine(self):
+        """ Query for the 'engine' parameter. """
+        return self.__engine
+    @engine.setter
+    def engine(self, value):
+        """ Set the 'engine' parameter to a given value.
+        :param value: The value to set 'engine' to.
+        :type value: str
+        """
+        engine = checkAndSetInstance( str, value, "auto" )
+
+        if engine in ["auto", "binary", "numpy"]:
+            self.__engine = engine
+        else:
+            raise ValueError( "Parameter 'engine' must be one of 'auto', 'binary' or 'numpy'.")
+
+    @property
+    def number_of_processes(self):
+        """ Query for the 'number_of_processes' parameter. """
+        return self.__number_of_processes
+    @number_of_processes.setter
+    def number_of_processes(self, value):
+        """ Set the 'number_of_processes' parameter to a given value.
+        :param value: The value to set 'number_of_processes' to.
+        :type value: int
+        """
+        number_of_processes = checkAndSetInstance( int, value, None )
+
+        if number_of_processes is None or number_of_processes > 0:
+            self.__number_of_processes = number_of_processes
+        else:
+            raise ValueError( "The parameter 'number_of_processes' must be a positive integer.")
@@ -42,16 +42,20 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
                 min_error=None,
                 beamstop=None,
                 detailed_output=None,
+                engine=None,
+                history_compression=None,
+                history_compression_level=None,
+                history_depth=None,
                 parameters_dictionary=None,
                 **kwargs
                 ):
         """
         Constructor for the EMCOrientationParameters.
         :param initial_number_of_quaternions: Number of quaternions to start the EMC algorithm.
-        :type initial_number_of_quaternions: int (0<n<10), default 1
+        :type initial_number_of_quaternions: int (n>0), default 1
 
         :param max_number_of_quaternions: Maximum number of quaternions for the EMC algorithm.
-        :type max_number_of_quaternions: int (initial_number_of_quaternions < n <= 10), default initial_number_of_quaternions + 1
+        :type max_number_of_quaternions: int (n > initial_number_of_quaternions), default initial_number_of_quaternions + 1
 
         :param min_error: Relative convergence criterion (Go to next quaternion is relative error gets below this value.)
         :type min_error: float (>0), default 1.e-6
@@ -65,6 +69,18 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
         :param detailed_output: Whether to write detailed info to log.
         :type detailed_output: bool, default True
 
+        :param engine: Which EMC implementation to run: The EMC executable ("binary"), the in-process numpy engine ("numpy") or the executable if found in PATH, else numpy ("auto").
+        :type engine: str, default "auto"
+
+        :param history_compression: Compression filter for the intensity and orientation history in the output file ("gzip", "lzf" or "none").
+        :type history_compression: str, default "gzip"
+
+        :param history_compression_level: Compression level if history_compression is "gzip".
+        :type history_compression_level: int (0 <= n <= 9), default 4
+
+        :param history_depth: Number of most recent intensity and orientation snapshots to keep in the history (None: keep all).
+        :type history_depth: int (>0), default None
+
         """
         # Legacy support for dictionaries.
         if parameters_dictionary is not None:
@@ -74,6 +90,10 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
             self.max_number_of_iterations = parameters_dictionary['max_number_of_iterations']
             self.beamstop = parameters_dictionary['beamstop']
             self.detailed_output = parameters_dictionary['detailed_output']
+            self.engine = parameters_dictionary.get('engine', None)
+            self.history_compression = parameters_dictionary.get('history_compression', None)
+            self.history_compression_level = parameters_dictionary.get('history_compression_level', None)
+            self.history_depth = parameters_dictionary.get('history_depth', None)
 
         else:
             # Check all parameters.
@@ -83,6 +103,10 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
             self.max_number_of_iterations = max_number_of_iterations
             self.beamstop = beamstop
             self.detailed_output = detailed_output
+            self.engine = engine
+            self.history_compression = history_compression
+            self.history_compression_level = history_compression_level
+            self.history_depth = history_depth
 
         super(EMCOrientationParameters, self).__init__(**kwargs)
 
@@ -103,10 +127,10 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
         """
         initial_number_of_quaternions = checkAndSetInstance( int, value, 1 )
 
-        if all([initial_number_of_quaternions > 0, initial_number_of_quaternions < 10]):
+        if initial_number_of_quaternions > 0:
             self.__initial_number_of_quaternions = initial_number_of_quaternions
         else:
-            raise ValueError( "Parameter 'initial_number_of_quaternions' must be an integer (0 < n < 10)")
+            raise ValueError( "Parameter 'initial_number_of_quaternions' must be a positive integer")
 
     @property
     def max_number_of_quaternions(self):
@@ -119,10 +143,10 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
         """
         max_number_of_quaternions = checkAndSetInstance( int, value, self.__initial_number_of_quaternions+1 )
 
-        if all([ max_number_of_quaternions <= 10, max_number_of_quaternions > self.initial_number_of_quaternions]):
+        if max_number_of_quaternions > self.initial_number_of_quaternions:
             self.__max_number_of_quaternions = max_number_of_quaternions
         else:
-            raise ValueError( "Parameter 'max_number_of_quaternions' must be an integer (initial_number_of_quaternions < n <= 10)")
+            raise ValueError( "Parameter 'max_number_of_quaternions' must be an integer (initial_number_of_quaternions < n)")
 
     @property
     def max_number_of_iterations(self):
@@ -177,3 +201,67 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
         :param value: The value to set 'detailed_output' to.
         """
         self.__detailed_output = checkAndSetInstance( bool, value, True )
+
+    @property
+    def engine(self):
+        """ Query for the 'engine' parameter. """
+        return self.__engine
+    @engine.setter
+    def engine(self, value):
+        """ Set the 'engine' parameter to a given value.
+        :param value: The value to set 'engine' to.
+        """
+        engine = checkAndSetInstance( str, value, "auto" )
+
+        if engine in ["auto", "binary", "numpy"]:
+            self.__engine = engine
+        else:
+            raise ValueError( "Parameter 'engine' must be one of 'auto', 'binary' or 'numpy'.")
+
+    @property
+    def history_compression(self):
+        """ Query for the 'history_compression' parameter. """
+        return self.__history_compression
+    @history_compression.setter
+    def history_compression(self, value):
+        """ Set the 'history_compression' parameter to a given value.
+        :param value: The value to set 'history_compression' to.
+        """
+        history_compression = checkAndSetInstance( str, value, "gzip" )
+
+        if history_compression in ["gzip", "lzf", "none"]:
+            self.__history_compression = history_compression
+        else:
+            raise ValueError( "Parameter 'history_compression' must be one of 'gzip', 'lzf' or 'none'.")
+
+    @property
+    def history_compression_level(self):
+        """ Query for the 'history_compression_level' parameter. """
+        return self.__history_compression_level
+    @history_compression_level.setter
+    def history_compression_level(self, value):
+        """ Set the 'history_compression_level' parameter to a given value.
+        :param value: The value to set 'history_compression_level' to.
+        """
+        history_compression_level = checkAndSetInstance( int, value, 4 )
+
+        if 0 <= history_compression_level <= 9:
+            self.__history_compression_level = history_compression_level
+        else:
+            raise ValueError( "Parameter 'history_compression_level' must be an integer between 0 and 9.")
+
+    @property
+    def history_depth(self):
+        """ Query for the 'history_depth' parameter. """
+        return self.__history_depth
+    @history_depth.setter
+    def history_depth(self, value):
+        """ Set the 'history_depth' parameter to a given value.
+        :param value: The value to set 'history_depth' to.
+        """
+        history_depth = checkAndSetInstance( int, value, None )
+
+        if history_depth is None or history_depth > 0:
+            self.__history_depth = history_depth
+        else:
+            raise ValueError( "Parameter 'history_depth' must be a positive integer or None.")
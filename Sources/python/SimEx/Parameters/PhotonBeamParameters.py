@@ -23,12 +23,9 @@
 from SimEx.Parameters.AbstractCalculatorParameters import AbstractCalculatorParameters
 from SimEx.Utilities.EntityChecks import checkAndSetInstance, checkAndSetPhysicalQuantity
 from SimEx.Utilities.Units import meter, electronvolt, joule, radian
+from SimEx.Utilities.WavefrontStream import beamMoments
 
 from scipy import constants
-from wpg import Wavefront, wpg_uti_wf
-from wpg.srwlib import srwl
-import math
-import numpy
 import os
 import sys
 
@@ -174,80 +171,41 @@ class PhotonBeamParameters(AbstractCalculatorParameters):
         stream.write("beam/radius = %8.7e" % (self.beam_diameter_fwhm.m_as(meter)/2. ) )
         stream.write("\n")
 
-def propToBeamParameters( prop_output_path ):
-    """ Utility to setup a PhotonBeamParameters instance from propagation output. """
+def propToBeamParameters( prop_output_path, number_of_processes=1 ):
+    """ Utility to setup a PhotonBeamParameters instance from propagation output.
 
-    # Check prop out exists.
-    if not os.path.isfile(prop_output_path):
-        raise IOError("File not found: %s." % (prop_output_path) )
-
-    # Construct the wavefront.
-    wavefront = Wavefront()
-    wavefront.load_hdf5( prop_output_path )
-
-    pulse_energy = wpg_uti_wf.calc_pulse_energy( wavefront )
+    The moments are reduced from chunks of the wavefront file, without loading the wavefront,
+    and cached by file content.
 
-    mesh = wavefront.params.Mesh
-    dx = (mesh.xMax - mesh.xMin)/(mesh.nx - 1)
-    dy = (mesh.yMax - mesh.yMin)/(mesh.ny - 1)
-    int0 = wavefront.get_intensity().sum(axis=0).sum(axis=0)  # I(slice_num)
-    total_intensity = int0*dx*dy # [J]
+    :param prop_output_path: Path of the propagation output.
+    :type prop_output_path: str
 
-    times = numpy.linspace(mesh.sliceMin, mesh.sliceMax, mesh.nSlices)
+    :param number_of_processes: Number of processes reducing the wavefront (default 1).
+    :type number_of_processes: int
 
-    t = times[:-1]
-    dt = times[1:] - times[:-1]
+    :return: The beam parameters.
+    :rtype: PhotonBeamParameters
+    """
 
-    It = total_intensity[:-1]
+    # Check prop out exists.
+    if not os.path.isfile(prop_output_path):
+        raise IOError("File not found: %s." % (prop_output_path) )
 
-    m0 = numpy.sum( It*dt)
-    m1 = numpy.sum( It*t*dt )/m0
-    m2 = numpy.sum( It*t**2*dt)/m0
+    moments = beamMoments( prop_output_path, number_of_processes )
 
-    rms = math.sqrt(m2 - m1**2)
+    photon_energy = moments['photon_energy']
 
-    spike_fwhm_J = constants.hbar/rms
+    # Spike width from the rms duration.
+    spike_fwhm_J = constants.hbar/moments['duration_rms']
     spike_fwhm_eV = spike_fwhm_J/constants.e
 
-    # Switch to energy domain
-    srwl.SetRepresElecField(wavefront._srwl_wf, 'f')
-
-    mesh = wavefront.params.Mesh
-    spectrum = wavefront.get_intensity().sum(axis=0).sum(axis=0)  # I(slice_num)
-    energies = numpy.linspace(mesh.sliceMin, mesh.sliceMax, mesh.nSlices)
-
-    w = energies[:-1]
-    dw = energies[1:] - energies[:-1]
-
-    Iw = spectrum[:-1]
-
-    m0 = numpy.sum( Iw*dw)
-    m1 = numpy.sum( Iw*w*dw )/m0
-    m2 = numpy.sum( Iw*w**2*dw)/m0
-
-    rms = math.sqrt(m2 - m1**2)
-
-    photon_energy = m1
-    #spec_fwhm_eV = rms
-
-    # Extract beam diameter fwhm
-    xy_fwhm = wpg_uti_wf.calculate_fwhm(wavefront)
-
-    # Extract divergence
-    # Switch to reciprocal space
-    srwl.SetRepresElecField(wavefront._srwl_wf, 'a')
-    qxqy_fwhm = wpg_uti_wf.calculate_fwhm(wavefront)
-
-    del wavefront
-
     beam_parameters = PhotonBeamParameters(
             photon_energy=photon_energy*electronvolt,
             photon_energy_relative_bandwidth=spike_fwhm_eV/photon_energy,
-            pulse_energy=pulse_energy*joule,
-            divergence=max([qxqy_fwhm['fwhm_x'],qxqy_fwhm['fwhm_y']])/2.*radian,
-            beam_diameter_fwhm=max([xy_fwhm['fwhm_x'],xy_fwhm['fwhm_y']])*meter,
+            pulse_energy=moments['pulse_energy']*joule,
+            divergence=max([moments['divergence_fwhm_x'],moments['divergence_fwhm_y']])/2.*radian,
+            beam_diameter_fwhm=max([moments['fwhm_x'],moments['fwhm_y']])*meter,
             photon_energy_spectrum_type="SASE",
             )
 
     return beam_parameters
-
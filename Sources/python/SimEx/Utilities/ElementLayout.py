@@ -0,0 +1,143 @@
+""" Module for the element sorted atom layout shared by photon-matter interaction and diffraction.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+"""
+In the element sorted layout all atoms of one element are stored contiguously, in order of
+increasing atomic number. The layout is described by
+
+* 'elements': The atomic numbers present in the sample (ascending).
+* 'element_offsets': Offsets into the atom arrays, atoms of elements[i] are in [element_offsets[i], element_offsets[i+1]).
+* 'permutation': Index of each sorted atom in the original (unsorted) sample.
+
+Files written in this layout store the permutation next to the layout, readers restore the
+original atom order with restoreOrder.
+
+Per element data are then obtained by slicing (views, no copies) instead of index lookups.
+"""
+
+import numpy
+
+def sortByElement(atoms_dict):
+    """
+    Reorder a sample dictionary into the element sorted layout.
+
+    All per atom arrays (first dimension equal to the number of atoms) are permuted, 'selZ' is
+    replaced by slices into the sorted arrays and the layout description is added.
+
+    :param atoms_dict: The sample dictionary (as returned by e.g. IOUtilities.loadPDB).
+    :type atoms_dict: dict
+
+    :return: The sample dictionary in element sorted layout.
+    :rtype: dict
+    """
+
+    Z = numpy.asarray(atoms_dict['Z'])
+    number_of_atoms = Z.shape[0]
+
+    # Stable sort keeps the original order within each element.
+    permutation = numpy.argsort(Z, kind='mergesort')
+    elements, counts = numpy.unique(Z, return_counts=True)
+    offsets = numpy.append(0, numpy.cumsum(counts))
+
+    sorted_dict = dict()
+    for key, value in atoms_dict.items():
+        if isinstance(value, numpy.ndarray) and value.ndim > 0 and value.shape[0] == number_of_atoms:
+            sorted_dict[key] = numpy.ascontiguousarray(value[permutation])
+        else:
+            sorted_dict[key] = value
+
+    sorted_dict['elements'] = elements
+    sorted_dict['element_offsets'] = offsets
+    sorted_dict['permutation'] = permutation
+    sorted_dict['selZ'] = elementSlices(elements, offsets)
+    sorted_dict['N'] = int(number_of_atoms)
+
+    return sorted_dict
+
+def elementSlices(elements, element_offsets):
+    """
+    Map each element to the slice holding its atoms.
+
+    :param elements: The atomic numbers in the layout.
+    :type elements: numpy.array
+
+    :param element_offsets: The offset table of the layout.
+    :type element_offsets: numpy.array
+
+    :return: Dictionary atomic number -> slice.
+    :rtype: dict
+    """
+
+    return dict([(Z, slice(int(element_offsets[i]), int(element_offsets[i+1]))) for i, Z in enumerate(elements)])
+
+def isElementSorted(Z):
+    """
+    Check if the given atomic numbers are in element sorted layout.
+
+    :param Z: Atomic numbers.
+    :type Z: numpy.array
+
+    :return: True if Z is non-decreasing.
+    :rtype: bool
+    """
+
+    Z = numpy.asarray(Z)
+    return bool(numpy.all(Z[1:] >= Z[:-1]))
+
+def restoreOrder(values, permutation):
+    """
+    Reorder per atom data from the element sorted layout back to the original sample order.
+
+    :param values: Per atom values in element sorted layout (first dimension: atoms).
+    :type values: numpy.array
+
+    :param permutation: Index of each sorted atom in the original sample.
+    :type permutation: numpy.array
+
+    :return: The values in the original atom order.
+    :rtype: numpy.array
+    """
+
+    values = numpy.asarray(values)
+    restored = numpy.empty_like(values)
+    restored[numpy.asarray(permutation, dtype=int)] = values
+
+    return restored
+
+def reduceByElement(values, element_offsets, reduction=numpy.add):
+    """
+    Reduce a per atom quantity over the atoms of each element in a single pass.
+
+    :param values: Per atom values in element sorted layout (first dimension: atoms).
+    :type values: numpy.array
+
+    :param element_offsets: The offset table of the layout.
+    :type element_offsets: numpy.array
+
+    :param reduction: The ufunc to reduce with (default: numpy.add).
+    :type reduction: numpy.ufunc
+
+    :return: The reduced values, one entry per element.
+    :rtype: numpy.array
+    """
+
+    return reduction.reduceat(values, numpy.asarray(element_offsets[:-1], dtype=int), axis=0)
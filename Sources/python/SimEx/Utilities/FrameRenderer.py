@@ -0,0 +1,342 @@
+""" Module for rendering image sequences into animations on a process pool.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+"""
+Frames are drawn with the Agg canvas directly (no pyplot), so rendering works without a display and
+independent of the backend selected by the caller. Each process sets up its figure once and only
+replaces the image data per frame; the color scale is fixed for all frames and is usually obtained
+from colorLimits() in a pre-pass over the data.
+
+The rendered RGBA frames are piped in order into an encoder process: ImageMagick's convert for
+.gif output, ffmpeg for video formats (.mp4, .avi, ...). No intermediate image files are written.
+"""
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import LogNorm, Normalize
+from matplotlib.figure import Figure
+import collections
+import multiprocessing
+import numpy
+import os
+import subprocess
+import tempfile
+
+class FrameRenderer(object):
+    """
+    :class FrameRenderer: Render 2D arrays as color coded images with a fixed color scale.
+    """
+
+    def __init__(self,
+                 vmin,
+                 vmax,
+                 logscale=False,
+                 offset=0.0,
+                 extent=None,
+                 origin='upper',
+                 aspect='equal',
+                 xlabel=None,
+                 ylabel=None,
+                 cmap='viridis',
+                 colorbar=True,
+                 figsize=(6.4, 4.8),
+                 dpi=100,
+                 ):
+        """
+        Constructor for the FrameRenderer class.
+
+        :param vmin: Lower limit of the color scale.
+        :type vmin: float
+
+        :param vmax: Upper limit of the color scale.
+        :type vmax: float
+
+        :param logscale: Whether to use a logarithmic color scale (default False).
+        :type logscale: bool
+
+        :param offset: Offset added to each frame if logscale is True (default 0.0).
+        :type offset: float
+
+        :param extent: Axis limits (left, right, bottom, top) (default None: pixel indices).
+        :type extent: list
+
+        :param origin: Position of the [0,0] index, 'upper' or 'lower' (default 'upper').
+        :type origin: str
+
+        :param aspect: Aspect ratio of the axes (default 'equal').
+        :type aspect: str || float
+
+        :param xlabel: Label of the x axis (default None).
+        :type xlabel: str
+
+        :param ylabel: Label of the y axis (default None).
+        :type ylabel: str
+
+        :param cmap: Name of the color map (default 'viridis').
+        :type cmap: str
+
+        :param colorbar: Whether to draw a colorbar (default True).
+        :type colorbar: bool
+
+        :param figsize: Figure size in inches (default (6.4, 4.8)).
+        :type figsize: tuple
+
+        :param dpi: Resolution in dots per inch (default 100).
+        :type dpi: int
+
+        :raises ValueError: If the color scale is empty or not positive for logscale.
+        """
+        if not vmax > vmin:
+            raise ValueError("The color scale needs vmax > vmin, got vmin=%s, vmax=%s." % (vmin, vmax))
+        if logscale and vmin <= 0.0:
+            raise ValueError("A logarithmic color scale needs vmin > 0, got %s." % (vmin))
+
+        self.vmin = vmin
+        self.vmax = vmax
+        self.logscale = logscale
+        self.offset = offset
+        self.extent = extent
+        self.origin = origin
+        self.aspect = aspect
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.cmap = cmap
+        self.colorbar = colorbar
+        self.figsize = figsize
+        self.dpi = dpi
+
+        self.__canvas = None
+        self.__image = None
+
+    def __getstate__(self):
+        """ """
+        """ Pickle the settings only, each process sets up its own figure. """
+        state = self.__dict__.copy()
+        state['_FrameRenderer__canvas'] = None
+        state['_FrameRenderer__image'] = None
+        return state
+
+    @property
+    def size(self):
+        """ Query the size (width, height) of a rendered frame in pixels. """
+        return (int(self.figsize[0]*self.dpi), int(self.figsize[1]*self.dpi))
+
+    def render(self, frame):
+        """
+        Render a single frame.
+
+        :param frame: The data to show.
+        :type frame: numpy.array, shape (ny, nx)
+
+        :return: The image.
+        :rtype: numpy.array, shape (height, width, 4), dtype uint8
+        """
+        if self.logscale:
+            frame = frame + self.offset
+        if self.__image is None:
+            self.__setup(frame)
+        else:
+            self.__image.set_data(frame)
+
+        self.__canvas.draw()
+        width, height = self.__canvas.get_width_height()
+        return numpy.frombuffer(self.__canvas.buffer_rgba(), dtype=numpy.uint8).reshape(height, width, 4).copy()
+
+    def renderMany(self, frames, number_of_processes=1, max_pending=None):
+        """
+        Render frames in order, on a process pool if requested.
+
+        :param frames: The data to show.
+        :type frames: iterable over numpy.array
+
+        :param number_of_processes: Number of rendering processes (default 1, None: one per cpu).
+        :type number_of_processes: int
+
+        :param max_pending: Maximum number of frames submitted to the pool but not yet yielded (default: two per process).
+        :type max_pending: int
+
+        :return: Generator over the images, see render().
+        """
+        if number_of_processes is None:
+            number_of_processes = multiprocessing.cpu_count()
+
+        if number_of_processes <= 1:
+            for frame in frames:
+                yield self.render(frame)
+            return
+
+        if max_pending is None:
+            max_pending = 2*number_of_processes
+
+        pool = multiprocessing.Pool(number_of_processes, initializer=_initRenderer, initargs=(self,))
+        pending = collections.deque()
+        try:
+            # Read the next frame only once an image is taken, so a slow consumer bounds the frames and images held.
+            for frame in frames:
+                if len(pending) >= max_pending:
+                    yield pending.popleft().get()
+                pending.append(pool.apply_async(_renderFrame, (frame,)))
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def animate(self, frames, output_path, fps=10, number_of_processes=None):
+        """
+        Render frames into an animated gif or a video.
+
+        :param frames: The data to show, one array per frame.
+        :type frames: iterable over numpy.array
+
+        :param output_path: Path of the animation. The format follows from the extension (.gif or a video format understood by ffmpeg).
+        :type output_path: str
+
+        :param fps: Frames per second (default 10).
+        :type fps: float
+
+        :param number_of_processes: Number of rendering processes (default None: one per cpu).
+        :type number_of_processes: int
+
+        :return: The number of frames written.
+        :rtype: int
+
+        :raises IOError: If the encoder is not available or fails.
+        """
+        encoder, log = _openEncoder(output_path, self.size, fps)
+
+        count = 0
+        try:
+            try:
+                for image in self.renderMany(frames, number_of_processes):
+                    encoder.stdin.write(image.tobytes())
+                    count += 1
+                encoder.stdin.close()
+            except EnvironmentError:
+                # A broken pipe means that the encoder stopped, its log tells why.
+                if encoder.poll() is None:
+                    encoder.kill()
+                    encoder.wait()
+                    raise
+            except:
+                encoder.kill()
+                encoder.wait()
+                raise
+
+            if encoder.wait() != 0:
+                log.seek(0)
+                raise IOError("Encoding %s failed: %s" % (output_path, log.read()))
+        finally:
+            log.close()
+
+        return count
+
+    def __setup(self, frame):
+        """ """
+        """ Create the figure, drawn on a headless Agg canvas. """
+        if self.logscale:
+            norm = LogNorm(vmin=self.vmin, vmax=self.vmax, clip=True)
+        else:
+            norm = Normalize(vmin=self.vmin, vmax=self.vmax, clip=True)
+
+        figure = Figure(figsize=self.figsize, dpi=self.dpi)
+        self.__canvas = FigureCanvasAgg(figure)
+        axes = figure.add_subplot(111)
+        self.__image = axes.imshow(frame, norm=norm, cmap=self.cmap, extent=self.extent, origin=self.origin, aspect=self.aspect, interpolation='nearest')
+        if self.xlabel is not None:
+            axes.set_xlabel(self.xlabel)
+        if self.ylabel is not None:
+            axes.set_ylabel(self.ylabel)
+        if self.colorbar:
+            figure.colorbar(self.__image)
+        figure.tight_layout()
+
+def colorLimits(frames, logscale=False):
+    """
+    Get the limits of a color scale common to all frames.
+
+    :param frames: The data, arrays of any shape.
+    :type frames: iterable over numpy.array
+
+    :param logscale: Whether to exclude values <= 0 from the lower limit (default False).
+    :type logscale: bool
+
+    :return: The smallest (positive if logscale) and the largest value, (None, None) if there are none.
+    :rtype: tuple
+    """
+    vmin, vmax = None, None
+    for frame in frames:
+        frame = numpy.asarray(frame)
+        if logscale:
+            frame = frame[frame > 0.0]
+        if frame.size == 0:
+            continue
+        mn, mx = frame.min(), frame.max()
+        vmin = mn if vmin is None else min(vmin, mn)
+        vmax = mx if vmax is None else max(vmax, mx)
+
+    return vmin, vmax
+
+_RENDERER = None
+
+def _initRenderer(renderer):
+    """ """
+    """ Set the renderer of a pool process. """
+    global _RENDERER
+    _RENDERER = renderer
+
+def _renderFrame(frame):
+    """ """
+    """ Render a frame in a pool process. """
+    return _RENDERER.render(frame)
+
+def _openEncoder(output_path, size, fps):
+    """ """
+    """ Start the encoder reading raw RGBA frames from its stdin, return the process and its log file. """
+    width, height = size
+    if os.path.splitext(output_path)[1].lower() == '.gif':
+        # ImageMagick reads consecutive frames from the raw stream, delay is in 1/100 s.
+        command = ['convert',
+                   '-delay', '%d' % (max(1, int(round(100./fps)))),
+                   '-loop', '0',
+                   '-size', '%dx%d' % (width, height),
+                   '-depth', '8',
+                   'rgba:-',
+                   output_path]
+    else:
+        command = ['ffmpeg', '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo',
+                   '-pix_fmt', 'rgba',
+                   '-s', '%dx%d' % (width, height),
+                   '-r', '%s' % (fps),
+                   '-i', '-',
+                   # Most codecs need even dimensions for yuv420p.
+                   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                   '-pix_fmt', 'yuv420p',
+                   output_path]
+
+    # The encoder log goes to a file, a pipe could fill up and block the encoder.
+    log = tempfile.TemporaryFile()
+    try:
+        return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=log, stderr=log), log
+    except OSError as e:
+        log.close()
+        raise IOError("Cannot start the encoder %s: %s" % (command[0], e))
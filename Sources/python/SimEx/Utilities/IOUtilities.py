@@ -23,11 +23,14 @@
 
 import exceptions
 import h5py
+import hashlib
+import itertools
 import numpy
 import urllib
 import os, shutil
 import periodictable
 import sys, os
+import tempfile
 
 from SimEx.Utilities import xpdb
 
@@ -93,71 +96,69 @@ def checkAndGetPDB( path ):
 
     return path
 
-def loadXYZ( path=None):
+def loadXYZ( path=None, cache_dir=None):
     """ Load atomic structure from a xyz file and setup a dictionary readable by xmdyn calculator.
 
     :param path: The path to the xyz file.
-    """
-    # Setup the return dictionary.
-    atoms_dict = {'Z' : [],     # Atomic number.
-                  'r' : [],     # Cartesian coordinates.
-                  'selZ' : {},  # Abundance of each element.
-                  'N' : 0,      # Number of atoms.
-                  }
-
-    with open(path) as fin:
-        natoms = int(fin.readline())
-        title = fin.readline()[:-1]
+    :type path: str
 
-        print "Reading %d atoms of %s from %s." % (natoms, title, path)
-        for x in range(natoms):
-            line = fin.readline().split()
+    :param cache_dir: Directory of the binary sample cache (default: $SIMEX_SAMPLE_CACHE, no caching if unset).
+    :type cache_dir: str
 
-            # Get the element symbol from pdb.
-            symbol = line[0]
+    :return: The dictionary describing the sample.
+    :rtype: dict
+    """
 
-            # Get the corresponding periodic table element as an instance.
-            atom_obj = getattr(periodictable, symbol)
+    return _loadSampleWithCache(path, _xyzToS2ESampleDict, cache_dir)
 
-            # Query the atomic number.
-            charge = atom_obj.number
+def _xyzToS2ESampleDict(path=None):
+    """ """
+    """
+    Workhorse function that converts a xyz file to the sample dictionary.
 
-            xyz = numpy.zeros(3, dtype="float64")
-            xyz[:] = map(float, line[1:4])
+    :param path: Path to the xyz file to be loaded.
+    :type path : string
 
-            # Write to dict.
-            atoms_dict['Z'].append(charge)
-            atoms_dict['r'].append(xyz*1e-10)
+    :return: The dictionary expected by downstream simex modules.
+    :rtype : dict
 
+    :throws IOError: Path not existing or corrupt.
+    """
 
-    if len(atoms_dict['Z']) == 0:
+    try:
+        with open(path) as fin:
+            natoms = int(fin.readline())
+            title = fin.readline()[:-1]
+
+            print "Reading %d atoms of %s from %s." % (natoms, title, path)
+
+            # Parse all atoms in one go, lines after the atom block are not read.
+            data = numpy.atleast_1d(numpy.genfromtxt(itertools.islice(fin, natoms),
+                                                     usecols=(0,1,2,3),
+                                                     dtype={'names' : ('symbol', 'x', 'y', 'z'),
+                                                            'formats' : ('S3', 'f8', 'f8', 'f8')},
+                                                     ))
+    except:
         raise IOError( "Error reading structure file %s. " % (path) )
 
-    # Get unique elements.
-    for sel_Z in numpy.unique( atoms_dict['Z'] ) :
-        atoms_dict['selZ'][sel_Z] = numpy.nonzero( atoms_dict['Z'] == sel_Z )[0]
-
-    # Count number of atoms.
-    atoms_dict['N'] = len( atoms_dict['Z'] )
-
-    # Convert to numpy arrays.
-    atoms_dict['Z'] = numpy.array( atoms_dict['Z'] )
-    atoms_dict['r'] = numpy.array( atoms_dict['r'] )
-
-    # Return.
-    return atoms_dict
-
-
-
+    if data.shape[0] == 0:
+        raise IOError( "Error reading structure file %s. " % (path) )
 
+    # Look up atomic numbers once per element.
+    Z = _symbolsToAtomicNumbers(data['symbol'])
+    r = numpy.vstack((data['x'], data['y'], data['z'])).transpose()*1e-10
 
+    return _arraysToS2ESampleDict(Z, r)
 
-def loadPDB( path = None ):
+def loadPDB( path = None, cache_dir=None ):
     """ Wrapper to convert a given pdb file to a sample dictionary used by e.g. the XMDYNCalculator.
 
     :param path: The path to the pdb file to be converted.
     :type path: str
 
+    :param cache_dir: Directory of the binary sample cache (default: $SIMEX_SAMPLE_CACHE, no caching if unset).
+    :type cache_dir: str
+
     :return: The dictionary describing the sample molecule.
     :rtype: dict
     """
@@ -166,7 +167,7 @@ def loadPDB( path = None ):
     target = checkAndGetPDB(path)
 
     # Convert to dict and return.
-    return _pdbToS2ESampleDict(target)
+    return _loadSampleWithCache(target, _pdbToS2ESampleDict, cache_dir)
 
 def _pdbToS2ESampleDict(path=None):
     """ """
@@ -188,64 +189,271 @@ def _pdbToS2ESampleDict(path=None):
     except:
         raise IOError( "Parameter 'path' must be a valid pdb file.")
 
-    # Setup the return dictionary.
-    atoms_dict = {'Z' : [],     # Atomic number.
-                  'r' : [],     # Cartesian coordinates.
-                  'selZ' : {},  # Abundance of each element.
-                  'N' : 0,      # Number of atoms.
-                  }
-
     # Attempt loading the pdb.
     try:
-        #parser = PDB.PDBParser()
-        #structure = parser.get_structure("sample", path)
+        Z, r = _parsePDBColumns(path)
 
-        # Cope with > 100000 pdb atoms
+    except:
+        raise IOError( "Input file %s is not a valid pdb file. " % (path) )
 
-        structure = xpdb.sloppyparser.get_structure("sample", path)
+    # Files without element columns are handed to the (slow but tolerant) pdb parser.
+    if Z is None:
+        Z, r = _parsePDBWithBio(path)
 
+    if len(Z) == 0:
+        raise IOError( "Input file %s is not a valid pdb file. " % (path) )
 
-        # Get the atoms.
-        atoms = structure.get_atoms()
+    return _arraysToS2ESampleDict(Z, r)
 
-        # Loop over atoms and get charge and coordinates.
-        for atom in atoms:
+def _parsePDBColumns(path, block_size=100000):
+    """ """
+    """
+    Parse ATOM and HETATM records of a pdb file using the fixed column layout of the format.
+
+    The file is read in blocks of lines, the atom records of each block are stored as one
+    fixed width (80 byte) array from which the columns are sliced. Only the first alternate
+    location of each atom is kept.
+
+    :param path: Path to the pdb file.
+    :type path: str
+
+    :param block_size: Number of lines per block (default 100000).
+    :type block_size: int
+
+    :return: Atomic numbers and cartesian coordinates (m); (None, None) if the file has no element columns.
+    :rtype: tuple
+    """
+
+    altlocs, symbols, coordinates = [], [], []
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: list(itertools.islice(fin, block_size)), []):
+            records = [line.rstrip(b'\r\n') for line in block if line[:6] in (b'ATOM  ', b'HETATM')]
+            if len(records) == 0:
+                continue
+
+            # (records, 80) bytes, short lines are null padded.
+            chars = numpy.array(records, dtype='S80').view(numpy.uint8).reshape(-1, 80)
+            altlocs.append(chars[:,16].copy())
+            symbols.append(numpy.char.strip(chars[:,76:78].copy().view('S2')[:,0]))
+            coordinates.append(chars[:,30:54].copy().view('S8'))
+
+    if len(symbols) == 0:
+        return numpy.zeros((0,), dtype=int), numpy.zeros((0,3))
+
+    altloc = numpy.concatenate(altlocs)
+    symbols = numpy.concatenate(symbols)
+    coordinates = numpy.concatenate(coordinates)
+
+    # Alternate locations.
+    blank = (altloc == ord(' ')) | (altloc == 0)
+    if not numpy.all(blank):
+        keep = blank | (altloc == altloc[~blank][0])
+        symbols, coordinates = symbols[keep], coordinates[keep]
+
+    # Element symbols.
+    if numpy.any(symbols == b''):
+        return None, None
+    Z = _symbolsToAtomicNumbers(symbols)
 
-            # Get the element symbol from pdb.
-            symbol = atom.element.title()
+    # Coordinates (Angstrom -> m).
+    r = coordinates.astype(numpy.float64)*1e-10
 
-            # Get the coordinates from pdb.
-            coordinates = atom.coord
+    return Z, r
 
-            # Get the corresponding periodic table element as an instance.
-            atom_obj = getattr(periodictable, symbol)
+def _parsePDBWithBio(path):
+    """ """
+    """
+    Parse a pdb file with the Bio.PDB based sloppy parser.
+
+    :param path: Path to the pdb file.
+    :type path: str
 
-            # Query the atomic number.
-            charge = atom_obj.number
+    :return: Atomic numbers and cartesian coordinates (m).
+    :rtype: tuple
+    """
+
+    Z = []
+    r = []
+    try:
+        # Cope with > 100000 pdb atoms
+        structure = xpdb.sloppyparser.get_structure("sample", path)
 
-            # Write to dict.
-            atoms_dict['Z'].append(charge)
-            atoms_dict['r'].append(coordinates*1e-10)
+        # Loop over atoms and get charge and coordinates.
+        for atom in structure.get_atoms():
+            Z.append(getattr(periodictable, atom.element.title()).number)
+            r.append(atom.coord*1e-10)
 
     except:
         raise IOError( "Input file %s is not a valid pdb file. " % (path) )
 
+    return numpy.array(Z), numpy.array(r)
 
-    if len(atoms_dict['Z']) == 0:
-        raise IOError( "Input file %s is not a valid pdb file. " % (path) )
+def _symbolsToAtomicNumbers(symbols):
+    """ """
+    """
+    Convert an array of element symbols to atomic numbers, querying the periodic table once per element.
+
+    :param symbols: The element symbols.
+    :type symbols: numpy.array
 
-    # Get unique elements.
-    for sel_Z in numpy.unique( atoms_dict['Z'] ) :
-        atoms_dict['selZ'][sel_Z] = numpy.nonzero( atoms_dict['Z'] == sel_Z )[0]
+    :return: The atomic numbers.
+    :rtype: numpy.array
+    """
 
-    # Count number of atoms.
-    atoms_dict['N'] = len( atoms_dict['Z'] )
+    unique_symbols, inverse = numpy.unique(symbols, return_inverse=True)
+    unique_Z = numpy.array([getattr(periodictable, symbol.decode().strip().title()).number for symbol in unique_symbols])
 
-    # Convert to numpy arrays.
-    atoms_dict['Z'] = numpy.array( atoms_dict['Z'] )
-    atoms_dict['r'] = numpy.array( atoms_dict['r'] )
+    return unique_Z[inverse]
+
+def _arraysToS2ESampleDict(Z, r):
+    """ """
+    """
+    Setup the sample dictionary from atom arrays.
+
+    :param Z: Atomic numbers.
+    :type Z: numpy.array
+
+    :param r: Cartesian coordinates (m).
+    :type r: numpy.array, shape (N,3)
+
+    :return: The dictionary expected by downstream simex modules.
+    :rtype: dict
+    """
+
+    Z = numpy.asarray(Z)
+
+    atoms_dict = {'Z' : Z,      # Atomic number.
+                  'r' : r,      # Cartesian coordinates.
+                  'selZ' : {},  # Abundance of each element.
+                  'N' : len(Z), # Number of atoms.
+                  }
+
+    # Group atom indices by element, a stable sort keeps the indices of each element ascending.
+    order = numpy.argsort(Z, kind='mergesort')
+    unique_Z, counts = numpy.unique(Z, return_counts=True)
+    offsets = numpy.append(0, numpy.cumsum(counts))
+    for i, sel_Z in enumerate(unique_Z):
+        atoms_dict['selZ'][sel_Z] = order[offsets[i]:offsets[i+1]]
+
+    return atoms_dict
+
+# Bump if the layout of the binary sample cache changes.
+SAMPLE_CACHE_VERSION = '2'
+
+def _sampleCacheKey(path):
+    """ """
+    """
+    Content hash of a sample file.
+
+    :param path: Path to the sample file.
+    :type path: str
+
+    :return: The hex digest identifying the file content.
+    :rtype: str
+    """
+
+    sha = hashlib.sha1(SAMPLE_CACHE_VERSION.encode())
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1<<20), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def _loadSampleWithCache(path, parser, cache_dir=None):
+    """ """
+    """
+    Load a sample from the binary cache if present, parse and store it otherwise.
+
+    The cache holds one directory per file content hash with the atom arrays stored as .npy files.
+    Cached samples are memory mapped (copy on write), so repeated loads of large samples
+    neither parse nor copy the data.
+
+    :param path: Path to the sample file.
+    :type path: str
+
+    :param parser: Function converting the file to the sample dictionary.
+    :type parser: function
+
+    :param cache_dir: Cache directory, default $SIMEX_SAMPLE_CACHE. No caching if None.
+    :type cache_dir: str
+
+    :return: The sample dictionary.
+    :rtype: dict
+    """
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('SIMEX_SAMPLE_CACHE', None)
+
+    if cache_dir is None or not os.path.isfile(path):
+        return parser(path)
+
+    cache_path = os.path.join(cache_dir, _sampleCacheKey(path))
+
+    if os.path.isdir(cache_path):
+        try:
+            return _readSampleCache(cache_path)
+        except:
+            print "WARNING: Could not read sample cache %s, parsing %s." % (cache_path, path)
+
+    atoms_dict = parser(path)
+
+    try:
+        _writeSampleCache(cache_path, atoms_dict)
+    except:
+        print "WARNING: Could not write sample cache %s." % (cache_path)
+
+    return atoms_dict
+
+def _writeSampleCache(cache_path, atoms_dict):
+    """ """
+    """ Store the sample arrays and element grouping under cache_path. """
+
+    Z = numpy.asarray(atoms_dict['Z'])
+    order = numpy.argsort(Z, kind='mergesort')
+    unique_Z, counts = numpy.unique(Z, return_counts=True)
+
+    # Write to a temporary directory and move it in place, so concurrent writers never leave a partial cache.
+    parent = os.path.dirname(os.path.abspath(cache_path))
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    numpy.save(os.path.join(tmp_path, 'Z.npy'), Z)
+    numpy.save(os.path.join(tmp_path, 'r.npy'), numpy.asarray(atoms_dict['r'], dtype=numpy.float64))
+    numpy.save(os.path.join(tmp_path, 'order.npy'), order)
+    numpy.save(os.path.join(tmp_path, 'elements.npy'), unique_Z)
+    numpy.save(os.path.join(tmp_path, 'offsets.npy'), numpy.append(0, numpy.cumsum(counts)))
+
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # Another process was faster.
+        shutil.rmtree(tmp_path)
+
+def _readSampleCache(cache_path):
+    """ """
+    """ Memory map a cached sample and rebuild the sample dictionary. """
+
+    def load(name):
+        return numpy.load(os.path.join(cache_path, name+'.npy'), mmap_mode='c')
+
+    Z = load('Z')
+    order = load('order')
+    elements = numpy.load(os.path.join(cache_path, 'elements.npy'))
+    offsets = numpy.load(os.path.join(cache_path, 'offsets.npy'))
+
+    atoms_dict = {'Z' : Z,
+                  'r' : load('r'),
+                  'selZ' : {},
+                  'N' : int(Z.shape[0]),
+                  }
+    for i, sel_Z in enumerate(elements):
+        atoms_dict['selZ'][sel_Z] = order[offsets[i]:offsets[i+1]]
 
-    # Return.
     return atoms_dict
 
 def pic2dist( pic_file_name, target='genesis'):
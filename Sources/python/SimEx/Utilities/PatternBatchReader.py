@@ -0,0 +1,257 @@
+""" Module for reading diffraction patterns in batches into reusable buffers.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+"""
+Patterns located through a PatternIndex are read with h5py's read_direct straight into preallocated
+(batch, ny, nx) buffers and the mask is applied in place, so no arrays are allocated per pattern.
+While the caller processes one batch, the next one is read in a background thread into the other
+buffer of the pool.
+
+A yielded batch is a view into a pooled buffer and is only valid until the next batch is requested;
+copy it if it has to be kept.
+"""
+
+import h5py
+import numpy
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class PatternBatchReader(object):
+    """
+    :class PatternBatchReader: Iterate over patterns in batches of fixed size, filling reusable buffers.
+    """
+
+    def __init__(self, index, numbers=None, batch_size=100, poissonize=True, mask=None, dtype=numpy.float64, buffers=None, prefetch=True):
+        """
+        Constructor for the PatternBatchReader class.
+
+        :param index: The index of the patterns to read.
+        :type index: PatternIndex
+
+        :param numbers: The pattern numbers to read, in order (default: all indexed patterns).
+        :type numbers: iterable over int
+
+        :param batch_size: Number of patterns per batch (default 100). Ignored if buffers are given.
+        :type batch_size: int
+
+        :param poissonize: Whether to read the patterns with (True) or without (False) Poisson noise (default True).
+        :type poissonize: bool
+
+        :param mask: Mask to multiply on each pattern (default None: no mask).
+        :type mask: numpy.array
+
+        :param dtype: Data type of the allocated buffers (default numpy.float64).
+        :type dtype: numpy.dtype
+
+        :param buffers: Buffers to fill instead of allocated ones, each of shape (batch_size, ny, nx) and C-contiguous.
+        :type buffers: numpy.array || list of numpy.array
+
+        :param prefetch: Whether to read the next batch in a background thread (default True). Needs at least two buffers.
+        :type prefetch: bool
+
+        :raises KeyError: If a pattern is not in the index.
+        :raises ValueError: If the patterns differ in shape or the buffers do not fit.
+        """
+        self.index = index
+        if numbers is None:
+            numbers = index.numbers
+        self.numbers = [int(n) for n in numbers]
+        self.poissonize = poissonize
+        self.prefetch = prefetch
+
+        shapes = set(index.entry(n)['shape'] for n in self.numbers)
+        if len(shapes) > 1:
+            raise ValueError("Cannot read patterns of different shapes %s in batches." % (sorted(shapes)))
+        self.shape = shapes.pop() if shapes else None
+
+        if mask is not None:
+            mask = numpy.asarray(mask)
+            if self.shape is not None and numpy.broadcast(numpy.empty(self.shape), mask).shape != self.shape:
+                raise ValueError("Mask of shape %s does not fit patterns of shape %s." % (mask.shape, self.shape))
+        self.mask = mask
+
+        if buffers is None:
+            self.batch_size = int(batch_size)
+            if self.batch_size < 1:
+                raise ValueError("The batch size must be positive.")
+            self.__buffers = None
+            self.__dtype = dtype
+        else:
+            if isinstance(buffers, numpy.ndarray):
+                buffers = [buffers]
+            self.__buffers = list(buffers)
+            self.batch_size = self.__buffers[0].shape[0]
+            for buffer in self.__buffers:
+                self.__checkBuffer(buffer)
+
+    @property
+    def buffers(self):
+        """ Query the buffer pool, allocated on first use. """
+        if self.__buffers is None:
+            number_of_buffers = 2 if self.prefetch else 1
+            self.__buffers = [numpy.empty((self.batch_size,) + self.shape, dtype=self.__dtype) for i in range(number_of_buffers)]
+        return self.__buffers
+
+    def __len__(self):
+        """ Number of batches. """
+        return (len(self.numbers) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        """ Yield the batches as views into the buffers. """
+        if not self.numbers:
+            return iter([])
+        if self.prefetch and len(self.buffers) > 1:
+            return self.__prefetchingBatches()
+        return self.__batches()
+
+    def readInto(self, numbers, out):
+        """
+        Read patterns into a buffer and apply the mask.
+
+        :param numbers: The pattern numbers, at most out.shape[0].
+        :type numbers: sequence of int
+
+        :param out: The buffer to fill, C-contiguous of shape (n, ny, nx).
+        :type out: numpy.array
+
+        :return: The filled part of the buffer, out[:len(numbers)].
+        :rtype: numpy.array
+        """
+        self.__checkBuffer(out)
+        if len(numbers) > out.shape[0]:
+            raise ValueError("Cannot read %d patterns into a buffer of %d." % (len(numbers), out.shape[0]))
+
+        open_files = {}
+        try:
+            return self.__read(numbers, out, open_files)
+        finally:
+            _closeFiles(open_files)
+
+    def __checkBuffer(self, buffer):
+        """ """
+        """ Check that patterns can be read directly into a buffer. """
+        if buffer.ndim != 3 or (self.shape is not None and buffer.shape[1:] != self.shape):
+            raise ValueError("Buffer of shape %s does not fit patterns of shape %s." % (buffer.shape, self.shape))
+        if buffer.shape[0] != self.batch_size:
+            raise ValueError("All buffers must hold %d patterns." % (self.batch_size))
+        if not (buffer.flags.c_contiguous and buffer.flags.writeable):
+            raise ValueError("Buffers must be C-contiguous and writeable.")
+
+    def __read(self, numbers, out, open_files):
+        """ """
+        """ Fill the first len(numbers) patterns of out, reusing the open files. """
+        dataset = 'data' if self.poissonize else 'diffr'
+        legacy = os.path.isdir(self.index.input_path)
+
+        for (i, number) in enumerate(numbers):
+            entry = self.index.entry(number)
+            if entry['file'] not in open_files:
+                # Legacy files hold a single pattern, no need to keep them open.
+                if legacy:
+                    _closeFiles(open_files)
+                open_files[entry['file']] = h5py.File(entry['file'], 'r')
+
+            data = open_files[entry['file']][entry['path'] + '/' + dataset]
+            if data.ndim > len(entry['shape']):
+                data.read_direct(out[i], source_sel=numpy.s_[entry['offset']])
+            else:
+                data.read_direct(out[i])
+
+        batch = out[:len(numbers)]
+        if self.mask is not None:
+            numpy.multiply(batch, self.mask, out=batch)
+
+        return batch
+
+    def __chunks(self):
+        """ """
+        """ Pattern numbers of each batch. """
+        for start in range(0, len(self.numbers), self.batch_size):
+            yield self.numbers[start:start + self.batch_size]
+
+    def __batches(self):
+        """ """
+        """ Read the batches in turn, cycling through the buffers. """
+        buffers = self.buffers
+        open_files = {}
+        try:
+            for (i, chunk) in enumerate(self.__chunks()):
+                yield self.__read(chunk, buffers[i % len(buffers)], open_files)
+        finally:
+            _closeFiles(open_files)
+
+    def __prefetchingBatches(self):
+        """ """
+        """ Read the batches in a background thread, one buffer ahead of the caller. """
+        free = queue.Queue()
+        filled = queue.Queue()
+        for buffer in self.buffers:
+            free.put(buffer)
+        stop = threading.Event()
+
+        def run():
+            open_files = {}
+            try:
+                for chunk in self.__chunks():
+                    buffer = free.get()
+                    if stop.is_set():
+                        return
+                    filled.put((buffer, self.__read(chunk, buffer, open_files)))
+                filled.put(None)
+            except Exception as e:
+                filled.put(e)
+            finally:
+                _closeFiles(open_files)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+        held = None
+        try:
+            while True:
+                item = filled.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                # The caller is done with the previous batch, its buffer can be refilled.
+                if held is not None:
+                    free.put(held)
+                held, batch = item
+                yield batch
+        finally:
+            stop.set()
+            free.put(None)
+            thread.join()
+
+def _closeFiles(open_files):
+    """ """
+    """ Close and forget open hdf5 files. """
+    for h5 in open_files.values():
+        h5.close()
+    open_files.clear()
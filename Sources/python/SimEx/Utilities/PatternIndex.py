@@ -0,0 +1,372 @@
+""" Module for a persistent index of the diffraction patterns in a diffraction file or directory.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+"""
+The index maps the number of each pattern to the file, HDF5 group and offset holding it, together
+with per pattern metadata (shape of the pattern, orientation quaternion if stored). Pattern numbers
+are the group names in v0.2 files (/data/0000001 is pattern 1) and the position of the file in the
+sorted directory listing for the legacy format (one diffr_out_*.h5 file per pattern).
+
+The index is built on first use and updated incrementally: only new or modified files are read. If a
+cache directory is given (or $SIMEX_PATTERN_INDEX_CACHE is set), the index is stored there, one file per
+input path, and reused by later instances. Otherwise, or if the cache cannot be written, the index is
+kept in memory.
+"""
+
+import h5py
+import hashlib
+import numpy
+import os
+
+from SimEx.Utilities.Utilities import decodeString
+from SimEx.Utilities.Utilities import writeAtomically
+
+# Bump if the layout of the stored index or the numbering changes.
+PATTERN_INDEX_VERSION = '2'
+
+class PatternIndex(object):
+    """
+    :class PatternIndex: Random access to the patterns of a diffraction file or directory.
+    """
+
+    def __init__(self, input_path, cache_dir=None, update=True):
+        """
+        Constructor for the PatternIndex class.
+
+        :param input_path: The diffraction file (v0.2) or directory (legacy format).
+        :type input_path: str
+
+        :param cache_dir: Directory to store the index in, default $SIMEX_PATTERN_INDEX_CACHE. In memory only if None.
+        :type cache_dir: str
+
+        :param update: Whether to bring the index up to date with the input (default True).
+        :type update: bool
+
+        :raises IOError: If the input path does not exist.
+        """
+        if not os.path.exists(input_path):
+            raise IOError("%s: no such file or directory." % (input_path))
+
+        self.input_path = os.path.abspath(input_path).rstrip(os.sep)
+
+        if cache_dir is None:
+            cache_dir = os.environ.get('SIMEX_PATTERN_INDEX_CACHE', None)
+        self.index_path = None
+        if cache_dir is not None:
+            key = hashlib.sha1(self.input_path.encode('utf-8')).hexdigest()
+            self.index_path = os.path.join(cache_dir, key + '.index.h5')
+
+        self.__files = []
+        self.__stamps = numpy.zeros((0,2))
+        self.__entries = _emptyEntries()
+        self.__lookup = {}
+
+        self.__load()
+        if update:
+            self.update()
+
+    @property
+    def numbers(self):
+        """ Query the numbers of all indexed patterns. """
+        return self.__entries['number'].copy()
+
+    @property
+    def stamps(self):
+        """ Query the modification time and size of the file holding each pattern, one row per pattern as in numbers. """
+        return self.__stamps[self.__entries['file']].reshape(-1,2)
+
+    def __len__(self):
+        return len(self.__entries['number'])
+
+    def __contains__(self, number):
+        return int(number) in self.__lookup
+
+    def entry(self, number):
+        """
+        Get the location and metadata of a pattern.
+
+        :param number: The pattern number.
+        :type number: int
+
+        :return: Dictionary with keys 'file', 'path', 'offset', 'shape' and 'angle' (nan if not stored).
+        :rtype: dict
+
+        :raises KeyError: If the pattern is not in the index.
+        """
+        row = self.__row(number)
+        entries = self.__entries
+        return {'file'   : self.__filePath(entries['file'][row]),
+                'path'   : entries['path'][row],
+                'offset' : int(entries['offset'][row]),
+                'shape'  : tuple(entries['shape'][row]),
+                'angle'  : entries['angle'][row].copy(),
+                }
+
+    def read(self, number, poissonize=True):
+        """
+        Read a single pattern.
+
+        :param number: The pattern number.
+        :type number: int
+
+        :param poissonize: Whether to read the pattern with (True) or without (False) Poisson noise (default True).
+        :type poissonize: bool
+
+        :return: The pattern.
+        :rtype: numpy.array
+        """
+        return next(self.readMany([number], poissonize))
+
+    def readMany(self, numbers, poissonize=True):
+        """
+        Yield the given patterns in the given order, opening each file only once.
+
+        :param numbers: The pattern numbers.
+        :type numbers: iterable over int
+
+        :param poissonize: Whether to read the patterns with (True) or without (False) Poisson noise (default True).
+        :type poissonize: bool
+
+        :raises KeyError: If a pattern is not in the index.
+        """
+        dataset = 'data' if poissonize else 'diffr'
+        open_files = {}
+        try:
+            for number in numbers:
+                row = self.__row(number)
+                file_index = self.__entries['file'][row]
+                if file_index not in open_files:
+                    # Legacy files hold a single pattern, no need to keep them open.
+                    if self.__isLegacy():
+                        for h5 in open_files.values():
+                            h5.close()
+                        open_files.clear()
+                    open_files[file_index] = h5py.File(self.__filePath(file_index), 'r')
+
+                data = open_files[file_index][self.__entries['path'][row] + '/' + dataset]
+                offset = int(self.__entries['offset'][row])
+                if data.ndim > len(self.__entries['shape'][row]):
+                    yield data[offset]
+                else:
+                    yield data[()]
+        finally:
+            for h5 in open_files.values():
+                h5.close()
+
+    def update(self):
+        """
+        Index new patterns and drop patterns that no longer exist. Only new or modified files are read.
+
+        :return: Whether the index changed.
+        :rtype: bool
+        """
+        if self.__isLegacy():
+            # Legacy patterns are numbered by their position in the sorted directory listing.
+            listing = sorted(os.listdir(self.input_path))
+            numbered = [(n, name) for (n, name) in enumerate(listing) if name.split('.')[-1] == "h5"]
+        else:
+            numbered = [(None, os.path.basename(self.input_path))]
+        names = [name for (n, name) in numbered]
+
+        stamps = numpy.array([_stamp(os.path.join(self.__inputDir(), name)) for name in names]).reshape(-1,2)
+
+        # Entries of unmodified files are kept, the rows of each file are contiguous.
+        old_entries = self.__entries
+        known = dict((name, i) for (i, name) in enumerate(self.__files))
+        old_rows = {}
+        for (i, name) in enumerate(names):
+            if name in known and numpy.array_equal(self.__stamps[known[name]], stamps[i]):
+                (start, stop) = numpy.searchsorted(old_entries['file'], [known[name], known[name]+1])
+                old_rows[name] = slice(start, stop)
+
+        renumbered = any(numpy.any(old_entries['number'][old_rows[name]] != n) for (n, name) in numbered if n is not None and name in old_rows)
+        if len(old_rows) == len(names) == len(self.__files) and not renumbered:
+            return False
+
+        parts = []
+        for (i, (n, name)) in enumerate(numbered):
+            if name in old_rows:
+                part = _selectEntries(old_entries, old_rows[name])
+            else:
+                try:
+                    part = self.__scan(name)
+                except (IOError, KeyError):
+                    # Unreadable files hold no patterns, like in a sequential scan.
+                    part = _emptyEntries()
+            part['file'] = numpy.full(len(part['number']), i, dtype=numpy.int32)
+            if n is not None:
+                part['number'] = numpy.full(len(part['number']), n, dtype=numpy.int64)
+            parts.append(part)
+
+        self.__files = names
+        self.__stamps = stamps
+        self.__entries = _concatenateEntries(parts)
+        self.__lookup = dict((int(n), row) for (row, n) in enumerate(self.__entries['number']))
+
+        if self.index_path is not None:
+            try:
+                self.__save()
+            except (IOError, OSError):
+                print "WARNING: Could not write pattern index %s, keeping it in memory." % (self.index_path)
+
+        return True
+
+    def __isLegacy(self):
+        """ """
+        """ Whether the input is a legacy directory. """
+        return os.path.isdir(self.input_path)
+
+    def __inputDir(self):
+        """ """
+        """ Directory holding the indexed files. """
+        if self.__isLegacy():
+            return self.input_path
+        return os.path.dirname(self.input_path)
+
+    def __filePath(self, file_index):
+        """ """
+        """ Path of an indexed file. """
+        return os.path.join(self.__inputDir(), self.__files[file_index])
+
+    def __row(self, number):
+        """ """
+        """ Row of a pattern in the entry table. """
+        try:
+            return self.__lookup[int(number)]
+        except KeyError:
+            raise KeyError("Pattern %d is not in %s." % (int(number), self.input_path))
+
+    def __scan(self, name):
+        """ """
+        """ Read the entries of one file. """
+        path = os.path.join(self.__inputDir(), name)
+        rows = []
+        with h5py.File(path, 'r') as h5:
+            if self.__isLegacy():
+                groups = [(0, '/data')]
+            else:
+                groups = [(int(key), '/data/%s' % (key)) for key in h5['data'].keys() if key.isdigit()]
+
+            for (number, group_path) in groups:
+                try:
+                    group = h5[group_path]
+                    shape = group['data'].shape if 'data' in group else group['diffr'].shape
+                except KeyError:
+                    # Skip groups that cannot be opened, e.g. broken external links.
+                    continue
+                angle = group['angle'][()] if 'angle' in group else numpy.full(4, numpy.nan)
+                rows.append((number, group_path, 0, shape, numpy.asarray(angle, dtype=float).ravel()[:4]))
+
+        entries = _emptyEntries()
+        if rows:
+            entries['number'] = numpy.array([r[0] for r in rows], dtype=numpy.int64)
+            entries['path'] = numpy.array([r[1] for r in rows], dtype=object)
+            entries['offset'] = numpy.array([r[2] for r in rows], dtype=numpy.int64)
+            entries['shape'] = numpy.array([r[3] for r in rows], dtype=numpy.int64).reshape(len(rows), -1)
+            entries['angle'] = numpy.array([r[4] for r in rows], dtype=float).reshape(len(rows), 4)
+        return entries
+
+    def __load(self):
+        """ """
+        """ Read the stored index if present and valid. """
+        if self.index_path is None or not os.path.isfile(self.index_path):
+            return
+        try:
+            with h5py.File(self.index_path, 'r') as h5:
+                if h5.attrs['version'] != PATTERN_INDEX_VERSION or h5.attrs['legacy'] != self.__isLegacy():
+                    return
+                if decodeString(h5.attrs['input_path']) != self.input_path:
+                    return
+                files = [decodeString(f) for f in h5['files'][()]]
+                stamps = h5['stamps'][()].reshape(-1,2)
+                entries = {'number' : h5['number'][()],
+                           'file'   : h5['file'][()],
+                           'path'   : numpy.array([decodeString(p) for p in h5['path'][()]], dtype=object),
+                           'offset' : h5['offset'][()],
+                           'shape'  : h5['shape'][()],
+                           'angle'  : h5['angle'][()],
+                           }
+        except:
+            print "WARNING: Could not read pattern index %s, rebuilding it." % (self.index_path)
+            return
+
+        self.__files = files
+        self.__stamps = stamps
+        self.__entries = entries
+        self.__lookup = dict((int(n), row) for (row, n) in enumerate(entries['number']))
+
+    def __save(self):
+        """ """
+        """ Write the index to the cache directory. """
+        index_dir = os.path.dirname(os.path.abspath(self.index_path))
+        if not os.path.isdir(index_dir):
+            try:
+                os.makedirs(index_dir)
+            except OSError:
+                if not os.path.isdir(index_dir):
+                    raise
+
+        def write(tmp_path):
+            with h5py.File(tmp_path, 'w') as h5:
+                h5.attrs['version'] = PATTERN_INDEX_VERSION
+                h5.attrs['legacy'] = self.__isLegacy()
+                h5.attrs['input_path'] = self.input_path
+                h5.create_dataset('files', data=numpy.array(self.__files, dtype='S'))
+                h5.create_dataset('stamps', data=self.__stamps)
+                entries = self.__entries
+                h5.create_dataset('number', data=entries['number'])
+                h5.create_dataset('file', data=entries['file'])
+                h5.create_dataset('path', data=numpy.array(list(entries['path']), dtype='S'))
+                h5.create_dataset('offset', data=entries['offset'])
+                h5.create_dataset('shape', data=entries['shape'])
+                h5.create_dataset('angle', data=entries['angle'])
+
+        writeAtomically(self.index_path, write, suffix='.h5')
+
+def _emptyEntries():
+    """ """
+    """ Entry table without rows. """
+    return {'number' : numpy.zeros(0, dtype=numpy.int64),
+            'file'   : numpy.zeros(0, dtype=numpy.int32),
+            'path'   : numpy.zeros(0, dtype=object),
+            'offset' : numpy.zeros(0, dtype=numpy.int64),
+            'shape'  : numpy.zeros((0,2), dtype=numpy.int64),
+            'angle'  : numpy.zeros((0,4)),
+            }
+
+def _selectEntries(entries, selection):
+    """ """
+    """ Rows of an entry table. """
+    return dict((key, value[selection]) for (key, value) in entries.items())
+
+def _concatenateEntries(parts):
+    """ """
+    """ Stack entry tables. """
+    if not parts:
+        return _emptyEntries()
+    return dict((key, numpy.concatenate([part[key] for part in parts])) for key in parts[0].keys())
+
+def _stamp(path):
+    """ """
+    """ Modification time and size of a file, used to detect changes. """
+    status = os.stat(path)
+    return (status.st_mtime, status.st_size)
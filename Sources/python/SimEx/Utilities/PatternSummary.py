@@ -0,0 +1,320 @@
+""" Module for a per pattern summary table of diffraction data, used to select patterns before reading them.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+"""
+The summary holds one row per pattern with the columns
+
+* 'number': The pattern number (see PatternIndex).
+* 'total_photons': Sum over all pixels.
+* 'max_pixel': Largest pixel value.
+* 'lit_pixels': Number of pixels with a value above zero.
+* 'radius_mean', 'radius_rms': First moment and root of the second moment of the distance from the detector
+  center (in pixels), weighted by the pixel values.
+* 'angle': Orientation quaternion of the sample (nan if not stored).
+* 'source_file': File holding the pattern (target of the external link for v0.2 files).
+* 'parent_file': Input file the pattern was calculated from (target of history/parent/detail, empty if unknown).
+
+Patterns are selected with boolean masks on the columns, e.g.
+
+    summary = PatternSummary('diffr.h5')
+    numbers = summary.select(summary['total_photons'] > 1000)
+
+The features are computed from the patterns multiplied by the mask, if given. The table is built in a
+single pass over the data. Rows are tied to the modification time and size of the file holding the
+pattern (see PatternIndex), so on update only new patterns and patterns of modified files are read.
+If a cache directory is given (or $SIMEX_PATTERN_INDEX_CACHE is set), the table is stored there next to
+the pattern index and reused by later instances, otherwise it is kept in memory.
+"""
+
+import h5py
+import hashlib
+import numpy
+import os
+
+from SimEx.Utilities.PatternIndex import PatternIndex
+from SimEx.Utilities.Utilities import decodeString
+from SimEx.Utilities.Utilities import writeAtomically
+
+# Bump if the columns or their definition change.
+PATTERN_SUMMARY_VERSION = '2'
+
+_NUMERIC_COLUMNS = ['number', 'total_photons', 'max_pixel', 'lit_pixels', 'radius_mean', 'radius_rms', 'angle']
+_STRING_COLUMNS = ['source_file', 'parent_file']
+
+class PatternSummary(object):
+    """
+    :class PatternSummary: Columnar table of per pattern features.
+    """
+
+    def __init__(self, input_path, cache_dir=None, poissonize=True, mask=None, update=True):
+        """
+        Constructor for the PatternSummary class.
+
+        :param input_path: The diffraction file (v0.2) or directory (legacy format).
+        :type input_path: str
+
+        :param cache_dir: Directory to store the table in, default $SIMEX_PATTERN_INDEX_CACHE. In memory only if None.
+        :type cache_dir: str
+
+        :param poissonize: Whether to summarize the patterns with (True) or without (False) Poisson noise (default True).
+        :type poissonize: bool
+
+        :param mask: Mask to multiply on each pattern before computing the features (default: no mask).
+        :type mask: numpy.array
+
+        :param update: Whether to summarize patterns not yet in the table (default True).
+        :type update: bool
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get('SIMEX_PATTERN_INDEX_CACHE', None)
+
+        self.index = PatternIndex(input_path, cache_dir=cache_dir, update=update)
+        self.input_path = self.index.input_path
+        self.summary_path = None
+        if cache_dir is not None:
+            key = hashlib.sha1(self.input_path.encode('utf-8')).hexdigest()
+            self.summary_path = os.path.join(cache_dir, key + '.summary.h5')
+        self.poissonize = poissonize
+        self.mask = None if mask is None else numpy.array(mask, dtype=float)
+
+        self.__columns = _emptyColumns()
+        self.__stamps = numpy.zeros((0,2))
+
+        self.__load()
+        if update:
+            self.update()
+
+    @property
+    def columns(self):
+        """ Query the column names. """
+        return _NUMERIC_COLUMNS + _STRING_COLUMNS
+
+    def __getitem__(self, name):
+        """ Get a column, one entry per pattern. """
+        if name not in self.__columns:
+            raise KeyError("No column %s, available columns are %s." % (name, ", ".join(self.columns)))
+        return self.__columns[name]
+
+    def __len__(self):
+        return len(self.__columns['number'])
+
+    def select(self, mask):
+        """
+        Get the numbers of the patterns selected by a boolean mask over the rows.
+
+        :param mask: One entry per pattern, True for patterns to select.
+        :type mask: numpy.array (bool)
+
+        :return: The selected pattern numbers, to be used e.g. as DiffractionAnalysis pattern_indices.
+        :rtype: list
+        """
+        mask = numpy.asarray(mask, dtype=bool)
+        if mask.shape != (len(self),):
+            raise ValueError("The mask must have one entry per pattern (%d), not shape %s." % (len(self), mask.shape))
+        return self.__columns['number'][mask].tolist()
+
+    def update(self):
+        """
+        Summarize new patterns and patterns of modified files, and drop those no longer present.
+
+        :return: Whether the table changed.
+        :rtype: bool
+        """
+        self.index.update()
+        numbers = self.index.numbers
+        stamps = self.index.stamps
+
+        # Rows are sorted by number. Keep those whose file is unchanged.
+        old_numbers = self.__columns['number']
+        rows = numpy.minimum(numpy.searchsorted(old_numbers, numbers), max(len(old_numbers)-1, 0))
+        if len(old_numbers):
+            known = (old_numbers[rows] == numbers) & numpy.all(self.__stamps[rows] == stamps, axis=1)
+        else:
+            known = numpy.zeros(len(numbers), dtype=bool)
+        if known.all() and len(numbers) == len(old_numbers):
+            return False
+
+        columns = dict((name, column[rows[known]]) for (name, column) in self.__columns.items())
+        if not known.all():
+            new_columns = self.__summarize(numbers[~known])
+            columns = dict((name, numpy.concatenate((columns[name], new_columns[name]))) for name in columns)
+        stamps = numpy.concatenate((stamps[known], stamps[~known]))
+
+        order = numpy.argsort(columns['number'], kind='mergesort')
+        self.__columns = dict((name, column[order]) for (name, column) in columns.items())
+        self.__stamps = stamps[order]
+
+        if self.summary_path is not None:
+            try:
+                self.__save()
+            except (IOError, OSError):
+                print "WARNING: Could not write pattern summary %s, keeping it in memory." % (self.summary_path)
+
+        return True
+
+    def __summarize(self, numbers):
+        """ """
+        """ Read the given patterns once and compute their features. """
+        dataset = 'data' if self.poissonize else 'diffr'
+        rows = dict((name, []) for name in _NUMERIC_COLUMNS + _STRING_COLUMNS)
+        radius = None
+
+        h5, h5_path = None, None
+        try:
+            for number in numbers:
+                entry = self.index.entry(number)
+                if entry['file'] != h5_path:
+                    if h5 is not None:
+                        h5.close()
+                    h5_path = entry['file']
+                    h5 = h5py.File(h5_path, 'r')
+
+                pattern = h5[entry['path'] + '/' + dataset][()].astype(float)
+                if self.mask is not None:
+                    pattern *= self.mask
+                if radius is None or radius.shape != pattern.shape:
+                    radius = _radiusMap(pattern.shape)
+
+                total = pattern.sum()
+                rows['number'].append(number)
+                rows['total_photons'].append(total)
+                rows['max_pixel'].append(pattern.max())
+                rows['lit_pixels'].append(numpy.count_nonzero(pattern > 0.))
+                if total > 0.:
+                    rows['radius_mean'].append(numpy.sum(radius*pattern) / total)
+                    rows['radius_rms'].append(numpy.sqrt(numpy.sum(radius**2*pattern) / total))
+                else:
+                    rows['radius_mean'].append(numpy.nan)
+                    rows['radius_rms'].append(numpy.nan)
+                rows['angle'].append(entry['angle'])
+                rows['source_file'].append(_linkTarget(h5, entry['path'], h5_path))
+                rows['parent_file'].append(_parentFile(h5, entry['path']))
+        finally:
+            if h5 is not None:
+                h5.close()
+
+        columns = _emptyColumns()
+        for name in _NUMERIC_COLUMNS:
+            columns[name] = numpy.array(rows[name], dtype=columns[name].dtype).reshape((-1,) + columns[name].shape[1:])
+        for name in _STRING_COLUMNS:
+            columns[name] = numpy.array(rows[name], dtype=object)
+
+        return columns
+
+    def __load(self):
+        """ """
+        """ Read the stored table if present and valid. """
+        if self.summary_path is None or not os.path.isfile(self.summary_path):
+            return
+        try:
+            with h5py.File(self.summary_path, 'r') as h5:
+                if h5.attrs['version'] != PATTERN_SUMMARY_VERSION or bool(h5.attrs['poissonize']) != self.poissonize:
+                    return
+                if decodeString(h5.attrs['input_path']) != self.input_path or decodeString(h5.attrs['mask']) != _maskDigest(self.mask):
+                    return
+                columns = dict((name, h5[name][()]) for name in _NUMERIC_COLUMNS)
+                for name in _STRING_COLUMNS:
+                    columns[name] = numpy.array([decodeString(s) for s in h5[name][()]], dtype=object)
+                stamps = h5['stamps'][()].reshape(-1,2)
+        except:
+            print "WARNING: Could not read pattern summary %s, rebuilding it." % (self.summary_path)
+            return
+
+        self.__columns = columns
+        self.__stamps = stamps
+
+    def __save(self):
+        """ """
+        """ Write the table to the cache directory. """
+        def write(tmp_path):
+            with h5py.File(tmp_path, 'w') as h5:
+                h5.attrs['version'] = PATTERN_SUMMARY_VERSION
+                h5.attrs['poissonize'] = self.poissonize
+                h5.attrs['input_path'] = self.input_path
+                h5.attrs['mask'] = _maskDigest(self.mask)
+                h5.create_dataset('stamps', data=self.__stamps)
+                for name in _NUMERIC_COLUMNS:
+                    h5.create_dataset(name, data=self.__columns[name])
+                for name in _STRING_COLUMNS:
+                    h5.create_dataset(name, data=numpy.array([s.encode('utf-8') for s in self.__columns[name]], dtype='S'))
+
+        writeAtomically(self.summary_path, write, suffix='.h5')
+
+def _emptyColumns():
+    """ """
+    """ Columns without rows. """
+    return {'number'        : numpy.zeros(0, dtype=numpy.int64),
+            'total_photons' : numpy.zeros(0),
+            'max_pixel'     : numpy.zeros(0),
+            'lit_pixels'    : numpy.zeros(0, dtype=numpy.int64),
+            'radius_mean'   : numpy.zeros(0),
+            'radius_rms'    : numpy.zeros(0),
+            'angle'         : numpy.zeros((0,4)),
+            'source_file'   : numpy.zeros(0, dtype=object),
+            'parent_file'   : numpy.zeros(0, dtype=object),
+            }
+
+def _maskDigest(mask):
+    """ """
+    """ Digest of the mask, to detect tables computed with another mask. """
+    if mask is None:
+        return ''
+    sha = hashlib.sha1(str(mask.shape).encode())
+    sha.update(numpy.ascontiguousarray(mask).tobytes())
+    return sha.hexdigest()
+
+def _radiusMap(shape):
+    """ """
+    """ Distance of each pixel from the detector center. """
+    y = numpy.arange(shape[0]) - 0.5*(shape[0]-1)
+    x = numpy.arange(shape[1]) - 0.5*(shape[1]-1)
+    return numpy.sqrt(y[:,None]**2 + x[None,:]**2)
+
+def _linkTarget(h5, path, default):
+    """ """
+    """ File an external link points to, default if path is no external link. """
+    parent, name = path.rstrip('/').rsplit('/', 1)
+    try:
+        link = h5[parent or '/'].get(name, getlink=True)
+    except KeyError:
+        return default
+    if isinstance(link, h5py.ExternalLink):
+        return decodeString(link.filename)
+    return default
+
+def _parentFile(h5, path):
+    """ """
+    """ Input file of a pattern: target of history/parent/detail or of the links it holds, empty if unknown. """
+    detail_path = path + '/history/parent/detail'
+    target = _linkTarget(h5, detail_path, '')
+    if target:
+        return target
+    try:
+        detail = h5[detail_path]
+        names = list(detail.keys())
+    except (KeyError, AttributeError):
+        return ''
+    for name in names:
+        target = _linkTarget(h5, detail_path + '/' + name, '')
+        if target:
+            return target
+    return ''
@@ -0,0 +1,301 @@
+""" Module for the generation of uniform rotation samplings (quaternion grids) used by EMC.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+"""
+The rotation sampling follows the refinement scheme of the EMC code (Loh & Elser, Phys. Rev. E 80, 026705 (2009)):
+The 120 vertices of the 600-cell are unit quaternions; each of its 600 tetrahedral cells is subdivided into
+a regular lattice with 'level' divisions per edge and the lattice points are projected onto the unit sphere.
+Since q and -q describe the same rotation, only the half with negative first nonzero component is kept, which
+gives 10*(5*level**3 + level) rotations. The weights compensate for the non-uniform density after projection.
+Weights are identical to those of the quaternion files shipped with SimEx, but unlike these files (which
+contain repeated rotations from level 3 on) every rotation appears exactly once. Rotations are sorted
+lexicographically.
+"""
+
+import hashlib
+import numpy
+import os
+import tempfile
+
+# Bump if the generated grid or the cache layout changes.
+QUATERNION_CACHE_VERSION = '1'
+
+_TOLERANCE = 1.e-10
+
+def generateQuaternions(level, symmetry=None, cache_dir=None):
+    """
+    Generate the quaternions and weights of a given refinement level.
+
+    :param level: Number of divisions of the 600-cell edges.
+    :type level: int (>0)
+
+    :param symmetry: Quaternions of the symmetry group of the object (see reduceBySymmetry). The identity may be omitted.
+    :type symmetry: numpy.array, shape (m, 4), default None (no symmetry)
+
+    :param cache_dir: Directory of the binary quaternion cache (default: $SIMEX_QUATERNION_CACHE, no caching if unset).
+    :type cache_dir: str
+
+    :return: The quaternions and their weights.
+    :rtype: tuple (numpy.array, shape (n,4), numpy.array, shape (n,))
+
+    :raises ValueError: If the level is not a positive integer.
+    """
+
+    if int(level) != level or level < 1:
+        raise ValueError("The refinement level must be a positive integer.")
+    level = int(level)
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('SIMEX_QUATERNION_CACHE', None)
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, _cacheKey(level, symmetry) + '.npy')
+        if os.path.isfile(cache_path):
+            try:
+                data = numpy.load(cache_path)
+                return data[:,:4], data[:,4]
+            except:
+                print "WARNING: Could not read quaternion cache %s, generating level %d." % (cache_path, level)
+
+    quaternions, weights = _refine600Cell(level)
+    if symmetry is not None:
+        quaternions, weights = reduceBySymmetry(quaternions, weights, symmetry)
+
+    if cache_path is not None:
+        try:
+            _writeCache(cache_path, numpy.column_stack((quaternions, weights)))
+        except:
+            print "WARNING: Could not write quaternion cache %s." % (cache_path)
+
+    return quaternions, weights
+
+def numberOfQuaternions(level):
+    """
+    Number of quaternions of a given refinement level (without symmetry reduction).
+
+    :param level: Number of divisions of the 600-cell edges.
+    :type level: int
+
+    :return: The number of quaternions.
+    :rtype: int
+    """
+    return 10*(5*level**3 + level)
+
+def reduceBySymmetry(quaternions, weights, symmetry):
+    """
+    Restrict a rotation sampling to the fundamental zone of a symmetry group.
+
+    For an object invariant under the rotations of the group, q and q*g (g in the group) describe the same
+    orientation. A quaternion is kept if no q*g is closer to the identity. Quaternions on the boundary of the
+    zone are shared by several equivalent copies, their weights are divided by the number of copies.
+
+    :param quaternions: The quaternions.
+    :type quaternions: numpy.array, shape (n,4)
+
+    :param weights: The weights.
+    :type weights: numpy.array, shape (n,)
+
+    :param symmetry: Quaternions of the symmetry group. The identity may be omitted.
+    :type symmetry: numpy.array, shape (m,4)
+
+    :return: The reduced quaternions and weights.
+    :rtype: tuple (numpy.array, shape (k,4), numpy.array, shape (k,))
+    """
+
+    quaternions = numpy.asarray(quaternions, dtype=float)
+    weights = numpy.asarray(weights, dtype=float)
+    symmetry = numpy.asarray(symmetry, dtype=float).reshape(-1,4)
+
+    # Scalar part of q*g for all pairs: (q*g)_0 = q0*g0 - q.g
+    conjugate = symmetry * numpy.array([1., -1., -1., -1.])
+    distance = numpy.abs(numpy.dot(quaternions, conjugate.T))
+    own = numpy.abs(quaternions[:,0])
+
+    keep = own >= distance.max(axis=1) - _TOLERANCE
+    # Identity is counted once whether or not it is part of the given group.
+    is_identity = numpy.abs(numpy.abs(symmetry[:,0]) - 1.) < _TOLERANCE
+    copies = 1 + numpy.sum(distance[:,~is_identity] >= own[:,None] - _TOLERANCE, axis=1)
+
+    return quaternions[keep], weights[keep] / copies[keep]
+
+def cyclicSymmetry(order, axis=(0., 0., 1.)):
+    """
+    Quaternions of the cyclic group C_n (rotations by multiples of 2 pi / n about an axis).
+
+    :param order: The order n of the group.
+    :type order: int
+
+    :param axis: The rotation axis.
+    :type axis: array like, default (0, 0, 1)
+
+    :return: The group elements including the identity.
+    :rtype: numpy.array, shape (n,4)
+    """
+
+    axis = numpy.asarray(axis, dtype=float)
+    axis = axis / numpy.linalg.norm(axis)
+    half_angles = numpy.pi * numpy.arange(order) / order
+
+    return numpy.column_stack((numpy.cos(half_angles), numpy.sin(half_angles)[:,None] * axis))
+
+def writeQuaternionFile(path, quaternions, weights):
+    """
+    Write quaternions and weights in the format of the EMC code (number of quaternions, then one "q0 q1 q2 q3 weight" line per quaternion).
+
+    :param path: Path of the quaternion file.
+    :type path: str
+
+    :param quaternions: The quaternions.
+    :type quaternions: numpy.array, shape (n,4)
+
+    :param weights: The weights.
+    :type weights: numpy.array, shape (n,)
+    """
+
+    data = numpy.column_stack((quaternions, weights))
+    numpy.savetxt(path, data, fmt='%.16g', delimiter='\t', header=str(len(data)), comments='')
+
+def _refine600Cell(level):
+    """ """
+    """
+    Subdivide the cells of the 600-cell and project the lattice points onto the unit sphere.
+
+    :param level: Number of divisions of the 600-cell edges.
+    :type level: int
+
+    :return: The quaternions and their weights, sorted lexicographically.
+    :rtype: tuple (numpy.array, shape (n,4), numpy.array, shape (n,))
+    """
+
+    vertices = _600CellVertices()
+
+    # Vertices are neighbours if their distance is the edge length 1/phi.
+    phi = 0.5*(1. + numpy.sqrt(5.))
+    adjacency = numpy.abs(numpy.dot(vertices, vertices.T) - 0.5*phi) < _TOLERANCE
+
+    # Edges, triangles and tetrahedra as sorted vertex index tuples.
+    simplices = [numpy.arange(len(vertices)).reshape(-1,1)]
+    for dimension in range(3):
+        lower = simplices[-1]
+        common = numpy.all(adjacency[lower], axis=1)
+        common &= numpy.arange(len(vertices)) > lower[:,-1:]
+        row, new = numpy.nonzero(common)
+        simplices.append(numpy.column_stack((lower[row], new)))
+
+    # Fraction of the full solid angle (3d) around a lattice point that is covered by the cells meeting there:
+    # 20 cells meet at a vertex, 5 at an edge, the solid angle and dihedral angle of a regular tetrahedron.
+    dihedral = numpy.arccos(1./3.)
+    fractions = [20.*(3.*dihedral - numpy.pi)/(4.*numpy.pi), 5.*dihedral/(2.*numpy.pi), 1., 1.]
+
+    # Lattice points strictly inside each simplex (all barycentric coordinates > 0).
+    points = []
+    weights = []
+    for dimension, simplex in enumerate(simplices):
+        coefficients = _compositions(level, dimension+1)
+        if len(coefficients) == 0:
+            continue
+        p = numpy.einsum('ck,skd->scd', coefficients / float(level), vertices[simplex]).reshape(-1,4)
+        norm = numpy.sqrt(numpy.sum(p*p, axis=1))
+        points.append(p / norm[:,None])
+        weights.append(fractions[dimension] / norm**4)
+
+    quaternions = numpy.concatenate(points)
+    # Distance of the cell hyperplanes from the origin (volume element of the projection).
+    cell_center = numpy.mean(vertices[simplices[3][0]], axis=0)
+    weights = numpy.linalg.norm(cell_center) * numpy.concatenate(weights)
+
+    # q and -q are the same rotation: keep the points with negative first nonzero component.
+    quaternions[numpy.abs(quaternions) < _TOLERANCE] = 0.
+    first = numpy.argmax(quaternions != 0., axis=1)
+    keep = quaternions[numpy.arange(len(quaternions)), first] < 0.
+    quaternions = quaternions[keep]
+    weights = weights[keep]
+
+    order = numpy.lexsort(numpy.round(quaternions[:,::-1], 9).T)
+
+    return quaternions[order], weights[order]
+
+def _600CellVertices():
+    """ """
+    """
+    The 120 vertices of the 600-cell with unit circumradius: all permutations of (+-1, 0, 0, 0), (+-1/2, +-1/2, +-1/2, +-1/2)
+    and the even permutations of (+-phi, +-1, +-1/phi, 0)/2.
+    """
+
+    phi = 0.5*(1. + numpy.sqrt(5.))
+    signs = numpy.array([(a, b, c, d) for a in (1,-1) for b in (1,-1) for c in (1,-1) for d in (1,-1)], dtype=float)
+
+    vertices = [numpy.vstack((numpy.eye(4), -numpy.eye(4))), 0.5*signs]
+
+    even_permutations = [(0,1,2,3), (0,2,3,1), (0,3,1,2), (1,0,3,2), (1,2,0,3), (1,3,2,0),
+                         (2,0,1,3), (2,1,3,0), (2,3,0,1), (3,0,2,1), (3,1,0,2), (3,2,1,0)]
+    base = 0.5*numpy.array([phi, 1., 1./phi, 0.])
+    # Only three signs matter, the last entry is zero.
+    products = base * signs[::2]
+    for permutation in even_permutations:
+        vertices.append(products[:, numpy.argsort(permutation)])
+
+    return numpy.vstack(vertices)
+
+def _compositions(total, parts):
+    """ """
+    """ All tuples of 'parts' positive integers summing up to 'total', as an array of shape (n, parts). """
+
+    if parts == 1:
+        return numpy.array([[total]]) if total > 0 else numpy.zeros((0,1), dtype=int)
+
+    rows = [numpy.column_stack((numpy.full(len(rest), first, dtype=int), rest))
+            for first in range(1, total)
+            for rest in [_compositions(total - first, parts - 1)] if len(rest)]
+    if not rows:
+        return numpy.zeros((0, parts), dtype=int)
+
+    return numpy.vstack(rows)
+
+def _cacheKey(level, symmetry):
+    """ """
+    """ Name of the cache file of a refinement level and symmetry group. """
+
+    key = 'quaternion_v%s_%d' % (QUATERNION_CACHE_VERSION, level)
+    if symmetry is not None:
+        key += '_' + hashlib.sha1(numpy.ascontiguousarray(symmetry, dtype=float).tobytes()).hexdigest()[:16]
+
+    return key
+
+def _writeCache(cache_path, data):
+    """ """
+    """ Store a quaternion array under cache_path. """
+
+    cache_dir = os.path.dirname(os.path.abspath(cache_path))
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+
+    # Write to a temporary file and move it in place, so concurrent writers never leave a partial cache.
+    handle, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.npy')
+    with os.fdopen(handle, 'wb') as tmp_file:
+        numpy.save(tmp_file, data)
+    os.rename(tmp_path, cache_path)
@@ -0,0 +1,191 @@
+""" Module for azimuthal integration of batches of detector images with cached pixel-to-bin maps.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+"""
+For a given detector geometry, every pixel is assigned to one radial bin according to the
+momentum transfer q = 4 pi sin(theta) / lambda at its center. The assignment, together with the
+mask and the solid angle and polarization corrections, is stored as a sparse matrix such that the
+radial profiles of a whole batch of patterns are obtained with one matrix product. Integrators are
+cached by geometry, repeated calls for the same detector reuse the precomputed matrix.
+"""
+
+import hashlib
+import numpy
+import scipy.sparse
+
+from SimEx.Utilities.ReciprocalGrid import LRUCache
+
+# Maximum number of integrators kept in the cache. The least recently used integrator is dropped first.
+INTEGRATOR_CACHE_SIZE = 8
+
+_INTEGRATOR_CACHE = LRUCache(INTEGRATOR_CACHE_SIZE)
+
+class RadialIntegrator(object):
+    """
+    :class RadialIntegrator: Azimuthal integration of detector images into radial q bins.
+    """
+
+    def __init__(self,
+                 shape,
+                 pixel_size,
+                 distance,
+                 wavelength,
+                 center=None,
+                 number_of_bins=None,
+                 mask=None,
+                 correct_solid_angle=True,
+                 polarization_factor=None,
+                ):
+        """
+        Constructor for the RadialIntegrator class.
+
+        :param shape: Number of pixels of the detector (rows, columns).
+        :type shape: tuple
+
+        :param pixel_size: Edge length of a (square) pixel (m).
+        :type pixel_size: float
+
+        :param distance: Sample to detector distance (m).
+        :type distance: float
+
+        :param wavelength: Photon wavelength (nm).
+        :type wavelength: float
+
+        :param center: Position of the direct beam (row, column) in pixels (default: center of the detector).
+        :type center: tuple
+
+        :param number_of_bins: Number of radial bins (default: min(number of rows, 1024)).
+        :type number_of_bins: int
+
+        :param mask: Pixels to include (nonzero) or exclude (zero) (default: all pixels).
+        :type mask: numpy.array
+
+        :param correct_solid_angle: Whether to divide by the solid angle of each pixel relative to a pixel at normal incidence (default True).
+        :type correct_solid_angle: bool
+
+        :param polarization_factor: Degree of horizontal polarization of the beam in [-1,1] for polarization correction (default None: no correction).
+        :type polarization_factor: float
+        """
+        shape = tuple(int(s) for s in shape)
+        if len(shape) != 2:
+            raise ValueError("The detector shape must be a tuple of two ints.")
+        if pixel_size <= 0. or distance <= 0. or wavelength <= 0.:
+            raise ValueError("Pixel size, distance and wavelength must be positive.")
+        if polarization_factor is not None and not -1. <= polarization_factor <= 1.:
+            raise ValueError("The polarization factor must be in [-1,1].")
+        if center is None:
+            center = (0.5*(shape[0]-1), 0.5*(shape[1]-1))
+        if number_of_bins is None:
+            number_of_bins = min(shape[0], 1024)
+        if mask is None:
+            valid = numpy.ones(shape, dtype=bool)
+        else:
+            valid = numpy.asarray(mask) != 0
+            if valid.shape != shape:
+                raise ValueError("The mask shape %s does not match the detector shape %s." % (valid.shape, shape))
+
+        self.shape = shape
+
+        # Scattering geometry at the pixel centers.
+        y = (numpy.arange(shape[0]) - center[0]) * pixel_size
+        x = (numpy.arange(shape[1]) - center[1]) * pixel_size
+        y, x = numpy.meshgrid(y, x, indexing='ij')
+        r2 = x*x + y*y
+        two_theta = numpy.arctan2(numpy.sqrt(r2), distance)
+        q = 4.*numpy.pi / wavelength * numpy.sin(0.5*two_theta)
+
+        correction = numpy.ones(shape)
+        if correct_solid_angle:
+            correction *= numpy.cos(two_theta)**3
+        if polarization_factor is not None:
+            cos_2chi = numpy.where(r2 > 0., (x*x - y*y) / numpy.where(r2 > 0., r2, 1.), 0.)
+            correction *= 0.5*(1. + numpy.cos(two_theta)**2 - polarization_factor*cos_2chi*numpy.sin(two_theta)**2)
+
+        # Bin the valid pixels.
+        q_valid = q[valid]
+        if len(q_valid):
+            q_min, q_max = q_valid.min(), q_valid.max()
+        else:
+            q_min, q_max = 0., 1.
+        edges = numpy.linspace(q_min, q_max, number_of_bins+1)
+        bins = numpy.clip(numpy.searchsorted(edges, q_valid, side='right') - 1, 0, number_of_bins-1)
+        counts = numpy.bincount(bins, minlength=number_of_bins)
+
+        # Matrix mapping (flat) patterns to the mean corrected intensity per bin.
+        pixels = numpy.flatnonzero(valid)
+        weights = 1. / (correction[valid] * counts[bins])
+        self.__matrix = scipy.sparse.csr_matrix((weights, (bins, pixels)), shape=(number_of_bins, valid.size))
+
+        self.q = 0.5*(edges[1:] + edges[:-1])
+        self.q.flags.writeable = False
+        self.counts = counts
+        self.counts.flags.writeable = False
+
+    def integrate(self, patterns):
+        """
+        Compute the radial profile of one pattern or a batch of patterns.
+
+        :param patterns: The pattern(s) to integrate.
+        :type patterns: numpy.array, shape (rows, columns) or (number of patterns, rows, columns)
+
+        :return: The mean corrected intensity in each bin (0 for empty bins).
+        :rtype: numpy.array, shape (number_of_bins,) or (number of patterns, number_of_bins)
+        """
+        patterns = numpy.asarray(patterns)
+        if patterns.shape[-2:] != self.shape:
+            raise ValueError("Pattern shape %s does not match the detector shape %s." % (patterns.shape[-2:], self.shape))
+
+        flat = patterns.reshape(-1, self.shape[0]*self.shape[1])
+        profiles = numpy.asarray(self.__matrix.dot(flat.T)).T
+
+        if patterns.ndim == 2:
+            return profiles[0]
+        return profiles
+
+def radialIntegrator(shape, pixel_size, distance, wavelength, center=None, number_of_bins=None, mask=None, correct_solid_angle=True, polarization_factor=None):
+    """
+    Get the (cached) integrator for a detector geometry. See RadialIntegrator for the parameters.
+
+    :return: The integrator.
+    :rtype: RadialIntegrator
+    """
+    mask_key = None
+    if mask is not None:
+        mask = numpy.ascontiguousarray(numpy.asarray(mask) != 0)
+        mask_key = (mask.shape, hashlib.sha1(mask.view(numpy.uint8)).hexdigest())
+
+    key = (tuple(int(s) for s in shape),
+           float(pixel_size),
+           float(distance),
+           float(wavelength),
+           None if center is None else tuple(float(c) for c in center),
+           number_of_bins,
+           mask_key,
+           bool(correct_solid_angle),
+           polarization_factor,
+           )
+
+    return _INTEGRATOR_CACHE.get(key, lambda : RadialIntegrator(shape, pixel_size, distance, wavelength, center, number_of_bins, mask, correct_solid_angle, polarization_factor))
+
+def clearCache():
+    """ Drop all cached integrators. """
+    _INTEGRATOR_CACHE.clear()
@@ -0,0 +1,314 @@
+""" Module providing cached coordinate grids, radial shells and spherical masks for 3D reciprocal space volumes.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+"""
+All grids describe a cubic volume of linear size 2*half_size+1 centered on the origin, the voxel
+(i,j,k) of the volume being located at (i-half_size, j-half_size, k-half_size)/oversampling.
+Grids are built once per set of arguments with vectorized numpy operations and kept in a module
+wide cache. The returned arrays are shared between all callers and therefore read-only; take a copy
+if you need to modify them.
+"""
+
+import collections
+import numpy
+import threading
+
+# Maximum number of grids kept in the cache. The least recently used grid is dropped first.
+GRID_CACHE_SIZE = 16
+
+class LRUCache(object):
+    """
+    :class LRUCache: Thread safe cache of a limited number of values. The least recently used value is dropped first.
+    """
+
+    def __init__(self, max_size):
+        """
+        Constructor for the LRUCache class.
+
+        :param max_size: Maximum number of values kept.
+        :type max_size: int
+        """
+        self.max_size = max_size
+        self.__values = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__values)
+
+    def get(self, key, build):
+        """
+        Look up a value, build and store it if not found.
+
+        :param key: The cache key.
+        :type key: hashable
+
+        :param build: Function building the value.
+        :type build: callable
+
+        :return: The cached value.
+        """
+        with self.__lock:
+            if key in self.__values:
+                value = self.__values.pop(key)
+                self.__values[key] = value
+                return value
+
+        # Build outside the lock, values may be composed of other cached values.
+        value = build()
+
+        with self.__lock:
+            value = self.__values.setdefault(key, value)
+            while len(self.__values) > self.max_size:
+                self.__values.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        """ Drop all cached values. """
+        with self.__lock:
+            self.__values.clear()
+
+_GRID_CACHE = LRUCache(GRID_CACHE_SIZE)
+
+def coordinateAxis(half_size, oversampling=1):
+    """
+    Get the coordinates of the voxels along one axis of the volume.
+
+    :param half_size: Number of voxels between the center and the edge of the volume.
+    :type half_size: int (>=0)
+
+    :param oversampling: Number of voxels per unit of the coordinates (default 1).
+    :type oversampling: float (>0)
+
+    :return: The voxel coordinates.
+    :rtype: numpy.array, shape (2*half_size+1,)
+    """
+    half_size, oversampling = _checkGridArguments(half_size, oversampling)
+
+    return _cached(('axis', half_size, oversampling),
+                   lambda : numpy.arange(-half_size, half_size+1) / oversampling)
+
+def coordinateGrid(half_size, oversampling=1):
+    """
+    Get the coordinates of all voxels in the volume.
+
+    :param half_size: Number of voxels between the center and the edge of the volume.
+    :type half_size: int (>=0)
+
+    :param oversampling: Number of voxels per unit of the coordinates (default 1).
+    :type oversampling: float (>0)
+
+    :return: The voxel coordinates in C order (last index running fastest).
+    :rtype: numpy.array, shape ((2*half_size+1)**3, 3)
+    """
+    half_size, oversampling = _checkGridArguments(half_size, oversampling)
+
+    def build():
+        axis = coordinateAxis(half_size, oversampling)
+        size = len(axis)
+        grid = numpy.empty((size, size, size, 3))
+        grid[...,0] = axis[:,None,None]
+        grid[...,1] = axis[None,:,None]
+        grid[...,2] = axis[None,None,:]
+        return grid.reshape(-1, 3)
+
+    return _cached(('grid', half_size, oversampling), build)
+
+def radiusGrid(half_size, oversampling=1):
+    """
+    Get the distance of all voxels from the center of the volume.
+
+    :param half_size: Number of voxels between the center and the edge of the volume.
+    :type half_size: int (>=0)
+
+    :param oversampling: Number of voxels per unit of the coordinates (default 1).
+    :type oversampling: float (>0)
+
+    :return: The distance from the center.
+    :rtype: numpy.array, shape (2*half_size+1, 2*half_size+1, 2*half_size+1)
+    """
+    half_size, oversampling = _checkGridArguments(half_size, oversampling)
+
+    def build():
+        axis2 = coordinateAxis(half_size, oversampling)**2
+        return numpy.sqrt(axis2[:,None,None] + axis2[None,:,None] + axis2[None,None,:])
+
+    return _cached(('radius', half_size, oversampling), build)
+
+def radialShells(half_size, oversampling=1):
+    """
+    Get the index of the radial shell of unit width every voxel belongs to.
+
+    Shell n holds the voxels at distance [n-0.5, n+0.5) from the center, such that the shell
+    populations are given by numpy.bincount(radialShells(half_size).ravel()).
+
+    :param half_size: Number of voxels between the center and the edge of the volume.
+    :type half_size: int (>=0)
+
+    :param oversampling: Number of voxels per unit of the coordinates (default 1).
+    :type oversampling: float (>0)
+
+    :return: The shell indices.
+    :rtype: numpy.array (int), shape (2*half_size+1, 2*half_size+1, 2*half_size+1)
+    """
+    half_size, oversampling = _checkGridArguments(half_size, oversampling)
+
+    return _cached(('shells', half_size, oversampling),
+                   lambda : numpy.floor(radiusGrid(half_size, oversampling) + 0.5).astype(int))
+
+def sphericalMask(half_size, radius, oversampling=1, inclusive=False):
+    """
+    Get the mask of all voxels inside a sphere centered on the volume.
+
+    :param half_size: Number of voxels between the center and the edge of the volume.
+    :type half_size: int (>=0)
+
+    :param radius: Radius of the sphere.
+    :type radius: float
+
+    :param oversampling: Number of voxels per unit of the coordinates (default 1).
+    :type oversampling: float (>0)
+
+    :param inclusive: Whether to include voxels located exactly on the surface of the sphere (default False).
+    :type inclusive: bool
+
+    :return: The mask, True inside the sphere.
+    :rtype: numpy.array (bool), shape (2*half_size+1, 2*half_size+1, 2*half_size+1)
+    """
+    half_size, oversampling = _checkGridArguments(half_size, oversampling)
+    radius = float(radius)
+    inclusive = bool(inclusive)
+
+    def build():
+        r = radiusGrid(half_size, oversampling)
+        if inclusive:
+            return r <= radius
+        return r < radius
+
+    return _cached(('mask', half_size, oversampling, radius, inclusive), build)
+
+def spherePositions(half_size, radius, oversampling=1, inclusive=False, centered=True):
+    """
+    Get the positions of all voxels inside a sphere centered on the volume, e.g. to list a support or a beamstop.
+
+    :param half_size: Number of voxels between the center and the edge of the volume.
+    :type half_size: int (>=0)
+
+    :param radius: Radius of the sphere.
+    :type radius: float
+
+    :param oversampling: Number of voxels per unit of the coordinates (default 1).
+    :type oversampling: float (>0)
+
+    :param inclusive: Whether to include voxels located exactly on the surface of the sphere (default False).
+    :type inclusive: bool
+
+    :param centered: Whether to give positions relative to the center (True, default) or as array indices (False).
+    :type centered: bool
+
+    :return: The voxel positions in C order.
+    :rtype: numpy.array (int), shape (n, 3)
+    """
+    half_size, oversampling = _checkGridArguments(half_size, oversampling)
+    radius = float(radius)
+    inclusive = bool(inclusive)
+    centered = bool(centered)
+
+    def build():
+        positions = numpy.argwhere(sphericalMask(half_size, radius, oversampling, inclusive))
+        if centered:
+            positions -= half_size
+        return positions
+
+    return _cached(('sphere', half_size, oversampling, radius, inclusive, centered), build)
+
+def planarSlicePositions(half_size, q_low=0., oversampling=1):
+    """
+    Get the coordinates of the voxels in the three central planes (z=0, y=0 and x=0) outside of a central disk.
+
+    These are the voxels used to compare the orientation of two intensity volumes.
+
+    :param half_size: Number of voxels between the center and the edge of the planes.
+    :type half_size: int (>=0)
+
+    :param q_low: Radius of the excluded disk, voxels at a distance <= q_low from the center are dropped (default 0).
+    :type q_low: float
+
+    :param oversampling: Number of voxels per unit of the coordinates (default 1).
+    :type oversampling: float (>0)
+
+    :return: The coordinates of the voxels in the z=0, y=0 and x=0 planes, in this order.
+    :rtype: numpy.array, shape (n, 3)
+    """
+    half_size, oversampling = _checkGridArguments(half_size, oversampling)
+    q_low = float(q_low)
+
+    def build():
+        axis = coordinateAxis(half_size, oversampling)
+        size = len(axis)
+        u = numpy.repeat(axis, size)
+        v = numpy.tile(axis, size)
+        keep = numpy.sqrt(u*u + v*v) > q_low
+        u, v = u[keep], v[keep]
+        w = numpy.zeros_like(u)
+        return numpy.concatenate((numpy.column_stack((u, v, w)),
+                                  numpy.column_stack((u, w, v)),
+                                  numpy.column_stack((w, u, v))))
+
+    return _cached(('slices', half_size, oversampling, q_low), build)
+
+def clearCache():
+    """ Drop all cached grids. """
+    _GRID_CACHE.clear()
+
+def _checkGridArguments(half_size, oversampling):
+    """ """
+    """ Check and normalize the size and oversampling of a grid.
+
+    :raises ValueError: If the half size is not a non-negative integer or the oversampling is not positive.
+    """
+    if int(half_size) != half_size or half_size < 0:
+        raise ValueError("The half size of the grid must be a non-negative integer.")
+    if not oversampling > 0:
+        raise ValueError("The oversampling must be positive.")
+
+    return int(half_size), float(oversampling)
+
+def _cached(key, build):
+    """ """
+    """ Look up a grid in the cache, build and store it as a read-only array if not found.
+
+    :param key: The cache key.
+    :type key: tuple
+
+    :param build: Function building the grid.
+    :type build: callable
+
+    :return: The cached grid.
+    :rtype: numpy.array
+    """
+    def buildReadOnly():
+        grid = build()
+        grid.flags.writeable = False
+        return grid
+
+    return _GRID_CACHE.get(key, buildReadOnly)
@@ -0,0 +1,485 @@
+""" Module for the binary, memory mappable sparse photon container used by EMC.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+"""
+A sparse photon file stores diffraction patterns as lists of pixels that detected
+exactly one photon ("ones") and pixels that detected more than one photon ("multi")
+together with their photon counts. All numbers are little endian. The file consists of
+
+* a header of HEADER_SIZE bytes: the magic string, format version, number of patterns,
+  number of detector pixels, mean photon count, total number of ones and of multi pixels,
+* 'ones_offsets' (int64, number of patterns + 1): ones of pattern i are place_ones[ones_offsets[i]:ones_offsets[i+1]],
+* 'multi_offsets' (int64, number of patterns + 1): same for place_multi and count_multi,
+* 'place_ones' (int32), 'place_multi' (int32) and 'count_multi' (int32).
+
+Thanks to the offset index every pattern is accessible in O(1) without parsing the file.
+In memory, a chunk of sparse patterns is a dict with the same five array entries.
+"""
+
+import numpy
+import os
+import shutil
+
+SPARSE_PHOTON_MAGIC = b'S2ESPARS'
+SPARSE_PHOTON_VERSION = 1
+HEADER_SIZE = 1024
+
+_HEADER_DTYPE = numpy.dtype([('magic', 'S8'),
+                             ('version', '<i8'),
+                             ('num_data', '<i8'),
+                             ('num_pix', '<i8'),
+                             ('mean_photon', '<f8'),
+                             ('num_ones', '<i8'),
+                             ('num_multi', '<i8'),
+                             ])
+
+_ARRAYS = (('ones_offsets', '<i8'),
+           ('multi_offsets', '<i8'),
+           ('place_ones', '<i4'),
+           ('place_multi', '<i4'),
+           ('count_multi', '<i4'),
+           )
+
+def _header(num_data, num_pix, mean_photon, num_ones, num_multi):
+    """ """
+    """ Pack the file header, padded to HEADER_SIZE bytes. """
+    header = numpy.zeros(1, dtype=_HEADER_DTYPE)
+    header['magic'] = SPARSE_PHOTON_MAGIC
+    header['version'] = SPARSE_PHOTON_VERSION
+    header['num_data'] = num_data
+    header['num_pix'] = num_pix
+    header['mean_photon'] = mean_photon
+    header['num_ones'] = num_ones
+    header['num_multi'] = num_multi
+
+    return header.tobytes() + b'\0'*(HEADER_SIZE - _HEADER_DTYPE.itemsize)
+
+def _readHeader(path):
+    """ """
+    """ Read and check the file header. """
+    header = numpy.fromfile(path, dtype=_HEADER_DTYPE, count=1)
+    if len(header) != 1 or header['magic'][0] != SPARSE_PHOTON_MAGIC:
+        raise IOError("%s is not a sparse photon file." % path)
+    if header['version'][0] > SPARSE_PHOTON_VERSION:
+        raise IOError("Sparse photon file %s has unsupported version %d." % (path, header['version'][0]))
+
+    return dict([(name, header[name][0]) for name in ('num_data', 'num_pix', 'mean_photon', 'num_ones', 'num_multi')])
+
+def _layout(num_data, num_ones, num_multi):
+    """ """
+    """ Byte offset and length of each array in the file. """
+    lengths = {'ones_offsets' : num_data+1,
+               'multi_offsets' : num_data+1,
+               'place_ones' : num_ones,
+               'place_multi' : num_multi,
+               'count_multi' : num_multi,
+               }
+
+    layout = dict()
+    offset = HEADER_SIZE
+    for name, dtype in _ARRAYS:
+        layout[name] = (offset, int(lengths[name]), dtype)
+        offset += int(lengths[name]) * numpy.dtype(dtype).itemsize
+    layout['size'] = offset
+
+    return layout
+
+class SparsePhotonWriter(object):
+    """ Class for streaming sparse patterns into a sparse photon file. """
+
+    def __init__(self, path, num_pix, mean_photon=0.):
+        """
+        :param path: Path of the sparse photon file to write.
+        :type path: str
+
+        :param num_pix: Number of (qualified) detector pixels.
+        :type num_pix: int
+
+        :param mean_photon: Mean number of photons per pixel, stored in the header.
+        :type mean_photon: float, default 0.
+        """
+
+        self.path = path
+        self.num_pix = int(num_pix)
+        self.mean_photon = float(mean_photon)
+
+        self.__ones_offsets = [numpy.zeros(1, dtype='<i8')]
+        self.__multi_offsets = [numpy.zeros(1, dtype='<i8')]
+        self.__num_ones = 0
+        self.__num_multi = 0
+
+        # Index and count arrays are streamed to scratch files and assembled on close().
+        self.__scratch = dict([(name, open(path + '.' + name, 'wb')) for name in ('place_ones', 'place_multi', 'count_multi')])
+
+    @property
+    def num_data(self):
+        """ Query for the number of patterns written so far. """
+        return sum([len(o) for o in self.__ones_offsets]) - 1
+
+    def append(self, sparse):
+        """
+        Append a chunk of sparse patterns.
+
+        :param sparse: The sparse patterns ('ones_offsets', 'multi_offsets', 'place_ones', 'place_multi', 'count_multi').
+        :type sparse: dict
+        """
+
+        ones_offsets = numpy.asarray(sparse['ones_offsets'], dtype='<i8')
+        multi_offsets = numpy.asarray(sparse['multi_offsets'], dtype='<i8')
+
+        self.__ones_offsets.append(ones_offsets[1:] - ones_offsets[0] + self.__num_ones)
+        self.__multi_offsets.append(multi_offsets[1:] - multi_offsets[0] + self.__num_multi)
+
+        place_ones = numpy.asarray(sparse['place_ones'])[ones_offsets[0]:ones_offsets[-1]]
+        place_multi = numpy.asarray(sparse['place_multi'])[multi_offsets[0]:multi_offsets[-1]]
+        count_multi = numpy.asarray(sparse['count_multi'])[multi_offsets[0]:multi_offsets[-1]]
+
+        place_ones.astype('<i4').tofile(self.__scratch['place_ones'])
+        place_multi.astype('<i4').tofile(self.__scratch['place_multi'])
+        count_multi.astype('<i4').tofile(self.__scratch['count_multi'])
+
+        self.__num_ones += len(place_ones)
+        self.__num_multi += len(place_multi)
+
+    def close(self):
+        """ Assemble the sparse photon file from the header, the offset index and the streamed arrays. """
+
+        for fp in self.__scratch.values():
+            fp.close()
+
+        # Write to a temporary file and rename, readers never see a partial file.
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as fp:
+                fp.write(_header(self.num_data, self.num_pix, self.mean_photon, self.__num_ones, self.__num_multi))
+                numpy.concatenate(self.__ones_offsets).tofile(fp)
+                numpy.concatenate(self.__multi_offsets).tofile(fp)
+                for name in ('place_ones', 'place_multi', 'count_multi'):
+                    with open(self.path + '.' + name, 'rb') as scratch:
+                        shutil.copyfileobj(scratch, fp)
+            os.rename(tmp_path, self.path)
+        except:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            self.__removeScratch()
+
+    def abort(self):
+        """ Discard the patterns appended so far. No sparse photon file is written, an existing file is left untouched. """
+
+        for fp in self.__scratch.values():
+            fp.close()
+        self.__removeScratch()
+
+    def __removeScratch(self):
+        """ """
+        """ Remove the scratch files. """
+        for name in self.__scratch.keys():
+            if os.path.isfile(self.path + '.' + name):
+                os.remove(self.path + '.' + name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Only complete writes produce a file, a truncated file would look valid.
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class SparsePhotonBuffer(object):
+    """ Class for collecting sparse patterns in memory, with the append interface of SparsePhotonWriter. """
+
+    def __init__(self):
+        self.__ones_offsets = [numpy.zeros(1, dtype='<i8')]
+        self.__multi_offsets = [numpy.zeros(1, dtype='<i8')]
+        self.__arrays = dict([(name, []) for name in ('place_ones', 'place_multi', 'count_multi')])
+        self.__num_ones = 0
+        self.__num_multi = 0
+
+    @property
+    def num_data(self):
+        """ Query for the number of patterns collected so far. """
+        return sum([len(o) for o in self.__ones_offsets]) - 1
+
+    @property
+    def num_ones(self):
+        """ Query for the number of pixels with one photon collected so far. """
+        return self.__num_ones
+
+    @property
+    def num_multi(self):
+        """ Query for the number of pixels with more than one photon collected so far. """
+        return self.__num_multi
+
+    def append(self, sparse):
+        """
+        Append a chunk of sparse patterns.
+
+        :param sparse: The sparse patterns ('ones_offsets', 'multi_offsets', 'place_ones', 'place_multi', 'count_multi').
+        :type sparse: dict
+        """
+
+        ones_offsets = numpy.asarray(sparse['ones_offsets'], dtype='<i8')
+        multi_offsets = numpy.asarray(sparse['multi_offsets'], dtype='<i8')
+
+        self.__ones_offsets.append(ones_offsets[1:] - ones_offsets[0] + self.__num_ones)
+        self.__multi_offsets.append(multi_offsets[1:] - multi_offsets[0] + self.__num_multi)
+
+        self.__arrays['place_ones'].append(numpy.asarray(sparse['place_ones'])[ones_offsets[0]:ones_offsets[-1]].astype('<i4'))
+        self.__arrays['place_multi'].append(numpy.asarray(sparse['place_multi'])[multi_offsets[0]:multi_offsets[-1]].astype('<i4'))
+        self.__arrays['count_multi'].append(numpy.asarray(sparse['count_multi'])[multi_offsets[0]:multi_offsets[-1]].astype('<i4'))
+
+        self.__num_ones += len(self.__arrays['place_ones'][-1])
+        self.__num_multi += len(self.__arrays['place_multi'][-1])
+
+    def sparse(self):
+        """
+        Query for the collected patterns.
+
+        :return: The sparse patterns, as accepted by writeSparsePhotonRegion.
+        :rtype: dict
+        """
+
+        sparse = {'ones_offsets' : numpy.concatenate(self.__ones_offsets),
+                  'multi_offsets' : numpy.concatenate(self.__multi_offsets),
+                 }
+        for name, arrays in self.__arrays.items():
+            sparse[name] = numpy.concatenate(arrays) if arrays else numpy.zeros(0, dtype='<i4')
+
+        return sparse
+
+def readSparsePhotons(path):
+    """
+    Open a sparse photon file. The arrays are memory mapped read-only.
+
+    :param path: Path of the sparse photon file.
+    :type path: str
+
+    :return: The header entries ('num_data', 'num_pix', 'mean_photon') and the sparse arrays.
+    :rtype: dict
+
+    :raises IOError: The file is not a sparse photon file.
+    """
+
+    header = _readHeader(path)
+    layout = _layout(header['num_data'], header['num_ones'], header['num_multi'])
+
+    sparse = {'num_data' : int(header['num_data']),
+              'num_pix' : int(header['num_pix']),
+              'mean_photon' : float(header['mean_photon']),
+              }
+
+    for name, dtype in _ARRAYS:
+        offset, length, dtype = layout[name]
+        if length > 0:
+            sparse[name] = numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(length,))
+        else:
+            sparse[name] = numpy.zeros(0, dtype=dtype)
+
+    return sparse
+
+def getPattern(sparse, index):
+    """
+    Access a single pattern.
+
+    :param sparse: The sparse patterns.
+    :type sparse: dict
+
+    :param index: Index of the pattern.
+    :type index: int
+
+    :return: Pixels with one photon, pixels with multiple photons and their counts (views, no copies).
+    :rtype: tuple (numpy.array, numpy.array, numpy.array)
+    """
+
+    o0, o1 = sparse['ones_offsets'][index], sparse['ones_offsets'][index+1]
+    m0, m1 = sparse['multi_offsets'][index], sparse['multi_offsets'][index+1]
+
+    return sparse['place_ones'][o0:o1], sparse['place_multi'][m0:m1], sparse['count_multi'][m0:m1]
+
+def allocateSparsePhotonFile(path, num_data, num_pix, num_ones, num_multi, mean_photon=0.):
+    """
+    Create a sparse photon file of the final size, to be filled by writeSparsePhotonRegion.
+
+    :param path: Path of the sparse photon file.
+    :type path: str
+
+    :param num_data: Total number of patterns.
+    :type num_data: int
+
+    :param num_pix: Number of (qualified) detector pixels.
+    :type num_pix: int
+
+    :param num_ones: Total number of pixels with one photon.
+    :type num_ones: int
+
+    :param num_multi: Total number of pixels with more than one photon.
+    :type num_multi: int
+
+    :param mean_photon: Mean number of photons per pixel.
+    :type mean_photon: float, default 0.
+    """
+
+    layout = _layout(num_data, num_ones, num_multi)
+    with open(path, 'wb') as fp:
+        fp.write(_header(num_data, num_pix, mean_photon, num_ones, num_multi))
+        # Unwritten regions read as zero, in particular the leading offsets.
+        fp.truncate(layout['size'])
+
+def writeSparsePhotonRegion(path, sparse, first_pattern, first_one, first_multi, chunk_size=1<<22):
+    """
+    Write sparse patterns into their region of an allocated sparse photon file.
+    Different processes may write disjoint regions of the same file concurrently.
+
+    :param path: Path of the allocated sparse photon file.
+    :type path: str
+
+    :param sparse: The sparse patterns to write.
+    :type sparse: dict
+
+    :param first_pattern: Index of the first pattern of the region.
+    :type first_pattern: int
+
+    :param first_one: Index of the first ones entry of the region.
+    :type first_one: int
+
+    :param first_multi: Index of the first multi entry of the region.
+    :type first_multi: int
+
+    :param chunk_size: Number of array elements copied at once.
+    :type chunk_size: int, default 4194304
+    """
+
+    header = _readHeader(path)
+    layout = _layout(header['num_data'], header['num_ones'], header['num_multi'])
+
+    ones_offsets = numpy.asarray(sparse['ones_offsets'])
+    multi_offsets = numpy.asarray(sparse['multi_offsets'])
+    data = {'ones_offsets' : (first_pattern+1, ones_offsets[1:] - ones_offsets[0] + first_one),
+            'multi_offsets' : (first_pattern+1, multi_offsets[1:] - multi_offsets[0] + first_multi),
+            'place_ones' : (first_one, sparse['place_ones'][ones_offsets[0]:ones_offsets[-1]]),
+            'place_multi' : (first_multi, sparse['place_multi'][multi_offsets[0]:multi_offsets[-1]]),
+            'count_multi' : (first_multi, sparse['count_multi'][multi_offsets[0]:multi_offsets[-1]]),
+            }
+
+    with open(path, 'r+b') as fp:
+        for name, dtype in _ARRAYS:
+            offset, length, dtype = layout[name]
+            first, values = data[name]
+            if first + len(values) > length:
+                raise IOError("Region exceeds the allocated %s of %s." % (name, path))
+            fp.seek(offset + first*numpy.dtype(dtype).itemsize)
+            for start in range(0, len(values), chunk_size):
+                numpy.asarray(values[start:start+chunk_size]).astype(dtype).tofile(fp)
+
+def joinSparsePhotonFiles(paths, out_path, mean_photon=None):
+    """
+    Concatenate sparse photon files.
+
+    :param paths: Paths of the files to join, in order.
+    :type paths: list of str
+
+    :param out_path: Path of the joined file.
+    :type out_path: str
+
+    :param mean_photon: Mean photon count for the header.
+    :type mean_photon: float, default None (take from first file)
+    """
+
+    parts = [readSparsePhotons(path) for path in paths]
+    if mean_photon is None:
+        mean_photon = parts[0]['mean_photon']
+
+    with SparsePhotonWriter(out_path, num_pix=parts[0]['num_pix'], mean_photon=mean_photon) as writer:
+        for part in parts:
+            writer.append(part)
+
+def toASCIILines(sparse, start=0, stop=None):
+    """
+    Format sparse patterns as lines of the ASCII EMC photons.dat format.
+
+    :param sparse: The sparse patterns.
+    :type sparse: dict
+
+    :param start: Index of the first pattern to format.
+    :type start: int, default 0
+
+    :param stop: Index after the last pattern to format.
+    :type stop: int, default None (all patterns)
+
+    :return: One line per pattern: number of ones, ones, number of multi pixels, (pixel, count) pairs.
+    :rtype: list of str
+    """
+
+    if stop is None:
+        stop = len(sparse['ones_offsets']) - 1
+
+    lines = []
+    for n in range(start, stop):
+        ones, multi, counts = getPattern(sparse, n)
+        ssO = ' '.join(map(str, ones.tolist()))
+        pairs = numpy.empty((len(multi), 2), dtype=numpy.int64)
+        pairs[:,0] = multi
+        pairs[:,1] = counts
+        ssM = ' '.join(["%d %d "]*len(pairs)) % tuple(pairs.ravel().tolist())
+        lines.append(' '.join([str(len(ones)), ssO, str(len(multi)), ssM]) + "\n")
+
+    return lines
+
+def asciiHeader(num_data, mean_photon):
+    """
+    Format the first line of the ASCII EMC photons.dat format.
+
+    :param num_data: Number of patterns.
+    :type num_data: int
+
+    :param mean_photon: Mean number of photons per pixel.
+    :type mean_photon: float
+
+    :return: The header line.
+    :rtype: str
+    """
+
+    return "%d %lf \n" % (num_data, mean_photon)
+
+def writeASCII(sparse, path, chunk_size=1024):
+    """
+    Write sparse patterns to an ASCII EMC photons.dat file.
+
+    :param sparse: The sparse patterns (as returned by readSparsePhotons).
+    :type sparse: dict
+
+    :param path: Path of the ASCII file.
+    :type path: str
+
+    :param chunk_size: Number of patterns formatted at once.
+    :type chunk_size: int, default 1024
+    """
+
+    num_data = len(sparse['ones_offsets']) - 1
+    with open(path, 'w') as fp:
+        fp.write(asciiHeader(num_data, sparse['mean_photon']))
+        for start in range(0, num_data, chunk_size):
+            fp.writelines(toASCIILines(sparse, start, min(start+chunk_size, num_data)))
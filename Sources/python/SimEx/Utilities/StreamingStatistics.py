@@ -0,0 +1,223 @@
+""" Module for single pass, constant memory statistics over sequences of arrays (e.g. diffraction patterns).  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+"""
+A StreamingStatistics object is updated with one array (pattern) at a time and holds
+
+* the per pixel sum, mean, variance (Welford's algorithm), minimum and maximum,
+* the total of each array (photon number per pattern),
+* optionally, the histogram of non-negative pixel values rounded to integers (photon count histogram)
+  over a fixed number of bins, the last bin collecting all larger values.
+
+Memory does not grow with the number of arrays, apart from one number per array for the totals.
+Partial statistics over disjoint sets of arrays (e.g. computed in different processes) are
+combined with merge() (Chan et al., "Updating formulae and a pairwise algorithm for computing
+sample variances", 1979).
+"""
+
+import numpy
+
+class StreamingStatistics(object):
+    """
+    :class StreamingStatistics: Running per pixel statistics over a sequence of arrays of equal shape.
+    """
+
+    def __init__(self, arrays=None, histogram_bins=None):
+        """
+        Constructor for the StreamingStatistics class.
+
+        :param arrays: Arrays to start with (default None).
+        :type arrays: iterable over numpy.array
+
+        :param histogram_bins: Number of bins of the photon count histogram (default None: no histogram).
+        :type histogram_bins: int
+        """
+        self.count = 0
+        self.sum = None
+        self.mean = None
+        self.min = None
+        self.max = None
+        self.__m2 = None
+        self.__totals = []
+        self.__histogram = None
+        if histogram_bins is not None:
+            if histogram_bins < 1:
+                raise ValueError("Number of histogram bins must be positive.")
+            self.__histogram = numpy.zeros(int(histogram_bins), dtype=numpy.int64)
+
+        if arrays is not None:
+            for array in arrays:
+                self.update(array)
+
+    def update(self, array):
+        """
+        Add an array to the statistics.
+
+        :param array: The array to add.
+        :type array: numpy.array
+
+        :raises ValueError: If the shape differs from the arrays added before.
+        """
+        array = numpy.asarray(array)
+
+        if self.count == 0:
+            self.sum = array.astype(float)
+            self.mean = array.astype(float)
+            self.min = array.astype(float)
+            self.max = array.astype(float)
+            self.__m2 = numpy.zeros(array.shape)
+        else:
+            if array.shape != self.mean.shape:
+                raise ValueError("Cannot add array of shape %s to statistics of shape %s." % (array.shape, self.mean.shape))
+
+            # Welford update.
+            delta = array - self.mean
+            self.mean += delta / (self.count + 1.)
+            self.__m2 += delta * (array - self.mean)
+            self.sum += array
+            numpy.minimum(self.min, array, out=self.min)
+            numpy.maximum(self.max, array, out=self.max)
+
+        self.count += 1
+        self.__totals.append(float(array.sum()))
+        if self.__histogram is not None:
+            bins = len(self.__histogram)
+            counts = numpy.minimum(numpy.rint(array[array >= 0]), bins - 1).astype(numpy.int64)
+            self.__histogram += numpy.bincount(counts.ravel(), minlength=bins)
+
+    def merge(self, other):
+        """
+        Add the statistics of another (disjoint) set of arrays.
+
+        :param other: The statistics to merge into this one. Totals of other are appended.
+        :type other: StreamingStatistics
+
+        :return: This object.
+        :rtype: StreamingStatistics
+
+        :raises ValueError: If the shapes or the histogram bins differ.
+        """
+        if (self.__histogram is None) != (other.__histogram is None) or \
+           (self.__histogram is not None and len(self.__histogram) != len(other.__histogram)):
+            raise ValueError("Cannot merge statistics with different histogram bins.")
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count = other.count
+            self.sum = other.sum.copy()
+            self.mean = other.mean.copy()
+            self.min = other.min.copy()
+            self.max = other.max.copy()
+            self.__m2 = other.__m2.copy()
+        else:
+            if other.mean.shape != self.mean.shape:
+                raise ValueError("Cannot merge statistics of shape %s into statistics of shape %s." % (other.mean.shape, self.mean.shape))
+
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.__m2 += other.__m2 + delta**2 * (self.count * other.count / float(count))
+            self.mean += delta * (other.count / float(count))
+            self.sum += other.sum
+            numpy.minimum(self.min, other.min, out=self.min)
+            numpy.maximum(self.max, other.max, out=self.max)
+            self.count = count
+
+        self.__totals.extend(other.totals)
+        if self.__histogram is not None:
+            self.__histogram += other.__histogram
+
+        return self
+
+    @property
+    def variance(self):
+        """ Query the per pixel (population) variance. """
+        if self.count == 0:
+            return None
+        return self.__m2 / self.count
+
+    @property
+    def std(self):
+        """ Query the per pixel standard deviation. """
+        if self.count == 0:
+            return None
+        return numpy.sqrt(self.variance)
+
+    @property
+    def totals(self):
+        """ Query the sum over each array (e.g. the photon number of each pattern), in order of addition. """
+        return numpy.array(self.__totals)
+
+    @property
+    def histogram(self):
+        """ Query the photon count histogram: entry n holds the number of pixels with n (rounded) counts, the last entry
+        the number of pixels with at least as many counts. Negative values are not counted. None if not requested. """
+        if self.__histogram is None:
+            return None
+        return self.__histogram.copy()
+
+    def reduce(self, operation):
+        """
+        Get the result of a numpy reduction over all arrays.
+
+        :param operation: The reduction (numpy.sum, numpy.mean, numpy.std, numpy.var, numpy.min or numpy.max).
+        :type operation: python function
+
+        :return: The per pixel result of operation(stack, axis=0), a copy that does not change with further updates.
+        :rtype: numpy.array
+
+        :raises ValueError: If the operation has no streaming equivalent.
+        """
+        if not isStreamable(operation):
+            raise ValueError("No streaming equivalent for %s." % (operation))
+
+        result = getattr(self, _STREAMING_OPERATIONS[operation])
+        if result is None:
+            return None
+
+        return numpy.array(result, copy=True)
+
+def isStreamable(operation):
+    """
+    Check if a numpy reduction has a streaming equivalent in StreamingStatistics.
+
+    :param operation: The reduction to check.
+    :type operation: python function
+
+    :return: True for numpy.sum, numpy.mean, numpy.std, numpy.var, numpy.min and numpy.max.
+    :rtype: bool
+    """
+    try:
+        return operation in _STREAMING_OPERATIONS
+    except TypeError:
+        return False
+
+_STREAMING_OPERATIONS = {
+        numpy.sum  : 'sum',
+        numpy.mean : 'mean',
+        numpy.std  : 'std',
+        numpy.var  : 'variance',
+        numpy.amin : 'min',
+        numpy.amax : 'max',
+        }
+# Aliases in older numpy versions, separate functions in newer ones.
+_STREAMING_OPERATIONS[numpy.min] = 'min'
+_STREAMING_OPERATIONS[numpy.max] = 'max'
@@ -21,6 +21,8 @@
 #                                                                        #
 ##########################################################################
 
+import os
+import tempfile
 
 ALL_ELEMENTS= ['H','He',
 'Li','Be','B','C','N','O','F','Ne',
@@ -31,3 +33,41 @@ ALL_ELEMENTS= ['H','He',
 'Fr','Ra','Rf','Db','Sg','Bh','Hs','Mt','Ds','Rg','Cn','Uut','Fl','Uup','Lv','Uus','Uuo',
 'La','Ce','Pr','Nd','Pm','Sm','Eu','Gd','Tb','Dy','Ho','Er','Tm','Yb','Lu',
 'Ac','Th','Pa','U','Np','Pu','Am','Cm','Bk','Cf','Es','Fm','Md','No','Lr']
+
+def decodeString(value):
+    """
+    Decode a string read from HDF5 (bytes under python3).
+
+    :param value: The string as read from the file.
+    :type value: bytes or str
+
+    :return: The decoded string.
+    :rtype: str
+    """
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8')
+    return str(value)
+
+def writeAtomically(path, write, suffix=''):
+    """
+    Write a file through a temporary file in the same directory that is moved in place, so readers
+    never see a partial file. The temporary file is removed if writing fails.
+
+    :param path: Path of the file to write.
+    :type path: str
+
+    :param write: Function writing the content to the (temporary) path passed as argument.
+    :type write: function
+
+    :param suffix: Suffix of the temporary file name (default '').
+    :type suffix: str
+    """
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=suffix)
+    os.close(handle)
+    try:
+        write(tmp_path)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,426 @@
+""" Module for bounded memory reductions over wavefront files.  """
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2017 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+"""
+A wavefront file written by wpg holds the complex electric field in /data/arrEhor and /data/arrEver,
+each of shape (ny, nx, nSlices, 2) (real and imaginary part), and the mesh in /params/Mesh. The
+reductions here read the field in chunks of time slices (or of rows, for transforms along the time
+axis), so memory does not grow with the number of slices. Chunks can be reduced on a process pool.
+
+The intensity is |Ehor|^2 + |Ever|^2, in W/mm^2 for fields in sqrt(W/mm^2), with nans set to 0.
+Spectra are normalized such that their integral over photon energy equals the pulse energy. The time
+domain fields are taken as slowly varying envelopes of exp(-i omega t) around the central photon energy,
+so a phase exp(-i delta t) shifts the spectrum to higher photon energies. This is the convention of the
+time to frequency switch of SRW (srwl.SetRepresElecField), which XFELPhotonAnalysis used before;
+WavefrontStreamTest compares both on a detuned pulse when SRW is available.
+"""
+
+from scipy.constants import physical_constants, speed_of_light
+import h5py
+import hashlib
+import multiprocessing
+import numpy
+import os
+
+from SimEx.Utilities.ReciprocalGrid import LRUCache
+from SimEx.Utilities.Utilities import decodeString
+
+# Planck constant in eV s.
+PLANCK_EV_S = physical_constants['Planck constant in eV s'][0]
+
+# Maximum number of files whose beam moments are kept.
+BEAM_MOMENTS_CACHE_SIZE = 64
+
+# Beam moments by digest of the file content, and content digests by file stamp.
+_BEAM_MOMENTS_CACHE = LRUCache(BEAM_MOMENTS_CACHE_SIZE)
+_DIGEST_CACHE = LRUCache(BEAM_MOMENTS_CACHE_SIZE)
+
+class WavefrontStream(object):
+    """
+    :class WavefrontStream: Reductions over a wavefront file, reading the electric field in chunks.
+    """
+
+    def __init__(self, input_path, chunk_size=64):
+        """
+        Constructor for the WavefrontStream class.
+
+        :param input_path: Path of the wavefront file.
+        :type input_path: str
+
+        :param chunk_size: Number of time slices per chunk (default 64). Transforms along the time axis read as many rows as hold the same number of values.
+        :type chunk_size: int
+
+        :raises IOError: If the file does not exist or holds no wavefront.
+        """
+        if not os.path.isfile(input_path):
+            raise IOError("File not found: %s." % (input_path))
+
+        self.input_path = input_path
+        self.chunk_size = max(1, int(chunk_size))
+
+        try:
+            with h5py.File(input_path, 'r') as h5:
+                mesh = h5['params/Mesh']
+                self.mesh = dict((key, mesh[key][()]) for key in ['nx', 'ny', 'nSlices', 'xMin', 'xMax', 'yMin', 'yMax', 'sliceMin', 'sliceMax'])
+                self.photon_energy = float(h5['params/photonEnergy'][()]) if 'photonEnergy' in h5['params'] else None
+                self.domain = decodeString(h5['params/wDomain'][()]) if 'wDomain' in h5['params'] else 'time'
+                self.shape = h5['data/arrEhor'].shape[:3]
+        except KeyError as e:
+            raise IOError("%s holds no wavefront: %s" % (input_path, e))
+
+    @property
+    def slices(self):
+        """ Query the time (s) or photon energy (eV, frequency domain) of each slice. """
+        mesh = self.mesh
+        if mesh['nSlices'] < 2:
+            return numpy.array([0.5*(mesh['sliceMin'] + mesh['sliceMax'])])
+        dSlice = (mesh['sliceMax'] - mesh['sliceMin'])/(mesh['nSlices'] - 1)
+        return numpy.arange(mesh['nSlices'])*dSlice + mesh['sliceMin']
+
+    @property
+    def limits(self):
+        """ Query the transverse limits (xmin, xmax, ymin, ymax) in m. """
+        mesh = self.mesh
+        return (mesh['xMin'], mesh['xMax'], mesh['yMin'], mesh['yMax'])
+
+    @property
+    def pixel_area(self):
+        """ Query the area of a mesh cell in mm^2. """
+        mesh = self.mesh
+        dx = (mesh['xMax'] - mesh['xMin'])/(mesh['nx'] - 1)
+        dy = (mesh['yMax'] - mesh['yMin'])/(mesh['ny'] - 1)
+        return dx*dy*1.e6
+
+    def intensityChunks(self, start=0, stop=None):
+        """
+        Yield the intensity in chunks of time slices.
+
+        :param start: First slice (default 0).
+        :type start: int
+
+        :param stop: Slice to stop before (default: all slices).
+        :type stop: int
+
+        :return: Generator over (first slice, intensity of shape (ny, nx, n)).
+        """
+        if stop is None:
+            stop = self.shape[2]
+        with h5py.File(self.input_path, 'r') as h5:
+            ehor, ever = h5['data/arrEhor'], h5['data/arrEver']
+            for first in range(start, stop, self.chunk_size):
+                last = min(stop, first + self.chunk_size)
+                yield first, _intensity(ehor[:,:,first:last], ever[:,:,first:last])
+
+    def totalPower(self, number_of_processes=1):
+        """
+        Get the power integrated over the transverse dimensions.
+
+        :param number_of_processes: Number of processes reducing disjoint slice ranges (default 1).
+        :type number_of_processes: int
+
+        :return: Time (s) of each slice and the power (W), photon energy (eV) and spectral energy (J/eV) in frequency domain.
+        :rtype: tuple (numpy.array, numpy.array)
+        """
+        parts = self.__reduce(_slicePower, self.shape[2], number_of_processes)
+        return self.slices, numpy.concatenate(parts)*self.pixel_area
+
+    def onAxisPowerDensity(self):
+        """
+        Get the power density at the center pixel. Only the center pixel is read.
+
+        :return: Time (s) of each slice and the power density (W/mm^2), photon energy (eV) and spectral fluence (J/eV/mm^2) in frequency domain.
+        :rtype: tuple (numpy.array, numpy.array)
+        """
+        center_ny, center_nx = int(self.mesh['ny']/2), int(self.mesh['nx']/2)
+        with h5py.File(self.input_path, 'r') as h5:
+            density = _intensity(h5['data/arrEhor'][center_ny, center_nx], h5['data/arrEver'][center_ny, center_nx])
+        return self.slices, density
+
+    def intensityMap(self, number_of_processes=1):
+        """
+        Get the intensity integrated over all slices.
+
+        :param number_of_processes: Number of processes reducing disjoint slice ranges (default 1).
+        :type number_of_processes: int
+
+        :return: The intensity map, shape (ny, nx), and its limits (xmin, xmax, ymin, ymax) in m.
+        :rtype: tuple (numpy.array, tuple)
+        """
+        parts = self.__reduce(_sliceMap, self.shape[2], number_of_processes)
+        return numpy.sum(parts, axis=0), self.limits
+
+    def angularIntensityMap(self, number_of_processes=1):
+        """
+        Get the far field (angular domain) intensity integrated over all slices.
+
+        Each chunk of slices is transformed with a batched 2D FFT over the transverse dimensions and the squared
+        transforms are accumulated, the wavefront is neither copied nor converted as a whole. Angles are
+        wavelength times spatial frequency, at the central photon energy.
+
+        :param number_of_processes: Number of processes reducing disjoint slice ranges (default 1).
+        :type number_of_processes: int
+
+        :return: The intensity map, shape (ny, nx), and the angles (rad) of its columns and rows. The map is normalized such that its integral over the angles equals the integral of intensityMap() over the area (m^2).
+        :rtype: tuple (numpy.array, numpy.array, numpy.array)
+
+        :raises ValueError: If the wavefront has no photon energy.
+        """
+        scale, angles_x, angles_y = self.__angles()
+        parts = self.__reduce(_sliceAngularMap, self.shape[2], number_of_processes)
+
+        return numpy.fft.fftshift(numpy.sum(parts, axis=0))*scale, angles_x, angles_y
+
+    def spectrum(self, number_of_processes=1):
+        """
+        Get the spectral energy integrated over the transverse dimensions, transforming each pixel along the time axis.
+
+        :param number_of_processes: Number of processes reducing disjoint row ranges (default 1).
+        :type number_of_processes: int
+
+        :return: Photon energy (eV) and spectral energy (J/eV).
+        :rtype: tuple (numpy.array, numpy.array)
+
+        :raises ValueError: If the wavefront is not in time domain.
+        """
+        self.__checkTimeDomain()
+        parts = self.__reduce(_rowSpectrum, self.shape[0], number_of_processes, self.__rowsPerChunk())
+        energies, order = self.__energies()
+        return energies, numpy.sum(parts, axis=0)[order]*self.__spectralScale()*self.pixel_area
+
+    def onAxisSpectrum(self):
+        """
+        Get the spectral fluence at the center pixel.
+
+        :return: Photon energy (eV) and spectral fluence (J/eV/mm^2).
+        :rtype: tuple (numpy.array, numpy.array)
+
+        :raises ValueError: If the wavefront is not in time domain.
+        """
+        self.__checkTimeDomain()
+        center_ny, center_nx = int(self.mesh['ny']/2), int(self.mesh['nx']/2)
+        with h5py.File(self.input_path, 'r') as h5:
+            fluence = _spectralIntensity(h5['data/arrEhor'][center_ny, center_nx], h5['data/arrEver'][center_ny, center_nx])
+        energies, order = self.__energies()
+        return energies, fluence[order]*self.__spectralScale()
+
+    def beamMoments(self, number_of_processes=1):
+        """
+        Get the beam parameters from one pass over chunks of slices and one pass over chunks of rows.
+
+        :param number_of_processes: Number of processes reducing disjoint ranges (default 1).
+        :type number_of_processes: int
+
+        :return: Dictionary of the pulse energy (J), the rms duration (s), the mean photon energy (eV), the full widths at half maximum in x and y (m) of the intensity map, and those of the far field map (rad).
+        :rtype: dict
+
+        :raises ValueError: If the wavefront is not in time domain or has no photon energy.
+        """
+        self.__checkTimeDomain()
+        scale, angles_x, angles_y = self.__angles()
+
+        parts = self.__reduce(_sliceMoments, self.shape[2], number_of_processes)
+        times = self.slices
+        power = numpy.concatenate([part[0] for part in parts])*self.pixel_area
+        intensity_map = numpy.sum([part[1] for part in parts], axis=0)
+        angular_map = numpy.fft.fftshift(numpy.sum([part[2] for part in parts], axis=0))
+
+        energies, spectrum = self.spectrum(number_of_processes)
+
+        mean_time = numpy.sum(power*times)/power.sum()
+        mean_energy = numpy.sum(spectrum*energies)/spectrum.sum()
+        dt = times[1] - times[0] if len(times) > 1 else 1.0
+        xmin, xmax, ymin, ymax = self.limits
+
+        return {
+                'pulse_energy' : power.sum()*dt,
+                'duration_rms' : numpy.sqrt(numpy.sum(power*(times - mean_time)**2)/power.sum()),
+                'photon_energy' : mean_energy,
+                'fwhm_x' : _fwhm(intensity_map, (xmax - xmin)/(self.shape[1] - 1), axis=1),
+                'fwhm_y' : _fwhm(intensity_map, (ymax - ymin)/(self.shape[0] - 1), axis=0),
+                'divergence_fwhm_x' : _fwhm(angular_map, angles_x[1] - angles_x[0], axis=1),
+                'divergence_fwhm_y' : _fwhm(angular_map, angles_y[1] - angles_y[0], axis=0),
+                }
+
+    def __angles(self):
+        """ """
+        """ Scale from squared transverse transforms to intensity per rad^2, and the ascending angles in x and y. """
+        if not self.photon_energy:
+            raise ValueError("Cannot compute angles without the photon energy of %s." % (self.input_path))
+
+        mesh = self.mesh
+        wavelength = PLANCK_EV_S*speed_of_light/self.photon_energy
+        dx = (mesh['xMax'] - mesh['xMin'])/(mesh['nx'] - 1)
+        dy = (mesh['yMax'] - mesh['yMin'])/(mesh['ny'] - 1)
+
+        angles_x = numpy.fft.fftshift(numpy.fft.fftfreq(self.shape[1], dx))*wavelength
+        angles_y = numpy.fft.fftshift(numpy.fft.fftfreq(self.shape[0], dy))*wavelength
+
+        return (dx*dy/wavelength)**2, angles_x, angles_y
+
+    def __checkTimeDomain(self):
+        """ """
+        """ Spectra are transforms of the time domain field. """
+        if self.domain != 'time':
+            raise ValueError("Cannot compute the spectrum of a wavefront in %s domain." % (self.domain))
+
+    def __rowsPerChunk(self):
+        """ """
+        """ Number of rows holding as many values as a chunk of slices. """
+        return max(1, self.chunk_size*self.shape[0]//max(1, self.shape[2]))
+
+    def __energies(self):
+        """ """
+        """ Ascending photon energies of the transformed slices, and the order to apply to the transform. """
+        dt = self.slices[1] - self.slices[0] if len(self.slices) > 1 else 1.0
+        photon_energy = self.photon_energy if self.photon_energy is not None else 0.0
+        # Envelopes of exp(-i omega t): frequency f of the numpy transform is photon energy E0 - h f.
+        energies = photon_energy - numpy.fft.fftfreq(self.shape[2], dt)*PLANCK_EV_S
+        order = numpy.argsort(energies)
+        return energies[order], order
+
+    def __spectralScale(self):
+        """ """
+        """ Factor from squared transforms to spectral densities per eV, such that the integral equals the time integral. """
+        dt = self.slices[1] - self.slices[0] if len(self.slices) > 1 else 1.0
+        return dt**2/PLANCK_EV_S
+
+    def __reduce(self, function, length, number_of_processes, chunk_size=None):
+        """ """
+        """ Apply function(stream, start, stop, chunk_size) to consecutive ranges, on a pool if requested. """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        tasks = [(function, self, start, min(length, start + chunk_size)) for start in range(0, length, chunk_size)]
+
+        if number_of_processes <= 1 or len(tasks) < 2:
+            return [_reduceRange(task) for task in tasks]
+
+        pool = multiprocessing.Pool(min(number_of_processes, len(tasks)))
+        try:
+            return pool.map(_reduceRange, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+def beamMoments(input_path, number_of_processes=1):
+    """
+    Get the beam parameters of a wavefront file, see WavefrontStream.beamMoments.
+
+    Results are cached by the SHA-1 digest of the file content, so renamed or copied files
+    are not reduced again and rewritten files are. The content is hashed only for files whose
+    size, modification time or inode changed since the last call.
+
+    :param input_path: Path of the wavefront file.
+    :type input_path: str
+
+    :param number_of_processes: Number of processes reducing disjoint ranges (default 1).
+    :type number_of_processes: int
+
+    :return: Dictionary of beam parameters.
+    :rtype: dict
+    """
+    if not os.path.isfile(input_path):
+        raise IOError("File not found: %s." % (input_path))
+
+    status = os.stat(input_path)
+    stamp = (os.path.abspath(input_path), status.st_size, status.st_mtime, status.st_dev, status.st_ino)
+    digest = _DIGEST_CACHE.get(stamp, lambda: _contentDigest(input_path))
+    moments = _BEAM_MOMENTS_CACHE.get(digest, lambda: WavefrontStream(input_path).beamMoments(number_of_processes))
+
+    return dict(moments)
+
+def _contentDigest(path, block_size=2**22):
+    """ """
+    """ SHA-1 hex digest of the file content, read in blocks. """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as stream:
+        for block in iter(lambda: stream.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _fwhm(intensity_map, step, axis):
+    """ """
+    """ Number of pixels above half maximum on the central row (axis 1) or column (axis 0), times the step. """
+    if axis == 1:
+        profile = intensity_map[intensity_map.shape[0]//2, :]
+    else:
+        profile = intensity_map[:, intensity_map.shape[1]//2]
+    return numpy.count_nonzero(profile > 0.5*profile.max())*abs(step)
+
+def _reduceRange(task):
+    """ """
+    """ Reduce one range of slices or rows, in a pool process or inline. """
+    function, stream, start, stop = task
+    with h5py.File(stream.input_path, 'r') as h5:
+        return function(h5['data/arrEhor'], h5['data/arrEver'], start, stop)
+
+def _slicePower(ehor, ever, start, stop):
+    """ """
+    """ Intensity of slices start:stop summed over the transverse dimensions. """
+    return _intensity(ehor[:,:,start:stop], ever[:,:,start:stop]).sum(axis=(0,1))
+
+def _sliceMap(ehor, ever, start, stop):
+    """ """
+    """ Intensity of slices start:stop summed over the slices. """
+    return _intensity(ehor[:,:,start:stop], ever[:,:,start:stop]).sum(axis=-1)
+
+def _sliceAngularMap(ehor, ever, start, stop):
+    """ """
+    """ Squared transverse transforms of slices start:stop, summed over the slices. """
+    return _angularMap(ehor[:,:,start:stop], ever[:,:,start:stop])
+
+def _sliceMoments(ehor, ever, start, stop):
+    """ """
+    """ Power per slice, intensity map and far field map of slices start:stop, from one read. """
+    ehor, ever = ehor[:,:,start:stop], ever[:,:,start:stop]
+    intensity = _intensity(ehor, ever)
+    return intensity.sum(axis=(0,1)), intensity.sum(axis=-1), _angularMap(ehor, ever)
+
+def _rowSpectrum(ehor, ever, start, stop):
+    """ """
+    """ Squared transforms along the time axis of rows start:stop, summed over the pixels. """
+    return _spectralIntensity(ehor[start:stop], ever[start:stop]).sum(axis=(0,1))
+
+def _intensity(ehor, ever):
+    """ """
+    """ |Ehor|^2 + |Ever|^2 from fields with real and imaginary part in the last axis, nans set to 0. """
+    intensity = numpy.square(ehor, dtype=numpy.float64).sum(axis=-1)
+    intensity += numpy.square(ever, dtype=numpy.float64).sum(axis=-1)
+    intensity[numpy.isnan(intensity)] = 0.0
+    return intensity
+
+def _angularMap(ehor, ever):
+    """ """
+    """ |FFT2(Ehor)|^2 + |FFT2(Ever)|^2 over the transverse dimensions, summed over the slices, nans set to 0. """
+    angular_map = numpy.zeros(ehor.shape[:2])
+    for field in (ehor, ever):
+        field = numpy.nan_to_num(field[...,0] + 1j*field[...,1])
+        angular_map += (numpy.abs(numpy.fft.fft2(field, axes=(0,1)))**2).sum(axis=-1)
+    return angular_map
+
+def _spectralIntensity(ehor, ever):
+    """ """
+    """ |FFT(Ehor)|^2 + |FFT(Ever)|^2 along the time axis (second to last), nans set to 0. """
+    spectral = numpy.zeros(ehor.shape[:-1])
+    for field in (ehor, ever):
+        field = numpy.nan_to_num(field[...,0] + 1j*field[...,1])
+        spectral += numpy.abs(numpy.fft.fft(field, axis=-1))**2
+    return spectral
@@ -39,7 +39,7 @@ from TestUtilities import TestUtilities
 # Import the class to test.
 from SimEx.Analysis.AbstractAnalysis import AbstractAnalysis, plt
 from SimEx.Analysis.DiffractionAnalysis import DiffractionAnalysis
-from SimEx.Analysis.DiffractionAnalysis import diffractionParameters, plotImage
+from SimEx.Analysis.DiffractionAnalysis import azimuthalIntegration, diffractionParameters, photonNumberHistogram, plotImage
 
 
 if 'RENDER_PLOT' in os.environ:
@@ -213,6 +213,111 @@ class DiffractionAnalysisTest(unittest.TestCase):
         analyzer.plotRadialProjection(operation=numpy.std)
 
 
+    def testComputeOnly(self):
+        """ Check that the data behind the plots is available without plotting. """
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=range(1,11), poissonize=True)
+        stack = numpy.array([p for p in analyzer.patternGenerator()])
+
+        self.assertTrue( numpy.allclose(analyzer.reducedPattern(), numpy.sum(stack, axis=0)) )
+        self.assertTrue( numpy.allclose(analyzer.reducedPattern(numpy.median), numpy.median(stack, axis=0)) )
+
+        qs, intensities = analyzer.radialProjection(operation=numpy.mean)
+        self.assertTrue( numpy.allclose(intensities, azimuthalIntegration(numpy.mean(stack, axis=0), analyzer.parameters)[1]) )
+
+        avg, rms, counts, edges = photonNumberHistogram(numpy.sum(stack, axis=(1,2)))
+        self.assertAlmostEqual( avg, numpy.sum(stack, axis=(1,2)).mean() )
+        self.assertEqual( counts.sum(), len(stack) )
+        self.assertEqual( len(counts), len(edges) - 1 )
+
+    def testStreamingStatistics(self):
+        """ Check that the single pass statistics agree with reductions over the stacked patterns. """
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices="all", poissonize=True)
+        stack = numpy.array([p for p in analyzer.patternGenerator()])
+
+        for number_of_processes in [1, 2]:
+            statistics = analyzer.streamingStatistics(number_of_processes=number_of_processes)
+
+            self.assertEqual( statistics.count, len(stack) )
+            self.assertTrue( numpy.allclose(statistics.sum, numpy.sum(stack, axis=0)) )
+            self.assertTrue( numpy.allclose(statistics.mean, numpy.mean(stack, axis=0)) )
+            self.assertTrue( numpy.allclose(statistics.std, numpy.std(stack, axis=0)) )
+            self.assertTrue( numpy.allclose(statistics.totals, numpy.sum(stack, axis=(1,2))) )
+
+    def testRadialProfiles(self):
+        """ Check that batched radial profiles agree with integrating each pattern. """
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=range(1,11), poissonize=True)
+
+        qs, profiles = analyzer.radialProfiles(batch_size=3)
+        self.assertEqual( profiles.shape, (10, len(qs)) )
+
+        for pattern, profile in zip(analyzer.patternGenerator(), profiles):
+            q, reference = azimuthalIntegration(pattern, analyzer.parameters)
+            self.assertTrue( numpy.allclose(q, qs) )
+            self.assertTrue( numpy.allclose(reference, profile) )
+
+    def testReadPattern(self):
+        """ Check random access to single patterns through the pattern index. """
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=[1,3,6], poissonize=True)
+
+        patterns = [p for p in analyzer.patternGenerator()]
+        self.assertEqual( len(patterns), 3 )
+        for number, pattern in zip([1,3,6], patterns):
+            self.assertTrue( numpy.array_equal(analyzer.readPattern(number), pattern) )
+            with h5py.File(self.__test_data, 'r') as h5:
+                self.assertTrue( numpy.array_equal(h5['data/%0.7d/data' % (number)][()], pattern) )
+
+        self.assertIn( 1000, analyzer.pattern_index )
+
+    def testPatternBatches(self):
+        """ Check that the batched reader yields the same patterns as the generator. """
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=range(1,12), poissonize=True)
+        mask = numpy.ones(analyzer.readPattern(1).shape)
+        mask[0] = 0.
+        analyzer.mask = mask
+
+        patterns = numpy.array([p for p in analyzer.patternGenerator()])
+        batches = [batch.copy() for batch in analyzer.patternBatches(batch_size=4)]
+        self.assertEqual( [len(b) for b in batches], [4, 4, 3] )
+        self.assertTrue( numpy.array_equal(numpy.concatenate(batches), patterns) )
+        self.assertTrue( numpy.all(patterns[:,0] == 0.) )
+
+        # Caller provided buffer, no prefetching.
+        buffer = numpy.empty((5,) + patterns.shape[1:])
+        batches = [batch.copy() for batch in analyzer.patternBatches(buffers=buffer, prefetch=False)]
+        self.assertTrue( numpy.array_equal(numpy.concatenate(batches), patterns) )
+
+    def testSummary(self):
+        """ Check that patterns can be selected from the summary table. """
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, poissonize=True)
+        summary = analyzer.summary
+
+        photons = numpy.array([p.sum() for p in analyzer.patternGenerator()])
+        self.assertEqual( len(summary), len(photons) )
+        self.assertTrue( numpy.allclose(numpy.sort(summary['total_photons']), numpy.sort(photons)) )
+
+        analyzer.pattern_indices = summary.select(summary['total_photons'] > numpy.median(photons))
+        selected = numpy.array([p.sum() for p in analyzer.patternGenerator()])
+        self.assertEqual( len(selected), len(analyzer.pattern_indices) )
+        self.assertTrue( numpy.all(selected > numpy.median(photons)) )
+
+        # The summary is computed again for the masked patterns.
+        mask = numpy.zeros(analyzer.readPattern(1).shape)
+        mask[:mask.shape[0]//2] = 1.
+        analyzer.mask = mask
+        analyzer.pattern_indices = 'all'
+        masked_photons = numpy.array([p.sum() for p in analyzer.patternGenerator()])
+        self.assertIsNot( analyzer.summary, summary )
+        self.assertTrue( numpy.allclose(numpy.sort(analyzer.summary['total_photons']), numpy.sort(masked_photons)) )
+
+    def testSummaryLegacy(self):
+        """ Check that the summary of a v0.1 dir describes the unmasked patterns, as returned by the generator. """
+        analyzer = DiffractionAnalysis(input_path=TestUtilities.generateTestFilePath('diffr_0.1'), poissonize=True)
+        analyzer.mask = numpy.zeros(analyzer.readPattern(analyzer.pattern_index.numbers[0]).shape)
+
+        photons = numpy.array([p.sum() for p in analyzer.patternGenerator()])
+        self.assertIsNone( analyzer.summary.mask )
+        self.assertTrue( numpy.allclose(numpy.sort(analyzer.summary['total_photons']), numpy.sort(photons)) )
+
     def testAnimatePatterns(self):
         """ Test the animation feature. """
 
@@ -0,0 +1,119 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+
+""" Test module for the alignment of EMC reconstructions (emc_diagnostics).
+    @author CFG
+    @institution XFEL
+    @creation 20171106
+"""
+import h5py
+import numpy
+import os
+import paths
+import unittest
+
+from ScriptCollection.DataAnalysis.emc.emc_alignment import OrientationAligner
+from ScriptCollection.DataAnalysis.emc.emc_alignment import RunningStatistics
+from ScriptCollection.DataAnalysis.emc.emc_alignment import coarse_quaternions
+from ScriptCollection.DataAnalysis.emc.emc_alignment import log_scaled_intensities
+from ScriptCollection.DataAnalysis.emc.emc_alignment import neighbouring_quaternions
+from SimEx.Utilities import ReciprocalGrid
+
+class EMCAlignmentTest(unittest.TestCase):
+    """ Test class for the emc_alignment utilities. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        self.__files_to_remove = []
+
+    def tearDown(self):
+        """ Tearing down a test. """
+        for f in self.__files_to_remove:
+            if os.path.isfile(f):
+                os.remove(f)
+
+    def testNeighbouringQuaternions(self):
+        """ Check the selection of quaternions close to the candidates, including the antipodes. """
+        quats = coarse_quaternions(2)
+        candidate = numpy.array([1., 0., 0., 0., 1.])
+
+        neighbours = neighbouring_quaternions(quats, [candidate, -candidate], 0.2)
+        self.assertEqual( len(neighbours), len(neighbouring_quaternions(quats, [candidate], 0.2)) )
+        self.assertTrue( numpy.all(numpy.abs(neighbours[:,0]) >= numpy.cos(0.2)) )
+        self.assertGreater( len(neighbours), 0 )
+
+        # A larger angle keeps more quaternions.
+        self.assertGreater( len(neighbouring_quaternions(quats, [candidate], 0.6)), len(neighbours) )
+
+    def testRunningStatistics(self):
+        """ Check mean, median and central slices against the stacked volumes. """
+        self.__files_to_remove.append('3d_stack.h5')
+
+        prng = numpy.random.RandomState(0)
+        volumes = prng.rand(5, 7, 7, 7)
+
+        with h5py.File('3d_stack.h5', 'w') as h5:
+            stack = h5.create_dataset("data/oriented_diffraction_volumes", shape=volumes.shape, dtype=volumes.dtype)
+            # Read one plane at a time in median().
+            stats = RunningStatistics(stack, max_bytes=5*7*7*8)
+            for index, volume in enumerate(volumes):
+                stats.add(index, volume)
+
+            self.assertEqual( stats.count, 5 )
+            self.assertTrue( numpy.allclose(stats.mean, volumes.mean(axis=0)) )
+            self.assertTrue( numpy.array_equal(stats.median(), numpy.median(volumes, axis=0)) )
+            self.assertTrue( numpy.array_equal(stats.central_slices, volumes[:,3]) )
+            self.assertTrue( numpy.array_equal(stack[...], volumes) )
+
+    def testOrientationAligner(self):
+        """ Check that serial and pooled scoring agree and that a volume aligns with itself. """
+        qmax = 8
+        x, y, z = numpy.mgrid[-qmax:qmax+1, -qmax:qmax+1, -qmax:qmax+1]
+        intensities = numpy.exp(-((x-3)**2 + (y-1)**2 + z**2)/4.) + 0.5*numpy.exp(-((x+1)**2 + (y-4)**2 + (z-2)**2)/3.)
+        intensities = log_scaled_intensities(intensities + intensities[::-1,::-1,::-1])
+        qPos = ReciprocalGrid.planarSlicePositions(int(0.9*qmax), 2)
+        quats = coarse_quaternions(1)
+
+        # The coarse grid is not coarser than the fine one, all quaternions are scored.
+        serial = OrientationAligner(intensities, qPos, quats, coarse_level=1, number_of_processes=1)
+        pooled = OrientationAligner(intensities, qPos, quats, coarse_level=1, number_of_processes=2)
+        try:
+            (best, score) = serial.align(intensities)
+            scores = serial.score(quats)
+            self.assertEqual( score, scores.min() )
+            self.assertAlmostEqual( abs(best[0]), 1. )
+
+            pooled.align(intensities)
+            self.assertTrue( numpy.allclose(pooled.score(quats), scores) )
+        finally:
+            serial.close()
+            pooled.close()
+
+        # Coarse to fine search finds the same orientation.
+        aligner = OrientationAligner(intensities, qPos, coarse_quaternions(2), coarse_level=1, number_of_candidates=2)
+        try:
+            self.assertAlmostEqual( abs(aligner.align(intensities)[0][0]), 1. )
+        finally:
+            aligner.close()
+
+if __name__ == '__main__':
+    unittest.main()
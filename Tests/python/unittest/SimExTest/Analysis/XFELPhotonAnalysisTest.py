@@ -133,6 +133,32 @@ class XFELPhotonAnalysisTest(unittest.TestCase):
 
         xfel_photon_analyzer.plotIntensityMap(qspace=True)
 
+    def testComputeOnly(self):
+        """ Check that the data behind the plots is available without plotting. """
+        xfel_photon_analyzer = XFELPhotonAnalysis(input_path=TestUtilities.generateTestFilePath('prop_out_0000001.h5'))
+        intensity = xfel_photon_analyzer.intensity
+
+        intensity_map, limits = xfel_photon_analyzer.intensityMap()
+        self.assertEqual( intensity_map.shape, intensity.shape[:2] )
+        self.assertEqual( len(limits), 4 )
+
+        angular_map, angular_limits = xfel_photon_analyzer.intensityMap(qspace=True)
+        self.assertEqual( angular_map.shape, intensity.shape[:2] )
+        self.assertLess( angular_limits[0], 0.0 )
+        self.assertGreater( angular_limits[1], 0.0 )
+
+        times, power = xfel_photon_analyzer.totalPower()
+        self.assertEqual( power.shape, (intensity.shape[-1],) )
+        self.assertEqual( times.shape, power.shape )
+        self.assertTrue( numpy.allclose(power / power.max(), intensity.sum(axis=(0,1)) / intensity.sum(axis=(0,1)).max()) )
+
+        times, density = xfel_photon_analyzer.onAxisPowerDensity()
+        self.assertEqual( density.shape, (intensity.shape[-1],) )
+
+        # The spectrum leaves the wavefront in the time domain.
+        energies, spectrum = xfel_photon_analyzer.totalPower(spectrum=True)
+        self.assertEqual( xfel_photon_analyzer.wavefront.params.wDomain, 'time' )
+
     def testMultiplePlots(self):
         """ Check that we can plot multiple times without clashes."""
 
@@ -25,6 +25,7 @@ import unittest
 
 # Import classes to test.
 from CrystFELPhotonDiffractorTest import CrystFELPhotonDiffractorTest
+from DMPhasingTest import DMPhasingTest
 from FEFFPhotonMatterInteractorTest import FEFFPhotonMatterInteractorParametersTest
 from FEFFPhotonMatterInteractorTest import FEFFPhotonMatterInteractorTest
 from GenesisPhotonSourceTest import GenesisPhotonSourceTest
@@ -45,6 +46,7 @@ is_travisCI = ("TRAVIS_BUILD_DIR" in os.environ.keys()) and (os.environ["TRAVIS_
 def suite():
     suites = [
              unittest.makeSuite(CrystFELPhotonDiffractorTest,               'test'),
+             unittest.makeSuite(DMPhasingTest,                              'test'),
              unittest.makeSuite(FEFFPhotonMatterInteractorParametersTest,   'test'),
              unittest.makeSuite(FEFFPhotonMatterInteractorTest,             'test'),
              unittest.makeSuite(S2EReconstructionTest,                      'test'),
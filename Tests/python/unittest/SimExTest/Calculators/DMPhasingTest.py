@@ -26,6 +26,8 @@
     @creation 20151202
 
 """
+import h5py
+import numpy
 import os
 
 import paths
@@ -35,8 +37,50 @@ import unittest
 # Import the class to test.
 from SimEx.Calculators.DMPhasing import DMPhasing
 from SimEx.Parameters.DMPhasingParameters import DMPhasingParameters
+from SimEx.Calculators import DMEngine
+from SimEx.Calculators import DMPhasing as DMPhasingModule
 from TestUtilities import TestUtilities
 
+def _reference_two_means(vals):
+    """ Element-wise 2-means clustering as in s2e_recon/DM/runDM.py. """
+    def find_two_means(v0, v1):
+        (v0_t, v0_t_n, v1_t, v1_t_n) = (0., 0., 0., 0.)
+        for vv in vals:
+            if (numpy.abs(vv-v0) > abs(vv-v1)):
+                v1_t    += vv
+                v1_t_n  += 1.
+            else:
+                v0_t    += vv
+                v0_t_n  += 1.
+        if v0_t_n > 0.:
+            v0_t /= v0_t_n
+        if v1_t_n > 0.:
+            v1_t /= v1_t_n
+        return (v0_t, v1_t)
+
+    (v0,v1)     = (0.,0.1)
+    (v00, v11)  = find_two_means(v0, v1)
+    err = 0.5*(numpy.abs(v00-v0)+numpy.abs(v11-v1))
+    while(err > 1.E-5):
+        (v00, v11)  = find_two_means(v0, v1)
+        err         = 0.5*(numpy.abs(v00-v0)+numpy.abs(v11-v1))
+        (v0, v1)    = (v00, v11)
+    return (v0, v1)
+
+def _reference_support(auto, thr_0, thr_1, kl=1):
+    """ Voxel-wise support from autocorrelation as in s2e_recon/DM/runDM.py. """
+    pos     = numpy.argwhere(numpy.abs(auto-thr_0) > numpy.abs(auto-thr_1))
+    pos_set = set()
+    kerl    = range(-kl,kl+1)
+    for (pi, pj, pk) in pos:
+        for ci in kerl:
+            for cj in kerl:
+                for ck in kerl:
+                    pos_set.add((pi+ci, pj+cj, pk+ck))
+    pos_array = numpy.array(list(pos_set))
+    pos_array -= pos_array.min(axis=0)
+    return numpy.ceil(0.5*pos_array).astype(int)
+
 class DMPhasingTest(unittest.TestCase):
     """
     Test class for the DM Phasing class.
@@ -57,6 +101,13 @@ class DMPhasingTest(unittest.TestCase):
         self.__files_to_remove = []
         self.__dirs_to_remove = ['analysis']
 
+        # Autocorrelation of a noisy gaussian blob.
+        prng = numpy.random.RandomState(1)
+        x, y, z = numpy.mgrid[-10:11, -10:11, -10:11]
+        intensities = 100.*numpy.exp(-(x**2 + y**2 + z**2)/25.) + prng.normal(0., 1., x.shape)
+        intensities = DMPhasingModule._v_zero_neg(intensities)
+        self.__auto = numpy.fft.fftshift(numpy.abs(numpy.fft.fftn(numpy.fft.ifftshift(intensities))))
+
     def tearDown(self):
         """ Tearing down a test. """
         for f in self.__files_to_remove:
@@ -88,7 +139,7 @@ class DMPhasingTest(unittest.TestCase):
         # Check parameters.
         self.assertEqual( analyzer.parameters.number_of_shrink_cycles, 10 )
 
-    def testConstructionParameters(self):
+    def testConstructionParametersDict(self):
         """ Testing the construction of the class with parameters. """
 
         # Construct the object.
@@ -129,6 +180,99 @@ class DMPhasingTest(unittest.TestCase):
 
         self.assertEqual(status, 0)
 
+    def testZeroNeg(self):
+        """ Check that negative values are clipped. """
+        clipped = DMPhasingModule._v_zero_neg(numpy.array([-1., 0., 2.5]))
+        self.assertEqual( list(clipped), [0., 0., 2.5] )
+
+    def testClusterTwoMeans(self):
+        """ Check the 2-means clustering against the element-wise reference. """
+
+        vals = self.__auto.ravel()
+        reference = _reference_two_means(vals)
+        (a_0, a_1) = DMPhasingModule._cluster_two_means(vals)
+
+        self.assertAlmostEqual( a_0, reference[0], 8 )
+        self.assertAlmostEqual( a_1, reference[1], 6 )
+        self.assertLess( a_0, a_1 )
+
+    def testSupportFromAutocorr(self):
+        """ Check the support against the voxel-wise reference. """
+
+        self.__files_to_remove.append('support.dat')
+
+        (a_0, a_1) = DMPhasingModule._cluster_two_means(self.__auto.ravel())
+        for kl in [1, 2]:
+            reference = _reference_support(self.__auto, a_0, a_1, kl=kl)
+            support = DMPhasingModule._support_from_autocorr(self.__auto, 10, a_0, a_1, 'support.dat', kl=kl)
+
+            # Same voxels (order is irrelevant).
+            self.assertEqual( sorted(map(tuple, support)), sorted(map(tuple, reference)) )
+
+        # Check support file.
+        with open('support.dat', 'r') as support_file:
+            lines = support_file.readlines()
+        self.assertEqual( lines[0], "10 %d\n" % len(support) )
+        self.assertEqual( len(lines), len(support) + 1 )
+
+    def testDMEngine(self):
+        """ Check that the in-process DM engine recovers a known object. """
+
+        # Two gaussian blobs in an oversampled box.
+        x, y, z = numpy.mgrid[:25, :25, :25]
+        density = numpy.exp(-((x-9)**2 + (y-9)**2 + (z-9)**2)/5.) + 0.6*numpy.exp(-((x-12)**2 + (y-7)**2 + (z-10)**2)/2.)
+        density[density < 1.e-3] = 0.
+        intensities = numpy.fft.fftshift(numpy.abs(numpy.fft.fftn(density))**2)
+        support = numpy.zeros(density.shape, dtype=bool)
+        support[3:18, 2:17, 3:17] = True
+
+        result = DMEngine.phase(intensities, support, number_of_trials=4, number_of_iterations=60, averaging_start=40,
+                                leash=0.2, number_of_shrink_cycles=2, number_of_processes=2, seed=1)
+
+        # Trials are ranked by their final error.
+        self.assertEqual( result['errors'].shape, (4, 60) )
+        self.assertTrue( numpy.all(numpy.diff(result['errors'][:,-1]) >= 0.) )
+        self.assertEqual( result['reconstructions'].shape, (4, 15, 15, 14) )
+        self.assertEqual( len(result['support_sizes']), 2 )
+        self.assertLessEqual( result['support_sizes'][1], result['support_sizes'][0] )
+
+        # The averaged density matches the object up to translation and inversion.
+        reference = density[result['box']]
+        aligned = DMEngine.alignReconstruction(reference, result['electron_density'])
+        self.assertGreater( numpy.corrcoef(aligned.ravel(), reference.ravel())[0,1], 0.9 )
+
+        # Serial and concurrent trials agree.
+        serial = DMEngine.runTrials(intensities, support, 2, 10, 5, 0.2, number_of_processes=1, seed=3)
+        concurrent = DMEngine.runTrials(intensities, support, 2, 10, 5, 0.2, number_of_processes=2, seed=3)
+        self.assertTrue( numpy.allclose(serial['reconstructions'], concurrent['reconstructions']) )
+
+    def testBackengineNumpy(self):
+        """ Check phasing with the in-process numpy engine. """
+
+        self.__files_to_remove += ['intensities.h5', 'phase_out.h5']
+
+        x, y, z = numpy.mgrid[-10:11, -10:11, -10:11]
+        with h5py.File('intensities.h5', 'w') as h5:
+            h5["data/data"] = 1.e3*numpy.exp(-(x**2 + y**2 + z**2)/20.)
+
+        analyzer = DMPhasing(parameters={'number_of_trials'        : 2,
+                                         'number_of_iterations'    : 5,
+                                         'averaging_start'         : 3,
+                                         'leash'                   : 0.2,
+                                         'number_of_shrink_cycles' : 1,
+                                         'engine'                  : 'numpy',
+                                         'number_of_processes'     : 1,
+                                         },
+                             input_path='intensities.h5',
+                             output_path='phase_out.h5')
+
+        self.assertEqual( analyzer.backengine(), 0 )
+
+        with h5py.File('phase_out.h5', 'r') as h5:
+            self.assertIn( "electronDensity", h5["data"] )
+            self.assertEqual( len(h5["history/error"]), 2 )
+            self.assertEqual( len(h5["history/object"]), 2 )
+            self.assertEqual( len(h5["history/shrinkwrap"].value), 1 )
 
 if __name__ == '__main__':
     unittest.main()
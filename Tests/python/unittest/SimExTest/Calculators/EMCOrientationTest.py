@@ -26,8 +26,11 @@
     @creation 20151109
 
 """
+import h5py
+import numpy
 import os
 import subprocess
+import sys
 
 import paths
 import unittest
@@ -35,7 +38,11 @@ import unittest
 
 # Import the class to test.
 from SimEx.Calculators.EMCOrientation import EMCOrientation, _checkPaths
+from SimEx.Calculators.EMCCaseGenerator import sparse_photon_arrays
+from SimEx.Calculators.EMCEngine import EMCEngine, quaternionsToRotations, readQuaternionFile
+from SimEx.Calculators.EMCHistoryWriter import EMCHistoryWriter
 from SimEx.Parameters.EMCOrientationParameters import EMCOrientationParameters
+from SimEx.Utilities import SparsePhotons
 from TestUtilities import TestUtilities
 
 class EMCOrientationTest(unittest.TestCase):
@@ -130,6 +137,134 @@ class EMCOrientationTest(unittest.TestCase):
 
         self.assertEqual(status, 0)
 
+    def testBackengineNumpy(self):
+        """ Test that we can run a calculation with the in-process numpy engine. """
+
+        self.__files_to_remove.append('orient_out.h5')
+
+        # Construct the object.
+        analyzer = EMCOrientation(parameters={"initial_number_of_quaternions" : 1,
+                                              "max_number_of_quaternions"     : 2,
+                                              "max_number_of_iterations"      : 2,
+                                              "min_error"                     : 1.e-6,
+                                              "beamstop"                      : True,
+                                              "detailed_output"               : True,
+                                              "engine"                        : "numpy",
+                                              },
+                                  input_path=self.input_h5,
+                                  output_path='orient_out.h5')
+
+        # Call backengine.
+        status = analyzer.backengine()
+
+        self.assertEqual(status, 0)
+
+        # Output files of the EMC executable are reproduced, the model stays in memory between iterations.
+        for ef in ["finish_intensity.dat", "most_likely_orientations.dat", "mutual_info.dat"]:
+            self.assertIn( ef, os.listdir(analyzer.run_files_path) )
+        self.assertNotIn( "start_intensity.dat", os.listdir(analyzer.run_files_path) )
+
+        # The ASCII photons.dat is only written for the EMC executable.
+        self.assertIn( "photons.bin", os.listdir(analyzer.tmp_files_path) )
+        self.assertNotIn( "photons.dat", os.listdir(analyzer.tmp_files_path) )
+
+    def testEMCEngine(self):
+        """ Check that the numpy EMC engine recovers orientations from a known model. """
+
+        quaternion_dir = os.path.join(os.path.dirname(sys.modules[EMCEngine.__module__].__file__), 'CalculatorUtilities', 'quaternions')
+        quaternions, weights = readQuaternionFile(os.path.join(quaternion_dir, 'quaternion2.dat'))
+        rotations = quaternionsToRotations(quaternions)
+
+        # Rotation matrices are orthogonal.
+        self.assertTrue( numpy.allclose(numpy.einsum('rij,rkj->rik', rotations, rotations), numpy.eye(3)) )
+
+        # Slightly curved detector and an asymmetric (but centrosymmetric) model.
+        qmax = 6
+        x, y = numpy.mgrid[-qmax:qmax+1, -qmax:qmax+1].reshape(2,-1).astype(float)
+        select = (numpy.hypot(x, y) < qmax - 0.5) & (numpy.hypot(x, y) > 1.5)
+        detector = numpy.column_stack((x[select], y[select], -0.02*(x[select]**2 + y[select]**2)))
+        x, y, z = numpy.mgrid[-qmax:qmax+1, -qmax:qmax+1, -qmax:qmax+1]
+        model = 100.*numpy.exp(-((x-3)**2 + (y-1)**2 + z**2)/4.) + 50.*numpy.exp(-((x+1)**2 + (y-3)**2 + (z-2)**2)/3.) + 1.
+        model = 0.5*(model + model[::-1,::-1,::-1])
+
+        # Simulate patterns in random orientations.
+        prng = numpy.random.RandomState(0)
+        true_orientations = prng.randint(0, len(quaternions), 50)
+        no_photons = {'num_data' : 0, 'ones_offsets' : [0], 'multi_offsets' : [0], 'place_ones' : [], 'place_multi' : [], 'count_multi' : []}
+        simulator = EMCEngine(detector, qmax, no_photons, quaternions)
+        simulator.intensities = model
+        counts = prng.poisson(simulator._expand(rotations[true_orientations])[0])
+
+        ones = [numpy.nonzero(c == 1)[0] for c in counts]
+        multi = [numpy.nonzero(c > 1)[0] for c in counts]
+        photons = {'num_data' : 50,
+                   'ones_offsets' : numpy.cumsum([0] + [len(o) for o in ones]),
+                   'multi_offsets' : numpy.cumsum([0] + [len(m) for m in multi]),
+                   'place_ones' : numpy.concatenate(ones),
+                   'place_multi' : numpy.concatenate(multi),
+                   'count_multi' : numpy.concatenate([c[m] for c,m in zip(counts, multi)]),
+                   }
+
+        engine = EMCEngine(detector, qmax, photons, quaternions, weights, rotation_block=50)
+        engine.intensities = model
+        engine.iterate()
+
+        recovered = numpy.abs(numpy.sum(engine.most_likely_orientations * quaternions[true_orientations], axis=1))
+        self.assertGreater( numpy.mean(recovered > 1. - 1.e-9), 0.9 )
+        self.assertEqual( engine.mutual_info.shape, (50,) )
+
+        # The rotation blocks only bound the memory, not the result.
+        blocked = EMCEngine(detector, qmax, photons, quaternions, weights, rotation_block=7)
+        blocked.intensities = model
+        blocked.iterate()
+        self.assertTrue( numpy.allclose(blocked.intensities, engine.intensities) )
+        self.assertTrue( numpy.allclose(blocked.mutual_info, engine.mutual_info) )
+
+    def testHistoryWriter(self):
+        """ Check the background writer of the iteration history. """
+
+        self.__files_to_remove.append('history.h5')
+
+        with h5py.File('history.h5', 'w') as h5:
+            for group in ["intensities", "error", "angle", "mutual_info", "quaternion", "time"]:
+                h5.create_group("history/"+group)
+            h5.create_group("data")
+
+        intensities = numpy.ones((5,5,5))
+        with EMCHistoryWriter('history.h5', compression="gzip", compression_level=1, history_depth=2) as writer:
+            for iteration in range(1,5):
+                # Modify the array after handing it over, the writer must have taken a snapshot.
+                intensities[...] = iteration
+                writer.write(iteration, intensities, 0.1/iteration, numpy.zeros((3,4)), numpy.ones(3), 1, 0.5)
+                intensities[...] = -1.
+
+        with h5py.File('history.h5', 'r') as h5:
+            # Only the last two snapshots are kept, scalar histories are complete.
+            self.assertEqual( sorted(h5["history/intensities"].keys()), ["0003", "0004"] )
+            self.assertEqual( sorted(h5["history/angle"].keys()), ["0003", "0004"] )
+            self.assertEqual( len(h5["history/error"].keys()), 4 )
+            self.assertEqual( h5["history/intensities/0004"].compression, "gzip" )
+            self.assertTrue( numpy.all(h5["history/intensities/0003"].value == 3.) )
+            self.assertTrue( numpy.all(h5["data/data"].value == 4.) )
+            self.assertEqual( h5["data/angle"].shape, (3,4) )
+
+        # Beyond the history depth, snapshots reuse the space of the oldest ones, also over continued runs.
+        sizes = []
+        with h5py.File('history.h5', 'w') as h5:
+            for group in ["intensities", "error", "angle", "mutual_info", "quaternion", "time"]:
+                h5.create_group("history/"+group)
+            h5.create_group("data")
+        for iteration in range(1,21):
+            with EMCHistoryWriter('history.h5', compression="none", history_depth=2) as writer:
+                writer.write(iteration, numpy.ones((40,40,40)), 0.1, numpy.zeros((3,4)), numpy.ones(3), 1, 0.5)
+            sizes.append(os.path.getsize('history.h5'))
+        self.assertLess( sizes[-1] - sizes[3], 40**3*8 )
+
+        # Errors in the writer thread are raised in the calling thread.
+        writer = EMCHistoryWriter('history.h5')
+        writer.write(1, intensities, 0.1, numpy.zeros((3,4)), numpy.ones(3), 1, 0.5)
+        self.assertRaises( IOError, writer.close )
+
     def testPaths(self):
         """ Test that we can start a test calculation. """
 
@@ -322,6 +457,11 @@ class EMCOrientationTest(unittest.TestCase):
         self.assertNotEqual( run_files_path, run_files_path2 )
         self.assertEqual( tmp_files_path, tmp_files_path2 )
 
+        # Prepared photon files are tagged with the file stamps of the input.
+        for ef in ["photons.bin", "detector.dat", "photons.key"]:
+            self.assertIn( ef, os.listdir(tmp_files_path2) )
+        self.assertEqual( "photons.dat" in os.listdir(tmp_files_path2), emc2._engine() == "binary" )
+
 
         expected_run_files2 = ["finish_intensity.dat", "quaternion.dat",
                               "detector.dat",
@@ -385,6 +525,24 @@ class EMCOrientationTest(unittest.TestCase):
         # Check success.
         self.assertEqual(status, 0)
 
+    def testSparsePhotonLines(self):
+        """ Test the vectorized conversion of dense patterns to sparse photon lines. """
+
+        # Two patterns on a 3x3 detector, first pixel disqualified.
+        pos = numpy.array([-1, 0, 1, 2, 3, 4, 5, 6, 7])
+        frames = numpy.array([[[4., 1., 0.],
+                               [2.7, 0., 1.],
+                               [0., 0., 1.2]],
+                              [[0., 0., 0.],
+                               [0., 0., 0.],
+                               [0., 0., 0.]]])
+
+        lines = SparsePhotons.toASCIILines(sparse_photon_arrays(frames, pos))
+
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0], "3 0 4 7 1 2 2 \n")
+        self.assertEqual(lines[1], "0  0 \n")
+
 
 if __name__ == '__main__':
     unittest.main()
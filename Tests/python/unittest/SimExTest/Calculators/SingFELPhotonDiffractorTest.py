@@ -352,6 +352,41 @@ class SingFELPhotonDiffractorTest(unittest.TestCase):
         # Check successful completion.
         self.assertEqual(status, 0)
 
+    def testCheckSnapshots(self):
+        """ Test that the snapshots read by the backengine are checked against the saved snapshots. """
+
+        # Cleanup.
+        self.__dirs_to_remove.append('pmi_strided')
+
+        # Pmi file with every 10th of 100 time steps saved.
+        os.mkdir('pmi_strided')
+        with h5py.File(os.path.join('pmi_strided', 'pmi_out_0000001.h5'), 'w') as h5:
+            h5['data/snapshots'] = numpy.arange(10, 101, 10)
+            h5['data/snapshots'].attrs['snapshot_stride'] = 10
+            h5['data/snapshots'].attrs['number_of_steps'] = 100
+
+        def diffractor(slice_interval, number_of_slices):
+            parameters = SingFELPhotonDiffractorParameters(
+                         uniform_rotation= True,
+                         slice_interval = slice_interval,
+                         number_of_slices = number_of_slices,
+                         pmi_start_ID = 1,
+                         pmi_stop_ID  = 1,
+                         number_of_diffraction_patterns = 2,
+                         beam_parameters = self.beam,
+                         detector_geometry = self.detector_geometry,
+                         )
+            return SingFELPhotonDiffractor(parameters=parameters, input_path=self.input_h5, output_path='diffr')
+
+        # Snapshots 20, 40, ..., 100 are saved.
+        diffractor(20, 5)._checkSnapshots('pmi_strided')
+
+        # Not a multiple of the stride.
+        self.assertRaises( ValueError, diffractor(15, 2)._checkSnapshots, 'pmi_strided' )
+
+        # Snapshot 150 is not saved.
+        self.assertRaises( ValueError, diffractor(50, 3)._checkSnapshots, 'pmi_strided' )
+
     def testBackengineNoBeam(self):
         """ Test that we can start a test calculation with no explicit beam parameters. """
 
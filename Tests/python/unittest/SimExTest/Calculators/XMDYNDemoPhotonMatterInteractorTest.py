@@ -35,6 +35,7 @@ import unittest
 
 # Import the class to test.
 from SimEx.Calculators.XMDYNDemoPhotonMatterInteractor import XMDYNDemoPhotonMatterInteractor
+from SimEx.Utilities import ElementLayout
 from TestUtilities import TestUtilities
 
 class XMDYNDemoPhotonMatterInteractorTest(unittest.TestCase):
@@ -176,6 +177,21 @@ class XMDYNDemoPhotonMatterInteractorTest(unittest.TestCase):
         # Check we have generated the expected output.
         self.assertTrue( 'pmi_out_0000001.h5' in os.listdir( test_interactor.output_path ) )
 
+        # Check atoms are stored in element sorted layout.
+        with h5py.File( os.path.join(test_interactor.output_path, 'pmi_out_0000001.h5'), 'r') as h5:
+            Z = h5['data/snp_0000001/Z'].value
+            offsets = h5['data/element_offsets'].value
+            elements = h5['data/elements'].value
+            permutation = h5['data/permutation'].value
+        self.assertTrue( numpy.all( Z[1:] >= Z[:-1] ) )
+        for i, sel_Z in enumerate(elements):
+            self.assertTrue( numpy.all( Z[offsets[i]:offsets[i+1]] == sel_Z ) )
+
+        # The permutation restores the sample's atom order.
+        with h5py.File( TestUtilities.generateTestFilePath('sample.h5'), 'r') as h5:
+            sample_Z = h5['Z'].value
+        self.assertEqual( list(ElementLayout.restoreOrder(Z, permutation)), list(sample_Z) )
+
     def testOPMD(self):
         """ Check that the input directory scanner filters out the opmd files."""
 
@@ -318,6 +334,95 @@ class XMDYNDemoPhotonMatterInteractorTest(unittest.TestCase):
             self.assertNotEqual( numpy.linalg.norm(angle), 0.)
 
 
+    def testIonization(self):
+        """ Check that the stochastic ionization is reproducible for a given seed and changes the charge states."""
+
+        # Clean up.
+        self.__dirs_to_remove.append('pmi')
+
+        # Get test instance.
+        pmi_parameters = {'number_of_trajectories' : 1,
+                          'number_of_steps'        : 100,
+                          'ionization'             : True,
+                          'random_seed'            : 42,
+                         }
+
+        test_interactor = XMDYNDemoPhotonMatterInteractor(parameters=pmi_parameters,
+                                                          input_path=self.input_h5,
+                                                          output_path='pmi',
+                                                          sample_path = TestUtilities.generateTestFilePath('sample.h5') )
+
+        # Call backengine
+        status = test_interactor.backengine()
+
+        # Check that the backengine returned zero.
+        self.assertEqual(status, 0)
+
+        with h5py.File( os.path.join(test_interactor.output_path, 'pmi_out_0000001.h5'), 'r') as h5:
+            first_xyz = h5['data/snp_0000001/xyz'].value
+            xyz = h5['data/snp_0000100/xyz'].value
+
+        # Charge states must have evolved during the pulse.
+        self.assertGreater( numpy.sum(xyz - first_xyz), 0 )
+
+        # Same seed, same trajectory.
+        shutil.rmtree('pmi')
+        test_interactor.backengine()
+        with h5py.File( os.path.join(test_interactor.output_path, 'pmi_out_0000001.h5'), 'r') as h5:
+            new_xyz = h5['data/snp_0000100/xyz'].value
+
+        self.assertEqual( numpy.sum(numpy.abs(xyz - new_xyz)), 0 )
+
+    def testOutputControls(self):
+        """ Check that snapshot stride, precision and compression settings are applied to the output."""
+
+        # Clean up.
+        self.__dirs_to_remove.append('pmi')
+
+        # Get test instance.
+        pmi_parameters = {'number_of_trajectories' : 1,
+                          'number_of_steps'        : 100,
+                          'snapshot_stride'        : 10,
+                          'output_dtypes'          : {'ff' : 'float16'},
+                          'compression'            : 'gzip',
+                         }
+
+        test_interactor = XMDYNDemoPhotonMatterInteractor(parameters=pmi_parameters,
+                                                          input_path=self.input_h5,
+                                                          output_path='pmi',
+                                                          sample_path = TestUtilities.generateTestFilePath('sample.h5') )
+
+        # Call backengine
+        status = test_interactor.backengine()
+
+        # Check that the backengine returned zero.
+        self.assertEqual(status, 0)
+
+        with h5py.File( os.path.join(test_interactor.output_path, 'pmi_out_0000001.h5'), 'r') as h5:
+            snapshots = [k for k in h5['data'].keys() if k.startswith('snp_')]
+            self.assertEqual( len(snapshots), 10 )
+            self.assertIn( 'snp_0000010', snapshots )
+            self.assertEqual( h5['data/snp_0000010/ff'].dtype, numpy.float16 )
+            # Quantities not requested otherwise keep full precision.
+            self.assertEqual( h5['data/snp_0000010/r'].dtype, numpy.float64 )
+            self.assertEqual( h5['data/snp_0000010/r'].compression, 'gzip' )
+
+            # The saved indices are listed.
+            self.assertEqual( list(h5['data/snapshots'][...]), range(10, 101, 10) )
+            self.assertEqual( h5['data/snapshots'].attrs['snapshot_stride'], 10 )
+            self.assertEqual( h5['data/snapshots'].attrs['number_of_steps'], 100 )
+
+    def testOutputControlsExceptions(self):
+        """ Check that invalid output settings raise."""
+
+        sample_path = TestUtilities.generateTestFilePath('sample.h5')
+        for parameters in [{'snapshot_stride' : 0},
+                           {'output_dtypes' : {'r' : 'float16'}},
+                           {'compression' : 'xz'},
+                          ]:
+            parameters['number_of_trajectories'] = 1
+            self.assertRaises( ValueError, XMDYNDemoPhotonMatterInteractor, parameters, self.input_h5, 'pmi', sample_path)
+
 if __name__ == '__main__':
     unittest.main()
 
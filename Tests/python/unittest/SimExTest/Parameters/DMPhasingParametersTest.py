@@ -82,6 +82,18 @@ class DMPhasingParametersTest(unittest.TestCase):
         self.assertEqual( parameters.averaging_start, 15 )
         self.assertEqual( parameters.leash, 0.2)
         self.assertEqual( parameters.number_of_shrink_cycles, 10 )
+        self.assertEqual( parameters.engine, "auto" )
+        self.assertIsNone( parameters.number_of_processes )
+
+    def testEngine(self):
+        """ Check the choice of the DM engine and the number of processes. """
+        parameters = DMPhasingParameters(engine="numpy", number_of_processes=4)
+        self.assertEqual( parameters.engine, "numpy" )
+        self.assertEqual( parameters.number_of_processes, 4 )
+
+        # Check invalid values raise.
+        self.assertRaises( ValueError, DMPhasingParameters, engine="cuda" )
+        self.assertRaises( ValueError, DMPhasingParameters, number_of_processes=0 )
 
     def testLegacyDictionary(self):
         """ Check parameter object can be initialized via a old-style dictionary. """
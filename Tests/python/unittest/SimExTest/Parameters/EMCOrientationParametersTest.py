@@ -86,6 +86,10 @@ class EMCOrientationParametersTest(unittest.TestCase):
         self.assertEqual( parameters.max_number_of_quaternions, 2)
         self.assertEqual( parameters.min_error, 1.e-5 )
         self.assertEqual( parameters.max_number_of_iterations, 100 )
+        self.assertEqual( parameters.engine, "auto" )
+        self.assertEqual( parameters.history_compression, "gzip" )
+        self.assertEqual( parameters.history_compression_level, 4 )
+        self.assertIsNone( parameters.history_depth )
 
     def testLegacyDictionary(self):
         """ Check parameter object can be initialized via a old-style dictionary. """
@@ -106,6 +110,29 @@ class EMCOrientationParametersTest(unittest.TestCase):
         self.assertEqual( parameters.max_number_of_quaternions, 9)
         self.assertEqual( parameters.min_error, 1.e-8 )
         self.assertEqual( parameters.max_number_of_iterations, 200 )
+        self.assertEqual( parameters.engine, "auto" )
+
+    def testEngine(self):
+        """ Check the choice of the EMC engine. """
+        parameters = EMCOrientationParameters(engine="numpy")
+        self.assertEqual( parameters.engine, "numpy" )
+
+        parameters.engine = "binary"
+        self.assertEqual( parameters.engine, "binary" )
+
+        # Check unknown engines raise.
+        self.assertRaises( ValueError, EMCOrientationParameters, engine="fortran" )
+
+    def testHistory(self):
+        """ Check the parameters of the iteration history. """
+        parameters = EMCOrientationParameters(history_compression="lzf", history_depth=5)
+        self.assertEqual( parameters.history_compression, "lzf" )
+        self.assertEqual( parameters.history_depth, 5 )
+
+        # Check invalid values raise.
+        self.assertRaises( ValueError, EMCOrientationParameters, history_compression="bzip2" )
+        self.assertRaises( ValueError, EMCOrientationParameters, history_compression_level=10 )
+        self.assertRaises( ValueError, EMCOrientationParameters, history_depth=0 )
 
     def notestNumberOfQuaternionsConsistency(self):
         """ Check that number of quaternions are checked for consistency. """
@@ -21,11 +21,14 @@
 ##########################################################################
 
 import paths
+import array
+import h5py
 import os
 import numpy
 import shutil
 import subprocess
 import StringIO
+import tempfile
 
 # Include needed directories in sys.path.
 import paths
@@ -36,6 +39,20 @@ from SimEx.Parameters.AbstractCalculatorParameters import AbstractCalculatorPara
 from SimEx.Parameters.PhotonBeamParameters import PhotonBeamParameters
 from SimEx.Parameters.PhotonBeamParameters import propToBeamParameters
 from SimEx.Utilities.Units import meter, electronvolt, joule, radian
+from SimEx.Utilities import WavefrontStream
+from SimEx.Utilities.WavefrontStream import beamMoments
+from scipy import constants
+
+# SRW provides the reference photon energy, through wpg or the srwpy package.
+try:
+    from wpg import srwlib
+    HAS_SRW = True
+except ImportError:
+    try:
+        from srwpy import srwlib
+        HAS_SRW = True
+    except ImportError:
+        HAS_SRW = False
 
 class PhotonBeamParametersTest(unittest.TestCase):
     """
@@ -208,10 +225,92 @@ beam/radius = 5.0000000e-07
     def testPropToBeamParameters(self):
         """ Test the utility function to construct a PhotonBeamParameters instance from prop output (wavefron file). """
 
-        beam_parameters = propToBeamParameters(TestUtilities.generateTestFilePath("prop_out_0000001.h5"))
+        prop_out = TestUtilities.generateTestFilePath("prop_out_0000001.h5")
+        beam_parameters = propToBeamParameters(prop_out)
 
         self.assertIsInstance( beam_parameters, PhotonBeamParameters )
-        self.assertAlmostEqual( beam_parameters.photon_energy.magnitude, 4972.840247*electronvolt.magnitude, 5 )
+
+        # 4972.840247 eV is the mean over the SRW frequency domain field, sampled without the last energy.
+        # The streamed mean uses the same sign convention but all samples of the FFT grid, allow one energy step.
+        self.assertAlmostEqual( beam_parameters.photon_energy.m_as(electronvolt), 4972.840247, delta=self.__energyStep(prop_out) )
+
+    @unittest.skipIf(not HAS_SRW, "SRW not available.")
+    def testPropToBeamParametersSRWReference(self):
+        """ Check the photon energy against the mean over the frequency domain field of SRW, as computed before the streamed reduction. """
+
+        prop_out = TestUtilities.generateTestFilePath("prop_out_0000001.h5")
+        with h5py.File(prop_out, 'r') as h5:
+            mesh = dict((key, h5['params/Mesh/' + key][()]) for key in ['nSlices', 'nx', 'ny', 'sliceMin', 'sliceMax', 'xMin', 'xMax', 'yMin', 'yMax'])
+            photon_energy = float(h5['params/photonEnergy'][()])
+            fields = [numpy.nan_to_num(h5['data/' + name][()]).astype(numpy.float32) for name in ['arrEhor', 'arrEver']]
+
+        wfr = srwlib.SRWLWfr()
+        wfr.allocate(int(mesh['nSlices']), int(mesh['nx']), int(mesh['ny']))
+        wfr.presFT = 1
+        wfr.avgPhotEn = photon_energy
+        wfr.mesh.eStart, wfr.mesh.eFin = mesh['sliceMin'], mesh['sliceMax']
+        wfr.mesh.xStart, wfr.mesh.xFin = mesh['xMin'], mesh['xMax']
+        wfr.mesh.yStart, wfr.mesh.yFin = mesh['yMin'], mesh['yMax']
+        wfr.arEx = array.array('f', fields[0].ravel().tolist())
+        wfr.arEy = array.array('f', fields[1].ravel().tolist())
+        srwlib.srwl.SetRepresElecField(wfr, 'f')
+
+        energies = numpy.linspace(wfr.mesh.eStart, wfr.mesh.eFin, wfr.mesh.ne)
+        spectrum = numpy.zeros(wfr.mesh.ne)
+        for field in (wfr.arEx, wfr.arEy):
+            spectrum += (numpy.array(field).reshape(wfr.mesh.ny, wfr.mesh.nx, wfr.mesh.ne, 2)**2).sum(axis=(0,1,3))
+        reference = numpy.sum(spectrum[:-1]*energies[:-1]*numpy.diff(energies))/numpy.sum(spectrum[:-1]*numpy.diff(energies))
+
+        beam_parameters = propToBeamParameters(prop_out)
+        self.assertAlmostEqual( beam_parameters.photon_energy.m_as(electronvolt), reference, delta=self.__energyStep(prop_out) )
+
+    def __energyStep(self, prop_out):
+        """ Photon energy step of the spectrum of a wavefront file. """
+        stream = WavefrontStream.WavefrontStream(prop_out)
+        return WavefrontStream.PLANCK_EV_S/(stream.shape[2]*(stream.slices[1] - stream.slices[0]))
+
+    def testPropToBeamParametersSynthetic(self):
+        """ Check the beam parameters of a synthetic wavefront file, reduced serially and on a process pool. """
+        tmp_dir = tempfile.mkdtemp()
+        self.__dirs_to_remove.append(tmp_dir)
+        prop_out = os.path.join(tmp_dir, 'prop_out.h5')
+
+        # Gaussian pulse of 4 fs rms duration in intensity, detuned by 3 eV from the central photon energy.
+        times = numpy.linspace(-40e-15, 40e-15, 160)
+        y, x = numpy.mgrid[:16, :14]
+        envelope = numpy.exp(-((x-6.5)**2 + (y-7.5)**2)/10.)[:,:,None] * numpy.exp(-times**2/(4*(4e-15)**2))
+        field = envelope * numpy.exp(-1j*3.0/6.582119514e-16*times)
+        ehor = numpy.stack([field.real, field.imag], axis=-1)
+
+        with h5py.File(prop_out, 'w') as h5:
+            h5['data/arrEhor'] = ehor
+            h5['data/arrEver'] = numpy.zeros_like(ehor)
+            mesh = dict(nx=14, ny=16, nSlices=160, xMin=-13e-6, xMax=13e-6, yMin=-15e-6, yMax=15e-6, sliceMin=times[0], sliceMax=times[-1])
+            for key, value in mesh.items():
+                h5['params/Mesh/' + key] = value
+            h5['params/photonEnergy'] = 8000.
+            h5['params/wDomain'] = 'time'
+
+        # Intensity in W/mm^2 times the pixel area in mm^2, integrated over time.
+        intensity = (ehor**2).sum(axis=-1)
+        pulse_energy = intensity.sum()*(2e-6*2e-6*1e6)*(times[1] - times[0])
+
+        serial = propToBeamParameters(prop_out)
+        # Reduce again instead of returning the cached moments.
+        WavefrontStream._BEAM_MOMENTS_CACHE.clear()
+        pooled = propToBeamParameters(prop_out, number_of_processes=2)
+
+        self.assertAlmostEqual( serial.photon_energy.m_as(electronvolt), 8003., delta=0.1 )
+        self.assertAlmostEqual( serial.pulse_energy.m_as(joule)/pulse_energy, 1.0 )
+        self.assertAlmostEqual( serial.photon_energy_relative_bandwidth*8003., constants.hbar/4e-15/constants.e, delta=1e-3 )
+
+        moments = beamMoments(prop_out)
+        self.assertAlmostEqual( serial.beam_diameter_fwhm.m_as(meter), max(moments['fwhm_x'], moments['fwhm_y']) )
+        self.assertAlmostEqual( serial.divergence.m_as(radian), max(moments['divergence_fwhm_x'], moments['divergence_fwhm_y'])/2. )
+
+        for attribute in ['photon_energy', 'pulse_energy', 'beam_diameter_fwhm', 'divergence']:
+            self.assertAlmostEqual( getattr(pooled, attribute).magnitude, getattr(serial, attribute).magnitude )
+        self.assertAlmostEqual( pooled.photon_energy_relative_bandwidth, serial.photon_energy_relative_bandwidth )
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,86 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+""" Test module for the element sorted atom layout.
+    @author CFG
+    @institution XFEL
+    @creation 20171020
+"""
+import numpy
+import paths
+import unittest
+
+from SimEx.Utilities import ElementLayout
+
+class ElementLayoutTest(unittest.TestCase):
+    """ Test class for the ElementLayout utilities. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        self.__sample = {'Z' : numpy.array([8, 1, 6, 6, 8, 1, 6]),
+                         'r' : numpy.arange(21, dtype=float).reshape(7,3),
+                         'N' : 7,
+                        }
+
+    def testSortByElement(self):
+        """ Check that atoms are grouped contiguously per element. """
+
+        sorted_sample = ElementLayout.sortByElement(self.__sample)
+
+        self.assertTrue( ElementLayout.isElementSorted(sorted_sample['Z']) )
+        self.assertEqual( list(sorted_sample['elements']), [1, 6, 8] )
+        self.assertEqual( list(sorted_sample['element_offsets']), [0, 2, 5, 7] )
+
+        # Positions follow their atoms.
+        self.assertEqual( numpy.linalg.norm(sorted_sample['r'] - self.__sample['r'][sorted_sample['permutation']]), 0.0 )
+
+        # Per element selection is a slice.
+        carbon = sorted_sample['selZ'][6]
+        self.assertIsInstance( carbon, slice )
+        self.assertEqual( list(sorted_sample['Z'][carbon]), [6, 6, 6] )
+        self.assertEqual( list(sorted_sample['permutation'][carbon]), [2, 3, 6] )
+
+    def testReduceByElement(self):
+        """ Check the per element reduction. """
+
+        sorted_sample = ElementLayout.sortByElement(self.__sample)
+        sums = ElementLayout.reduceByElement(sorted_sample['r'][:,0], sorted_sample['element_offsets'])
+
+        for i, Z in enumerate(sorted_sample['elements']):
+            self.assertEqual( sums[i], numpy.sum(self.__sample['r'][self.__sample['Z'] == Z, 0]) )
+
+    def testRestoreOrder(self):
+        """ Check that the permutation restores the original atom order. """
+
+        sorted_sample = ElementLayout.sortByElement(self.__sample)
+        restored = ElementLayout.restoreOrder(sorted_sample['r'], sorted_sample['permutation'])
+
+        self.assertEqual( numpy.linalg.norm(restored - self.__sample['r']), 0.0 )
+        self.assertEqual( list(ElementLayout.restoreOrder(sorted_sample['Z'], sorted_sample['permutation'])), list(self.__sample['Z']) )
+
+    def testIsElementSorted(self):
+        """ Check the layout query. """
+        self.assertFalse( ElementLayout.isElementSorted(self.__sample['Z']) )
+        self.assertTrue( ElementLayout.isElementSorted(numpy.array([1, 1, 6, 8])) )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+
+
+
+""" Test module for the parallel frame renderer.
+    @author CFG
+    @institution XFEL
+    @creation 20171109
+"""
+from distutils.spawn import find_executable
+import numpy
+import os
+import paths
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from SimEx.Utilities import FrameRenderer as FrameRenderer_module
+from SimEx.Utilities.FrameRenderer import FrameRenderer, colorLimits
+
+class FrameRendererTest(unittest.TestCase):
+    """ Test class for the FrameRenderer class. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        self.__tmp_dir = tempfile.mkdtemp()
+        self.__frames = [numpy.outer(numpy.arange(8.), numpy.ones(10)) * (i + 1) for i in range(6)]
+
+    def tearDown(self):
+        """ Tearing down a test. """
+        shutil.rmtree(self.__tmp_dir)
+
+    def testColorLimits(self):
+        """ Check the color scale pre-pass. """
+        frames = [numpy.array([[-1., 0.], [2., 3.]]), numpy.array([[0.5, 7.]])]
+        self.assertEqual( colorLimits(frames), (-1., 7.) )
+        self.assertEqual( colorLimits(frames, logscale=True), (0.5, 7.) )
+        self.assertEqual( colorLimits([numpy.zeros(3)], logscale=True), (None, None) )
+
+    def testRender(self):
+        """ Check that frames are rendered with a fixed color scale. """
+        self.assertRaises( ValueError, FrameRenderer, 1., 1. )
+        self.assertRaises( ValueError, FrameRenderer, 0., 1., logscale=True )
+
+        renderer = FrameRenderer(*colorLimits(self.__frames), figsize=(3, 2), dpi=50)
+        first = renderer.render(self.__frames[0])
+        self.assertEqual( first.shape, (100, 150, 4) )
+        self.assertEqual( first.dtype, numpy.uint8 )
+
+        # The same data gives the same image, independent of the frames rendered in between.
+        renderer.render(self.__frames[-1])
+        self.assertTrue( numpy.array_equal(renderer.render(self.__frames[0]), first) )
+        self.assertFalse( numpy.array_equal(renderer.render(self.__frames[-1]), first) )
+
+    def testRenderParallel(self):
+        """ Check that rendering on a process pool gives the serial result in order. """
+        renderer = FrameRenderer(*colorLimits(self.__frames, logscale=True), logscale=True, figsize=(3, 2), dpi=50)
+        serial = list(renderer.renderMany(self.__frames))
+        parallel = list(renderer.renderMany(self.__frames, number_of_processes=2))
+        self.assertEqual( len(parallel), len(self.__frames) )
+        for s, p in zip(serial, parallel):
+            self.assertTrue( numpy.array_equal(s, p) )
+
+    def testRenderParallelBounded(self):
+        """ Check that no more than max_pending frames are read ahead of the consumer. """
+        renderer = FrameRenderer(*colorLimits(self.__frames), figsize=(3, 2), dpi=50)
+        read = []
+        def frames():
+            for frame in self.__frames:
+                read.append(frame)
+                yield frame
+
+        images = renderer.renderMany(frames(), number_of_processes=2, max_pending=2)
+        first = next(images)
+        self.assertTrue( numpy.array_equal(first, renderer.render(self.__frames[0])) )
+        self.assertEqual( len(read), 3 )
+        self.assertEqual( len(list(images)), len(self.__frames) - 1 )
+
+    @unittest.skipIf(find_executable('convert') is None, "ImageMagick not available.")
+    def testAnimate(self):
+        """ Check that frames are encoded into an animated gif. """
+        renderer = FrameRenderer(*colorLimits(self.__frames), figsize=(3, 2), dpi=50)
+        output_path = os.path.join(self.__tmp_dir, 'frames.gif')
+        self.assertEqual( renderer.animate(iter(self.__frames), output_path, number_of_processes=2), len(self.__frames) )
+        self.assertTrue( os.path.isfile(output_path) )
+        self.assertEqual( os.listdir(self.__tmp_dir), ['frames.gif'] )
+
+    def testAnimateClosesLog(self):
+        """ Check that the encoder log is closed after success and failure. """
+        renderer = FrameRenderer(*colorLimits(self.__frames), figsize=(3, 2), dpi=50)
+        logs = []
+        open_encoder = FrameRenderer_module._openEncoder
+        def fakeEncoder(status):
+            # Read and discard the raw frames, then exit with the given status.
+            def openEncoder(output_path, size, fps):
+                log = tempfile.TemporaryFile()
+                logs.append(log)
+                return subprocess.Popen(['sh', '-c', 'cat > /dev/null; exit %d' % (status)], stdin=subprocess.PIPE, stdout=log, stderr=log), log
+            return openEncoder
+        try:
+            FrameRenderer_module._openEncoder = fakeEncoder(0)
+            self.assertEqual( renderer.animate(self.__frames, 'frames.mp4', number_of_processes=1), len(self.__frames) )
+            FrameRenderer_module._openEncoder = fakeEncoder(1)
+            self.assertRaises( IOError, renderer.animate, self.__frames, 'frames.mp4', number_of_processes=1 )
+        finally:
+            FrameRenderer_module._openEncoder = open_encoder
+
+        self.assertEqual( [log.closed for log in logs], [True, True] )
+
+if __name__ == '__main__':
+    unittest.main()
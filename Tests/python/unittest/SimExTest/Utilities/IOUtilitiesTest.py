@@ -105,6 +105,31 @@ class IOUtilitiesTest(unittest.TestCase):
         self.assertEqual( return_dict['Z'].shape, (100,) )
         self.assertEqual( return_dict['r'].shape, (100,3) )
 
+    def testLoadPDBCache(self):
+        """ Check that a pdb is stored in and loaded from the binary sample cache. """
+
+        # Setup path to pdb file.
+        pdb_path = generateTestFilePath("2nip.pdb")
+        cache_dir = 'sample_cache'
+        self.__paths_to_remove.append(cache_dir)
+
+        # First load parses and fills the cache.
+        parsed_dict = IOUtilities.loadPDB(pdb_path, cache_dir=cache_dir)
+        self.assertEqual( len(os.listdir(cache_dir)), 1 )
+
+        # Second load comes from the cache.
+        cached_dict = IOUtilities.loadPDB(pdb_path, cache_dir=cache_dir)
+        self.assertIsInstance( cached_dict['r'], numpy.memmap )
+        self.assertEqual( cached_dict['N'], parsed_dict['N'] )
+        self.assertEqual( numpy.linalg.norm(cached_dict['r'] - parsed_dict['r']), 0.0 )
+        self.assertEqual( sorted(cached_dict['selZ'].keys()), sorted(parsed_dict['selZ'].keys()) )
+        for sel_Z in parsed_dict['selZ'].keys():
+            self.assertEqual( list(cached_dict['selZ'][sel_Z]), list(parsed_dict['selZ'][sel_Z]) )
+
+        # Cached arrays can be modified without touching the cache.
+        cached_dict['r'][0,0] = 1.0
+        self.assertEqual( numpy.linalg.norm(IOUtilities.loadPDB(pdb_path, cache_dir=cache_dir)['r'] - parsed_dict['r']), 0.0 )
+
     def testQueryNonexisitngPDB(self):
         """ Check exception if querying a non-existing pdb """
         # Check exception on wrong input type.
@@ -171,6 +196,25 @@ class IOUtilitiesTest(unittest.TestCase):
         self.assertEqual( return_dict['Z'].shape, (4728,) )
         self.assertEqual( return_dict['r'].shape, (4728,3) )
 
+    def testPdbToS2ESampleDictColumns(self):
+        """ Check the fixed column parser on alternate locations, short lines and blocks. """
+
+        pdb_path = 'columns.pdb'
+        self.__files_to_remove.append(pdb_path)
+        with open(pdb_path, 'w') as pdb:
+            pdb.write("HEADER    TEST\n")
+            pdb.write("ATOM      1  N   MET A   1      27.340  24.430   2.614  1.00  9.67           N\r\n")
+            pdb.write("ATOM      2  CA AMET A   1      26.266  25.413   2.842  1.00 10.38           C\n")
+            pdb.write("ATOM      3  CA BMET A   1      26.000  25.000   2.000  1.00 10.38           C\n")
+            pdb.write("HETATM    4 FE   HEM A   2       1.000   2.000   3.000  1.00 10.38          FE")
+
+        Z, r = IOUtilities._parsePDBColumns(pdb_path, block_size=2)
+        self.assertEqual( list(Z), [7, 6, 26] )
+        self.assertAlmostEqual( numpy.linalg.norm(r[2] - numpy.array([1.0, 2.0, 3.0])*1e-10), 0.0 )
+
+        return_dict = IOUtilities._pdbToS2ESampleDict(pdb_path)
+        self.assertEqual( sorted(return_dict.keys()), ['N', 'Z', 'r', 'selZ'] )
+
     def testPdbToS2ESampleDictExceptions(self):
         """ Check that improper input raises in converter utility. """
 
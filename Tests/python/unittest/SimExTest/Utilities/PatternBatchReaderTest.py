@@ -0,0 +1,102 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+
+
+
+""" Test module for the batched pattern reader.
+    @author CFG
+    @institution XFEL
+    @creation 20171108
+"""
+import h5py
+import numpy
+import os
+import paths
+import shutil
+import tempfile
+import unittest
+
+from SimEx.Utilities.PatternBatchReader import PatternBatchReader
+from SimEx.Utilities.PatternIndex import PatternIndex
+
+class PatternBatchReaderTest(unittest.TestCase):
+    """ Test class for the PatternBatchReader class. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        self.__tmp_dir = tempfile.mkdtemp()
+
+        # v0.2 file with patterns 1 to 7, pattern n filled with n.
+        self.__path = os.path.join(self.__tmp_dir, 'diffr.h5')
+        with h5py.File(self.__path, 'w') as h5:
+            for number in range(1, 8):
+                h5.create_dataset('/data/%0.7d/data' % (number), data=numpy.full((5,6), number, dtype=numpy.uint32))
+                h5.create_dataset('/data/%0.7d/diffr' % (number), data=numpy.full((5,6), number + 0.5))
+        self.__index = PatternIndex(self.__path)
+
+    def tearDown(self):
+        """ Tearing down a test. """
+        shutil.rmtree(self.__tmp_dir)
+
+    def testBatches(self):
+        """ Check batch sizes, order and buffer reuse with prefetching. """
+        reader = PatternBatchReader(self.__index, [7, 1, 2, 3, 4, 5, 6], batch_size=3)
+        self.assertEqual( len(reader), 3 )
+
+        firsts = []
+        for batch in reader:
+            self.assertTrue( any(numpy.may_share_memory(batch, b) for b in reader.buffers) )
+            firsts.append(batch[:,0,0].tolist())
+        self.assertEqual( firsts, [[7, 1, 2], [3, 4, 5], [6]] )
+        self.assertEqual( len(reader.buffers), 2 )
+
+    def testMaskAndBuffers(self):
+        """ Check in place masking into caller provided buffers without prefetching. """
+        mask = numpy.ones((5,6))
+        mask[:,0] = 0.
+        buffer = numpy.empty((4,5,6))
+        reader = PatternBatchReader(self.__index, poissonize=False, mask=mask, buffers=buffer, prefetch=False)
+
+        batches = [batch.copy() for batch in reader]
+        self.assertEqual( [len(b) for b in batches], [4, 3] )
+        patterns = numpy.concatenate(batches)
+        self.assertTrue( numpy.all(patterns[:,:,0] == 0.) )
+        self.assertEqual( patterns[:,0,1].tolist(), [n + 0.5 for n in range(1, 8)] )
+
+        out = numpy.zeros((4,5,6))
+        self.assertEqual( reader.readInto([2, 3], out).shape, (2,5,6) )
+        self.assertEqual( out[:,1,1].tolist(), [2.5, 3.5, 0., 0.] )
+
+    def testErrors(self):
+        """ Check errors for unknown patterns and unfitting buffers. """
+        self.assertRaises( KeyError, PatternBatchReader, self.__index, [1, 9] )
+        self.assertRaises( ValueError, PatternBatchReader, self.__index, buffers=numpy.empty((4,6,5)) )
+        self.assertRaises( ValueError, PatternBatchReader, self.__index, mask=numpy.ones((6,5)) )
+
+        # Stopping early releases the background thread.
+        reader = PatternBatchReader(self.__index, batch_size=2)
+        batches = iter(reader)
+        self.assertEqual( next(batches)[0,0,0], 1 )
+        batches.close()
+
+if __name__ == '__main__':
+    unittest.main()
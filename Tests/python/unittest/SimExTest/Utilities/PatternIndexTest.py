@@ -0,0 +1,148 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+
+
+
+""" Test module for the persistent pattern index.
+    @author CFG
+    @institution XFEL
+    @creation 20171107
+"""
+import h5py
+import numpy
+import os
+import paths
+import shutil
+import tempfile
+import unittest
+
+from SimEx.Utilities.PatternIndex import PatternIndex
+
+class PatternIndexTest(unittest.TestCase):
+    """ Test class for the PatternIndex class. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        self.__tmp_dir = tempfile.mkdtemp()
+        self.__cache_dir = os.path.join(self.__tmp_dir, 'cache')
+
+    def tearDown(self):
+        """ Tearing down a test. """
+        shutil.rmtree(self.__tmp_dir)
+
+    def __writePatterns(self, h5, root, number):
+        """ Write a pattern with and without noise and its orientation. """
+        h5.create_dataset(root + 'data', data=numpy.full((5,6), number, dtype=numpy.uint32))
+        h5.create_dataset(root + 'diffr', data=numpy.full((5,6), number + 0.5))
+        h5.create_dataset(root + 'angle', data=numpy.array([1., 0., 0., number]))
+
+    def __writeFile(self, numbers, mode='w'):
+        """ Write a v0.2 diffraction file. """
+        path = os.path.join(self.__tmp_dir, 'diffr.h5')
+        with h5py.File(path, mode) as h5:
+            for number in numbers:
+                self.__writePatterns(h5, '/data/%0.7d/' % (number), number)
+        return path
+
+    def testFile(self):
+        """ Check random access to the patterns of a v0.2 file. """
+        path = self.__writeFile([1, 2, 3, 7])
+        index = PatternIndex(path)
+
+        self.assertEqual( sorted(index.numbers.tolist()), [1, 2, 3, 7] )
+        # Without cache directory nothing is written.
+        self.assertIsNone( index.index_path )
+        self.assertEqual( os.listdir(self.__tmp_dir), ['diffr.h5'] )
+        self.assertIn( 7, index )
+        self.assertNotIn( 4, index )
+
+        self.assertTrue( numpy.all(index.read(7) == 7) )
+        self.assertTrue( numpy.all(index.read(7, poissonize=False) == 7.5) )
+        self.assertEqual( [p[0,0] for p in index.readMany([3, 1, 7])], [3, 1, 7] )
+        self.assertRaises( KeyError, index.read, 4 )
+
+        entry = index.entry(2)
+        self.assertEqual( entry['path'], '/data/0000002' )
+        self.assertEqual( entry['shape'], (5,6) )
+        self.assertEqual( entry['angle'][3], 2. )
+
+    def testPersistenceAndUpdate(self):
+        """ Check that the index is reused and updated incrementally. """
+        path = self.__writeFile([1, 2])
+        PatternIndex(path, cache_dir=self.__cache_dir)
+        self.assertEqual( len(os.listdir(self.__cache_dir)), 1 )
+
+        # Unchanged input: the stored index is used as is.
+        index = PatternIndex(path, cache_dir=self.__cache_dir, update=False)
+        self.assertEqual( len(index), 2 )
+        self.assertFalse( index.update() )
+
+        # New patterns are added on update.
+        self.__writeFile([5], mode='a')
+        self.assertTrue( index.update() )
+        self.assertEqual( sorted(index.numbers.tolist()), [1, 2, 5] )
+        self.assertTrue( numpy.all(PatternIndex(path, cache_dir=self.__cache_dir, update=False).read(5) == 5) )
+
+    def testRewrittenFile(self):
+        """ Check that the metadata of a rewritten file is read again. """
+        path = self.__writeFile([1, 2])
+        index = PatternIndex(path, cache_dir=self.__cache_dir)
+
+        # Same group names, different shapes and orientations.
+        with h5py.File(path, 'w') as h5:
+            for number in [1, 2]:
+                root = '/data/%0.7d/' % (number)
+                h5.create_dataset(root + 'data', data=numpy.full((3,4), number, dtype=numpy.uint32))
+                h5.create_dataset(root + 'angle', data=numpy.array([0., 1., 0., number]))
+        os.utime(path, (0, 0))
+
+        self.assertTrue( index.update() )
+        self.assertEqual( index.entry(2)['shape'], (3,4) )
+        self.assertEqual( index.entry(2)['angle'][1], 1. )
+        self.assertEqual( PatternIndex(path, cache_dir=self.__cache_dir, update=False).entry(1)['shape'], (3,4) )
+
+    def testLegacy(self):
+        """ Check the index of a legacy directory, one file per pattern numbered by position in the listing. """
+        path = os.path.join(self.__tmp_dir, 'diffr')
+        os.mkdir(path)
+        for number in [3, 1, 2]:
+            with h5py.File(os.path.join(path, 'diffr_out_%0.7d.h5' % (number)), 'w') as h5:
+                self.__writePatterns(h5, '/data/', number)
+        with open(os.path.join(path, 'diffr_out_0000004.h5'), 'w') as broken:
+            broken.write('not a hdf5 file')
+
+        index = PatternIndex(path, cache_dir=self.__cache_dir)
+        self.assertEqual( index.numbers.tolist(), [0, 1, 2] )
+        self.assertEqual( [p[0,0] for p in index.readMany([2, 0])], [3, 1] )
+        self.assertEqual( index.entry(1)['file'], os.path.join(path, 'diffr_out_0000002.h5') )
+
+        # Other files in the listing count, as in a sequential scan.
+        with open(os.path.join(path, 'README'), 'w') as readme:
+            readme.write('patterns')
+        self.assertTrue( index.update() )
+        self.assertEqual( index.numbers.tolist(), [1, 2, 3] )
+        self.assertEqual( index.entry(1)['file'], os.path.join(path, 'diffr_out_0000001.h5') )
+        self.assertEqual( PatternIndex(path, cache_dir=self.__cache_dir, update=False).numbers.tolist(), [1, 2, 3] )
+
+if __name__ == '__main__':
+    unittest.main()
+
@@ -0,0 +1,154 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+
+
+
+""" Test module for the pattern summary table.
+    @author CFG
+    @institution XFEL
+    @creation 20171108
+"""
+import h5py
+import numpy
+import os
+import paths
+import shutil
+import tempfile
+import unittest
+
+from SimEx.Utilities.PatternSummary import PatternSummary
+
+class PatternSummaryTest(unittest.TestCase):
+    """ Test class for the PatternSummary class. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        self.__tmp_dir = tempfile.mkdtemp()
+        self.__path = os.path.join(self.__tmp_dir, 'diffr.h5')
+        self.__cache_dir = os.path.join(self.__tmp_dir, 'cache')
+        numpy.random.seed(1)
+        self.__patterns = {}
+
+    def tearDown(self):
+        """ Tearing down a test. """
+        shutil.rmtree(self.__tmp_dir)
+
+    def __writePatterns(self, numbers, mode='w'):
+        """ Write random patterns to a v0.2 file, with the parent input file linked. """
+        with h5py.File(self.__path, mode) as h5:
+            for number in numbers:
+                pattern = numpy.random.poisson(0.2*number, size=(9,11)).astype(numpy.uint32)
+                self.__patterns[number] = pattern
+                h5.create_dataset('/data/%0.7d/data' % (number), data=pattern)
+                h5.create_dataset('/data/%0.7d/diffr' % (number), data=pattern + 0.5)
+                h5.create_dataset('/data/%0.7d/angle' % (number), data=numpy.array([1., 0., 0., 0.]))
+                h5['/data/%0.7d/history/parent/detail' % (number)] = h5py.ExternalLink('pmi_out_%0.7d.h5' % (number), '/')
+
+    def testColumns(self):
+        """ Check the features against the patterns. """
+        self.__writePatterns([1, 2, 3, 10])
+        summary = PatternSummary(self.__path)
+
+        self.assertEqual( len(summary), 4 )
+        self.assertEqual( summary['number'].tolist(), [1, 2, 3, 10] )
+        # Without cache directory nothing is written.
+        self.assertEqual( os.listdir(self.__tmp_dir), ['diffr.h5'] )
+
+        y, x = numpy.mgrid[-4:5, -5:6]
+        r = numpy.sqrt(x*x + y*y)
+        for row, number in enumerate(summary['number']):
+            pattern = self.__patterns[number]
+            self.assertEqual( summary['total_photons'][row], pattern.sum() )
+            self.assertEqual( summary['max_pixel'][row], pattern.max() )
+            self.assertEqual( summary['lit_pixels'][row], numpy.count_nonzero(pattern) )
+            self.assertAlmostEqual( summary['radius_mean'][row], numpy.sum(r*pattern)/pattern.sum() )
+            self.assertAlmostEqual( summary['radius_rms'][row], numpy.sqrt(numpy.sum(r*r*pattern)/pattern.sum()) )
+            self.assertEqual( summary['angle'][row].tolist(), [1., 0., 0., 0.] )
+            self.assertEqual( summary['source_file'][row], self.__path )
+            self.assertEqual( summary['parent_file'][row], 'pmi_out_%0.7d.h5' % (number) )
+
+        self.assertRaises( KeyError, summary.__getitem__, 'no_such_column' )
+
+    def testSelect(self):
+        """ Check selection of patterns by boolean masks. """
+        self.__writePatterns([1, 2, 3, 10])
+        summary = PatternSummary(self.__path)
+
+        self.assertEqual( summary.select(summary['number'] > 2), [3, 10] )
+        bright = summary.select(summary['total_photons'] > summary['total_photons'].mean())
+        self.assertIn( 10, bright )
+        self.assertNotIn( 1, bright )
+        self.assertRaises( ValueError, summary.select, numpy.ones(3, dtype=bool) )
+
+    def testPersistenceAndUpdate(self):
+        """ Check that the table is stored and only new patterns are summarized. """
+        self.__writePatterns([1, 2])
+        PatternSummary(self.__path, cache_dir=self.__cache_dir)
+
+        summary = PatternSummary(self.__path, cache_dir=self.__cache_dir, update=False)
+        self.assertEqual( summary['number'].tolist(), [1, 2] )
+        self.assertEqual( summary['parent_file'].tolist(), ['pmi_out_0000001.h5', 'pmi_out_0000002.h5'] )
+        self.assertFalse( summary.update() )
+
+        self.__writePatterns([4], mode='a')
+        self.assertTrue( summary.update() )
+        self.assertEqual( summary['number'].tolist(), [1, 2, 4] )
+        self.assertEqual( summary['total_photons'][2], self.__patterns[4].sum() )
+
+        # Summaries without Poisson noise are computed from the noise free patterns.
+        summary = PatternSummary(self.__path, cache_dir=self.__cache_dir, poissonize=False)
+        self.assertEqual( summary['total_photons'][0], self.__patterns[1].sum() + 0.5*self.__patterns[1].size )
+
+    def testRewrittenFile(self):
+        """ Check that the rows of a rewritten file are computed again. """
+        self.__writePatterns([1, 2])
+        summary = PatternSummary(self.__path, cache_dir=self.__cache_dir)
+
+        # Same pattern numbers, different content.
+        numpy.random.seed(2)
+        self.__writePatterns([1, 2, 3])
+        os.utime(self.__path, (0, 0))
+
+        self.assertTrue( summary.update() )
+        self.assertEqual( summary['number'].tolist(), [1, 2, 3] )
+        self.assertEqual( summary['total_photons'].tolist(), [self.__patterns[n].sum() for n in [1, 2, 3]] )
+        self.assertEqual( PatternSummary(self.__path, cache_dir=self.__cache_dir, update=False)['total_photons'].tolist(), summary['total_photons'].tolist() )
+
+    def testMask(self):
+        """ Check that the features are computed from the masked patterns. """
+        self.__writePatterns([1, 2])
+        mask = numpy.zeros((9,11))
+        mask[2:6,3:8] = 1.
+        summary = PatternSummary(self.__path, cache_dir=self.__cache_dir, mask=mask)
+
+        for row, number in enumerate(summary['number']):
+            pattern = self.__patterns[number]*mask
+            self.assertEqual( summary['total_photons'][row], pattern.sum() )
+            self.assertEqual( summary['lit_pixels'][row], numpy.count_nonzero(pattern) )
+
+        # A table computed with another mask is not reused.
+        self.assertEqual( len(PatternSummary(self.__path, cache_dir=self.__cache_dir, update=False)), 0 )
+        self.assertEqual( len(PatternSummary(self.__path, cache_dir=self.__cache_dir, mask=mask, update=False)), 2 )
+
+if __name__ == '__main__':
+    unittest.main()
+
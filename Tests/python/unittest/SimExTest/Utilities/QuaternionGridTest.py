@@ -0,0 +1,114 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+
+
+""" Test module for the quaternion grid generator.
+    @author CFG
+    @institution XFEL
+    @creation 20171024
+"""
+import numpy
+import os
+import paths
+import shutil
+import unittest
+
+from SimEx.Utilities import QuaternionGrid
+
+class QuaternionGridTest(unittest.TestCase):
+    """ Test class for the QuaternionGrid utilities. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        self.__dirs_to_remove = []
+
+    def tearDown(self):
+        """ Tearing down a test. """
+        for d in self.__dirs_to_remove:
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+
+    def testShippedQuaternions(self):
+        """ Check that generated quaternions and weights agree with the shipped quaternion files. """
+
+        quaternion_dir = os.path.join(os.path.dirname(os.path.dirname(QuaternionGrid.__file__)), 'Calculators', 'CalculatorUtilities', 'quaternions')
+
+        for level in [1, 2, 3]:
+            quaternions, weights = QuaternionGrid.generateQuaternions(level)
+
+            self.assertEqual( len(quaternions), QuaternionGrid.numberOfQuaternions(level) )
+            self.assertAlmostEqual( numpy.abs(numpy.linalg.norm(quaternions, axis=1) - 1.).max(), 0.0 )
+
+            # Every shipped rotation is generated with the same weight (the shipped files repeat some rotations).
+            shipped = numpy.loadtxt(os.path.join(quaternion_dir, 'quaternion%d.dat' % level), skiprows=1)
+            distance = numpy.abs(numpy.dot(shipped[:,:4], quaternions.T))
+            match = numpy.argmax(distance, axis=1)
+            self.assertAlmostEqual( distance.max(axis=1).min(), 1.0 )
+            self.assertTrue( numpy.allclose(weights[match], shipped[:,4]) )
+
+            # No rotation appears twice (q and -q are the same rotation).
+            overlap = numpy.abs(numpy.dot(quaternions, quaternions.T)) - numpy.eye(len(quaternions))
+            self.assertLess( overlap.max(), 1. - 1.e-6 )
+
+    def testSymmetry(self):
+        """ Check the reduction to the fundamental zone of a symmetry group. """
+
+        quaternions, weights = QuaternionGrid.generateQuaternions(4)
+
+        # The 600-cell grid is invariant under a two-fold rotation about z.
+        reduced, reduced_weights = QuaternionGrid.generateQuaternions(4, symmetry=QuaternionGrid.cyclicSymmetry(2))
+        self.assertAlmostEqual( reduced_weights.sum(), 0.5*weights.sum() )
+        self.assertLess( len(reduced), 0.55*len(quaternions) )
+
+        # All rotations are closest to the identity among their equivalents.
+        twofold = numpy.array([0., 0., 0., 1.])
+        self.assertTrue( numpy.all(numpy.abs(reduced[:,0]) >= numpy.abs(numpy.dot(reduced, twofold)) - 1.e-10) )
+
+        # Trivial group.
+        same, same_weights = QuaternionGrid.reduceBySymmetry(quaternions, weights, QuaternionGrid.cyclicSymmetry(1))
+        self.assertTrue( numpy.array_equal(same, quaternions) )
+        self.assertTrue( numpy.array_equal(same_weights, weights) )
+
+    def testCache(self):
+        """ Check that quaternions are stored in and loaded from the binary cache. """
+
+        cache_dir = 'quaternion_cache'
+        self.__dirs_to_remove.append(cache_dir)
+
+        quaternions, weights = QuaternionGrid.generateQuaternions(3, cache_dir=cache_dir)
+        self.assertEqual( len(os.listdir(cache_dir)), 1 )
+
+        cached_quaternions, cached_weights = QuaternionGrid.generateQuaternions(3, cache_dir=cache_dir)
+        self.assertTrue( numpy.array_equal(quaternions, cached_quaternions) )
+        self.assertTrue( numpy.array_equal(weights, cached_weights) )
+
+        # Symmetry reduced grids are cached separately.
+        QuaternionGrid.generateQuaternions(3, symmetry=QuaternionGrid.cyclicSymmetry(2), cache_dir=cache_dir)
+        self.assertEqual( len(os.listdir(cache_dir)), 2 )
+
+    def testInvalidLevel(self):
+        """ Check that invalid refinement levels raise. """
+        self.assertRaises( ValueError, QuaternionGrid.generateQuaternions, 0 )
+        self.assertRaises( ValueError, QuaternionGrid.generateQuaternions, 1.5 )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+
+
+
+""" Test module for the radial integration utilities.
+    @author CFG
+    @institution XFEL
+    @creation 20171106
+"""
+import numpy
+import paths
+import unittest
+
+from SimEx.Utilities import RadialIntegration
+
+class RadialIntegrationTest(unittest.TestCase):
+    """ Test class for the RadialIntegration utilities. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        RadialIntegration.clearCache()
+        numpy.random.seed(0)
+        self.__geometry = dict(shape=(41,41), pixel_size=2.2e-4, distance=0.13, wavelength=0.25)
+
+    def tearDown(self):
+        """ Tearing down a test. """
+        RadialIntegration.clearCache()
+
+    def testAgainstPixelLoop(self):
+        """ Check the radial profile against a loop over the pixels. """
+        geometry = self.__geometry
+        pattern = numpy.random.poisson(5., size=geometry['shape']).astype(float)
+        integrator = RadialIntegration.radialIntegrator(number_of_bins=20, **geometry)
+
+        # Reference: bin each pixel by its q, average the solid angle corrected intensities.
+        center = 0.5*(geometry['shape'][0]-1)
+        q = numpy.zeros(geometry['shape'])
+        corrected = numpy.zeros(geometry['shape'])
+        for i in range(geometry['shape'][0]):
+            for j in range(geometry['shape'][1]):
+                r = numpy.hypot(i-center, j-center)*geometry['pixel_size']
+                two_theta = numpy.arctan(r/geometry['distance'])
+                q[i,j] = 4.*numpy.pi/geometry['wavelength']*numpy.sin(0.5*two_theta)
+                corrected[i,j] = pattern[i,j] / numpy.cos(two_theta)**3
+        edges = numpy.linspace(q.min(), q.max(), 21)
+        reference = numpy.zeros(20)
+        for b in range(20):
+            in_bin = (q >= edges[b]) & (q < edges[b+1]) if b < 19 else (q >= edges[b])
+            reference[b] = corrected[in_bin].mean() if in_bin.any() else 0.
+
+        self.assertTrue( numpy.allclose(integrator.q, 0.5*(edges[1:]+edges[:-1])) )
+        self.assertTrue( numpy.allclose(integrator.integrate(pattern), reference) )
+
+    def testBatch(self):
+        """ Check that a batch gives the profiles of the individual patterns. """
+        geometry = self.__geometry
+        patterns = numpy.random.poisson(5., size=(7,)+geometry['shape'])
+        integrator = RadialIntegration.radialIntegrator(**geometry)
+
+        profiles = integrator.integrate(patterns)
+        self.assertEqual( profiles.shape, (7, len(integrator.q)) )
+        for pattern, profile in zip(patterns, profiles):
+            self.assertTrue( numpy.allclose(integrator.integrate(pattern), profile) )
+
+    def testMaskAndPolarization(self):
+        """ Check that masked pixels are ignored and the polarization correction is applied. """
+        geometry = self.__geometry
+        pattern = numpy.ones(geometry['shape'])
+        mask = numpy.ones(geometry['shape'])
+        mask[:, :10] = 0
+
+        masked = RadialIntegration.radialIntegrator(mask=mask, correct_solid_angle=False, **geometry)
+        self.assertEqual( masked.counts.sum(), mask.sum() )
+
+        # Masked pixels do not contribute, even if hot.
+        pattern[:, :10] = 1e6
+        profile = masked.integrate(pattern)
+        self.assertTrue( numpy.allclose(profile[masked.counts > 0], 1.) )
+
+        # Unpolarized correction only depends on the scattering angle and exceeds 1/2.
+        polarized = RadialIntegration.radialIntegrator(mask=mask, correct_solid_angle=False, polarization_factor=0.0, **geometry)
+        corrected = polarized.integrate(numpy.ones(geometry['shape']))[polarized.counts > 0]
+        self.assertTrue( numpy.all(corrected >= 1.) and numpy.all(corrected < 2.) )
+
+    def testCache(self):
+        """ Check that integrators are cached by geometry. """
+        geometry = self.__geometry
+        integrator = RadialIntegration.radialIntegrator(**geometry)
+
+        self.assertIs( RadialIntegration.radialIntegrator(**geometry), integrator )
+        self.assertIsNot( RadialIntegration.radialIntegrator(number_of_bins=5, **geometry), integrator )
+
+        mask = numpy.ones(geometry['shape'])
+        with_mask = RadialIntegration.radialIntegrator(mask=mask, **geometry)
+        self.assertIs( RadialIntegration.radialIntegrator(mask=mask.copy(), **geometry), with_mask )
+        self.assertIsNot( with_mask, integrator )
+
+    def testExceptions(self):
+        """ Check that invalid geometries and patterns are rejected. """
+        geometry = self.__geometry
+        self.assertRaises( ValueError, RadialIntegration.RadialIntegrator, shape=(3,3), pixel_size=0., distance=1., wavelength=1. )
+        self.assertRaises( ValueError, RadialIntegration.RadialIntegrator, mask=numpy.ones((3,3)), **geometry )
+        self.assertRaises( ValueError, RadialIntegration.RadialIntegrator, polarization_factor=2., **geometry )
+        self.assertRaises( ValueError, RadialIntegration.radialIntegrator(**geometry).integrate, numpy.ones((3,3)) )
+
+if __name__ == '__main__':
+    unittest.main()
+
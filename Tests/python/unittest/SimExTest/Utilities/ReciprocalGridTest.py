@@ -0,0 +1,128 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+
+
+
+""" Test module for the reciprocal space grid utilities.
+    @author CFG
+    @institution XFEL
+    @creation 20171102
+"""
+import numpy
+import paths
+import unittest
+
+from SimEx.Utilities import ReciprocalGrid
+
+class ReciprocalGridTest(unittest.TestCase):
+    """ Test class for the ReciprocalGrid utilities. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        ReciprocalGrid.clearCache()
+
+    def tearDown(self):
+        """ Tearing down a test. """
+        ReciprocalGrid.clearCache()
+
+    def testCoordinateGrid(self):
+        """ Check that the coordinate grid agrees with the list comprehension it replaces. """
+        qmax = 6
+        qRange2 = numpy.arange(-qmax, qmax + 1)
+        reference = numpy.array([[i,j,k] for i in qRange2 for j in qRange2 for k in qRange2]).astype("float")
+
+        grid = ReciprocalGrid.coordinateGrid(qmax)
+        self.assertEqual( grid.dtype, reference.dtype )
+        self.assertTrue( numpy.array_equal(grid, reference) )
+
+        # Oversampling scales the coordinates.
+        self.assertTrue( numpy.allclose(ReciprocalGrid.coordinateGrid(qmax, oversampling=2), 0.5*reference) )
+
+    def testPlanarSlicePositions(self):
+        """ Check that the central plane positions agree with the list comprehensions they replace. """
+        (q_low, q_high) = (3, 7)
+        qRange1 = numpy.arange(-q_high, q_high + 1)
+        qPos0   = numpy.array([[i,j,0] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
+        qPos1   = numpy.array([[i,0,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
+        qPos2   = numpy.array([[0,i,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
+        reference = numpy.concatenate((qPos0, qPos1, qPos2))
+
+        self.assertTrue( numpy.array_equal(ReciprocalGrid.planarSlicePositions(q_high, q_low), reference) )
+
+    def testRadiusAndShells(self):
+        """ Check the radius grid and the radial shells. """
+        half_size = 5
+        [x,y,z] = numpy.mgrid[-half_size:half_size+1, -half_size:half_size+1, -half_size:half_size+1]
+        r = numpy.sqrt(x*x + y*y + z*z)
+
+        self.assertTrue( numpy.allclose(ReciprocalGrid.radiusGrid(half_size), r) )
+
+        shells = ReciprocalGrid.radialShells(half_size)
+        self.assertEqual( shells.shape, r.shape )
+        self.assertEqual( shells[half_size, half_size, half_size], 0 )
+        self.assertTrue( numpy.all(numpy.abs(shells - r) <= 0.5) )
+        self.assertEqual( numpy.bincount(shells.ravel())[:2].tolist(), [1, 6+12] )
+
+    def testSpheres(self):
+        """ Check spherical masks and positions against the list comprehensions they replace. """
+        half_size = 4
+        radius = 3.2
+        [x,y,z] = numpy.mgrid[-half_size:half_size+1, -half_size:half_size+1, -half_size:half_size+1]
+        mask = numpy.sqrt(x*x + y*y + z*z) < radius
+        reference = numpy.array([[half_size+i,half_size+j,half_size+k] for i,j,k,l in zip(x.flat, y.flat, z.flat, mask.flat) if l >0]).astype(int)
+
+        self.assertTrue( numpy.array_equal(ReciprocalGrid.sphericalMask(half_size, radius), mask) )
+        self.assertTrue( numpy.array_equal(ReciprocalGrid.spherePositions(half_size, radius, centered=False), reference) )
+        self.assertTrue( numpy.array_equal(ReciprocalGrid.spherePositions(half_size, radius), reference - half_size) )
+
+        # Surface voxels are only kept if requested.
+        self.assertEqual( len(ReciprocalGrid.spherePositions(2, 2.)), 1+6+12+8 )
+        self.assertEqual( len(ReciprocalGrid.spherePositions(2, 2., inclusive=True)), 1+6+12+8+6 )
+
+    def testSharedReadOnly(self):
+        """ Check that grids are cached and cannot be modified. """
+        grid = ReciprocalGrid.coordinateGrid(3)
+
+        self.assertIs( ReciprocalGrid.coordinateGrid(3), grid )
+        self.assertIs( ReciprocalGrid.coordinateGrid(3.0, oversampling=1.), grid )
+        self.assertFalse( grid.flags.writeable )
+        self.assertRaises( ValueError, grid.__setitem__, 0, 1. )
+
+        ReciprocalGrid.clearCache()
+        self.assertIsNot( ReciprocalGrid.coordinateGrid(3), grid )
+
+    def testCacheSize(self):
+        """ Check that the cache does not grow beyond its size. """
+        for half_size in range(2*ReciprocalGrid.GRID_CACHE_SIZE):
+            ReciprocalGrid.coordinateAxis(half_size)
+
+        self.assertEqual( len(ReciprocalGrid._GRID_CACHE), ReciprocalGrid.GRID_CACHE_SIZE )
+
+    def testExceptions(self):
+        """ Check that invalid grid arguments are rejected. """
+        self.assertRaises( ValueError, ReciprocalGrid.coordinateGrid, -1 )
+        self.assertRaises( ValueError, ReciprocalGrid.coordinateGrid, 2.5 )
+        self.assertRaises( ValueError, ReciprocalGrid.radiusGrid, 2, oversampling=0. )
+
+if __name__ == '__main__':
+    unittest.main()
+
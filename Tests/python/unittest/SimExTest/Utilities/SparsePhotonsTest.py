@@ -0,0 +1,153 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+
+""" Test module for the binary sparse photon container.
+    @author CFG
+    @institution XFEL
+    @creation 20171024
+"""
+import numpy
+import os
+import paths
+import unittest
+
+from SimEx.Utilities import SparsePhotons
+
+class SparsePhotonsTest(unittest.TestCase):
+    """ Test class for the SparsePhotons utilities. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        self.__files_to_remove = []
+
+        # Three patterns: ones and multis, empty, only multis.
+        self.__sparse = {'ones_offsets' : numpy.array([0, 3, 3, 3]),
+                         'multi_offsets' : numpy.array([0, 1, 1, 3]),
+                         'place_ones' : numpy.array([0, 4, 7]),
+                         'place_multi' : numpy.array([2, 1, 5]),
+                         'count_multi' : numpy.array([2, 3, 4]),
+                        }
+
+    def tearDown(self):
+        """ Tearing down a test. """
+        for f in self.__files_to_remove:
+            if os.path.isfile(f):
+                os.remove(f)
+
+    def testWriteRead(self):
+        """ Check that patterns survive a write/read cycle and are randomly accessible. """
+
+        self.__files_to_remove.append('photons.bin')
+
+        with SparsePhotons.SparsePhotonWriter('photons.bin', num_pix=8, mean_photon=0.5) as writer:
+            writer.append(self.__sparse)
+            self.assertEqual( writer.num_data, 3 )
+
+        sparse = SparsePhotons.readSparsePhotons('photons.bin')
+
+        self.assertEqual( sparse['num_data'], 3 )
+        self.assertEqual( sparse['num_pix'], 8 )
+        self.assertAlmostEqual( sparse['mean_photon'], 0.5 )
+        self.assertIsInstance( sparse['place_ones'], numpy.memmap )
+
+        ones, multi, counts = SparsePhotons.getPattern(sparse, 2)
+        self.assertEqual( list(ones), [] )
+        self.assertEqual( list(multi), [1, 5] )
+        self.assertEqual( list(counts), [3, 4] )
+
+    def testJoin(self):
+        """ Check joining of files with offset shifts. """
+
+        self.__files_to_remove += ['part_0', 'part_1', 'photons.bin']
+
+        with SparsePhotons.SparsePhotonWriter('part_0', num_pix=8, mean_photon=0.5) as writer:
+            writer.append(self.__sparse)
+        with SparsePhotons.SparsePhotonWriter('part_1', num_pix=8) as writer:
+            writer.append(self.__sparse)
+
+        SparsePhotons.joinSparsePhotonFiles(['part_0', 'part_1'], 'photons.bin')
+        sparse = SparsePhotons.readSparsePhotons('photons.bin')
+
+        self.assertEqual( sparse['num_data'], 6 )
+        self.assertAlmostEqual( sparse['mean_photon'], 0.5 )
+        self.assertEqual( list(sparse['ones_offsets']), [0, 3, 3, 3, 6, 6, 6] )
+        self.assertEqual( list(SparsePhotons.getPattern(sparse, 3)[0]), [0, 4, 7] )
+
+    def testBufferRegions(self):
+        """ Check that buffered ranges written into an allocated file match a joined file. """
+
+        self.__files_to_remove += ['part_0', 'joined.bin', 'photons.bin']
+
+        with SparsePhotons.SparsePhotonWriter('part_0', num_pix=8) as writer:
+            writer.append(self.__sparse)
+        SparsePhotons.joinSparsePhotonFiles(['part_0', 'part_0'], 'joined.bin')
+
+        buffers = [SparsePhotons.SparsePhotonBuffer() for i in range(2)]
+        buffers[0].append(self.__sparse)
+        buffers[1].append(self.__sparse)
+        self.assertEqual( (buffers[0].num_data, buffers[0].num_ones, buffers[0].num_multi), (3, 3, 3) )
+
+        SparsePhotons.allocateSparsePhotonFile('photons.bin', 6, 8, 6, 6)
+        SparsePhotons.writeSparsePhotonRegion('photons.bin', buffers[1].sparse(), 3, 3, 3)
+        SparsePhotons.writeSparsePhotonRegion('photons.bin', buffers[0].sparse(), 0, 0, 0)
+
+        with open('photons.bin', 'rb') as fp:
+            written = fp.read()
+        with open('joined.bin', 'rb') as fp:
+            self.assertEqual( written, fp.read() )
+
+    def testASCII(self):
+        """ Check the conversion to the ASCII photons.dat format. """
+
+        lines = SparsePhotons.toASCIILines(self.__sparse)
+
+        self.assertEqual( lines, ["3 0 4 7 1 2 2 \n",
+                                  "0  0 \n",
+                                  "0  2 1 3  5 4 \n",
+                                 ] )
+
+    def testWriteInterrupted(self):
+        """ Check that an exception while writing leaves no file behind. """
+
+        self.__files_to_remove.append('photons.bin')
+
+        try:
+            with SparsePhotons.SparsePhotonWriter('photons.bin', num_pix=8) as writer:
+                writer.append(self.__sparse)
+                raise RuntimeError("Interrupted.")
+        except RuntimeError:
+            pass
+
+        self.assertEqual( [f for f in os.listdir('.') if f.startswith('photons.bin')], [] )
+
+    def testNotASparsePhotonFile(self):
+        """ Check that other files are rejected. """
+
+        self.__files_to_remove.append('photons.dat')
+        with open('photons.dat', 'w') as fp:
+            fp.write("3 0.5 \n")
+
+        self.assertRaises( IOError, SparsePhotons.readSparsePhotons, 'photons.dat' )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+
+
+
+""" Test module for the streaming statistics.
+    @author CFG
+    @institution XFEL
+    @creation 20171103
+"""
+import numpy
+import paths
+import unittest
+
+from SimEx.Utilities.StreamingStatistics import StreamingStatistics, isStreamable
+
+class StreamingStatisticsTest(unittest.TestCase):
+    """ Test class for the StreamingStatistics class. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        numpy.random.seed(0)
+        self.__stack = numpy.random.poisson(3.0, size=(50, 8, 9)).astype(float)
+
+    def testStatistics(self):
+        """ Check that single pass statistics agree with reductions over the stack. """
+        stack = self.__stack
+        statistics = StreamingStatistics(stack, histogram_bins=int(stack.max())+1)
+
+        self.assertEqual( statistics.count, len(stack) )
+        self.assertTrue( numpy.allclose(statistics.sum, numpy.sum(stack, axis=0)) )
+        self.assertTrue( numpy.allclose(statistics.mean, numpy.mean(stack, axis=0)) )
+        self.assertTrue( numpy.allclose(statistics.variance, numpy.var(stack, axis=0)) )
+        self.assertTrue( numpy.allclose(statistics.std, numpy.std(stack, axis=0)) )
+        self.assertTrue( numpy.array_equal(statistics.min, numpy.min(stack, axis=0)) )
+        self.assertTrue( numpy.array_equal(statistics.max, numpy.max(stack, axis=0)) )
+        self.assertTrue( numpy.allclose(statistics.totals, numpy.sum(stack, axis=(1,2))) )
+        self.assertTrue( numpy.array_equal(statistics.histogram, numpy.bincount(stack.astype(int).ravel())) )
+
+    def testHistogram(self):
+        """ Check that the histogram is opt-in and larger counts go to the last bin. """
+        stack = self.__stack
+        self.assertIsNone( StreamingStatistics(stack).histogram )
+
+        histogram = StreamingStatistics(stack, histogram_bins=4).histogram
+        reference = numpy.bincount(stack.astype(int).ravel())
+        self.assertEqual( len(histogram), 4 )
+        self.assertTrue( numpy.array_equal(histogram[:3], reference[:3]) )
+        self.assertEqual( histogram[3], reference[3:].sum() )
+
+        self.assertRaises( ValueError, StreamingStatistics(stack[:2], histogram_bins=4).merge, StreamingStatistics(stack[2:]) )
+
+    def testMerge(self):
+        """ Check that merging partial statistics gives the statistics over all arrays. """
+        stack = self.__stack
+        reference = StreamingStatistics(stack, histogram_bins=6)
+
+        merged = StreamingStatistics(histogram_bins=6)
+        for part in numpy.array_split(stack, 4):
+            merged.merge(StreamingStatistics(part, histogram_bins=6))
+        merged.merge(StreamingStatistics(histogram_bins=6))
+
+        self.assertEqual( merged.count, reference.count )
+        for name in ['sum', 'mean', 'variance', 'min', 'max', 'totals', 'histogram']:
+            self.assertTrue( numpy.allclose(getattr(merged, name), getattr(reference, name)) )
+
+    def testReduce(self):
+        """ Check the numpy reductions with streaming equivalents. """
+        stack = self.__stack
+        statistics = StreamingStatistics(stack)
+
+        for operation in [numpy.sum, numpy.mean, numpy.std, numpy.var, numpy.min, numpy.max]:
+            self.assertTrue( isStreamable(operation) )
+            self.assertTrue( numpy.allclose(statistics.reduce(operation), operation(stack, axis=0)) )
+
+        # Results do not change with further updates.
+        mean = statistics.reduce(numpy.mean)
+        statistics.update(stack[0] + 100.)
+        self.assertTrue( numpy.allclose(mean, numpy.mean(stack, axis=0)) )
+
+        self.assertFalse( isStreamable(numpy.median) )
+        self.assertRaises( ValueError, statistics.reduce, numpy.median )
+
+    def testShapeMismatch(self):
+        """ Check that arrays of different shape are rejected. """
+        statistics = StreamingStatistics(self.__stack)
+        self.assertRaises( ValueError, statistics.update, numpy.zeros((3,3)) )
+        self.assertRaises( ValueError, statistics.merge, StreamingStatistics([numpy.zeros((3,3))]) )
+
+    def testEmpty(self):
+        """ Check an empty statistics object. """
+        statistics = StreamingStatistics()
+        self.assertEqual( statistics.count, 0 )
+        self.assertIsNone( statistics.mean )
+        self.assertIsNone( statistics.variance )
+        self.assertEqual( len(statistics.totals), 0 )
+
+if __name__ == '__main__':
+    unittest.main()
+
@@ -23,18 +23,40 @@ import paths
 import unittest
 
 # Import classes to test.
+from ElementLayoutTest import ElementLayoutTest
 from EntityChecksTest import EntityChecksTest
+from FrameRendererTest import FrameRendererTest
 from IOUtilitiesTest import IOUtilitiesTest
 from ParallelUtilitiesTest import ParallelUtilitiesTest
 from OpenPMDToolsTest import OpenPMDToolsTest
+from PatternBatchReaderTest import PatternBatchReaderTest
+from PatternIndexTest import PatternIndexTest
+from PatternSummaryTest import PatternSummaryTest
+from QuaternionGridTest import QuaternionGridTest
+from RadialIntegrationTest import RadialIntegrationTest
+from ReciprocalGridTest import ReciprocalGridTest
+from SparsePhotonsTest import SparsePhotonsTest
+from StreamingStatisticsTest import StreamingStatisticsTest
+from WavefrontStreamTest import WavefrontStreamTest
 
 # Setup the suite.
 def suite():
     suites = (
+             unittest.makeSuite(ElementLayoutTest,    'test'),
              unittest.makeSuite(EntityChecksTest,    'test'),
+             unittest.makeSuite(FrameRendererTest,       'test'),
              unittest.makeSuite(IOUtilitiesTest,       'test'),
              unittest.makeSuite(ParallelUtilitiesTest,       'test'),
              unittest.makeSuite(OpenPMDToolsTest,       'test'),
+             unittest.makeSuite(PatternBatchReaderTest,       'test'),
+             unittest.makeSuite(PatternIndexTest,       'test'),
+             unittest.makeSuite(PatternSummaryTest,       'test'),
+             unittest.makeSuite(QuaternionGridTest,       'test'),
+             unittest.makeSuite(RadialIntegrationTest,       'test'),
+             unittest.makeSuite(ReciprocalGridTest,       'test'),
+             unittest.makeSuite(SparsePhotonsTest,       'test'),
+             unittest.makeSuite(StreamingStatisticsTest,       'test'),
+             unittest.makeSuite(WavefrontStreamTest,       'test'),
              )
 
     return unittest.TestSuite(suites)
@@ -0,0 +1,230 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2017 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+
+
+
+""" Test module for the chunked wavefront reductions.
+    @author CFG
+    @institution XFEL
+    @creation 20171110
+"""
+import array
+import h5py
+import numpy
+import os
+import paths
+import shutil
+import tempfile
+import unittest
+
+from SimEx.Utilities import WavefrontStream as WavefrontStream_module
+from SimEx.Utilities.WavefrontStream import WavefrontStream, beamMoments
+
+# SRW provides the reference for the sign convention of the spectra, through wpg or the srwpy package.
+try:
+    from wpg import srwlib
+    HAS_SRW = True
+except ImportError:
+    try:
+        from srwpy import srwlib
+        HAS_SRW = True
+    except ImportError:
+        HAS_SRW = False
+
+class WavefrontStreamTest(unittest.TestCase):
+    """ Test class for the WavefrontStream class. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        self.__tmp_dir = tempfile.mkdtemp()
+        self.__path = os.path.join(self.__tmp_dir, 'prop_out.h5')
+
+        # Gaussian pulse, detuned by 2 eV from the central photon energy.
+        times = numpy.linspace(-30e-15, 30e-15, 200)
+        y, x = numpy.mgrid[:12, :10]
+        envelope = numpy.exp(-((x-4.5)**2 + (y-5.5)**2)/8.)[:,:,None] * numpy.exp(-times**2/(2*(5e-15)**2))
+        field = envelope * numpy.exp(-1j*2.0/6.582119514e-16*times)
+        self.__ehor = numpy.stack([field.real, field.imag], axis=-1)
+        self.__ever = 0.5*self.__ehor
+
+        with h5py.File(self.__path, 'w') as h5:
+            h5['data/arrEhor'] = self.__ehor
+            h5['data/arrEver'] = self.__ever
+            mesh = dict(nx=10, ny=12, nSlices=200, xMin=-1e-6, xMax=1e-6, yMin=-2e-6, yMax=2e-6, sliceMin=times[0], sliceMax=times[-1])
+            for key, value in mesh.items():
+                h5['params/Mesh/' + key] = value
+            h5['params/photonEnergy'] = 5000.
+            h5['params/wDomain'] = 'time'
+
+        self.__intensity = (self.__ehor**2).sum(axis=-1) + (self.__ever**2).sum(axis=-1)
+
+    def tearDown(self):
+        """ Tearing down a test. """
+        shutil.rmtree(self.__tmp_dir)
+
+    def testTimeDomain(self):
+        """ Check the chunked reductions against the full intensity. """
+        stream = WavefrontStream(self.__path, chunk_size=30)
+        self.assertEqual( stream.shape, (12, 10, 200) )
+
+        times, power = stream.totalPower()
+        self.assertEqual( len(times), 200 )
+        self.assertTrue( numpy.allclose(power, self.__intensity.sum(axis=(0,1))*stream.pixel_area) )
+        self.assertTrue( numpy.allclose(stream.totalPower(number_of_processes=2)[1], power) )
+
+        times, density = stream.onAxisPowerDensity()
+        self.assertTrue( numpy.allclose(density, self.__intensity[6,5]) )
+
+        intensity_map, limits = stream.intensityMap(number_of_processes=2)
+        self.assertTrue( numpy.allclose(intensity_map, self.__intensity.sum(axis=-1)) )
+        self.assertEqual( limits, (-1e-6, 1e-6, -2e-6, 2e-6) )
+
+        self.assertEqual( [first for (first, chunk) in stream.intensityChunks()], [0, 30, 60, 90, 120, 150, 180] )
+
+    def testSpectrum(self):
+        """ Check that the spectrum is centered at the detuned photon energy and integrates to the pulse energy. """
+        stream = WavefrontStream(self.__path, chunk_size=30)
+        times, power = stream.totalPower()
+        energies, spectrum = stream.spectrum()
+
+        self.assertAlmostEqual( energies[numpy.argmax(spectrum)], 5002., delta=0.2 )
+        self.assertAlmostEqual( spectrum.sum()*(energies[1] - energies[0]) / (power.sum()*(times[1] - times[0])), 1.0 )
+        self.assertTrue( numpy.allclose(stream.spectrum(number_of_processes=2)[1], spectrum) )
+
+        energies, fluence = stream.onAxisSpectrum()
+        times, density = stream.onAxisPowerDensity()
+        self.assertAlmostEqual( fluence.sum()*(energies[1] - energies[0]) / (density.sum()*(times[1] - times[0])), 1.0 )
+
+    @unittest.skipIf(not HAS_SRW, "SRW not available.")
+    def testSpectrumSRWReference(self):
+        """ Check the spectrum of the detuned pulse against the frequency domain field of SRW. """
+        energies, spectrum = WavefrontStream(self.__path).spectrum()
+
+        # Same field as a SRW wavefront in time domain, switched to frequency domain by SRW.
+        with h5py.File(self.__path, 'r') as h5:
+            mesh = dict((key, h5['params/Mesh/' + key][()]) for key in h5['params/Mesh'].keys())
+        wfr = srwlib.SRWLWfr()
+        wfr.allocate(mesh['nSlices'], mesh['nx'], mesh['ny'])
+        wfr.presFT = 1
+        wfr.avgPhotEn = 5000.
+        wfr.mesh.eStart, wfr.mesh.eFin = mesh['sliceMin'], mesh['sliceMax']
+        wfr.mesh.xStart, wfr.mesh.xFin = mesh['xMin'], mesh['xMax']
+        wfr.mesh.yStart, wfr.mesh.yFin = mesh['yMin'], mesh['yMax']
+        wfr.arEx = array.array('f', self.__ehor.astype(numpy.float32).ravel().tolist())
+        wfr.arEy = array.array('f', self.__ever.astype(numpy.float32).ravel().tolist())
+        srwlib.srwl.SetRepresElecField(wfr, 'f')
+
+        srw_energies = numpy.linspace(wfr.mesh.eStart, wfr.mesh.eFin, wfr.mesh.ne)
+        srw_spectrum = numpy.zeros(wfr.mesh.ne)
+        for field in (wfr.arEx, wfr.arEy):
+            srw_spectrum += (numpy.array(field).reshape(wfr.mesh.ny, wfr.mesh.nx, wfr.mesh.ne, 2)**2).sum(axis=(0,1,3))
+
+        self.assertAlmostEqual( srw_energies[numpy.argmax(srw_spectrum)], 5002., delta=0.2 )
+        self.assertAlmostEqual( energies[numpy.argmax(spectrum)], srw_energies[numpy.argmax(srw_spectrum)], delta=1e-3 )
+        self.assertTrue( numpy.allclose(numpy.interp(srw_energies, energies, spectrum/spectrum.max()), srw_spectrum/srw_spectrum.max(), atol=1e-3) )
+
+    def testAngularIntensityMap(self):
+        """ Check the far field map against the transform of the full field and its normalization. """
+        stream = WavefrontStream(self.__path, chunk_size=30)
+        angular_map, angles_x, angles_y = stream.angularIntensityMap()
+        self.assertEqual( angular_map.shape, (12, 10) )
+        self.assertEqual( (len(angles_x), len(angles_y)), (10, 12) )
+
+        # Angular spacing is wavelength over field of view.
+        wavelength = 1.23984193e-6/5000.
+        self.assertAlmostEqual( (angles_x[1] - angles_x[0]) / (wavelength/(10*2e-6/9)), 1.0 )
+        self.assertEqual( numpy.argmax(angles_x == 0.0), 5 )
+
+        # Same as the transform of the full field, up to normalization.
+        expected = numpy.zeros((12, 10))
+        for field in (self.__ehor, self.__ever):
+            expected += (numpy.abs(numpy.fft.fft2(field[...,0] + 1j*field[...,1], axes=(0,1)))**2).sum(axis=-1)
+        expected = numpy.fft.fftshift(expected)
+        self.assertTrue( numpy.allclose(angular_map/angular_map.sum(), expected/expected.sum()) )
+        self.assertTrue( numpy.allclose(stream.angularIntensityMap(number_of_processes=2)[0], angular_map) )
+
+        # Integral over the angles equals the integral over the area.
+        intensity_map, limits = stream.intensityMap()
+        dx, dy = 2e-6/9, 4e-6/11
+        dqx, dqy = angles_x[1] - angles_x[0], angles_y[1] - angles_y[0]
+        self.assertAlmostEqual( angular_map.sum()*dqx*dqy / (intensity_map.sum()*dx*dy), 1.0 )
+
+    def testBeamMoments(self):
+        """ Check the beam moments against the separate reductions. """
+        stream = WavefrontStream(self.__path, chunk_size=30)
+        moments = stream.beamMoments()
+
+        times, power = stream.totalPower()
+        self.assertAlmostEqual( moments['pulse_energy'] / (power.sum()*(times[1] - times[0])), 1.0 )
+        self.assertAlmostEqual( moments['duration_rms'] / (5e-15/numpy.sqrt(2.)), 1.0, 3 )
+        self.assertAlmostEqual( moments['photon_energy'], 5002., 3 )
+
+        # Four pixels above half maximum on the central row and column.
+        self.assertAlmostEqual( moments['fwhm_x'], 4*2e-6/9 )
+        self.assertAlmostEqual( moments['fwhm_y'], 4*4e-6/11 )
+        self.assertGreater( moments['divergence_fwhm_x'], 0.0 )
+        self.assertGreater( moments['divergence_fwhm_y'], 0.0 )
+
+        self.assertEqual( stream.beamMoments(number_of_processes=2), moments )
+
+    def testBeamMomentsCache(self):
+        """ Check that beam moments are cached by file content and files are hashed only if their stamp changed. """
+        digests = []
+        content_digest = WavefrontStream_module._contentDigest
+        def countingDigest(path):
+            digests.append(path)
+            return content_digest(path)
+        WavefrontStream_module._contentDigest = countingDigest
+        try:
+            moments = beamMoments(self.__path)
+            self.assertEqual( beamMoments(self.__path), moments )
+            self.assertEqual( digests, [self.__path] )
+
+            # A copy is hashed and hits the cache.
+            copy_path = os.path.join(self.__tmp_dir, 'copy.h5')
+            shutil.copy(self.__path, copy_path)
+            cache_size = len(WavefrontStream_module._BEAM_MOMENTS_CACHE)
+            self.assertEqual( beamMoments(copy_path), moments )
+            self.assertEqual( len(WavefrontStream_module._BEAM_MOMENTS_CACHE), cache_size )
+            self.assertEqual( digests, [self.__path, copy_path] )
+
+            # Changed content is reduced again.
+            with h5py.File(copy_path, 'a') as h5:
+                h5['data/arrEver'][...] = 0.0
+            os.utime(copy_path, (0, 0))
+            self.assertLess( beamMoments(copy_path)['pulse_energy'], moments['pulse_energy'] )
+            self.assertEqual( len(WavefrontStream_module._BEAM_MOMENTS_CACHE), min(cache_size + 1, WavefrontStream_module.BEAM_MOMENTS_CACHE_SIZE) )
+            self.assertEqual( len(digests), 3 )
+        finally:
+            WavefrontStream_module._contentDigest = content_digest
+
+    def testErrors(self):
+        """ Check errors for missing files and wavefronts in frequency domain. """
+        self.assertRaises( IOError, WavefrontStream, os.path.join(self.__tmp_dir, 'missing.h5') )
+
+        with h5py.File(self.__path, 'a') as h5:
+            del h5['params/wDomain']
+            h5['params/wDomain'] = 'frequency'
+        self.assertRaises( ValueError, WavefrontStream(self.__path).spectrum )
+
+if __name__ == '__main__':
+    unittest.main()